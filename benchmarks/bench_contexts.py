@@ -0,0 +1,32 @@
+import os
+
+from patchworkdocker.contexts import DirectoryContextBase, StreamingContext, stream_tar
+from patchworkdocker.dockerignore import DockerIgnore
+from patchworkdocker.importers import GitImporter
+
+
+def _consume(chunks) -> int:
+    return sum(len(chunk) for chunk in chunks)
+
+
+def bench_stream_directory(benchmark, context_directory: str):
+    base = DirectoryContextBase(context_directory)
+    benchmark(lambda: _consume(stream_tar(base.get_members())))
+
+
+def bench_stream_directory_with_dockerignore(benchmark, context_directory: str):
+    base = DirectoryContextBase(context_directory)
+    dockerignore = DockerIgnore(["**/f1*.txt", "large.bin"])
+    benchmark(lambda: _consume(stream_tar(base.get_members(dockerignore))))
+
+
+def bench_stream_git(benchmark, git_origin: str, temp_directory: str):
+    base = GitImporter().load_base(git_origin, os.path.join(temp_directory, "base"))
+    benchmark(lambda: _consume(stream_tar(base.get_members())))
+
+
+def bench_stream_overlay(benchmark, context_directory: str, temp_directory: str):
+    context = StreamingContext(DirectoryContextBase(context_directory), os.path.join(temp_directory, "upper"))
+    with open(os.path.join(context.get_writable("Dockerfile")), "a") as file:
+        file.write("RUN true\n")
+    benchmark(lambda: _consume(context.stream()))
@@ -0,0 +1,47 @@
+import os
+from tempfile import mkdtemp
+
+from patchworkdocker.importers import FileSystemImporter, GitImporter
+
+
+def _new_directory(parent: str):
+    """
+    Setup for benchmark rounds that load into a new directory.
+    """
+    location = mkdtemp(dir=parent)
+    os.rmdir(location)
+    return (location, ), {}
+
+
+def bench_file_system_importer(benchmark, context_directory: str, temp_directory: str):
+    importer = FileSystemImporter()
+    benchmark.pedantic(lambda location: importer.load(context_directory, location),
+                       setup=lambda: _new_directory(temp_directory), rounds=5)
+
+
+def bench_file_system_importer_linked(benchmark, context_directory: str, temp_directory: str):
+    importer = FileSystemImporter(link_files=True)
+    benchmark.pedantic(lambda location: importer.load(context_directory, location),
+                       setup=lambda: _new_directory(temp_directory), rounds=5)
+
+
+def bench_file_system_importer_fingerprint(benchmark, context_directory: str):
+    benchmark(FileSystemImporter().get_fingerprint, context_directory)
+
+
+def bench_git_importer(benchmark, git_origin: str, temp_directory: str):
+    importer = GitImporter()
+    benchmark.pedantic(lambda location: importer.load(git_origin, location),
+                       setup=lambda: _new_directory(temp_directory), rounds=5)
+
+
+def bench_git_importer_shallow(benchmark, git_origin: str, temp_directory: str):
+    importer = GitImporter(shallow=True)
+    benchmark.pedantic(lambda location: importer.load(f"{git_origin}#master", location),
+                       setup=lambda: _new_directory(temp_directory), rounds=5)
+
+
+def bench_git_importer_load_base(benchmark, git_origin: str, temp_directory: str):
+    importer = GitImporter()
+    benchmark.pedantic(lambda location: importer.load_base(git_origin, location),
+                       setup=lambda: _new_directory(temp_directory), rounds=5)
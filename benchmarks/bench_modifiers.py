@@ -0,0 +1,55 @@
+import os
+from tempfile import mkdtemp
+
+import pytest
+
+from conftest import create_lines, create_patch
+from patchworkdocker.modifiers import copy_file, apply_patch, change_base_image
+
+_LARGE_TARGET_LINES = 200000
+_HUGE_DOCKERFILE_INSTRUCTIONS = 100000
+
+
+def bench_copy_file_tree(benchmark, context_directory: str, temp_directory: str):
+    def setup():
+        location = mkdtemp(dir=temp_directory)
+        os.rmdir(location)
+        return (context_directory, location), {}
+
+    benchmark.pedantic(copy_file, setup=setup, rounds=5)
+
+
+def bench_copy_file_large(benchmark, context_directory: str, temp_directory: str, context_size):
+    if context_size.large_file_size == 0:
+        pytest.skip("Generated contexts have no large file")
+    source = os.path.join(context_directory, "large.bin")
+    benchmark.pedantic(copy_file, setup=lambda: ((source, os.path.join(mkdtemp(dir=temp_directory), "large.bin")), {}),
+                       rounds=5)
+
+
+@pytest.mark.parametrize("hunks", [1, 1000])
+def bench_apply_patch(benchmark, temp_directory: str, hunks: int):
+    original = create_lines(_LARGE_TARGET_LINES)
+    target_location = os.path.join(temp_directory, "target")
+    patch_location = os.path.join(temp_directory, "change.patch")
+    with open(patch_location, "w") as file:
+        file.write(create_patch(original, hunks))
+
+    def setup():
+        with open(target_location, "w") as file:
+            file.write(original)
+        return (patch_location, target_location), {}
+
+    benchmark.pedantic(apply_patch, setup=setup, rounds=5)
+
+
+def bench_change_base_image(benchmark, temp_directory: str):
+    dockerfile = "FROM alpine\n" + "".join(f"RUN echo {i}\n" for i in range(_HUGE_DOCKERFILE_INSTRUCTIONS))
+    dockerfile_location = os.path.join(temp_directory, "Dockerfile")
+
+    def setup():
+        with open(dockerfile_location, "w") as file:
+            file.write(dockerfile)
+        return (dockerfile_location, "debian"), {}
+
+    benchmark.pedantic(change_base_image, setup=setup, rounds=5)
@@ -0,0 +1,126 @@
+import difflib
+import os
+import random
+from dataclasses import dataclass
+from tempfile import TemporaryDirectory
+from typing import Iterator
+
+import pytest
+from git import Repo, Actor
+
+DEFAULT_CONTEXT_FILES = 2000
+DEFAULT_CONTEXT_DEPTH = 4
+DEFAULT_CONTEXT_LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+_SMALL_FILE_MAX_SIZE = 16 * 1024
+_FILES_PER_DIRECTORY = 20
+_SEED = 0
+
+
+@dataclass
+class ContextSize:
+    """
+    Size of the synthetic build contexts that are benchmarked with.
+    """
+    files: int
+    depth: int
+    large_file_size: int
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("patchworkdocker", "synthetic build contexts")
+    group.addoption("--context-files", type=int, default=DEFAULT_CONTEXT_FILES,
+                    help="number of small files in generated contexts")
+    group.addoption("--context-depth", type=int, default=DEFAULT_CONTEXT_DEPTH,
+                    help="directory depth of generated contexts")
+    group.addoption("--context-large-file-size", type=int, default=DEFAULT_CONTEXT_LARGE_FILE_SIZE,
+                    help="size in bytes of the large binary file in generated contexts (0 for none)")
+
+
+def create_context(directory: str, size: ContextSize):
+    """
+    Creates a synthetic build context, with a Dockerfile, many small text files spread over nested directories and a
+    large binary file.
+    :param directory: directory to create the context in
+    :param size: size of the context
+    """
+    generator = random.Random(_SEED)
+    with open(os.path.join(directory, "Dockerfile"), "w") as file:
+        file.write("FROM alpine\nCOPY . /context\n")
+    for i in range(size.files):
+        parts = [f"d{(i // _FILES_PER_DIRECTORY ** (level + 1)) % _FILES_PER_DIRECTORY}" for level in range(size.depth)]
+        location = os.path.join(directory, *parts, f"f{i}.txt")
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, "w") as file:
+            file.write("x" * generator.randint(0, _SMALL_FILE_MAX_SIZE))
+    if size.large_file_size > 0:
+        with open(os.path.join(directory, "large.bin"), "wb") as file:
+            file.write(generator.getrandbits(8 * size.large_file_size).to_bytes(size.large_file_size, "little"))
+
+
+def create_lines(number: int) -> str:
+    """
+    Creates text with the given number of distinct lines.
+    :param number: number of lines
+    :return: the text
+    """
+    return "".join(f"line {i}: the quick brown fox jumps over the lazy dog\n" for i in range(number))
+
+
+def create_patch(original: str, hunks: int) -> str:
+    """
+    Creates a unified diff patch of the given text with changes spread evenly across it, such that there are the given
+    number of hunks.
+    :param original: text to patch
+    :param hunks: number of hunks
+    :return: the patch
+    """
+    lines = original.splitlines(keepends=True)
+    modified = list(lines)
+    spacing = max(len(lines) // hunks, 1)
+    for i in range(0, len(lines), spacing):
+        modified[i] = f"changed {lines[i]}"
+    return "".join(difflib.unified_diff(lines, modified, "a/target", "b/target"))
+
+
+@pytest.fixture(scope="session")
+def context_size(request) -> ContextSize:
+    return ContextSize(files=request.config.getoption("--context-files"),
+                       depth=request.config.getoption("--context-depth"),
+                       large_file_size=request.config.getoption("--context-large-file-size"))
+
+
+@pytest.fixture(scope="session")
+def context_directory(context_size: ContextSize) -> Iterator[str]:
+    with TemporaryDirectory() as directory:
+        create_context(directory, context_size)
+        yield directory
+
+
+@pytest.fixture(scope="session")
+def git_origin(context_size: ContextSize) -> Iterator[str]:
+    """
+    `file://` URL of a bare git repository whose master branch has a synthetic context, on top of an earlier commit.
+    """
+    with TemporaryDirectory() as directory:
+        working_location = os.path.join(directory, "working")
+        os.makedirs(working_location)
+        repository = Repo.init(working_location)
+        author = Actor("benchmark", "benchmark@example.com")
+        with open(os.path.join(working_location, "README"), "w") as file:
+            file.write("Benchmark\n")
+        repository.index.add(["README"])
+        repository.index.commit("Initial commit", author=author, committer=author)
+        repository.git.branch("-M", "master")
+        create_context(working_location, context_size)
+        repository.git.add("--all")
+        repository.index.commit("Add context", author=author, committer=author)
+        bare_location = os.path.join(directory, "origin.git")
+        Repo.clone_from(working_location, bare_location, bare=True)
+        yield f"file://{bare_location}"
+
+
+@pytest.fixture
+def temp_directory() -> Iterator[str]:
+    with TemporaryDirectory() as directory:
+        yield directory
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import functools
+import shutil
+from concurrent.futures import Executor
+from tempfile import mkdtemp
+from typing import Callable, TypeVar, TYPE_CHECKING
+
+from patchworkdocker.build_logs import BuildEventListener, BuildEvent
+from patchworkdocker.cancellation import CancellationToken, cancellable
+from patchworkdocker.core import PatchworkDocker
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+_T = TypeVar("_T")
+
+
+class AsyncPatchworkDocker:
+    """
+    Asynchronous interface to `PatchworkDocker`, for use in asyncio applications.
+
+    The blocking work (git, file system and Docker I/O) is run in an executor, so the event loop is not blocked and
+    many builds can be run at once. Cancelling the task awaiting an operation stops the operation at its next
+    checkpoint (e.g. between files, or build output) and removes the temp directory that it was working in, before the
+    cancellation completes.
+    """
+    def __init__(self, core: PatchworkDocker, *, executor: Executor=None):
+        """
+        Constructor.
+        :param core: the core to run operations with
+        :param executor: executor to run the blocking work in (the event loop's default executor if `None`)
+        """
+        self.core = core
+        self.executor = executor
+
+    async def prepare(self, build_directory: str=None, *, overlay: bool=False, update: bool=False) -> str:
+        """
+        Prepare a directory with the patched build materials (see `PatchworkDocker.prepare`).
+        :param build_directory: the directory to load the patched build context in (generated temp directory if `None`,
+        which is removed if the preparation fails or is cancelled)
+        :param overlay: whether to prepare the directory as a link farm of the overlay of the imported materials and
+        the files that are added or modified
+        :param update: whether to update the build directory in place if it was prepared to be updated before
+        :return: the location of the build directory
+        """
+        created_build_directory = build_directory is None
+        if created_build_directory:
+            build_directory = mkdtemp()
+        try:
+            return await self._run(self.core.prepare, build_directory, overlay=overlay, update=update)
+        except BaseException:
+            if created_build_directory:
+                shutil.rmtree(build_directory, ignore_errors=True)
+            raise
+
+    async def build(self, image_name: str, build_directory: str=None, *, docker_client: "DockerClient"=None,
+                    stream_context: bool=False, overlay: bool=False, update: bool=False,
+                    reuse_image: bool=True, on_build_event: BuildEventListener=None):
+        """
+        Builds the patchworked Docker image (see `PatchworkDocker.build`).
+        :param image_name: image tag (can optionally include a version tag)
+        :param build_directory: directory to build in (generated temp directory, which is always removed, if `None`)
+        :param docker_client: Docker client to build with (created from the environment if `None`)
+        :param stream_context: whether to stream the build context to the Docker daemon
+        :param overlay: whether to prepare the build directory as an overlay
+        :param update: whether to update the build directory in place if it was prepared to be updated before
+        :param reuse_image: whether to tag an existing image that was built from the same inputs, rather than building
+        :param on_build_event: called in the event loop with each event of the Docker build as it progresses
+        """
+        created_build_directory = build_directory is None
+        if created_build_directory:
+            build_directory = mkdtemp()
+        try:
+            await self._run(self.core.build, image_name, build_directory, docker_client=docker_client,
+                            stream_context=stream_context, overlay=overlay, update=update, reuse_image=reuse_image,
+                            on_build_event=self._call_in_event_loop(on_build_event))
+        finally:
+            if created_build_directory:
+                shutil.rmtree(build_directory, ignore_errors=True)
+
+    async def build_prepared(self, image_name: str, repository_location: str, *, docker_client: "DockerClient"=None,
+                             reuse_image: bool=True, on_build_event: BuildEventListener=None):
+        """
+        Builds the patchworked Docker image from a build directory that has already been prepared (see
+        `PatchworkDocker.build_prepared`).
+        :param image_name: image tag (can optionally include a version tag)
+        :param repository_location: the prepared build directory
+        :param docker_client: Docker client to build with (created from the environment if `None`)
+        :param reuse_image: whether to tag an existing image that was built from the same inputs, rather than building
+        :param on_build_event: called in the event loop with each event of the Docker build as it progresses
+        """
+        await self._run(self.core.build_prepared, image_name, repository_location, docker_client=docker_client,
+                        reuse_image=reuse_image, on_build_event=self._call_in_event_loop(on_build_event))
+
+    async def _run(self, function: Callable[..., _T], *args, **kwargs) -> _T:
+        """
+        Runs the given blocking function in the executor, stopping it if the awaiting task is cancelled.
+        :param function: the function
+        :param args: positional arguments to call the function with
+        :param kwargs: keyword arguments to call the function with
+        :return: what the function returns
+        """
+        token = CancellationToken()
+        with cancellable(token):
+            context = contextvars.copy_context()
+        operation = asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(context.run, function, *args, **kwargs))
+        try:
+            return await asyncio.shield(operation)
+        except asyncio.CancelledError:
+            token.cancel()
+            # Waits for the operation to stop, so it has cleaned up before the cancellation completes
+            await asyncio.wait([operation])
+            if not operation.cancelled():
+                operation.exception()
+            raise
+
+    @staticmethod
+    def _call_in_event_loop(listener: BuildEventListener=None) -> BuildEventListener:
+        """
+        Wraps the given build event listener so that it is called in the running event loop, rather than in the
+        executor.
+        :param listener: the listener
+        :return: the wrapped listener (`None` if the listener is `None`)
+        """
+        if listener is None:
+            return None
+        loop = asyncio.get_running_loop()
+
+        def call_in_event_loop(event: BuildEvent):
+            loop.call_soon_threadsafe(listener, event)
+
+        return call_in_event_loop
@@ -0,0 +1,314 @@
+import copy
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from dataclasses import dataclass
+from enum import Enum, unique
+from threading import BoundedSemaphore
+from typing import List, Optional, Dict, Callable, Tuple, Any, TYPE_CHECKING
+
+from logzero import logger
+
+from patchworkdocker.core import PatchworkDocker
+from patchworkdocker.docker_images import ImagePuller
+from patchworkdocker.dockerfiles import SetArgDefaults, AddLabels
+from patchworkdocker.importers import ImporterFactory, Importer, FileSystemImporter
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+DEFAULT_PREPARE_CONCURRENCY = 4
+DEFAULT_BUILD_CONCURRENCY = 2
+
+_REQUIRED_SPECIFICATION_KEYS = {"import_from", "image_name"}
+_OPTIONAL_SPECIFICATION_KEYS = {"additional_files", "patches", "dockerfile_location", "base_image", "stage_base_images",
+                                 "target", "pin_base_images", "sparse_paths", "arg_defaults", "labels"}
+
+
+@unique
+class JobStatus(Enum):
+    """
+    Status of a batch job.
+    """
+    PENDING = "pending"
+    IMPORTING = "importing"
+    PREPARING = "preparing"
+    BUILDING = "building"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@dataclass
+class BatchJob:
+    """
+    Job to build a patchwork Docker image as part of a batch.
+    """
+    image_name: str
+    core: PatchworkDocker
+    status: JobStatus = JobStatus.PENDING
+    error: Optional[Exception] = None
+    duration: Optional[float] = None
+
+
+def load_manifest(location: str, **core_kwargs) -> List[BatchJob]:
+    """
+    Loads batch jobs from the given manifest.
+
+    The manifest is a JSON (or YAML, if PyYAML is installed) object with a `builds` list, where each build has the keys
+    `import_from` and `image_name`, and optionally `additional_files`, `patches`, `dockerfile_location`, `base_image`,
+    `stage_base_images`, `target`, `pin_base_images`, `sparse_paths`, `arg_defaults` and `labels` (see
+    `create_core`). Relative file locations are relative to the manifest.
+    :param location: location of the manifest
+    :param core_kwargs: keyword arguments to construct every job's `PatchworkDocker` with (e.g. caches)
+    :return: the jobs in the manifest
+    :raises ValueError: raised if the manifest is invalid
+    """
+    with open(location, "r") as file:
+        if location.endswith((".yml", ".yaml")):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("PyYAML must be installed to read YAML manifests") from e
+            manifest = yaml.safe_load(file)
+        else:
+            manifest = json.load(file)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("builds"), list):
+        raise ValueError(f"Manifest must be an object with a list of builds: {location}")
+
+    manifest_directory = os.path.dirname(os.path.abspath(location))
+    jobs = []
+    for specification in manifest["builds"]:
+        if not _REQUIRED_SPECIFICATION_KEYS.issubset(specification.keys()):
+            raise ValueError(f"Build must have keys {sorted(_REQUIRED_SPECIFICATION_KEYS)}: {specification}")
+        core = create_core(specification, manifest_directory, **core_kwargs)
+        jobs.append(BatchJob(specification["image_name"], core))
+    return jobs
+
+
+def create_core(specification: Dict[str, Any], base_directory: str, **core_kwargs) -> PatchworkDocker:
+    """
+    Creates the core to build with from the given build specification.
+
+    The specification has the key `import_from`, and optionally `image_name` (which is not used), `additional_files`,
+    `patches`, `dockerfile_location`, `base_image`, `stage_base_images`, `target`, `pin_base_images`, `sparse_paths`,
+    `arg_defaults` and `labels`, which are as the `PatchworkDocker` parameters of the same names (`arg_defaults` and
+    `labels` are as `SetArgDefaults` and `AddLabels` transforms of the Dockerfile).
+    :param specification: the build specification
+    :param base_directory: directory that relative file locations in the specification are relative to
+    :param core_kwargs: keyword arguments to construct the `PatchworkDocker` with (e.g. caches)
+    :return: the core
+    :raises ValueError: raised if the specification is invalid
+    """
+    if "import_from" not in specification:
+        raise ValueError(f"Build must have key import_from: {specification}")
+    unknown_keys = set(specification.keys()) - _REQUIRED_SPECIFICATION_KEYS - _OPTIONAL_SPECIFICATION_KEYS
+    if len(unknown_keys) > 0:
+        raise ValueError(f"Build has unknown keys {sorted(unknown_keys)}: {specification}")
+
+    def resolve(path: str) -> str:
+        return os.path.join(base_directory, path)
+
+    import_from = specification["import_from"]
+    if os.path.exists(resolve(import_from)):
+        import_from = resolve(import_from)
+    dockerfile_transforms = []
+    if len(specification.get("arg_defaults", {})) > 0:
+        dockerfile_transforms.append(SetArgDefaults(specification["arg_defaults"]))
+    if len(specification.get("labels", {})) > 0:
+        dockerfile_transforms.append(AddLabels(specification["labels"]))
+    return PatchworkDocker(
+        import_from,
+        additional_files={resolve(src): dest for src, dest in specification.get("additional_files", {}).items()},
+        patches={resolve(src): dest for src, dest in specification.get("patches", {}).items()},
+        dockerfile_location=specification.get("dockerfile_location", "Dockerfile"),
+        base_image=specification.get("base_image"),
+        stage_base_images=specification.get("stage_base_images", {}),
+        target=specification.get("target"),
+        pin_base_images=specification.get("pin_base_images", False),
+        git_sparse_paths=specification.get("sparse_paths"),
+        dockerfile_transforms=dockerfile_transforms,
+        **core_kwargs)
+
+
+class BatchBuilder:
+    """
+    Builds many patchwork Docker images concurrently.
+
+    Jobs that import from the same origin (including the same fragment) share a single import.
+    """
+    def __init__(self, jobs: List[BatchJob], *, prepare_concurrency: int=DEFAULT_PREPARE_CONCURRENCY,
+                 build_concurrency: int=DEFAULT_BUILD_CONCURRENCY, importer_factory: ImporterFactory=None,
+                 docker_client: "DockerClient"=None, on_status_change: Callable[[BatchJob], None]=None):
+        """
+        Constructor.
+        :param jobs: jobs to run
+        :param prepare_concurrency: maximum number of imports and preparations to run at once
+        :param build_concurrency: maximum number of Docker builds to run at once
+        :param importer_factory: factory to create the importers for imports shared between jobs
+        :param docker_client: Docker client to build with (created from the environment for each job if `None`)
+        :param on_status_change: called with a job when its status changes
+        """
+        if prepare_concurrency < 1 or build_concurrency < 1:
+            raise ValueError("Concurrency must be at least 1")
+        self.jobs = jobs
+        self.prepare_concurrency = prepare_concurrency
+        self.build_concurrency = build_concurrency
+        self.importer_factory = importer_factory if importer_factory is not None else ImporterFactory()
+        self.docker_client = docker_client
+        self.on_status_change = on_status_change
+        self._prepare_semaphore = BoundedSemaphore(prepare_concurrency)
+        self._build_semaphore = BoundedSemaphore(build_concurrency)
+
+    def run(self) -> bool:
+        """
+        Runs all the jobs, blocking until they have completed.
+        :return: whether all the jobs succeeded
+        """
+        # Each job is fingerprinted once (which hashes local origins and resolves git references), for the context
+        # cache and the input digest of its build
+        with ThreadPoolExecutor(self.prepare_concurrency) as fingerprint_executor:
+            fingerprints = {id(job): fingerprint_executor.submit(job.core.get_fingerprint) for job in self.jobs}
+
+        jobs_by_origin: Dict[str, List[BatchJob]] = {}
+        for job in self.jobs:
+            if not BatchBuilder._is_prepared_context_cached(job, fingerprints[id(job)]):
+                jobs_by_origin.setdefault(job.core.import_repository_from, []).append(job)
+
+        shared_imports: Dict[str, Future] = {}
+        shared_import_by_job: Dict[int, Future] = {}
+        # Base images are shared between jobs and pulled whilst the jobs' contexts are prepared
+        with ImagePuller(self.docker_client) as image_puller, \
+                ThreadPoolExecutor(self.prepare_concurrency) as import_executor, \
+                ThreadPoolExecutor(self.prepare_concurrency + self.build_concurrency) as job_executor:
+            for origin, jobs in jobs_by_origin.items():
+                if len(jobs) > 1:
+                    logger.info(f"Importing {origin} once for {len(jobs)} jobs")
+                    shared_imports[origin] = import_executor.submit(self._import, origin)
+                    shared_import_by_job.update({id(job): shared_imports[origin] for job in jobs})
+            wait([job_executor.submit(self._run_job, job, fingerprints[id(job)], shared_import_by_job.get(id(job)),
+                                      image_puller) for job in self.jobs])
+
+        for shared_import in shared_imports.values():
+            if shared_import.exception() is None:
+                shutil.rmtree(shared_import.result(), ignore_errors=True)
+
+        return all(job.status == JobStatus.SUCCEEDED for job in self.jobs)
+
+    def _import(self, origin: str) -> str:
+        """
+        Imports from the given origin for use by many jobs.
+        :param origin: where to import from
+        :return: the directory containing the import
+        """
+        with self._prepare_semaphore:
+            return self.importer_factory.create(origin).load(origin)
+
+    def _run_job(self, job: BatchJob, fingerprint: Future, shared_import: Optional[Future], image_puller: ImagePuller):
+        """
+        Runs the given job.
+        :param job: the job to run
+        :param fingerprint: the job's fingerprint (see `PatchworkDocker.get_fingerprint`), which resolves to `None` if
+        it cannot be fingerprinted
+        :param shared_import: import shared with other jobs, which resolves to the imported directory (`None` if the
+        job is to import by itself)
+        :param image_puller: puller of base images, shared with other jobs
+        """
+        started_at = time.monotonic()
+        try:
+            core = job.core
+            if shared_import is not None:
+                self._set_status(job, JobStatus.IMPORTING)
+                shared_import.result()
+                core = copy.copy(core)
+                core.importer = _SharedImporter(shared_import, job.core.create_importer(), job.core.dockerfile_location)
+
+            with self._prepare_semaphore:
+                self._set_status(job, JobStatus.PREPARING)
+                fingerprint = fingerprint.result()
+                repository_location = core.prepare(on_base_images=image_puller.pull_all, fingerprint=fingerprint)
+            try:
+                with self._build_semaphore:
+                    self._set_status(job, JobStatus.BUILDING)
+                    core.build_prepared(job.image_name, repository_location, docker_client=self.docker_client,
+                                        image_puller=image_puller, fingerprint=fingerprint)
+            finally:
+                shutil.rmtree(repository_location, ignore_errors=True)
+            job.duration = time.monotonic() - started_at
+            self._set_status(job, JobStatus.SUCCEEDED)
+        except Exception as e:
+            logger.error(f"Failed to build {job.image_name}: {e}")
+            job.error = e
+            job.duration = time.monotonic() - started_at
+            self._set_status(job, JobStatus.FAILED)
+
+    def _set_status(self, job: BatchJob, status: JobStatus):
+        """
+        Sets the status of the given job.
+        :param job: the job
+        :param status: the job's new status
+        """
+        job.status = status
+        logger.info(f"{job.image_name}: {status.value}")
+        if self.on_status_change is not None:
+            self.on_status_change(job)
+
+    @staticmethod
+    def _is_prepared_context_cached(job: BatchJob, fingerprint: Future) -> bool:
+        """
+        Gets whether the given job's prepared context is already cached, in which case it does not need an import.
+        :param job: the job
+        :param fingerprint: the job's fingerprint (it is not cached if it could not be got)
+        :return: whether the context is cached
+        """
+        if job.core.context_cache is None or fingerprint.exception() is not None or fingerprint.result() is None:
+            return False
+        return job.core.context_cache.contains(fingerprint.result())
+
+
+class _SharedImporter(Importer):
+    """
+    Imports from an import that is shared between jobs, whilst fingerprinting as the importer it stands in for.
+    """
+    def __init__(self, shared_import: Future, importer: Importer, dockerfile_location: str):
+        """
+        Constructor.
+        :param shared_import: shared import, which resolves to the imported directory
+        :param importer: importer that the shared import stands in for
+        :param dockerfile_location: location of the Dockerfile relative to the root of the imported directory
+        """
+        self.shared_import = shared_import
+        self.importer = importer
+        self.dockerfile_location = dockerfile_location
+
+    def _load(self, origin: str, load_directory: str) -> str:
+        # Both the shared import and the jobs' build directories are private, so files can be linked between them
+        importer = FileSystemImporter(dockerfile_location=self.dockerfile_location,
+                                      excluded_patterns=self.importer.default_excluded_patterns, link_files=True)
+        return importer.load(self.shared_import.result(), load_directory)
+
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        return self.importer.get_fingerprint(origin)
+
+    @property
+    def default_excluded_patterns(self) -> Tuple[str, ...]:
+        return self.importer.default_excluded_patterns
+
+
+def format_summary(jobs: List[BatchJob]) -> str:
+    """
+    Formats a summary of the given jobs.
+    :param jobs: the jobs to summarise
+    :return: human readable summary
+    """
+    lines = []
+    for job in jobs:
+        duration = f" ({job.duration:.1f}s)" if job.duration is not None else ""
+        error = f": {job.error}" if job.error is not None else ""
+        lines.append(f"{job.image_name}: {job.status.value}{duration}{error}")
+    succeeded = sum(1 for job in jobs if job.status == JobStatus.SUCCEEDED)
+    lines.append(f"{succeeded}/{len(jobs)} succeeded")
+    return "\n".join(lines)
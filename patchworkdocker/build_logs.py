@@ -0,0 +1,195 @@
+import json
+import re
+import time
+from dataclasses import dataclass, asdict
+from enum import Enum, unique
+from typing import Optional, Dict, Any, Iterator, TextIO, Callable, List
+
+from logzero import logger
+
+_STEP_PATTERN = re.compile(r"^Step (\d+)/(\d+) : (.*)$")
+_LAYER_PATTERN = re.compile(r"^ ---> ([0-9a-f]{12,64})$")
+_USING_CACHE_LINE = " ---> Using cache"
+
+
+@unique
+class BuildEventType(Enum):
+    """
+    Type of Docker build event.
+    """
+    STEP_STARTED = "step-started"
+    STEP_FINISHED = "step-finished"
+    CACHE_HIT = "cache-hit"
+    OUTPUT = "output"
+    BUILD_FINISHED = "build-finished"
+    ERROR = "error"
+
+
+@dataclass(frozen=True)
+class BuildEvent:
+    """
+    Event that occurred during a Docker build.
+    """
+    type: BuildEventType
+    timestamp: float
+    step: Optional[int] = None
+    total_steps: Optional[int] = None
+    instruction: Optional[str] = None
+    message: Optional[str] = None
+    cached: Optional[bool] = None
+    layer: Optional[str] = None
+    duration: Optional[float] = None
+    image_id: Optional[str] = None
+
+    def to_json(self) -> str:
+        """
+        Serialises the event as a single line of JSON.
+        :return: the JSON
+        """
+        event = asdict(self)
+        event["type"] = self.type.value
+        return json.dumps({key: value for key, value in event.items() if value is not None})
+
+
+BuildEventListener = Callable[[BuildEvent], None]
+
+
+@dataclass
+class _Step:
+    """
+    State of the build step that is being parsed.
+    """
+    step: int
+    total_steps: int
+    instruction: str
+    started: float
+    cached: bool = False
+    layer: Optional[str] = None
+
+
+class BuildLogParser:
+    """
+    Parses the JSON stream of a Docker build, as it is received, into build events.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.image_id: Optional[str] = None
+        self.error: Optional[str] = None
+        self._buffer = ""
+        self._step: Optional[_Step] = None
+
+    def feed(self, chunk: Dict[str, Any]) -> Iterator[BuildEvent]:
+        """
+        Parses the given decoded chunk of the build's JSON stream.
+        :param chunk: the chunk
+        :return: iterator of the events that the chunk completes
+        """
+        if "stream" in chunk:
+            self._buffer += chunk["stream"]
+            *lines, self._buffer = self._buffer.split("\n")
+            for line in lines:
+                yield from self._parse_line(line)
+        if "aux" in chunk and "ID" in chunk["aux"]:
+            self.image_id = chunk["aux"]["ID"]
+        if "error" in chunk:
+            self.error = chunk["error"].strip()
+            yield from self._finish_step()
+            yield BuildEvent(BuildEventType.ERROR, time.time(), message=self.error)
+
+    def close(self) -> Iterator[BuildEvent]:
+        """
+        Finishes parsing the build's JSON stream.
+        :return: iterator of the events that the end of the stream completes
+        """
+        if self._buffer != "":
+            yield from self._parse_line(self._buffer)
+            self._buffer = ""
+        yield from self._finish_step()
+        if self.error is None:
+            yield BuildEvent(BuildEventType.BUILD_FINISHED, time.time(), image_id=self.image_id)
+
+    def _parse_line(self, line: str) -> Iterator[BuildEvent]:
+        """
+        Parses the given line of build output.
+        :param line: the line
+        :return: iterator of the events that the line completes
+        """
+        now = time.time()
+        match = _STEP_PATTERN.match(line)
+        if match is not None:
+            yield from self._finish_step()
+            self._step = _Step(int(match.group(1)), int(match.group(2)), match.group(3).strip(), now)
+            yield BuildEvent(BuildEventType.STEP_STARTED, now, step=self._step.step,
+                             total_steps=self._step.total_steps, instruction=self._step.instruction, cached=False)
+        elif line == _USING_CACHE_LINE and self._step is not None:
+            self._step.cached = True
+            yield BuildEvent(BuildEventType.CACHE_HIT, now, step=self._step.step, total_steps=self._step.total_steps,
+                             instruction=self._step.instruction)
+        elif _LAYER_PATTERN.match(line) and self._step is not None:
+            self._step.layer = _LAYER_PATTERN.match(line).group(1)
+        elif line.strip() != "":
+            yield BuildEvent(BuildEventType.OUTPUT, now, step=self._step.step if self._step is not None else None,
+                             message=line)
+
+    def _finish_step(self) -> Iterator[BuildEvent]:
+        """
+        Finishes the current step, if there is one.
+        :return: iterator of the step finished event, if there was a step
+        """
+        if self._step is not None:
+            step = self._step
+            self._step = None
+            yield BuildEvent(BuildEventType.STEP_FINISHED, time.time(), step=step.step, total_steps=step.total_steps,
+                             instruction=step.instruction, cached=step.cached, layer=step.layer,
+                             duration=time.time() - step.started)
+
+
+class NdjsonBuildEventWriter:
+    """
+    Build event listener that writes events to a file as newline delimited JSON.
+    """
+    def __init__(self, file: TextIO):
+        """
+        Constructor.
+        :param file: file to write to
+        """
+        self.file = file
+
+    def __call__(self, event: BuildEvent):
+        self.file.write(f"{event.to_json()}\n")
+        self.file.flush()
+
+
+def log_build_event(event: BuildEvent):
+    """
+    Build event listener that logs events.
+    :param event: the event
+    """
+    if event.type == BuildEventType.STEP_STARTED:
+        logger.info(f"Step {event.step}/{event.total_steps}: {event.instruction}")
+    elif event.type == BuildEventType.STEP_FINISHED:
+        logger.info(f"Step {event.step}/{event.total_steps} finished in {event.duration:.1f}s"
+                    f"{' (cached)' if event.cached else ''}{f': {event.layer}' if event.layer else ''}")
+    elif event.type == BuildEventType.OUTPUT:
+        logger.debug(event.message)
+    elif event.type == BuildEventType.BUILD_FINISHED:
+        logger.info(f"Built image {event.image_id}")
+    elif event.type == BuildEventType.ERROR:
+        logger.error(f"Build failed: {event.message}")
+
+
+def combine_listeners(*listeners: Optional[BuildEventListener]) -> BuildEventListener:
+    """
+    Combines the given build event listeners into one.
+    :param listeners: the listeners (`None`s are ignored)
+    :return: listener that calls each of the given listeners in turn
+    """
+    listeners: List[BuildEventListener] = [listener for listener in listeners if listener is not None]
+
+    def listener(event: BuildEvent):
+        for wrapped in listeners:
+            wrapped(event)
+
+    return listener
@@ -0,0 +1,286 @@
+import fcntl
+import hashlib
+import os
+import shutil
+from threading import Lock
+from contextlib import contextmanager
+from typing import Optional, Iterable, List, Iterator, Callable, Any
+from urllib.parse import urlparse, urlunparse
+
+from logzero import logger
+
+from patchworkdocker.copying import clone_tree
+
+_LOCK_FILE_SUFFIX = ".lock"
+_PARTIAL_ENTRY_SUFFIX = ".partial"
+
+
+def get_directory_size(directory: str) -> int:
+    """
+    Gets the total size of the files in the given directory (symlinks are not followed).
+    :param directory: directory to get the size of
+    :return: size in bytes
+    """
+    size = 0
+    for root, directories, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class DirectoryCache:
+    """
+    Cache of directories stored on the local file system, which are indexed by a string key.
+
+    Entries are locked whilst in use so the cache can be shared between processes. If the cache has a maximum size,
+    the least recently used entries are evicted when the cache exceeds it. The size of the cache is measured when
+    entries are evicted and then tracked as entries are added (see `evict_if_full`), so the cache is not walked on
+    every addition.
+    """
+    def __init__(self, directory: str, max_size: Optional[int]=None):
+        """
+        Constructor.
+        :param directory: directory to store the cache in (created if it does not exist)
+        :param max_size: maximum size of the cache in bytes (`None` for unbounded)
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        # Size of the cache when it was last measured, plus the size of the entries added since (`None` if unmeasured)
+        self._tracked_size: Optional[int] = None
+        self._tracked_size_lock = Lock()
+
+    def get_location(self, key: str) -> str:
+        """
+        Gets the location of the entry with the given key (which may not exist).
+        :param key: entry key
+        :return: location of the entry
+        """
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def contains(self, key: str) -> bool:
+        """
+        Gets whether the cache has an entry for the given key.
+        :param key: entry key
+        :return: whether the entry exists
+        """
+        return os.path.exists(self.get_location(key))
+
+    @contextmanager
+    def lock(self, key: str, *, shared: bool=False) -> Iterator[str]:
+        """
+        Locks the entry with the given key, blocking until the lock is acquired.
+        :param key: entry key
+        :param shared: whether the lock can be held by other shared users at the same time (i.e. a read lock)
+        :return: context manager that yields the location of the entry whilst the lock is held
+        """
+        location = self.get_location(key)
+        with _lock(f"{location}{_LOCK_FILE_SUFFIX}", blocking=True, shared=shared):
+            yield location
+
+    def touch(self, key: str):
+        """
+        Marks the entry with the given key as used.
+        :param key: entry key
+        """
+        os.utime(self.get_location(key))
+
+    def evict(self, *, keep: Iterable[str]=()) -> List[str]:
+        """
+        Evicts the least recently used entries until the cache is no larger than its maximum size.
+
+        Entries that are locked by another user are not evicted.
+        :param keep: keys of entries that must not be evicted
+        :return: locations of the evicted entries
+        """
+        if self.max_size is None:
+            return []
+
+        keep_locations = {self.get_location(key) for key in keep}
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((_LOCK_FILE_SUFFIX, _PARTIAL_ENTRY_SUFFIX)) \
+                    or not entry.is_dir(follow_symlinks=False):
+                continue
+            entries.append((entry.stat(follow_symlinks=False).st_mtime, entry.path, get_directory_size(entry.path)))
+        total_size = sum(size for _, _, size in entries)
+
+        evicted = []
+        for _, location, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if location in keep_locations:
+                continue
+            try:
+                with _lock(f"{location}{_LOCK_FILE_SUFFIX}", blocking=False):
+                    logger.info(f"Evicting cache entry: {location}")
+                    shutil.rmtree(location)
+            except BlockingIOError:
+                logger.debug(f"Not evicting cache entry as it is in use: {location}")
+                continue
+            total_size -= size
+            evicted.append(location)
+        with self._tracked_size_lock:
+            self._tracked_size = total_size
+        return evicted
+
+    def evict_if_full(self, added_size: int, *, keep: Iterable[str]=()) -> List[str]:
+        """
+        Evicts the least recently used entries (see `evict`) if the tracked size of the cache exceeds its maximum size
+        once an entry of the given size has been added to it.
+
+        The cache is measured the first time that this is called, as it may have been populated by another process.
+        :param added_size: size in bytes of the entry that has been added
+        :param keep: keys of entries that must not be evicted
+        :return: locations of the evicted entries
+        """
+        if self.max_size is None:
+            return []
+        with self._tracked_size_lock:
+            if self._tracked_size is not None:
+                self._tracked_size += added_size
+                if self._tracked_size <= self.max_size:
+                    return []
+        return self.evict(keep=keep)
+
+
+class GitMirrorCache(DirectoryCache):
+    """
+    Cache of bare mirrors of remote git repositories, keyed by the normalised origin URL.
+    """
+    @staticmethod
+    def normalise_origin(origin: str) -> str:
+        """
+        Normalises the given git origin so that equivalent URLs share a mirror.
+        :param origin: git origin (without fragment)
+        :return: normalised origin
+        """
+        parsed_origin = urlparse(origin)
+        path = parsed_origin.path.rstrip("/")
+        if path.endswith(".git"):
+            path = path[:-len(".git")]
+        return urlunparse(parsed_origin._replace(
+            scheme=parsed_origin.scheme.lower(), netloc=parsed_origin.netloc.lower(), path=path, fragment=""))
+
+    @contextmanager
+    def mirror(self, origin: str) -> Iterator[str]:
+        """
+        Updates the mirror of the given origin, creating it if it does not exist.
+
+        The mirror is locked for the duration of the context.
+        :param origin: git origin (without fragment)
+        :return: context manager that yields the location of the up-to-date mirror
+        """
+        from git import Repo
+
+        key = GitMirrorCache.normalise_origin(origin)
+        with self.lock(key) as location:
+            if os.path.exists(location):
+                logger.info(f"Fetching {origin} into mirror: {location}")
+                Repo(location).remote().fetch(prune=True)
+            else:
+                logger.info(f"Creating mirror of {origin}: {location}")
+                temp_location = f"{location}{_PARTIAL_ENTRY_SUFFIX}"
+                shutil.rmtree(temp_location, ignore_errors=True)
+                Repo.clone_from(url=origin, to_path=temp_location, mirror=True)
+                os.rename(temp_location, location)
+            self.touch(key)
+            yield location
+        self.evict(keep=[key])
+
+
+class PreparedContextCache(DirectoryCache):
+    """
+    Cache of prepared build contexts, keyed by a fingerprint of the inputs used to prepare them.
+
+    Files are copied between the cache and the build directories that it is used with, sharing their contents only
+    where the file system supports reflinks, so build directories can be modified in place without changing the cache.
+    """
+    def get(self, key: str, destination: str) -> bool:
+        """
+        Materialises the prepared context with the given key into the given directory, if it is in the cache.
+        :param key: prepared context fingerprint
+        :param destination: directory to materialise the context in
+        :return: whether the context was in the cache
+        """
+        with self.lock(key) as location:
+            if not os.path.exists(location):
+                return False
+            logger.info(f"Materialising cached prepared context {location} to {destination}")
+            clone_tree(location, destination)
+            self.touch(key)
+        return True
+
+    def put(self, key: str, source: str):
+        """
+        Adds the prepared context in the given directory to the cache.
+        :param key: prepared context fingerprint
+        :param source: directory containing the prepared context
+        """
+        with self.lock(key) as location:
+            if os.path.exists(location):
+                return
+            logger.info(f"Caching prepared context {source} in {location}")
+            temp_location = f"{location}{_PARTIAL_ENTRY_SUFFIX}"
+            shutil.rmtree(temp_location, ignore_errors=True)
+            clone_tree(source, temp_location)
+            os.rename(temp_location, location)
+            self.touch(key)
+            added_size = get_directory_size(location) if self.max_size is not None else 0
+        self.evict_if_full(added_size, keep=[key])
+
+
+class ImportCache(DirectoryCache):
+    """
+    Cache of imported repositories, keyed by the fingerprint of what was imported, which are shared read-only between
+    builds (see `PatchworkDocker.prepare_overlay`).
+    """
+    @contextmanager
+    def use(self, key: str, load: Callable[[str], Any]) -> Iterator[str]:
+        """
+        Uses the imported repository with the given key, importing it first if it is not in the cache.
+
+        The entry is not evicted whilst in use and must not be modified.
+        :param key: fingerprint of the imported repository
+        :param load: loads the repository into the directory that it is given
+        :return: context manager that yields the location of the imported repository
+        """
+        added_size = 0
+        while True:
+            with self.lock(key, shared=True) as location:
+                if os.path.exists(location):
+                    self.touch(key)
+                    yield location
+                    break
+            # Shared locks cannot be upgraded atomically, so the entry is checked again once it is exclusively locked
+            with self.lock(key) as location:
+                if not os.path.exists(location):
+                    logger.info(f"Importing to cache entry: {location}")
+                    temp_location = f"{location}{_PARTIAL_ENTRY_SUFFIX}"
+                    shutil.rmtree(temp_location, ignore_errors=True)
+                    os.makedirs(temp_location)
+                    load(temp_location)
+                    os.rename(temp_location, location)
+                    if self.max_size is not None:
+                        added_size = get_directory_size(location)
+        self.evict_if_full(added_size)
+
+
+@contextmanager
+def _lock(lock_location: str, *, blocking: bool, shared: bool=False) -> Iterator[None]:
+    """
+    Holds a lock on the given lock file for the duration of the context.
+    :param lock_location: location of the lock file (created if it does not exist)
+    :param blocking: whether to wait for the lock, else `BlockingIOError` is raised if it is held elsewhere
+    :param shared: whether to take a shared lock, rather than an exclusive lock
+    """
+    with open(lock_location, "a") as lock_file:
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,85 @@
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from threading import Event
+from typing import Optional, Iterator, Callable, TypeVar
+
+from patchworkdocker.errors import PatchworkDockerError
+
+
+class OperationCancelledError(PatchworkDockerError):
+    """
+    Raised when an operation is stopped because it has been cancelled.
+    """
+
+
+class CancellationToken:
+    """
+    Signals to an operation, which may be running in another thread, that it should stop.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._event = Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        """
+        Cancels the operation, which stops at its next check (see `check_cancelled`).
+        """
+        self._event.set()
+
+
+_T = TypeVar("_T")
+
+_token: ContextVar[Optional[CancellationToken]] = ContextVar("cancellation_token", default=None)
+
+
+@contextmanager
+def cancellable(token: CancellationToken) -> Iterator[CancellationToken]:
+    """
+    Makes operations run in the context (and in copies of the context, e.g. by `asyncio.to_thread`) stop when the given
+    token is cancelled.
+    :param token: the token
+    :return: context manager that yields the token
+    """
+    reset_token = _token.set(token)
+    try:
+        yield token
+    finally:
+        _token.reset(reset_token)
+
+
+def check_cancelled():
+    """
+    Stops the current operation if it has been cancelled.
+
+    Called between units of work that can be safely stopped after, so there is no overhead when not cancellable.
+    :raises OperationCancelledError: raised if the current operation has been cancelled
+    """
+    token = _token.get()
+    if token is not None and token.cancelled:
+        raise OperationCancelledError("Operation cancelled")
+
+
+def submit_cancellable(executor: Executor, function: Callable[..., _T], *args, **kwargs) -> "Future[_T]":
+    """
+    Submits the given function to the given executor to be run as part of the current operation: it is run in a copy
+    of the current context, so it can be cancelled with the operation, and it is not started if the operation has been
+    cancelled by the time that it would run.
+    :param executor: the executor
+    :param function: the function
+    :param args: positional arguments to call the function with
+    :param kwargs: keyword arguments to call the function with
+    :return: future of what the function returns
+    """
+    def run() -> _T:
+        check_cancelled()
+        return function(*args, **kwargs)
+
+    # Each call gets its own copy, as a context cannot be entered by many threads at once
+    return executor.submit(copy_context().run, run)
@@ -1,11 +1,13 @@
 import dataclasses
 import json
 import logging
+import os
 import sys
 from argparse import ArgumentParser
+from contextlib import ExitStack
 from dataclasses import dataclass
 from enum import Enum, unique
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Optional, Union, Callable, Any, TYPE_CHECKING
 
 import logzero
 from logzero import logger
@@ -13,8 +15,15 @@ from logzero import logger
 from patchworkdocker._external.key_value_string_parser import KeyValueStringParserAction
 from patchworkdocker._external.verbosity_argument_parser import verbosity_parser_configuration, VERBOSE_PARAMETER_KEY, \
     get_verbosity, DEFAULT_LOG_VERBOSITY_KEY
-from patchworkdocker.core import PatchworkDocker
-from patchworkdocker.meta import EXECUTABLE_NAME, DESCRIPTION, VERSION
+from patchworkdocker.build_logs import NdjsonBuildEventWriter
+from patchworkdocker.meta import EXECUTABLE_NAME, DESCRIPTION, VERSION, PACKAGE_NAME
+from patchworkdocker.profiling import Profiler, profiling, format_table, to_json, to_chrome_trace, \
+    PROFILE_FORMATS
+
+# The modules that run actions (and their dependencies, e.g. GitPython and docker-py) are only imported by the actions
+# that use them, so the CLI starts quickly (e.g. for `--help` and `--dry-run`)
+if TYPE_CHECKING:
+    from patchworkdocker.core import PatchworkDocker
 
 ACTION_PARAMETER = "action"
 IMPORT_REPOSITORY_FROM_PARAMETER = "context"
@@ -29,13 +38,52 @@ BUILD_LOCATION_LONG_PARAMETER = "build-location"
 BUILD_LOCATION_SHORT_PARAMETER = "b"
 VERBOSITY_SHORT_PARAMETER = verbosity_parser_configuration[VERBOSE_PARAMETER_KEY]
 DRY_RUN_LONG_PARAMETER = "dry-run"
+PROFILE_LONG_PARAMETER = "profile"
+PROFILE_OUTPUT_LONG_PARAMETER = "profile-output"
+PROFILE_FORMAT_LONG_PARAMETER = "profile-format"
 BASE_IMAGE_SHORT_PARAMETER = "i"
 BASE_IMAGE_LONG_PARAMETER = "base-image"
+ARG_DEFAULT_LONG_PARAMETER = "arg-default"
+LABEL_LONG_PARAMETER = "label"
+TARGET_LONG_PARAMETER = "target"
+PIN_BASE_IMAGES_LONG_PARAMETER = "pin-base-images"
+GIT_CACHE_DIRECTORY_LONG_PARAMETER = "git-cache-dir"
+GIT_CACHE_MAX_SIZE_LONG_PARAMETER = "git-cache-max-size"
+SHALLOW_LONG_PARAMETER = "shallow"
+SPARSE_LONG_PARAMETER = "sparse"
+SPARSE_PATH_LONG_PARAMETER = "sparse-path"
+CACHE_DIRECTORY_LONG_PARAMETER = "cache-dir"
+CACHE_MAX_SIZE_LONG_PARAMETER = "cache-max-size"
+NO_CACHE_LONG_PARAMETER = "no-cache"
+MANIFEST_PARAMETER = "manifest"
+PREPARE_CONCURRENCY_LONG_PARAMETER = "prepare-concurrency"
+BUILD_CONCURRENCY_LONG_PARAMETER = "build-concurrency"
+STREAM_CONTEXT_LONG_PARAMETER = "stream-context"
+OVERLAY_LONG_PARAMETER = "overlay"
+UPDATE_LONG_PARAMETER = "update"
+IMPORT_CACHE_DIRECTORY_LONG_PARAMETER = "import-cache-dir"
+LOCKFILE_LONG_PARAMETER = "lockfile"
+UPDATE_LOCKFILE_LONG_PARAMETER = "update-lockfile"
+NO_REUSE_IMAGE_LONG_PARAMETER = "no-reuse-image"
+BUILD_LOG_LONG_PARAMETER = "build-log"
+SERVER_SOCKET_LONG_PARAMETER = "server-socket"
+NO_SERVER_LONG_PARAMETER = "no-server"
+PRIORITY_LONG_PARAMETER = "priority"
+CONCURRENCY_LONG_PARAMETER = "concurrency"
 
 DEFAULT_ADDITIONAL_FILES = {}
 DEFAULT_PATCHES = {}
+DEFAULT_ARG_DEFAULTS = {}
+DEFAULT_LABELS = {}
 DEFAULT_DOCKERFILE_LOCATION = "Dockerfile"
 DEFAULT_VERBOSITY = verbosity_parser_configuration[DEFAULT_LOG_VERBOSITY_KEY]
+DEFAULT_CACHE_DIRECTORY = None
+DEFAULT_CACHE_MAX_SIZE = 5 * 1024 ** 3
+DEFAULT_IMPORT_CACHE_DIRECTORY = None
+DEFAULT_SERVER_SOCKET_LOCATION = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), PACKAGE_NAME)),
+    f"{PACKAGE_NAME}.sock")
 
 
 @unique
@@ -45,6 +93,8 @@ class ActionValue(Enum):
     """
     BUILD = "build"
     PREPARE = "prepare"
+    BUILD_MANY = "build-many"
+    SERVE = "serve"
 
 
 @dataclass
@@ -54,10 +104,28 @@ class BaseCliConfiguration:
     """
     log_verbosity: int
     dry_run: bool
+    profile: bool
+    profile_output_location: Optional[str]
+    profile_format: str
 
 
 @dataclass
-class SubcommandCliConfiguration(BaseCliConfiguration):
+class CachingCliConfiguration(BaseCliConfiguration):
+    """
+    CLI configuration for subcommands that import and cache.
+    """
+    git_cache_directory: Optional[str]
+    git_cache_max_size: Optional[int]
+    shallow: bool
+    cache_directory: Optional[str]
+    cache_max_size: int
+    import_cache_directory: Optional[str]
+    lockfile_location: Optional[str]
+    update_lockfile: bool
+
+
+@dataclass
+class SubcommandCliConfiguration(CachingCliConfiguration):
     """
     CLI configuration for subcommands.
     """
@@ -66,7 +134,17 @@ class SubcommandCliConfiguration(BaseCliConfiguration):
     dockerfile_location: str
     build_location: Optional[str]
     import_from: str
-    base_image: str
+    base_image: Optional[str]
+    stage_base_images: Dict[str, str]
+    target: Optional[str]
+    pin_base_images: bool
+    arg_defaults: Dict[str, str]
+    labels: Dict[str, str]
+    sparse_paths: Optional[List[str]]
+    overlay: bool
+    update: bool
+    server_socket_location: Optional[str]
+    priority: int
 
 
 @dataclass
@@ -82,6 +160,28 @@ class BuildCliConfiguration(SubcommandCliConfiguration):
     CLI configuration for building a patchwork Docker image.
     """
     image_name: str
+    stream_context: bool
+    reuse_image: bool
+    build_log_location: Optional[str]
+
+
+@dataclass
+class BuildManyCliConfiguration(CachingCliConfiguration):
+    """
+    CLI configuration for building many patchwork Docker images from a manifest.
+    """
+    manifest_location: str
+    prepare_concurrency: int
+    build_concurrency: int
+
+
+@dataclass
+class ServeCliConfiguration(CachingCliConfiguration):
+    """
+    CLI configuration for serving patchwork Docker builds to clients.
+    """
+    server_socket_location: str
+    concurrency: int
 
 
 def _create_parser() -> ArgumentParser:
@@ -93,6 +193,14 @@ def _create_parser() -> ArgumentParser:
     parser.add_argument(f"-{VERBOSITY_SHORT_PARAMETER}", action="count", default=0,
                         help="increase the level of log verbosity (add multiple increase further)")
     parser.add_argument(f"--{DRY_RUN_LONG_PARAMETER}", action="store_true", default=False, help="")
+    parser.add_argument(f"--{PROFILE_LONG_PARAMETER}", action="store_true", default=False,
+                        help="time each phase of the run (e.g. import, patching, context upload and build) and print a "
+                             "table of the timings to stderr")
+    parser.add_argument(f"--{PROFILE_OUTPUT_LONG_PARAMETER}", default=None,
+                        help=f"file to write the timings of each phase to (implies --{PROFILE_LONG_PARAMETER})")
+    parser.add_argument(f"--{PROFILE_FORMAT_LONG_PARAMETER}", choices=PROFILE_FORMATS, default=PROFILE_FORMATS[0],
+                        help=f"format of the --{PROFILE_OUTPUT_LONG_PARAMETER} file (chrome is the Chrome trace event "
+                             "format, viewable in chrome://tracing or Perfetto)")
     subparsers = parser.add_subparsers(dest=ACTION_PARAMETER, help="TODO")
 
     def take_context_arguments(parser: ArgumentParser):
@@ -108,18 +216,101 @@ def _create_parser() -> ArgumentParser:
                             help="TODO", default=DEFAULT_DOCKERFILE_LOCATION)
         parser.add_argument(f"-{BUILD_LOCATION_SHORT_PARAMETER}", f"--{BUILD_LOCATION_LONG_PARAMETER}",
                             help="TODO", default=None)
-        parser.add_argument(f"-{BASE_IMAGE_SHORT_PARAMETER}", f"--{BASE_IMAGE_LONG_PARAMETER}",
-                            help="TODO", default=None)
+        parser.add_argument(f"-{BASE_IMAGE_SHORT_PARAMETER}", f"--{BASE_IMAGE_LONG_PARAMETER}", action="append",
+                            default=[],
+                            help="base image to change to, optionally for a stage given by name or index in the form "
+                                 "stage=image (can be given for many stages)")
+        parser.add_argument(f"--{TARGET_LONG_PARAMETER}", default=None,
+                            help="name or index of the stage to build (stages that it does not need are not built)")
+        parser.add_argument(f"--{PIN_BASE_IMAGES_LONG_PARAMETER}", action="store_true", default=False,
+                            help="pin the images that the Dockerfile's stages are built from to their current "
+                                 "digests in the registry")
+        parser.add_argument(f"--{ARG_DEFAULT_LONG_PARAMETER}", action=KeyValueStringParserAction,
+                            default=DEFAULT_ARG_DEFAULTS,
+                            help="default value to give a build argument declared in the Dockerfile, in the form "
+                                 "name:value")
+        parser.add_argument(f"--{LABEL_LONG_PARAMETER}", action=KeyValueStringParserAction, default=DEFAULT_LABELS,
+                            help="label to add to the Dockerfile's final stage, in the form key:value")
+        parser.add_argument(f"--{SPARSE_LONG_PARAMETER}", action="store_true", default=False,
+                            help="only checkout the Dockerfile's directory and the destinations of additional files and "
+                                 "patches when importing from a git repository")
+        parser.add_argument(f"--{SPARSE_PATH_LONG_PARAMETER}", action="append", default=[],
+                            help="additional path to checkout when importing from a git repository (implies "
+                                 f"--{SPARSE_LONG_PARAMETER})")
+        parser.add_argument(f"--{OVERLAY_LONG_PARAMETER}", action="store_true", default=False,
+                            help="share the imported materials between builds (in the import cache), only copying the "
+                                 "files that are added or modified")
+        parser.add_argument(f"--{UPDATE_LONG_PARAMETER}", action="store_true", default=False,
+                            help="update the build directory in place if it was prepared with this option before, only "
+                                 "importing what has changed and redoing the modifications that it affects")
+        parser.add_argument(f"--{SERVER_SOCKET_LONG_PARAMETER}", default=DEFAULT_SERVER_SOCKET_LOCATION,
+                            help="socket of the server to run on if it is running, in which case the server's caches "
+                                 "are used")
+        parser.add_argument(f"--{NO_SERVER_LONG_PARAMETER}", action="store_true", default=False,
+                            help="do not run on the server, even if it is running")
+        parser.add_argument(f"--{PRIORITY_LONG_PARAMETER}", type=int, default=0,
+                            help="priority of the job when run on the server (jobs with a higher priority are run "
+                                 "first)")
+        take_caching_arguments(parser)
+
+    def take_caching_arguments(parser: ArgumentParser):
+        parser.add_argument(f"--{GIT_CACHE_DIRECTORY_LONG_PARAMETER}", default=None,
+                            help="directory in which to keep mirrors of git repositories between runs")
+        parser.add_argument(f"--{GIT_CACHE_MAX_SIZE_LONG_PARAMETER}", type=int, default=None,
+                            help="maximum size of the git cache in bytes, after which the least recently used mirrors "
+                                 "are evicted")
+        parser.add_argument(f"--{SHALLOW_LONG_PARAMETER}", action="store_true", default=False,
+                            help="only fetch the commit that is built when importing from a git repository")
+        parser.add_argument(f"--{CACHE_DIRECTORY_LONG_PARAMETER}", default=DEFAULT_CACHE_DIRECTORY,
+                            help="directory in which to cache prepared build contexts (not cached if not given)")
+        parser.add_argument(f"--{CACHE_MAX_SIZE_LONG_PARAMETER}", type=int, default=DEFAULT_CACHE_MAX_SIZE,
+                            help="maximum size of the prepared build context cache in bytes")
+        parser.add_argument(f"--{NO_CACHE_LONG_PARAMETER}", action="store_true", default=False,
+                            help="do not use the prepared build context cache or the import cache")
+        parser.add_argument(f"--{IMPORT_CACHE_DIRECTORY_LONG_PARAMETER}", default=DEFAULT_IMPORT_CACHE_DIRECTORY,
+                            help="directory in which to keep imported materials that are shared between overlay "
+                                 f"builds (not kept if not given; shares --{CACHE_MAX_SIZE_LONG_PARAMETER})")
+        parser.add_argument(f"--{LOCKFILE_LONG_PARAMETER}", default=None,
+                            help="JSON file in which to pin the commits that git references resolve to, so repeat "
+                                 "builds use the same commits without resolving them again")
+        parser.add_argument(f"--{UPDATE_LOCKFILE_LONG_PARAMETER}", action="store_true", default=False,
+                            help=f"resolve git references pinned in the --{LOCKFILE_LONG_PARAMETER} again and update "
+                                 "their pins")
 
     build_parser = subparsers.add_parser(ActionValue.BUILD.value, help="TODO")
     take_context_arguments(build_parser)
     build_parser.add_argument(IMAGE_NAME_PARAMETER, help="TODO")
+    build_parser.add_argument(f"--{STREAM_CONTEXT_LONG_PARAMETER}", action="store_true", default=False,
+                              help="stream the build context to Docker straight from where it is imported from, "
+                                   "rather than preparing a copy of it first")
+    build_parser.add_argument(f"--{NO_REUSE_IMAGE_LONG_PARAMETER}", action="store_true", default=False,
+                              help="build even if there is an image that was built from the same inputs, rather than "
+                                   "tagging that image")
+    build_parser.add_argument(f"--{BUILD_LOG_LONG_PARAMETER}", default=None,
+                              help="file to write the events of the Docker build to, as newline delimited JSON")
     take_common_arguments(build_parser)
 
     prepare_parser = subparsers.add_parser(ActionValue.PREPARE.value, help="TODO")
     take_context_arguments(prepare_parser)
     take_common_arguments(prepare_parser)
 
+    build_many_parser = subparsers.add_parser(ActionValue.BUILD_MANY.value,
+                                              help="build many patchwork Docker images from a manifest")
+    build_many_parser.add_argument(MANIFEST_PARAMETER, help="JSON (or YAML) manifest of the images to build")
+    build_many_parser.add_argument(f"--{PREPARE_CONCURRENCY_LONG_PARAMETER}", type=int, default=None,
+                                   help="maximum number of build contexts to import and prepare at once")
+    build_many_parser.add_argument(f"--{BUILD_CONCURRENCY_LONG_PARAMETER}", type=int, default=None,
+                                   help="maximum number of Docker builds to run at once")
+    take_caching_arguments(build_many_parser)
+
+    serve_parser = subparsers.add_parser(ActionValue.SERVE.value,
+                                         help="serve builds to clients, keeping caches warm between them")
+    serve_parser.add_argument(f"--{SERVER_SOCKET_LONG_PARAMETER}", default=DEFAULT_SERVER_SOCKET_LOCATION,
+                              help="Unix socket to serve on")
+    serve_parser.add_argument(f"--{CONCURRENCY_LONG_PARAMETER}", type=int, default=None,
+                              help="maximum number of jobs to run at once")
+    take_caching_arguments(serve_parser)
+
     return parser
 
 
@@ -130,33 +321,82 @@ def parse_cli_configuration(arguments: List[str]) -> BaseCliConfiguration:
     :return: parsed configuration
     """
     # XXX: Setting a value other than the display string seems to be non-trivial: https://bugs.python.org/issue23487
-    parsed_arguments = _create_parser().parse_args(arguments)
+    parser = _create_parser()
+    parsed_arguments = parser.parse_args(arguments)
     parsed_arguments = {x.replace("_", "-"): y for x, y in vars(parsed_arguments).items()}
     action_value = parsed_arguments[ACTION_PARAMETER]
     if action_value is None:
         logger.error("No action specified")
-        _create_parser().print_help(sys.stderr)
+        parser.print_help(sys.stderr)
         exit(1)
     parsed_arguments[ACTION_PARAMETER] = ActionValue(action_value)
 
     cli_configuration_class = {
         ActionValue.BUILD: BuildCliConfiguration,
-        ActionValue.PREPARE: PrepareCliConfiguration
+        ActionValue.PREPARE: PrepareCliConfiguration,
+        ActionValue.BUILD_MANY: BuildManyCliConfiguration,
+        ActionValue.SERVE: ServeCliConfiguration
     }[parsed_arguments[ACTION_PARAMETER]]
 
     extra_configuration = {}
     if issubclass(cli_configuration_class, BuildCliConfiguration):
         extra_configuration["image_name"] = parsed_arguments[IMAGE_NAME_PARAMETER]
+        extra_configuration["stream_context"] = parsed_arguments[STREAM_CONTEXT_LONG_PARAMETER]
+        extra_configuration["reuse_image"] = not parsed_arguments[NO_REUSE_IMAGE_LONG_PARAMETER]
+        extra_configuration["build_log_location"] = parsed_arguments[BUILD_LOG_LONG_PARAMETER]
+    if issubclass(cli_configuration_class, SubcommandCliConfiguration):
+        try:
+            base_images = _parse_base_images(parsed_arguments[BASE_IMAGE_LONG_PARAMETER])
+        except ValueError as e:
+            parser.error(str(e))
+        extra_configuration.update(dict(
+            additional_files=parsed_arguments[ADDITIONAL_FILES_LONG_PARAMETER],
+            patches=parsed_arguments[PATCHES_LONG_PARAMETER],
+            dockerfile_location=parsed_arguments[DOCKERFILE_LOCATION_LONG_PARAMETER],
+            build_location=parsed_arguments[BUILD_LOCATION_LONG_PARAMETER],
+            import_from=parsed_arguments[IMPORT_REPOSITORY_FROM_PARAMETER],
+            **base_images,
+            target=parsed_arguments[TARGET_LONG_PARAMETER],
+            pin_base_images=parsed_arguments[PIN_BASE_IMAGES_LONG_PARAMETER],
+            arg_defaults=parsed_arguments[ARG_DEFAULT_LONG_PARAMETER],
+            labels=parsed_arguments[LABEL_LONG_PARAMETER],
+            sparse_paths=parsed_arguments[SPARSE_PATH_LONG_PARAMETER]
+            if parsed_arguments[SPARSE_LONG_PARAMETER] or parsed_arguments[SPARSE_PATH_LONG_PARAMETER] else None,
+            overlay=parsed_arguments[OVERLAY_LONG_PARAMETER],
+            update=parsed_arguments[UPDATE_LONG_PARAMETER],
+            server_socket_location=parsed_arguments[SERVER_SOCKET_LONG_PARAMETER]
+            if not parsed_arguments[NO_SERVER_LONG_PARAMETER] else None,
+            priority=parsed_arguments[PRIORITY_LONG_PARAMETER]))
+    if issubclass(cli_configuration_class, BuildManyCliConfiguration):
+        from patchworkdocker.batch import DEFAULT_PREPARE_CONCURRENCY, DEFAULT_BUILD_CONCURRENCY
+        extra_configuration.update(dict(
+            manifest_location=parsed_arguments[MANIFEST_PARAMETER],
+            prepare_concurrency=_get_or_default(parsed_arguments[PREPARE_CONCURRENCY_LONG_PARAMETER],
+                                               DEFAULT_PREPARE_CONCURRENCY),
+            build_concurrency=_get_or_default(parsed_arguments[BUILD_CONCURRENCY_LONG_PARAMETER],
+                                              DEFAULT_BUILD_CONCURRENCY)))
+    if issubclass(cli_configuration_class, ServeCliConfiguration):
+        from patchworkdocker.server import DEFAULT_SERVER_CONCURRENCY
+        extra_configuration.update(dict(
+            server_socket_location=parsed_arguments[SERVER_SOCKET_LONG_PARAMETER],
+            concurrency=_get_or_default(parsed_arguments[CONCURRENCY_LONG_PARAMETER], DEFAULT_SERVER_CONCURRENCY)))
 
     cli_configuration = cli_configuration_class(
         log_verbosity=get_verbosity(parsed_arguments),
         dry_run=parsed_arguments[DRY_RUN_LONG_PARAMETER],
-        additional_files=parsed_arguments[ADDITIONAL_FILES_LONG_PARAMETER],
-        patches=parsed_arguments[PATCHES_LONG_PARAMETER],
-        dockerfile_location=parsed_arguments[DOCKERFILE_LOCATION_LONG_PARAMETER],
-        build_location=parsed_arguments[BUILD_LOCATION_LONG_PARAMETER],
-        import_from=parsed_arguments[IMPORT_REPOSITORY_FROM_PARAMETER],
-        base_image=parsed_arguments[BASE_IMAGE_LONG_PARAMETER],
+        profile=parsed_arguments[PROFILE_LONG_PARAMETER] or parsed_arguments[PROFILE_OUTPUT_LONG_PARAMETER] is not None,
+        profile_output_location=parsed_arguments[PROFILE_OUTPUT_LONG_PARAMETER],
+        profile_format=parsed_arguments[PROFILE_FORMAT_LONG_PARAMETER],
+        git_cache_directory=parsed_arguments[GIT_CACHE_DIRECTORY_LONG_PARAMETER],
+        git_cache_max_size=parsed_arguments[GIT_CACHE_MAX_SIZE_LONG_PARAMETER],
+        shallow=parsed_arguments[SHALLOW_LONG_PARAMETER],
+        cache_directory=parsed_arguments[CACHE_DIRECTORY_LONG_PARAMETER]
+        if not parsed_arguments[NO_CACHE_LONG_PARAMETER] else None,
+        cache_max_size=parsed_arguments[CACHE_MAX_SIZE_LONG_PARAMETER],
+        import_cache_directory=parsed_arguments[IMPORT_CACHE_DIRECTORY_LONG_PARAMETER]
+        if not parsed_arguments[NO_CACHE_LONG_PARAMETER] else None,
+        lockfile_location=parsed_arguments[LOCKFILE_LONG_PARAMETER],
+        update_lockfile=parsed_arguments[UPDATE_LOCKFILE_LONG_PARAMETER],
         **extra_configuration
     )
 
@@ -183,27 +423,214 @@ def print_configuration(configuration: BaseCliConfiguration):
     print(configuration_as_json)
 
 
-def build(core: PatchworkDocker, configuration: BuildCliConfiguration):
+def build(core: "PatchworkDocker", configuration: BuildCliConfiguration):
     """
     Builds patchwork Docker image with the given configuration.
     :param core: patchwork Docker core
     :param configuration: build configuration
     :return:
     """
-    core.build(configuration.image_name, configuration.build_location)
+    with ExitStack() as stack:
+        on_build_event = None
+        if configuration.build_log_location is not None:
+            on_build_event = NdjsonBuildEventWriter(stack.enter_context(open(configuration.build_log_location, "w")))
+        core.build(configuration.image_name, configuration.build_location,
+                   stream_context=configuration.stream_context, overlay=configuration.overlay,
+                   update=configuration.update, reuse_image=configuration.reuse_image, on_build_event=on_build_event)
 
 
-def prepare(core: PatchworkDocker, configuration: PrepareCliConfiguration):
+def prepare(core: "PatchworkDocker", configuration: PrepareCliConfiguration):
     """
     Prepares for patchwork Docker build.
     :param core: patchwork Docker core
     :param configuration: build configuration
     :return:
     """
-    output = core.prepare(configuration.build_location)
+    output = core.prepare(configuration.build_location, overlay=configuration.overlay, update=configuration.update)
     print(output)
 
 
+def build_many(configuration: BuildManyCliConfiguration):
+    """
+    Builds many patchwork Docker images from a manifest, exiting with a non-zero code if any fail to build.
+    :param configuration: build many configuration
+    """
+    from patchworkdocker.batch import load_manifest, BatchBuilder, format_summary
+    from patchworkdocker.docker_images import create_docker_client
+    from patchworkdocker.importers import ImporterFactory
+
+    caching_kwargs = _create_caching_kwargs(configuration)
+    jobs = load_manifest(configuration.manifest_location, **caching_kwargs)
+    importer_factory = ImporterFactory(git_mirror_cache=caching_kwargs["git_mirror_cache"],
+                                       git_shallow=caching_kwargs["git_shallow"],
+                                       git_ref_resolver=caching_kwargs["ref_resolver"],
+                                       resources=caching_kwargs["importer_resources"])
+    builder = BatchBuilder(jobs, prepare_concurrency=configuration.prepare_concurrency,
+                           build_concurrency=configuration.build_concurrency, importer_factory=importer_factory,
+                           docker_client=create_docker_client())
+    with caching_kwargs["importer_resources"]:
+        succeeded = builder.run()
+    print(format_summary(jobs))
+    if not succeeded:
+        exit(1)
+
+
+def serve(configuration: ServeCliConfiguration):
+    """
+    Serves patchwork Docker builds to clients until interrupted.
+    :param configuration: serve configuration
+    """
+    from patchworkdocker.server import PatchworkDockerServer
+
+    caching_kwargs = _create_caching_kwargs(configuration)
+    server = PatchworkDockerServer(configuration.server_socket_location, concurrency=configuration.concurrency,
+                                   **caching_kwargs)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping server")
+    finally:
+        caching_kwargs["importer_resources"].close()
+
+
+def forward_to_server(configuration: Union[PrepareCliConfiguration, BuildCliConfiguration]) -> bool:
+    """
+    Runs the action of the given configuration on the server, if it is running, exiting with a non-zero code if the
+    server's job does not succeed.
+
+    Not run on the server if profiling, or if writing a build log, as they are of the local run.
+    :param configuration: prepare or build configuration
+    :return: whether the action was run on the server
+    """
+    if configuration.server_socket_location is None or configuration.profile \
+            or getattr(configuration, "build_log_location", None) is not None \
+            or not os.path.exists(configuration.server_socket_location):
+        return False
+    from patchworkdocker.client import ServerClient
+
+    client = ServerClient(configuration.server_socket_location)
+    if not client.is_running():
+        return False
+
+    specification = _create_specification(configuration)
+    options = dict(overlay=configuration.overlay, update=configuration.update)
+    if configuration.build_location is not None:
+        options["build_location"] = os.path.abspath(configuration.build_location)
+    action = ActionValue.PREPARE
+    if isinstance(configuration, BuildCliConfiguration):
+        action = ActionValue.BUILD
+        specification["image_name"] = configuration.image_name
+        options.update(stream_context=configuration.stream_context, reuse_image=configuration.reuse_image)
+
+    job = client.submit(action.value, specification, options=options, priority=configuration.priority)
+    logger.info(f"Running on server {configuration.server_socket_location} as job {job['id']}")
+    try:
+        job = client.wait(job["id"])
+    except KeyboardInterrupt:
+        client.cancel(job["id"])
+        raise
+    if job["status"] != "succeeded":
+        logger.error(f"Job {job['id']} {job['status']} on server" + (f": {job['error']}" if job["error"] else ""))
+        exit(1)
+    if action == ActionValue.PREPARE:
+        print(job["result"])
+    return True
+
+
+def output_profile(profiler: Profiler, configuration: BaseCliConfiguration):
+    """
+    Prints a table of the timings recorded by the given profiler to stderr and writes them to the output file in the
+    given configuration, if any.
+    :param profiler: the profiler
+    :param configuration: configuration with the profiling options
+    """
+    print(format_table(profiler), file=sys.stderr)
+    if configuration.profile_output_location is not None:
+        serialise = {"json": to_json, "chrome": to_chrome_trace}[configuration.profile_format]
+        with open(configuration.profile_output_location, "w") as file:
+            file.write(serialise(profiler))
+
+
+def _parse_base_images(values: List[str]) -> Dict:
+    """
+    Parses the given base image arguments.
+    :param values: base images, each optionally given for a stage in the form `stage=image`
+    :return: the `base_image` and `stage_base_images` of the configuration
+    :raises ValueError: raised if more than one base image is given without a stage, or if one is given for a stage
+    more than once
+    """
+    base_image = None
+    stage_base_images = {}
+    for value in values:
+        # Image references cannot contain "="
+        if "=" in value:
+            stage, image = value.split("=", 1)
+            if stage in stage_base_images:
+                raise ValueError(f"Base image given for stage {stage} more than once")
+            stage_base_images[stage] = image
+        else:
+            if base_image is not None:
+                raise ValueError(f"Base image given more than once (use stage=image for stages): {value}")
+            base_image = value
+    return dict(base_image=base_image, stage_base_images=stage_base_images)
+
+
+def _create_specification(configuration: SubcommandCliConfiguration) -> Dict:
+    """
+    Creates the build specification (see `create_core`) from the given configuration, with absolute file locations so
+    that it can be run from any directory.
+    :param configuration: configuration with the build options
+    :return: the build specification
+    """
+    import_from = configuration.import_from
+    if os.path.exists(import_from):
+        import_from = os.path.abspath(import_from)
+    return dict(import_from=import_from,
+                additional_files={os.path.abspath(src): dest for src, dest in configuration.additional_files.items()},
+                patches={os.path.abspath(src): dest for src, dest in configuration.patches.items()},
+                dockerfile_location=configuration.dockerfile_location, base_image=configuration.base_image,
+                stage_base_images=configuration.stage_base_images, target=configuration.target,
+                pin_base_images=configuration.pin_base_images, sparse_paths=configuration.sparse_paths,
+                arg_defaults=configuration.arg_defaults, labels=configuration.labels)
+
+
+def _get_or_default(value: Optional[int], default: int) -> int:
+    """
+    Gets the given parsed value, or the given default if the value was not given.
+    :param value: the parsed value (`None` if not given)
+    :param default: the default
+    :return: the value or default
+    """
+    return value if value is not None else default
+
+
+def _create_caching_kwargs(configuration: CachingCliConfiguration) -> Dict:
+    """
+    Creates the caching keyword arguments for `PatchworkDocker` from the given configuration.
+    :param configuration: configuration with caching options
+    :return: keyword arguments
+    """
+    from patchworkdocker.caches import GitMirrorCache, PreparedContextCache, ImportCache
+    from patchworkdocker.importers import ImporterResources
+    from patchworkdocker.refs import RefResolver
+
+    git_mirror_cache = None
+    if configuration.git_cache_directory is not None:
+        git_mirror_cache = GitMirrorCache(configuration.git_cache_directory, configuration.git_cache_max_size)
+    context_cache = None
+    if configuration.cache_directory is not None:
+        context_cache = PreparedContextCache(configuration.cache_directory, configuration.cache_max_size)
+    import_cache = None
+    if configuration.import_cache_directory is not None:
+        import_cache = ImportCache(configuration.import_cache_directory, configuration.cache_max_size)
+    # Shared between cores, so references are resolved once per run
+    ref_resolver = RefResolver(lockfile_location=configuration.lockfile_location, update=configuration.update_lockfile)
+    # Shared between cores, so connections are reused between imports
+    importer_resources = ImporterResources()
+    return dict(git_mirror_cache=git_mirror_cache, git_shallow=configuration.shallow, context_cache=context_cache,
+                import_cache=import_cache, ref_resolver=ref_resolver, importer_resources=importer_resources)
+
+
 def main(cli_arguments: List[str]):
     """
     Main.
@@ -221,15 +648,29 @@ def main(cli_arguments: List[str]):
 
     # XXX: Ideally, we would use `configuration: Intersect[ContextUsingCliConfiguration, SubcommandCliConfiguration]
     # but multiple bounds are sadly not supported in Python's type hinting: https://github.com/python/typing/issues/213
-    def create_core(configuration: Union[PrepareCliConfiguration, BuildCliConfiguration]) -> PatchworkDocker:
-        return PatchworkDocker(configuration.import_from, additional_files=configuration.additional_files,
-                               patches=configuration.patches, dockerfile_location=configuration.dockerfile_location,
-                               base_image=cli_configuration.base_image)
-
-    {
-        BuildCliConfiguration: lambda: build(create_core(cli_configuration), cli_configuration),
-        PrepareCliConfiguration: lambda: prepare(create_core(cli_configuration), cli_configuration),
-    }[type(cli_configuration)]()
+    def run_locally(action: Callable[["PatchworkDocker", Any], None],
+                    configuration: Union[PrepareCliConfiguration, BuildCliConfiguration]):
+        from patchworkdocker.batch import create_core
+        caching_kwargs = _create_caching_kwargs(configuration)
+        with caching_kwargs["importer_resources"]:
+            action(create_core(_create_specification(configuration), os.getcwd(), **caching_kwargs), configuration)
+
+    run = {
+        BuildCliConfiguration: lambda: forward_to_server(cli_configuration) or run_locally(build, cli_configuration),
+        PrepareCliConfiguration: lambda: forward_to_server(cli_configuration)
+        or run_locally(prepare, cli_configuration),
+        BuildManyCliConfiguration: lambda: build_many(cli_configuration),
+        ServeCliConfiguration: lambda: serve(cli_configuration)
+    }[type(cli_configuration)]
+
+    if not cli_configuration.profile:
+        run()
+        return
+    with profiling(Profiler()) as profiler:
+        try:
+            run()
+        finally:
+            output_profile(profiler, cli_configuration)
 
 
 def entrypoint():
@@ -0,0 +1,132 @@
+import json
+import socket
+from http.client import HTTPConnection
+from typing import Dict, Any, List
+
+from patchworkdocker.errors import PatchworkDockerError
+
+_WAIT_INTERVAL = 30
+_FINISHED_STATUSES = {"succeeded", "failed", "cancelled"}
+
+
+class ServerError(PatchworkDockerError):
+    """
+    Raised when the server rejects a request.
+    """
+
+
+class ServerClient:
+    """
+    Client of a `PatchworkDockerServer`.
+    """
+    def __init__(self, socket_location: str, timeout: float=None):
+        """
+        Constructor.
+        :param socket_location: location of the Unix socket that the server is listening on
+        :param timeout: timeout in seconds of blocking socket operations (no timeout if `None`)
+        """
+        self.socket_location = socket_location
+        self.timeout = timeout
+
+    def is_running(self) -> bool:
+        """
+        Gets whether the server is running.
+        :return: whether the server is running
+        """
+        try:
+            self._request("GET", "/health")
+            return True
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+    def submit(self, action: str, specification: Dict[str, Any], *, options: Dict[str, Any]=None,
+               priority: int=0) -> Dict[str, Any]:
+        """
+        Submits a job to the server (see `PatchworkDockerServer.submit`).
+        :param action: what the job does (`prepare` or `build`)
+        :param specification: specification of the build, where file locations must be absolute
+        :param options: options of the action
+        :param priority: priority of the job (jobs with a higher priority are run first)
+        :return: the submitted job
+        :raises ServerError: raised if the server rejects the job
+        """
+        return self._request("POST", "/jobs", dict(action=action, specification=specification,
+                                                   options=options if options is not None else {}, priority=priority))
+
+    def get_job(self, job_id: str, wait: float=0) -> Dict[str, Any]:
+        """
+        Gets the job with the given ID.
+        :param job_id: ID of the job
+        :param wait: maximum time in seconds to wait for the job to finish before getting it
+        :return: the job
+        :raises ServerError: raised if there is no job with the ID
+        """
+        return self._request("GET", f"/jobs/{job_id}?wait={wait}")
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """
+        Lists the jobs that have been submitted to the server.
+        :return: the jobs
+        """
+        return self._request("GET", "/jobs")
+
+    def wait(self, job_id: str) -> Dict[str, Any]:
+        """
+        Waits for the job with the given ID to finish.
+        :param job_id: ID of the job
+        :return: the finished job
+        :raises ServerError: raised if there is no job with the ID
+        """
+        while True:
+            job = self.get_job(job_id, wait=_WAIT_INTERVAL)
+            if job["status"] in _FINISHED_STATUSES:
+                return job
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        """
+        Cancels the job with the given ID.
+        :param job_id: ID of the job
+        :return: the job
+        :raises ServerError: raised if there is no job with the ID
+        """
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def _request(self, method: str, path: str, body: Any=None) -> Any:
+        """
+        Makes a request to the server.
+        :param method: HTTP method
+        :param path: path of the request
+        :param body: body of the request, serialised as JSON (no body if `None`)
+        :return: the deserialised JSON body of the response
+        :raises ServerError: raised if the server responds with an error
+        """
+        connection = _UnixHTTPConnection(self.socket_location, self.timeout)
+        try:
+            headers = {}
+            content = None
+            if body is not None:
+                content = json.dumps(body).encode()
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, body=content, headers=headers)
+            response = connection.getresponse()
+            response_body = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise ServerError(response_body.get("error", f"Server responded with {response.status}"))
+        return response_body
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+    def __init__(self, socket_location: str, timeout: float=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_location = socket_location
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_location)
@@ -0,0 +1,488 @@
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Tuple, Optional, BinaryIO, Dict, Iterable, Set
+
+from patchworkdocker.cancellation import check_cancelled, submit_cancellable
+from patchworkdocker.copying import clone_file
+from patchworkdocker.dockerignore import DockerIgnore, walk
+from patchworkdocker.profiling import record
+
+_BLOCK_SIZE = tarfile.BLOCKSIZE
+_READ_SIZE = 1024 * 1024
+
+ContextMember = Tuple[tarfile.TarInfo, Optional[BinaryIO]]
+
+
+class ContextBase(metaclass=ABCMeta):
+    """
+    Read-only tree of files that a build context is based on.
+    """
+    @abstractmethod
+    def get_members(self, dockerignore: DockerIgnore=None) -> Iterator[ContextMember]:
+        """
+        Gets the members of the tree, in the form of tar members with their contents.
+
+        Contents must be read before the next member is requested.
+        :param dockerignore: rules for members that are excluded (nothing is excluded if `None`)
+        :return: iterator of tar member information and contents (`None` if the member has no contents)
+        """
+
+    @abstractmethod
+    def is_directory(self, path: str) -> bool:
+        """
+        Gets whether the given path is a directory in the tree.
+        :param path: path relative to the root of the tree
+        :return: whether the path is a directory
+        """
+
+    @abstractmethod
+    def is_file(self, path: str) -> bool:
+        """
+        Gets whether the given path is a regular file in the tree.
+        :param path: path relative to the root of the tree
+        :return: whether the path is a file
+        """
+
+    @abstractmethod
+    def extract(self, path: str, destination: str) -> bool:
+        """
+        Extracts the file at the given path in the tree to the given destination.
+        :param path: path relative to the root of the tree
+        :param destination: location to extract to
+        :return: whether the file existed
+        """
+
+    @abstractmethod
+    def read(self, path: str) -> Optional[bytes]:
+        """
+        Reads the file at the given path in the tree.
+        :param path: path relative to the root of the tree
+        :return: contents of the file, or `None` if there is no such file
+        """
+
+    def get_location(self, path: str) -> Optional[str]:
+        """
+        Gets the location of the file at the given path in the tree on the local file system, if it is stored there.
+        :param path: path relative to the root of the tree
+        :return: location of the file, or `None` if the file is not on the local file system
+        """
+        return None
+
+
+class DirectoryContextBase(ContextBase):
+    """
+    Build context base that is a directory on the local file system.
+    """
+    def __init__(self, directory: str):
+        """
+        Constructor.
+        :param directory: the directory
+        """
+        self.directory = os.path.abspath(directory)
+
+    def get_members(self, dockerignore: DockerIgnore=None) -> Iterator[ContextMember]:
+        for path, entry in walk(self.directory, dockerignore):
+            yield from _get_file_system_members(entry.path, path)
+
+    def is_directory(self, path: str) -> bool:
+        return os.path.isdir(os.path.join(self.directory, path))
+
+    def is_file(self, path: str) -> bool:
+        return os.path.isfile(os.path.join(self.directory, path))
+
+    def extract(self, path: str, destination: str) -> bool:
+        location = os.path.join(self.directory, path)
+        if not os.path.isfile(location):
+            return False
+        clone_file(location, destination)
+        return True
+
+    def get_location(self, path: str) -> Optional[str]:
+        location = os.path.join(self.directory, path)
+        return location if os.path.lexists(location) else None
+
+    def read(self, path: str) -> Optional[bytes]:
+        location = os.path.join(self.directory, path)
+        if not os.path.isfile(location):
+            return None
+        with open(location, "rb") as file:
+            return file.read()
+
+
+class GitContextBase(ContextBase):
+    """
+    Build context base that is read directly from the objects of a commit in a git repository.
+    """
+    def __init__(self, repository_location: str, commit: str, paths: Iterable[str]=None):
+        """
+        Constructor.
+        :param repository_location: location of the (possibly bare) repository
+        :param commit: the commit to read
+        :param paths: paths to restrict the tree to (everything if `None`)
+        """
+        from git import Repo
+
+        self.repository = Repo(repository_location)
+        self.commit = self.repository.commit(commit)
+        self.paths = list(paths) if paths is not None else None
+
+    def get_members(self, dockerignore: DockerIgnore=None) -> Iterator[ContextMember]:
+        # Read from the commit's objects, rather than with `git archive`, which applies the repository's export
+        # attributes (e.g. `export-ignore`), so the members are the same as the files of a checkout
+        command = ["git", "ls-tree", "-r", "-t", "-z", "--full-tree", self.commit.hexsha]
+        if self.paths is not None:
+            command += ["--"] + [os.path.normpath(path) for path in self.paths if os.path.normpath(path) != "."]
+        listing = subprocess.run(command, cwd=self.repository.git_dir, stdout=subprocess.PIPE)
+        if listing.returncode != 0:
+            raise RuntimeError(f"Could not list {self.commit.hexsha} in {self.repository.git_dir}")
+
+        process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.repository.git_dir,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        completed = False
+        try:
+            for entry in listing.stdout.split(b"\0"):
+                if entry == b"":
+                    continue
+                information, path = entry.split(b"\t", 1)
+                mode, object_type, sha = information.decode().split(" ")
+                member = tarfile.TarInfo(os.fsdecode(path))
+                member.mtime = self.commit.committed_date
+                if dockerignore is not None and dockerignore.is_excluded(member.name):
+                    continue
+                # Submodules (`commit` entries) are empty directories, as in a checkout that does not initialise them
+                if object_type != "blob":
+                    member.type = tarfile.DIRTYPE
+                    member.mode = 0o755
+                    yield member, None
+                    continue
+                blob = _GitBlobReader(process, sha)
+                if stat.S_ISLNK(int(mode, 8)):
+                    member.type = tarfile.SYMTYPE
+                    member.mode = 0o777
+                    member.linkname = os.fsdecode(blob.read())
+                    blob.finish()
+                    yield member, None
+                else:
+                    member.mode = 0o755 if int(mode, 8) & stat.S_IXUSR else 0o644
+                    member.size = blob.size
+                    yield member, blob
+                    blob.finish()
+            completed = True
+        finally:
+            process.stdin.close()
+            process.stdout.close()
+            # Git is stopped by the broken pipe if the members are not all read (e.g. when the stream is cancelled),
+            # which must not mask why they were not
+            if process.wait() != 0 and completed:
+                raise RuntimeError(f"Could not read {self.commit.hexsha} from {self.repository.git_dir}")
+
+    def is_directory(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        if path == ".":
+            return True
+        try:
+            return (self.commit.tree / path).type == "tree"
+        except KeyError:
+            return False
+
+    def is_file(self, path: str) -> bool:
+        try:
+            blob = self.commit.tree / os.path.normpath(path)
+        except KeyError:
+            return False
+        return blob.type == "blob" and stat.S_ISREG(blob.mode)
+
+    def extract(self, path: str, destination: str) -> bool:
+        try:
+            blob = self.commit.tree / os.path.normpath(path)
+        except KeyError:
+            return False
+        if blob.type != "blob":
+            return False
+        with open(destination, "wb") as file:
+            blob.stream_data(file)
+        os.chmod(destination, blob.mode & 0o777)
+        return True
+
+    def read(self, path: str) -> Optional[bytes]:
+        try:
+            blob = self.commit.tree / os.path.normpath(path)
+        except KeyError:
+            return None
+        return blob.data_stream.read() if blob.type == "blob" else None
+
+
+class _GitBlobReader:
+    """
+    Reader of the contents of a blob, from a `git cat-file --batch` process.
+    """
+    def __init__(self, process: subprocess.Popen, sha: str):
+        """
+        Constructor.
+        :param process: the process, which must not be reading another blob
+        :param sha: SHA of the blob
+        """
+        self.process = process
+        process.stdin.write(f"{sha}\n".encode())
+        process.stdin.flush()
+        header = process.stdout.readline().decode().split()
+        if len(header) != 3 or header[1] != "blob":
+            raise RuntimeError(f"Could not read blob {sha}: {' '.join(header)}")
+        self.size = int(header[2])
+        self._remaining = self.size
+
+    def read(self, size: int=-1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self.process.stdout.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def finish(self):
+        """
+        Reads the rest of the blob, so the process can read the next one.
+        """
+        while self._remaining > 0:
+            if self.read(_READ_SIZE) == b"":
+                raise RuntimeError("Blob ended before all of its contents were read")
+        # The contents are followed by a line feed
+        self.process.stdout.read(1)
+
+
+class StreamingContext:
+    """
+    Build context that is streamed as a tar, made of a read-only base overlaid with files from the local file system.
+
+    Files in the base are never copied to disk, apart from those that are to be modified (see `get_writable`).
+    """
+    def __init__(self, base: ContextBase, upper_directory: str):
+        """
+        Constructor.
+
+        Set `dockerignore` to exclude files from the streamed context.
+        :param base: the tree the context is based on
+        :param upper_directory: directory in which copies of files that are modified are kept
+        """
+        self.base = base
+        self.upper_directory = upper_directory
+        self.overrides: Dict[str, str] = {}
+        # Paths of files in the base that have been removed from the context
+        self.removed: Set[str] = set()
+        self.dockerignore: Optional[DockerIgnore] = None
+
+    def add(self, source: str, destination: str):
+        """
+        Adds the given file or directory to the context, replacing any existing files.
+
+        Follows the semantics of `copy_file`: a file added to an existing directory is placed inside it, and a
+        directory is merged into an existing directory.
+        :param source: location of the file or directory on the local file system
+        :param destination: path relative to the root of the context
+        """
+        destination = os.path.normpath(destination)
+        if os.path.isfile(source):
+            if self.is_directory(destination):
+                destination = os.path.join(destination, os.path.basename(source))
+            self.overrides[destination] = source
+            self.removed.discard(destination)
+        else:
+            for root, directories, files in os.walk(source):
+                for name in directories + files:
+                    location = os.path.join(root, name)
+                    path = os.path.normpath(os.path.join(destination, os.path.relpath(location, source)))
+                    self.overrides[path] = location
+                    self.removed.discard(path)
+
+    def is_directory(self, path: str) -> bool:
+        """
+        Gets whether the given path is a directory in the context.
+        :param path: path relative to the root of the context
+        :return: whether the path is a directory
+        """
+        path = os.path.normpath(path)
+        if path in self.overrides:
+            return os.path.isdir(self.overrides[path])
+        return path not in self.removed and self.base.is_directory(path)
+
+    def is_file(self, path: str) -> bool:
+        """
+        Gets whether the given path is a regular file in the context.
+        :param path: path relative to the root of the context
+        :return: whether the path is a file
+        """
+        path = os.path.normpath(path)
+        if path in self.overrides:
+            return os.path.isfile(self.overrides[path])
+        return path not in self.removed and self.base.is_file(path)
+
+    def read(self, path: str) -> Optional[bytes]:
+        """
+        Reads the file at the given path in the context.
+        :param path: path relative to the root of the context
+        :return: contents of the file, or `None` if there is no such file
+        """
+        path = os.path.normpath(path)
+        if path in self.overrides:
+            if not os.path.isfile(self.overrides[path]):
+                return None
+            with open(self.overrides[path], "rb") as file:
+                return file.read()
+        return self.base.read(path) if path not in self.removed else None
+
+    def get_writable(self, path: str) -> str:
+        """
+        Gets a location on the local file system where the file at the given path can be modified.
+
+        The file is copied into the upper directory on first use.
+        :param path: path of the file relative to the root of the context
+        :return: location of the writable file
+        :raises FileNotFoundError: raised if the file is not in the context
+        """
+        path = os.path.normpath(path)
+        upper_location = os.path.join(self.upper_directory, path)
+        if self.overrides.get(path) == upper_location:
+            return upper_location
+        os.makedirs(os.path.dirname(upper_location), exist_ok=True)
+        if path in self.overrides:
+            clone_file(self.overrides[path], upper_location)
+        elif path in self.removed or not self.base.extract(path, upper_location):
+            raise FileNotFoundError(f"File not in build context: {path}")
+        self.overrides[path] = upper_location
+        return upper_location
+
+    def create_writable(self, path: str) -> str:
+        """
+        Gets a location on the local file system where a file that is not in the context can be created, so that it is
+        added to the context at the given path.
+        :param path: path of the file relative to the root of the context
+        :return: location at which to create the file (in the upper directory)
+        :raises FileExistsError: raised if there is already a file or directory at the path in the context
+        """
+        path = os.path.normpath(path)
+        if self.is_file(path) or self.is_directory(path):
+            raise FileExistsError(f"File already in build context: {path}")
+        upper_location = os.path.join(self.upper_directory, path)
+        os.makedirs(os.path.dirname(upper_location), exist_ok=True)
+        self.overrides[path] = upper_location
+        self.removed.discard(path)
+        return upper_location
+
+    def remove(self, path: str):
+        """
+        Removes the file at the given path from the context.
+        :param path: path of the file relative to the root of the context
+        """
+        path = os.path.normpath(path)
+        location = self.overrides.pop(path, None)
+        if location is not None and location.startswith(os.path.join(self.upper_directory, "")) \
+                and os.path.lexists(location):
+            os.remove(location)
+        self.removed.add(path)
+
+    def get_members(self) -> Iterator[ContextMember]:
+        """
+        Gets the members of the context, with the files that have been added or modified taking precedence.
+        :return: iterator of tar member information and contents
+        """
+        for member, content in self.base.get_members(self.dockerignore):
+            path = os.path.normpath(member.name)
+            if path not in self.overrides and path not in self.removed:
+                yield member, content
+        for path in sorted(self.overrides.keys()):
+            if self.dockerignore is None or not self.dockerignore.is_excluded(path):
+                yield from _get_file_system_members(self.overrides[path], path)
+
+    def stream(self) -> Iterator[bytes]:
+        """
+        Streams the context as a tar.
+        :return: iterator of tar data
+        """
+        return stream_tar(self.get_members())
+
+    def materialise(self, destination: str, *, link: bool=False, max_workers: int=None):
+        """
+        Writes the merged view of the context to the given directory.
+
+        Files that are on the local file system are shared rather than copied where possible (see `clone_file`).
+        :param destination: empty directory to write the context to
+        :param link: whether files may be hardlinks to those in the base and upper directory, in which case they must
+        be copied up (see `copy_up`) before being modified in place
+        :param max_workers: maximum number of files to copy at once (Python's default for thread pools if `None`)
+        """
+        files = 0
+        size = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for member, content in self.get_members():
+                path = os.path.normpath(member.name)
+                location = os.path.join(destination, path)
+                os.makedirs(os.path.dirname(location), exist_ok=True)
+                if member.isdir():
+                    os.makedirs(location, exist_ok=True)
+                elif member.issym():
+                    os.symlink(member.linkname, location)
+                else:
+                    files += 1
+                    size += member.size
+                    source = self.overrides[path] if path in self.overrides else self.base.get_location(path)
+                    if source is not None:
+                        futures.append(submit_cancellable(executor, clone_file, source, location, link=link))
+                    else:
+                        with open(location, "xb") as file:
+                            shutil.copyfileobj(content, file)
+                        os.chmod(location, member.mode)
+            for future in futures:
+                future.result()
+        record(files=files, bytes_written=size)
+
+
+def stream_tar(members: Iterable[ContextMember]) -> Iterator[bytes]:
+    """
+    Streams the given members as a tar, without buffering whole files in memory.
+    :param members: tar member information and contents
+    :return: iterator of tar data
+    """
+    for member, content in members:
+        check_cancelled()
+        yield member.tobuf(format=tarfile.PAX_FORMAT)
+        if content is not None:
+            remaining = member.size
+            while remaining > 0:
+                data = content.read(min(_READ_SIZE, remaining))
+                if len(data) == 0:
+                    raise IOError(f"Unexpected end of file when reading {member.name}")
+                remaining -= len(data)
+                yield data
+            if member.size % _BLOCK_SIZE != 0:
+                yield b"\0" * (_BLOCK_SIZE - member.size % _BLOCK_SIZE)
+    yield b"\0" * (_BLOCK_SIZE * 2)
+
+
+def _get_file_system_members(location: str, name: str) -> Iterator[ContextMember]:
+    """
+    Gets the tar member for the given location on the local file system (the contents of directories are not
+    included).
+    :param location: location of the file
+    :param name: name of the file in the tar
+    :return: iterator of tar member information and contents
+    """
+    status = os.lstat(location)
+    member = tarfile.TarInfo(name)
+    member.mode = stat.S_IMODE(status.st_mode)
+    member.mtime = int(status.st_mtime)
+    if stat.S_ISLNK(status.st_mode):
+        member.type = tarfile.SYMTYPE
+        member.linkname = os.readlink(location)
+        yield member, None
+    elif stat.S_ISDIR(status.st_mode):
+        member.type = tarfile.DIRTYPE
+        yield member, None
+    else:
+        member.size = status.st_size
+        with open(location, "rb") as file:
+            yield member, file
@@ -0,0 +1,192 @@
+import fcntl
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkstemp
+from typing import BinaryIO, List, Tuple
+
+from patchworkdocker.cancellation import check_cancelled, submit_cancellable
+from patchworkdocker.dockerignore import DockerIgnore, walk
+from patchworkdocker.profiling import record, is_profiling
+
+# Linux ioctl to share a file's extents with another file on copy-on-write file systems (`_IOW(0x94, 9, int)`)
+_FICLONE = 0x40049409
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def clone_file(source: str, destination: str, *, link: bool=False):
+    """
+    Copies the given regular file to the given destination, sharing the contents rather than copying them where
+    possible.
+
+    The contents are reflinked where the file system supports it, else hardlinked if allowed, else copied in the
+    kernel. An existing destination is replaced, rather than written to, so files that it is linked to are not changed.
+    :param source: file to copy
+    :param destination: location of the copy
+    :param link: whether the copy may be a hardlink to the source, in which case it must not be modified in place (see
+    `copy_up`)
+    """
+    if not os.path.lexists(destination):
+        _create_file(source, destination, link)
+        return
+    # The new file is created next to the destination, so it can atomically replace it
+    descriptor, temp_location = mkstemp(dir=os.path.dirname(destination), prefix=f".{os.path.basename(destination)}.")
+    os.close(descriptor)
+    os.remove(temp_location)
+    try:
+        _create_file(source, temp_location, link)
+        os.replace(temp_location, destination)
+    except BaseException:
+        if os.path.lexists(temp_location):
+            os.remove(temp_location)
+        raise
+
+
+def clone_tree(source: str, destination: str, *, link: bool=False, dockerignore: DockerIgnore=None,
+               max_workers: int=None):
+    """
+    Copies the given directory tree to the given destination, sharing file contents where possible (see `clone_file`).
+
+    Symlinks are copied as symlinks. Files are copied concurrently.
+    :param source: directory to copy
+    :param destination: where to copy the directory to (merged into if it already exists, replacing files)
+    :param link: whether copied files may be hardlinks to the source files
+    :param dockerignore: rules for files in the tree that are not copied (everything is copied if `None`)
+    :param max_workers: maximum number of files to copy at once (Python's default for thread pools if `None`)
+    """
+    created_directories: List[Tuple[str, str]] = []
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+        created_directories.append((source, destination))
+
+    profiling = is_profiling()
+    size = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for path, entry in walk(source, dockerignore):
+            check_cancelled()
+            destination_path = os.path.join(destination, path)
+            if entry.is_dir(follow_symlinks=False):
+                if not os.path.isdir(destination_path):
+                    os.mkdir(destination_path)
+                    created_directories.append((entry.path, destination_path))
+                continue
+            # The parent directory is not given by the walk if it is excluded but something in it is not
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            if entry.is_symlink():
+                if os.path.lexists(destination_path):
+                    os.remove(destination_path)
+                os.symlink(os.readlink(entry.path), destination_path)
+            else:
+                futures.append(submit_cancellable(executor, clone_file, entry.path, destination_path, link=link))
+                if profiling:
+                    size += entry.stat(follow_symlinks=False).st_size
+        for future in futures:
+            future.result()
+    record(files=len(futures), bytes_written=size)
+
+    # Directory times are set last, as adding to a directory changes them
+    for source_path, destination_path in reversed(created_directories):
+        shutil.copystat(source_path, destination_path)
+
+
+def clear_directory(directory: str):
+    """
+    Removes everything in the given directory.
+    :param directory: the directory
+    """
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+
+
+def copy_up(location: str):
+    """
+    Ensures that the given file is not shared with any other file (e.g. via a hardlink), so it can be modified in
+    place without changing others.
+    :param location: location of the file
+    """
+    status = os.lstat(location)
+    if stat.S_ISREG(status.st_mode) and status.st_nlink > 1:
+        clone_file(location, location)
+
+
+def _create_file(source: str, destination: str, link: bool):
+    """
+    Creates the given destination with the contents of the given source file.
+    :param source: file to copy
+    :param destination: location of the new file (must not exist)
+    :param link: whether the new file may be a hardlink to the source
+    """
+    with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+        if _reflink(source_file, destination_file):
+            copied = True
+        elif link:
+            copied = False
+        else:
+            _copy_contents(source_file, destination_file)
+            copied = True
+    if copied:
+        shutil.copystat(source, destination)
+        return
+    os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+            _copy_contents(source_file, destination_file)
+        shutil.copystat(source, destination)
+
+
+def _reflink(source_file: BinaryIO, destination_file: BinaryIO) -> bool:
+    """
+    Makes the given destination file share the contents of the given source file, if the file system supports it.
+    :param source_file: file to share the contents of
+    :param destination_file: empty file to share the contents with
+    :return: whether the contents are now shared
+    """
+    try:
+        fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _copy_contents(source_file: BinaryIO, destination_file: BinaryIO):
+    """
+    Copies the contents of the given source file to the given empty destination file, without passing the data through
+    user space where possible.
+    :param source_file: file to copy, read from the start
+    :param destination_file: empty file to copy to
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(source_file.fileno(), destination_file.fileno(), _COPY_CHUNK_SIZE) > 0:
+                pass
+            return
+        except OSError:
+            _reset(source_file, destination_file)
+    try:
+        offset = 0
+        while True:
+            sent = os.sendfile(destination_file.fileno(), source_file.fileno(), offset, _COPY_CHUNK_SIZE)
+            if sent == 0:
+                return
+            offset += sent
+    except OSError:
+        _reset(source_file, destination_file)
+    shutil.copyfileobj(source_file, destination_file)
+
+
+def _reset(source_file: BinaryIO, destination_file: BinaryIO):
+    """
+    Resets the given files after a partial copy between them.
+    :param source_file: file that was copied from
+    :param destination_file: file that was copied to, which is emptied
+    """
+    source_file.seek(0)
+    destination_file.seek(0)
+    destination_file.truncate()
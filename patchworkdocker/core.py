@@ -1,20 +1,67 @@
+import json
 import os
 import shutil
-from typing import Dict, Optional
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from tempfile import mkdtemp
+from types import MappingProxyType
+from typing import Dict, Optional, Iterable, List, Tuple, Iterator, Callable, TYPE_CHECKING
 
-from frozendict import frozendict
 from logzero import logger
 
-from patchworkdocker.docker_images import build_docker_image
-from patchworkdocker.importers import ImporterFactory
-from patchworkdocker.modifiers import copy_file, apply_patch, change_base_image
+from patchworkdocker.build_logs import BuildEventListener
+from patchworkdocker.caches import GitMirrorCache, PreparedContextCache, ImportCache
+from patchworkdocker.cancellation import check_cancelled
+from patchworkdocker.contexts import StreamingContext, DirectoryContextBase, stream_tar
+from patchworkdocker.copying import clear_directory
+from patchworkdocker.docker_images import build_docker_image_from_stream, find_image_with_label, tag_image, \
+    get_image_digest, create_docker_client, ImagePuller, INPUT_DIGEST_LABEL
+from patchworkdocker.dockerfiles import DockerfileTransform, SetBaseImage, SelectTarget, PinBaseImages
+from patchworkdocker.dockerignore import DockerIgnore, DOCKERIGNORE_FILE_NAME, walk
+from patchworkdocker.fingerprints import hash_path, hash_text
+from patchworkdocker.importers import ImporterFactory, Importer, ImporterResources
+from patchworkdocker.modifiers import copy_file, apply_patches, transform_dockerfile, get_base_images, \
+    get_patched_files, get_patch_set_path_candidates, PatchApplicationError
+from patchworkdocker.profiling import span
+from patchworkdocker.refs import RefResolver
+from patchworkdocker.updates import UpdateState, ModificationRecord, UPDATE_STATE_DIRECTORY_NAME, \
+    get_modifications_to_redo
 
-_importer_factory = ImporterFactory()
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+_EMPTY_MAPPING = MappingProxyType({})
+
+
+def _read_file(location: str) -> Optional[str]:
+    """
+    Reads the given file, if it exists.
+    :param location: location of the file
+    :return: the file's contents, or `None` if it is not a file
+    """
+    if not os.path.isfile(location):
+        return None
+    with open(location, "r") as file:
+        return file.read()
+
+
+@dataclass(frozen=True)
+class _Modification:
+    """
+    Modification of the imported materials.
+    """
+    # `file` to add a file, `patch` to apply a patch or `dockerfile` to transform the Dockerfile
+    kind: str
+    source: Optional[str]
+    destination: str
+    transforms: Tuple[DockerfileTransform, ...] = ()
 
 
 class PatchworkDocker:
     """
     Builds patchwork Docker images.
+
+    Can be used as a context manager, which closes the core's own importer resources (see `close`) on exit.
     """
     @property
     def dockerfile_location(self) -> str:
@@ -26,8 +73,14 @@ class PatchworkDocker:
             raise ValueError(f"Dockerfile location must be relative to the context root: {location}")
         self._dockerfile_location = location
 
-    def __init__(self, import_repository_from: str, *, additional_files: Dict[str, Optional[str]]=(),
-                 patches: Dict[str, str]=frozendict(), dockerfile_location: str="Dockerfile", base_image: str=None):
+    def __init__(self, import_repository_from: str, *, additional_files: Dict[str, Optional[str]]=_EMPTY_MAPPING,
+                 patches: Dict[str, str]=_EMPTY_MAPPING, dockerfile_location: str="Dockerfile", base_image: str=None,
+                 git_mirror_cache: GitMirrorCache=None, git_shallow: bool=False,
+                 git_sparse_paths: Optional[Iterable[str]]=None, context_cache: PreparedContextCache=None,
+                 importer: Importer=None, import_cache: ImportCache=None, ref_resolver: RefResolver=None,
+                 dockerfile_transforms: Iterable[DockerfileTransform]=(),
+                 stage_base_images: Dict[str, str]=_EMPTY_MAPPING, target: str=None, pin_base_images: bool=False,
+                 importer_resources: ImporterResources=None):
         """
         Constructor.
         :param import_repository_from: where to import the starting materials for the image from
@@ -35,9 +88,30 @@ class PatchworkDocker:
         value (if given) is the relative location in the build context (added in the order given, overwrites possible)
         :param patches: patches to apply to files in the build context, where the key is the location of the patch file
         and the value is the location of the file to apply it to, relative to the build context root (applied in the
-        order given)
+        order given), or of a directory (e.g. `.`) that the paths of the files in a multi-file patch are relative to
         :param dockerfile_location: location of the Dockerfile to build, relative to the root of the repository
-        :param base_image: Docker base image to change to
+        :param base_image: Docker base image to change to (that of the stage the final or target stage is based on)
+        :param git_mirror_cache: cache of mirrors to use when importing from a git repository (not used if `None`)
+        :param git_shallow: whether to only fetch the required commit when importing from a git repository
+        :param git_sparse_paths: paths, in addition to the Dockerfile's directory and the destinations of additional
+        files and patches, to checkout when importing from a git repository (the whole repository is checked out if
+        `None`)
+        :param context_cache: cache of prepared build contexts to use (not used if `None`)
+        :param importer: importer to import the repository with (determined from where the repository is imported from
+        if `None`)
+        :param import_cache: cache of imported repositories to share between overlay builds (see `prepare_overlay`)
+        :param ref_resolver: resolves the commit to import when importing from a git repository (see `RefResolver`)
+        :param dockerfile_transforms: transforms to apply to the Dockerfile, in order, after the base image is changed
+        (see `patchworkdocker.dockerfiles`)
+        :param stage_base_images: Docker base images to change stages to, where the key is the name or index of the
+        stage and the value is the image
+        :param target: name or index of the stage to build, which is made the final stage (stages that it does not need
+        are removed)
+        :param pin_base_images: whether to pin the images that the Dockerfile's stages are built from to their digests
+        in the registry when the context is prepared (contexts reused from the context cache keep the digests they were
+        prepared with)
+        :param importer_resources: resources (e.g. HTTP sessions) for the importer to share with those of other cores,
+        so that connections are reused between imports (the core has its own, which are closed by `close`, if `None`)
         """
         self._dockerfile_location = None
         self.import_repository_from = import_repository_from
@@ -45,60 +119,633 @@ class PatchworkDocker:
         self.patches = patches
         self.dockerfile_location = dockerfile_location
         self.base_image = base_image
+        self.git_mirror_cache = git_mirror_cache
+        self.git_shallow = git_shallow
+        self.git_sparse_paths = git_sparse_paths
+        self.context_cache = context_cache
+        self.importer = importer
+        self.import_cache = import_cache
+        self.ref_resolver = ref_resolver
+        self.dockerfile_transforms = list(dockerfile_transforms)
+        self.stage_base_images = stage_base_images
+        self.target = target
+        self.pin_base_images = pin_base_images
+        self._owns_importer_resources = importer_resources is None
+        self.importer_resources = importer_resources if importer_resources is not None else ImporterResources()
+        self._importer_factory: Optional[ImporterFactory] = None
+
+    def close(self):
+        """
+        Closes the core's own importer resources (resources that were given to the core are left open).
+        """
+        if self._owns_importer_resources:
+            self.importer_resources.close()
+
+    def __enter__(self) -> "PatchworkDocker":
+        return self
 
-    def build(self, image_name: str, build_directory: str=None):
+    def __exit__(self, *args):
+        self.close()
+
+    def build(self, image_name: str, build_directory: str=None, *, docker_client: "DockerClient"=None,
+              stream_context: bool=False, overlay: bool=False, reuse_image: bool=True,
+              on_build_event: BuildEventListener=None, update: bool=False):
         """
         Builds the patchworked Docker image.
         :param image_name: image tag (can optionally include a version tag)
         :param build_directory: directory to build in
+        :param docker_client: Docker client to build with (created from the environment if `None`)
+        :param stream_context: whether to stream the build context to the Docker daemon, reading unmodified files
+        straight from where they are imported from (or the import cache), rather than preparing a copy of the context
+        first
+        :param overlay: whether to prepare the build directory as an overlay (see `prepare`)
+        :param reuse_image: whether to tag an existing image that was built from the same inputs, rather than building
+        (see `get_input_digest`), in which case a built image is labelled with the digest of its inputs
+        :param on_build_event: called with each event of the Docker build as it progresses (see `BuildEvent`)
+        :param update: whether to update the build directory if it has already been prepared (see `prepare`)
         """
-        repository_location = self.prepare(build_directory)
-        dockerfile_location = os.path.join(repository_location, self.dockerfile_location)
-        try:
-            build_docker_image(image_name, repository_location, dockerfile_location)
-        finally:
-            if build_directory is None:
-                logger.info(f"Removing temp build directory: {repository_location}")
-                shutil.rmtree(repository_location)
+        if update and stream_context:
+            raise ValueError("Cannot update the build directory when streaming the context")
+        # Got once, for both the context cache and the input digest
+        fingerprint = None
+        if reuse_image or (self.context_cache is not None and not stream_context and not update):
+            fingerprint = self.get_fingerprint()
+        # Base images are pulled whilst the context is prepared: those that have been given are known now, and those in
+        # the Dockerfile are known as soon as it has been modified
+        with ImagePuller(docker_client) as image_puller:
+            image_puller.pull_all(self._get_given_base_images())
+            if stream_context:
+                repository_location = build_directory if build_directory is not None else mkdtemp()
             else:
-                logger.info(f"Not removing build directory as directory was given by the user: {repository_location}")
+                repository_location = self.prepare(build_directory, overlay=overlay,
+                                                   on_base_images=image_puller.pull_all, update=update,
+                                                   fingerprint=fingerprint)
+            try:
+                if stream_context:
+                    with self.prepare_overlay(repository_location, on_base_images=image_puller.pull_all) as context:
+                        dockerfile = context.read(self.dockerfile_location)
+                        self._build_image(image_name, dockerfile.decode() if dockerfile is not None else None,
+                                          context.stream, docker_client=docker_client, reuse_image=reuse_image,
+                                          on_build_event=on_build_event, image_puller=image_puller,
+                                          fingerprint=fingerprint)
+                else:
+                    self.build_prepared(image_name, repository_location, docker_client=docker_client,
+                                        reuse_image=reuse_image, on_build_event=on_build_event,
+                                        image_puller=image_puller, fingerprint=fingerprint)
+            finally:
+                if build_directory is None:
+                    logger.info(f"Removing temp build directory: {repository_location}")
+                    shutil.rmtree(repository_location)
+                else:
+                    logger.info(f"Not removing build directory as directory was given by the user: "
+                                f"{repository_location}")
+
+    def build_prepared(self, image_name: str, repository_location: str, *, docker_client: "DockerClient"=None,
+                       reuse_image: bool=True, on_build_event: BuildEventListener=None,
+                       image_puller: ImagePuller=None, fingerprint: str=None):
+        """
+        Builds the patchworked Docker image from a build directory that has already been prepared.
+
+        Files excluded by the directory's `.dockerignore` file, or by default for the type of import (e.g. `.git`), are
+        not sent to the Docker daemon, nor is the state that the directory is updated from (see `prepare`).
+        :param image_name: image tag (can optionally include a version tag)
+        :param repository_location: the prepared build directory (see `prepare`), which must not have been modified
+        since it was prepared
+        :param docker_client: Docker client to build with (created from the environment if `None`)
+        :param reuse_image: whether to tag an existing image that was built from the same inputs, rather than building
+        (see `get_input_digest`), in which case a built image is labelled with the digest of its inputs
+        :param on_build_event: called with each event of the Docker build as it progresses (see `BuildEvent`)
+        :param image_puller: puller of the base images, which may have already started pulling them (see
+        `ImagePuller`)
+        :param fingerprint: fingerprint of the inputs that the directory was prepared from (see `get_fingerprint`), if
+        it has already been got
+        """
+        dockerignore = DockerIgnore.from_directory(
+            repository_location,
+            default_patterns=(*self.create_importer().default_excluded_patterns, UPDATE_STATE_DIRECTORY_NAME),
+            dockerfile_location=self.dockerfile_location)
+        dockerfile = _read_file(os.path.join(repository_location, self.dockerfile_location))
+        self._build_image(image_name, dockerfile,
+                          lambda: stream_tar(DirectoryContextBase(repository_location).get_members(dockerignore)),
+                          docker_client=docker_client, reuse_image=reuse_image, on_build_event=on_build_event,
+                          image_puller=image_puller, fingerprint=fingerprint)
 
-    def prepare(self, build_directory: str=None) -> str:
+    def get_input_digest(self, dockerfile: str, *, importer: Importer=None, docker_client: "DockerClient"=None,
+                         image_puller: ImagePuller=None, fingerprint: str=None) -> Optional[str]:
+        """
+        Gets a digest of all the inputs to the image build: the inputs to the prepared build context (see
+        `get_fingerprint`) and the IDs of the base images, which are pulled if the Docker daemon does not have them.
+        :param dockerfile: contents of the prepared Dockerfile
+        :param importer: importer that will be used to import the repository (created if not given)
+        :param docker_client: Docker client to get base images with (created from the environment if `None`)
+        :param image_puller: puller of the base images, which may have already started pulling them (base images are
+        pulled concurrently by a new puller if `None`)
+        :param fingerprint: fingerprint of the inputs to the prepared build context, if it has already been got (got
+        with the importer if `None`)
+        :return: the digest, or `None` if any of the inputs cannot be determined
+        """
+        if fingerprint is None:
+            fingerprint = self.get_fingerprint(importer)
+        if fingerprint is None:
+            return None
+        base_images = get_base_images(dockerfile)
+        # Images given by build arguments are not known until build time
+        if any("$" in base_image for base_image in base_images):
+            return None
+        with ExitStack() as stack:
+            if image_puller is None:
+                image_puller = stack.enter_context(ImagePuller(docker_client))
+            image_puller.pull_all(base_images)
+            base_image_ids = {}
+            for base_image in base_images:
+                image_id = image_puller.get_image_id(base_image)
+                if image_id is None:
+                    return None
+                base_image_ids[base_image] = image_id
+        return hash_text(json.dumps({"context": fingerprint, "base_images": base_image_ids}))
+
+    def _build_image(self, image_name: str, dockerfile: Optional[str], get_context: Callable[[], Iterator[bytes]], *,
+                     docker_client: Optional["DockerClient"], reuse_image: bool,
+                     on_build_event: Optional[BuildEventListener], image_puller: Optional[ImagePuller],
+                     fingerprint: Optional[str]):
+        """
+        Builds the patchworked Docker image from the given context, unless an image built from the same inputs exists.
+        :param image_name: image tag (can optionally include a version tag)
+        :param dockerfile: contents of the prepared Dockerfile (`None` if there is no Dockerfile)
+        :param get_context: gets the tar of the prepared context
+        :param docker_client: Docker client to build with (created from the environment if `None`)
+        :param reuse_image: whether to tag an existing image that was built from the same inputs, rather than building,
+        and label the built image with the digest of its inputs (the digest is not got otherwise)
+        :param on_build_event: called with each event of the Docker build as it progresses
+        :param image_puller: puller of the base images (see `get_input_digest`)
+        :param fingerprint: fingerprint of the inputs to the context, if it has already been got
+        """
+        if docker_client is None:
+            docker_client = create_docker_client()
+        with span("build", image=image_name):
+            input_digest = None
+            if dockerfile is not None and reuse_image:
+                with span("input_digest"):
+                    input_digest = self.get_input_digest(dockerfile, docker_client=docker_client,
+                                                         image_puller=image_puller, fingerprint=fingerprint)
+            if input_digest is not None:
+                image = find_image_with_label(INPUT_DIGEST_LABEL, input_digest, docker_client)
+                if image is not None:
+                    logger.info(f"Tagging image {image.id} as {image_name}, as it was built from the same inputs "
+                                f"(digest: {input_digest})")
+                    tag_image(image, image_name)
+                    return
+            labels = {INPUT_DIGEST_LABEL: input_digest} if input_digest is not None else None
+            check_cancelled()
+            build_docker_image_from_stream(image_name, get_context(), self.dockerfile_location, client=docker_client,
+                                           labels=labels, on_event=on_build_event)
+
+    def get_sparse_paths(self) -> List[str]:
+        """
+        Gets the paths, relative to the context root, that are required for a sparse import of the context.
+        :return: the directory containing the Dockerfile, the destinations of additional files and patches, and any
+        other sparse paths that have been given
+        """
+        paths = [os.path.dirname(self.dockerfile_location) or "."]
+        for src, dest in self.additional_files.items():
+            paths.append(dest if dest is not None else os.path.basename(src))
+        paths.extend(self.patches.values())
+        paths.extend(self.git_sparse_paths or ())
+        return paths
+
+    def prepare(self, build_directory: str=None, *, overlay: bool=False,
+                on_base_images: Callable[[List[str]], None]=None, update: bool=False, fingerprint: str=None) -> str:
         """
         Prepare a directory with the patched build materials.
         :param build_directory: the directory to load the patched build context in
+        :param overlay: whether to prepare the directory as a link farm of the overlay of the imported materials and
+        the files that are added or modified (see `prepare_overlay`), in which case files in it are shared with the
+        import cache and must be replaced, or copied up (see `copy_up`), rather than modified in place
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from, as soon as
+        they are known (e.g. so they can be pulled whilst the rest of the context is prepared)
+        :param update: whether the build directory, which must be given, can have already been prepared (with
+        `update`), in which case it is updated: only what has changed is imported (e.g. new commits are fetched) and
+        only the modifications (added files, patches and Dockerfile transforms) whose inputs or files have changed are
+        made again. The state that it is updated from is kept in the build directory (see `UpdateState`)
+        :param fingerprint: fingerprint of the inputs (see `get_fingerprint`), if it has already been got, to use the
+        context cache with
         :return: the location of the build directory
         """
-        if build_directory is not None:
-            build_directory = os.path.abspath(build_directory)
-            if len(os.listdir(path=build_directory)) > 0:
-                raise ValueError(f"Build directory {build_directory} is not empty")
+        if update:
+            if build_directory is None:
+                raise ValueError("Build directory must be given to update it")
+            if overlay:
+                raise ValueError("Cannot update an overlay build directory")
+            with span("prepare"):
+                return self._prepare_update(os.path.abspath(build_directory), on_base_images)
 
-        repository_location = _importer_factory.create(self.import_repository_from).load(
-            self.import_repository_from, build_directory)
+        with span("prepare"):
+            if build_directory is not None:
+                build_directory = os.path.abspath(build_directory)
+                if len(os.listdir(path=build_directory)) > 0:
+                    raise ValueError(f"Build directory {build_directory} is not empty")
+
+            importer = self.create_importer()
+            if self.context_cache is None:
+                fingerprint = None
+            elif fingerprint is None:
+                fingerprint = self.get_fingerprint(importer)
+            if fingerprint is not None or overlay:
+                if build_directory is None:
+                    build_directory = mkdtemp()
+            # Base images are pinned after the context is got from, or put in, the cache, as the digests that they are
+            # pinned to are not inputs to its fingerprint
+            if fingerprint is not None and self.context_cache.get(fingerprint, build_directory):
+                logger.info(f"Prepared context in {build_directory} from cache (fingerprint: {fingerprint})")
+                repository_location = build_directory
+                report_base_images = True
+            else:
+                unpinned_on_base_images = on_base_images if not self.pin_base_images else None
+                if overlay:
+                    work_directory = mkdtemp()
+                    try:
+                        with self.prepare_overlay(work_directory, on_base_images=unpinned_on_base_images,
+                                                  pin_base_images=False) as context:
+                            with span("materialise"):
+                                context.materialise(build_directory, link=True)
+                    finally:
+                        shutil.rmtree(work_directory)
+                    logger.info(f"Prepared overlay of repository at {self.import_repository_from} in "
+                                f"{build_directory}")
+                    repository_location = build_directory
+                else:
+                    repository_location = self._prepare_copy(importer, build_directory, unpinned_on_base_images)
+
+                if fingerprint is not None:
+                    self.context_cache.put(fingerprint, repository_location)
+                report_base_images = self.pin_base_images
+
+            dockerfile_location = os.path.join(repository_location, self.dockerfile_location)
+            if self.pin_base_images:
+                logger.info("Pinning base images to their digests")
+                with span("transform_dockerfile"):
+                    transform_dockerfile(dockerfile_location, [PinBaseImages(get_image_digest)])
+            if report_base_images:
+                self._report_base_images(_read_file(dockerfile_location), on_base_images)
+            return repository_location
+
+    @contextmanager
+    def prepare_overlay(self, work_directory: str=None, *, on_base_images: Callable[[List[str]], None]=None,
+                        pin_base_images: bool=True) -> Iterator[StreamingContext]:
+        """
+        Prepares a build context that is an overlay of the imported materials (the base layer) and the files that are
+        added or modified (the upper layer).
+
+        Only files that are modified (e.g. patched) are written to the work directory. Files excluded by the context's
+        `.dockerignore` file, or by default for the type of import, are left out of the stream. If there is an import
+        cache, the base layer is shared read-only with other builds of the same materials, which can be concurrent.
+        Otherwise, the base layer is loaded for this context alone (see `Importer.load_base`).
+        :param work_directory: empty directory for the materials that have to be saved (generated temp directory if
+        `None`, which is not cleaned up automatically)
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from, as soon as
+        they are known
+        :param pin_base_images: whether to pin the base images to their digests, if the core is set to
+        :return: context manager that yields the prepared context, which can be used until the context exits
+        """
+        if work_directory is None:
+            work_directory = mkdtemp()
+        elif len(os.listdir(path=work_directory)) > 0:
+            raise ValueError(f"Work directory {work_directory} is not empty")
+
+        importer = self.create_importer()
+        fingerprint = importer.get_fingerprint(self.import_repository_from) if self.import_cache is not None else None
+        if fingerprint is None:
+            context = StreamingContext(
+                importer.load_base(self.import_repository_from, os.path.join(work_directory, "base")),
+                os.path.join(work_directory, "upper"))
+            self._modify_context(context, importer, on_base_images, pin_base_images)
+            yield context
+            return
+
+        with self.import_cache.use(fingerprint, lambda location: importer.load(self.import_repository_from, location)) \
+                as base_location:
+            logger.info(f"Using base layer at {base_location} for {self.import_repository_from}")
+            context = StreamingContext(DirectoryContextBase(base_location), os.path.join(work_directory, "upper"))
+            self._modify_context(context, importer, on_base_images, pin_base_images)
+            yield context
+
+    def _prepare_copy(self, importer: Importer, build_directory: Optional[str],
+                      on_base_images: Optional[Callable[[List[str]], None]]) -> str:
+        """
+        Prepares a copy of the imported materials, with files added and patched and the Dockerfile transformed (apart
+        from its base images being pinned, see `prepare`).
+        :param importer: importer to import the repository with
+        :param build_directory: the directory to load the patched build context in (generated temp directory if `None`)
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from
+        :return: the location of the build directory
+        """
+        repository_location = importer.load(self.import_repository_from, build_directory)
         logger.info(f"Imported repository at {self.import_repository_from} to {repository_location}")
+        self._modify_directory(repository_location, self._get_modifications(pin_base_images=False), on_base_images)
+        return repository_location
 
-        for src, dest in self.additional_files.items():
-            src = os.path.abspath(src)
-            if dest is None:
-                dest = os.path.basename(src)
-            if os.path.isabs(dest):
-                raise ValueError(f"Destination must be relative to the root of the context: {dest}")
-            dest = os.path.join(repository_location, dest)
-            os.path.exists(src), os.path.exists(dest)
-            logger.info(f"{'Overwriting' if os.path.exists(dest) else 'Creating'} {dest} with {src}")
-            copy_file(src, dest)
+    def _prepare_update(self, build_directory: str, on_base_images: Optional[Callable[[List[str]], None]]) -> str:
+        """
+        Updates the given build directory if it has been prepared to be updated, else prepares it to be.
+        :param build_directory: the build directory (absolute)
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from
+        :return: the location of the build directory
+        """
+        importer = self.create_importer()
+        os.makedirs(build_directory, exist_ok=True)
+        state = UpdateState.load(build_directory)
+        if state is None:
+            if os.path.exists(UpdateState.get_location(build_directory)):
+                logger.info(f"Preparing {build_directory} again, as it was not completely updated")
+                clear_directory(build_directory)
+            elif len(os.listdir(path=build_directory)) > 0:
+                raise ValueError(f"Build directory {build_directory} is not empty and was not prepared to be updated")
+            return self._prepare_updatable(importer, build_directory, on_base_images)
+
+        update = None
+        if state.importer == type(importer).__name__:
+            update = importer.get_update(self.import_repository_from, build_directory, state.import_state)
+        if update is None:
+            logger.info(f"Preparing {build_directory} again, as its imported materials cannot be updated")
+            clear_directory(build_directory)
+            return self._prepare_updatable(importer, build_directory, on_base_images)
+
+        modifications = self._get_modifications()
+        records = [self._record_modification(modification) for modification in modifications]
+        redo, restore = get_modifications_to_redo(state.modifications, records, update.changed_paths,
+                                                  state.originals.keys())
+        logger.info(f"Updating {build_directory}: {len(update.changed_paths)} imported file(s) changed, making "
+                    f"{len(redo)} of {len(modifications)} modification(s) again")
+        records_by_modification = dict(zip(modifications, records))
+        state.invalidate()
+        state.restore_originals(restore)
+        update.apply()
+        self._modify_directory(build_directory, [modifications[index] for index in sorted(redo)], on_base_images,
+                               before_modify=lambda modification: state.keep_originals(
+                                   records_by_modification[modification].paths))
+        state.import_state = update.state
+        state.modifications = records
+        state.save()
+        return build_directory
 
+    def _prepare_updatable(self, importer: Importer, build_directory: str,
+                           on_base_images: Optional[Callable[[List[str]], None]]) -> str:
+        """
+        Prepares the given empty build directory, keeping the state that it can be updated from.
+        :param importer: importer to import the repository with
+        :param build_directory: the build directory (absolute)
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from
+        :return: the location of the build directory
+        """
+        try:
+            importer.load(self.import_repository_from, build_directory)
+            logger.info(f"Imported repository at {self.import_repository_from} to {build_directory}")
+            state = UpdateState(build_directory, type(importer).__name__,
+                                importer.get_state(self.import_repository_from, build_directory))
+            modifications = self._get_modifications()
+            state.modifications = [self._record_modification(modification) for modification in modifications]
+            records_by_modification = dict(zip(modifications, state.modifications))
+            self._modify_directory(build_directory, modifications, on_base_images,
+                                   before_modify=lambda modification: state.keep_originals(
+                                       records_by_modification[modification].paths))
+            state.save()
+        except BaseException:
+            clear_directory(build_directory)
+            raise
+        return build_directory
+
+    def _modify_directory(self, repository_location: str, modifications: List[_Modification],
+                          on_base_images: Optional[Callable[[List[str]], None]], *,
+                          before_modify: Callable[[_Modification], None]=None):
+        """
+        Makes the given modifications to the imported materials in the given directory.
+        :param repository_location: the directory
+        :param modifications: the modifications, in order
+        :param on_base_images: called with the images that the modified Dockerfile's stages are built from
+        :param before_modify: called with each modification before it is made
+        """
+        patches = []
+        for modification in modifications:
+            if before_modify is not None:
+                before_modify(modification)
+            dest = os.path.join(repository_location, modification.destination)
+            if modification.kind == "file":
+                check_cancelled()
+                logger.info(f"{'Overwriting' if os.path.exists(dest) else 'Creating'} {dest} with "
+                            f"{modification.source}")
+                with span("copy_file", file=dest):
+                    copy_file(modification.source, dest)
+            elif modification.kind == "patch":
+                logger.info(f"Patching {dest} with {modification.source}")
+                patches.append((modification.source, dest))
+        check_cancelled()
+        apply_patches(patches)
+
+        check_cancelled()
+        dockerfile_location = os.path.join(repository_location, self.dockerfile_location)
+        for modification in modifications:
+            if modification.kind == "dockerfile":
+                with span("transform_dockerfile"):
+                    transform_dockerfile(dockerfile_location, modification.transforms)
+        self._report_base_images(_read_file(dockerfile_location), on_base_images)
+
+    def _modify_context(self, context: StreamingContext, importer: Importer,
+                        on_base_images: Optional[Callable[[List[str]], None]], pin_base_images: bool):
+        """
+        Adds files to, and patches, the given build context, which has been imported by the given importer.
+        :param context: the build context
+        :param importer: the importer that imported the context
+        :param on_base_images: called with the images that the prepared Dockerfile's stages are built from
+        :param pin_base_images: whether to pin the base images to their digests, if the core is set to
+        """
+        for src, dest in self._get_additional_files():
+            check_cancelled()
+            logger.info(f"Adding {src} to {dest}")
+            with span("copy_file", file=dest):
+                context.add(src, dest)
+
+        patches = []
+        deleted_paths = []
         for src, dest in self.patches.items():
             src = os.path.abspath(src)
-            dest = os.path.join(repository_location, dest)
-            os.path.exists(src), os.path.exists(dest)
             logger.info(f"Patching {dest} with {src}")
-            apply_patch(src, dest)
+            # Writable copies are got up front, as reading from the context's base is not thread-safe
+            if context.is_directory(dest):
+                patched_files = get_patched_files(src, lambda path: context.is_file(os.path.join(dest, path)),
+                                                  lambda path: context.is_directory(os.path.join(dest, path)))
+                for patched_file in patched_files:
+                    path = os.path.join(dest, patched_file.path)
+                    if patched_file.created:
+                        try:
+                            context.create_writable(path)
+                        except FileExistsError as e:
+                            raise PatchApplicationError(f"File to be created by patch {src} already exists: "
+                                                        f"{path}") from e
+                    else:
+                        context.get_writable(path)
+                    if patched_file.deleted:
+                        deleted_paths.append(path)
+                patches.append((src, os.path.join(context.upper_directory, os.path.normpath(dest))))
+            else:
+                patches.append((src, context.get_writable(dest)))
+        check_cancelled()
+        apply_patches(patches)
+        for path in deleted_paths:
+            context.remove(path)
+
+        check_cancelled()
+        transforms = self._get_dockerfile_transforms(pin_base_images=pin_base_images)
+        if len(transforms) > 0:
+            with span("transform_dockerfile"):
+                transform_dockerfile(context.get_writable(self.dockerfile_location), transforms)
+        if on_base_images is not None:
+            dockerfile = context.read(self.dockerfile_location)
+            self._report_base_images(dockerfile.decode() if dockerfile is not None else None, on_base_images)
+
+        dockerignore = context.read(DOCKERIGNORE_FILE_NAME) or b""
+        context.dockerignore = DockerIgnore.from_text(
+            dockerignore.decode(), default_patterns=importer.default_excluded_patterns,
+            dockerfile_location=self.dockerfile_location)
+
+    def get_fingerprint(self, importer: Importer=None) -> Optional[str]:
+        """
+        Gets a fingerprint of all the inputs to the prepared build context, without preparing it.
+        :param importer: importer that will be used to import the repository (created if not given)
+        :return: the fingerprint, or `None` if the repository that will be imported cannot be fingerprinted
+        """
+        if importer is None:
+            importer = self.create_importer()
+        repository_fingerprint = importer.get_fingerprint(self.import_repository_from)
+        if repository_fingerprint is None:
+            return None
+        return hash_text(json.dumps({
+            "repository": repository_fingerprint,
+            "additional_files": [[hash_path(src), dest if dest is not None else os.path.basename(src)]
+                                 for src, dest in self.additional_files.items()],
+            "patches": [[hash_path(src), dest] for src, dest in self.patches.items()],
+            "dockerfile_location": self.dockerfile_location,
+            "base_image": self.base_image,
+            "stage_base_images": sorted(self.stage_base_images.items()),
+            "target": self.target,
+            "dockerfile_transforms": [repr(transform) for transform in self.dockerfile_transforms]
+        }))
+
+    def _get_modifications(self, *, pin_base_images: bool=True) -> List[_Modification]:
+        """
+        Gets the modifications to make to the imported materials.
+        :param pin_base_images: whether the Dockerfile transforms pin the base images, if the core is set to
+        :return: the modifications, in the order that they are made (added files, then patches, then the Dockerfile
+        transforms)
+        """
+        modifications = [_Modification("file", src, dest) for src, dest in self._get_additional_files()]
+        modifications.extend(_Modification("patch", os.path.abspath(src), dest) for src, dest in self.patches.items())
+        transforms = self._get_dockerfile_transforms(pin_base_images=pin_base_images)
+        if len(transforms) > 0:
+            modifications.append(_Modification("dockerfile", None, self.dockerfile_location, tuple(transforms)))
+        return modifications
 
+    @staticmethod
+    def _record_modification(modification: _Modification) -> ModificationRecord:
+        """
+        Records the given modification, with a digest of its inputs and the paths of the files that it can change.
+        :param modification: the modification
+        :return: the record
+        """
+        destination = os.path.normpath(modification.destination)
+        if modification.kind == "file":
+            if os.path.isdir(modification.source):
+                paths = {os.path.normpath(os.path.join(destination, path)) for path, entry in walk(modification.source)
+                         if not entry.is_dir(follow_symlinks=False)}
+            else:
+                # The file is added into the destination if the destination is a directory
+                paths = {destination, os.path.join(destination, os.path.basename(modification.source))}
+            digest = hash_path(modification.source)
+        elif modification.kind == "patch":
+            paths = {destination}
+            # The files that a multi-file patch changes depend on which of its candidate paths exist
+            for candidates in get_patch_set_path_candidates(modification.source):
+                paths.update(os.path.normpath(os.path.join(destination, path)) for path in candidates)
+            digest = hash_path(modification.source)
+        else:
+            paths = {destination}
+            digest = hash_text(json.dumps([repr(transform) for transform in modification.transforms]))
+        return ModificationRecord(modification.kind, modification.source, modification.destination, digest,
+                                  frozenset(paths))
+
+    def _get_dockerfile_transforms(self, *, pin_base_images: bool=True) -> List[DockerfileTransform]:
+        """
+        Gets the transforms to apply to the Dockerfile.
+        :param pin_base_images: whether to include pinning the base images, if the core is set to
+        :return: the transforms, in order
+        """
+        transforms = []
+        # Stages are given by their index before any are removed for the target
+        for stage, image in self.stage_base_images.items():
+            logger.info(f"Setting base image of stage {stage} to {image}")
+            transforms.append(SetBaseImage(image, stage=str(stage)))
+        if self.target is not None:
+            logger.info(f"Building stage {self.target}")
+            transforms.append(SelectTarget(self.target))
         if self.base_image is not None:
             logger.info(f"Setting base image to {self.base_image}")
-            dockerfile_location = os.path.join(repository_location, self.dockerfile_location)
-            change_base_image(dockerfile_location, self.base_image)
+            transforms.append(SetBaseImage(self.base_image))
+        for transform in self.dockerfile_transforms:
+            logger.info(f"Transforming Dockerfile with {transform!r}")
+            transforms.append(transform)
+        if pin_base_images and self.pin_base_images:
+            logger.info("Pinning base images to their digests")
+            transforms.append(PinBaseImages(get_image_digest))
+        return transforms
 
-        return repository_location
+    def _get_given_base_images(self) -> List[str]:
+        """
+        Gets the base images that have been given, which are known before the Dockerfile is imported.
+        :return: the given base images that will be built from
+        """
+        base_images = [self.base_image] if self.base_image is not None else []
+        # Stages that are given base images may not be needed by the target
+        if self.target is None:
+            base_images.extend(self.stage_base_images.values())
+        return base_images
+
+    @staticmethod
+    def _report_base_images(dockerfile: Optional[str], on_base_images: Optional[Callable[[List[str]], None]]):
+        """
+        Calls the given callback with the images that the given Dockerfile's stages are built from.
+        :param dockerfile: contents of the Dockerfile (nothing is reported if `None`)
+        :param on_base_images: the callback (nothing is reported if `None`)
+        """
+        if dockerfile is not None and on_base_images is not None:
+            on_base_images(get_base_images(dockerfile))
+
+    def _get_additional_files(self) -> List[Tuple[str, str]]:
+        """
+        Gets the additional files to add to the build context.
+        :return: list of tuples where the first element is the absolute location of the file on the host and the second
+        is its destination relative to the root of the context
+        """
+        additional_files = []
+        for src, dest in self.additional_files.items():
+            src = os.path.abspath(src)
+            if dest is None:
+                dest = os.path.basename(src)
+            if os.path.isabs(dest):
+                raise ValueError(f"Destination must be relative to the root of the context: {dest}")
+            additional_files.append((src, dest))
+        return additional_files
+
+    def create_importer(self) -> Importer:
+        """
+        Creates the importer to import the repository with.
+        :return: the importer
+        """
+        if self.importer is not None:
+            return self.importer
+        # Created once, so the importers created for each operation share the factory's resources
+        if self._importer_factory is None:
+            self._importer_factory = ImporterFactory(
+                git_mirror_cache=self.git_mirror_cache, git_shallow=self.git_shallow,
+                git_sparse_paths=self.get_sparse_paths() if self.git_sparse_paths is not None else None,
+                git_ref_resolver=self.ref_resolver, dockerfile_location=self.dockerfile_location,
+                resources=self.importer_resources)
+        return self._importer_factory.create(self.import_repository_from)
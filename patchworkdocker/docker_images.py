@@ -1,9 +1,25 @@
 import os
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Iterator, Dict, Optional, Any, Iterable, TYPE_CHECKING
 
-import docker
-from docker.errors import BuildError
+from logzero import logger
 
+from patchworkdocker.build_logs import BuildEventListener, BuildLogParser, log_build_event, combine_listeners
+from patchworkdocker.cancellation import check_cancelled
 from patchworkdocker.errors import PatchworkDockerError
+from patchworkdocker.meta import PACKAGE_NAME
+from patchworkdocker.profiling import span, count_bytes_written
+
+if TYPE_CHECKING:
+    # docker-py (and requests) are slow to import, so they are only imported when the Docker daemon is used
+    from docker import DockerClient
+    from docker.models.images import Image
+
+INPUT_DIGEST_LABEL = f"{PACKAGE_NAME}.input-digest"
+DEFAULT_PULL_CONCURRENCY = 4
+_CANCELLATION_CHECK_INTERVAL = 0.1
 
 
 class DockerBuildError(PatchworkDockerError):
@@ -12,12 +28,26 @@ class DockerBuildError(PatchworkDockerError):
     """
 
 
-def build_docker_image(image_name: str, context: str, dockerfile: str):
+def create_docker_client() -> "DockerClient":
+    """
+    Creates a Docker client from the environment.
+    :return: the client
+    """
+    import docker
+    return docker.from_env()
+
+
+def build_docker_image(image_name: str, context: str, dockerfile: str, client: "DockerClient"=None,
+                       labels: Dict[str, str]=None, on_event: BuildEventListener=None) -> Optional[str]:
     """
     Builds a Docker image with the given tag from the given Dockerfile in the given context.
     :param image_name: image tag (can optionally include a version tag)
     :param context: context to build the image in (absolute file path)
     :param dockerfile: Dockerfile to build the image from (absolute file path)
+    :param client: Docker client to build with (created from the environment if `None`)
+    :param labels: labels to set on the image
+    :param on_event: called with each build event as the build progresses (events are always logged)
+    :return: ID of the built image, if the daemon reported it
     :raises BuildFailedError: raised if an error occurs during the build
     """
     if not os.path.isabs(context):
@@ -25,8 +55,219 @@ def build_docker_image(image_name: str, context: str, dockerfile: str):
     if not os.path.isabs(dockerfile):
         raise ValueError(f"Dockerfile location must be absolute: {dockerfile}")
 
-    client = docker.from_env()
+    if client is None:
+        client = create_docker_client()
+    with span("upload_context"):
+        build_stream = client.api.build(path=context, dockerfile=dockerfile, tag=image_name, labels=labels, rm=True,
+                                        decode=True)
+    return _consume_build(image_name, build_stream, on_event)
+
+
+def build_docker_image_from_stream(image_name: str, context: Iterator[bytes], dockerfile: str,
+                                   client: "DockerClient"=None, labels: Dict[str, str]=None,
+                                   on_event: BuildEventListener=None) -> Optional[str]:
+    """
+    Builds a Docker image with the given tag from the given Dockerfile in the given streamed context.
+
+    The context is sent to the Docker daemon as it is generated, rather than being written to disk or memory first.
+    :param image_name: image tag (can optionally include a version tag)
+    :param context: tar of the context to build the image in
+    :param dockerfile: Dockerfile to build the image from (relative to the root of the context)
+    :param client: Docker client to build with (created from the environment if `None`)
+    :param labels: labels to set on the image
+    :param on_event: called with each build event as the build progresses (events are always logged)
+    :return: ID of the built image, if the daemon reported it
+    :raises BuildFailedError: raised if an error occurs during the build
+    """
+    if os.path.isabs(dockerfile):
+        raise ValueError(f"Dockerfile location must be relative to the context root: {dockerfile}")
+
+    if client is None:
+        client = create_docker_client()
+    # The request, including the context, is sent before the daemon's output can be read
+    with span("upload_context"):
+        build_stream = client.api.build(fileobj=count_bytes_written(context), custom_context=True,
+                                        dockerfile=dockerfile, tag=image_name, labels=labels, rm=True, decode=True)
+    return _consume_build(image_name, build_stream, on_event)
+
+
+def _consume_build(image_name: str, build_stream: Iterator[Dict[str, Any]],
+                   on_event: Optional[BuildEventListener]) -> Optional[str]:
+    """
+    Consumes the given build's JSON stream as it is received, emitting build events.
+    :param image_name: tag of the image being built
+    :param build_stream: decoded JSON stream of the build
+    :param on_event: called with each build event (events are always logged)
+    :return: ID of the built image, if the daemon reported it
+    :raises BuildFailedError: raised if the build reports an error
+    """
+    parser = BuildLogParser()
+    emit = combine_listeners(log_build_event, on_event)
+
+    with span("docker_build"):
+        for chunk in build_stream:
+            # Stopping reading closes the connection, which stops the build
+            check_cancelled()
+            for event in parser.feed(chunk):
+                emit(event)
+        for event in parser.close():
+            emit(event)
+    if parser.error is not None:
+        raise DockerBuildError(f"Error building image {image_name}: {parser.error}")
+    return parser.image_id
+
+
+def get_image_id(image_name: str, client: "DockerClient"=None, *, pull: bool=False) -> Optional[str]:
+    """
+    Gets the ID of the given image in the Docker daemon.
+    :param image_name: image name (can optionally include a version tag)
+    :param client: Docker client to use (created from the environment if `None`)
+    :param pull: whether to pull the image if the daemon does not have it
+    :return: the image ID, or `None` if the daemon does not have the image (and it could not be pulled)
+    """
+    from docker.errors import ImageNotFound, APIError
+    from docker.utils import parse_repository_tag
+
+    if client is None:
+        client = create_docker_client()
+    try:
+        return client.images.get(image_name).id
+    except ImageNotFound:
+        if not pull:
+            return None
+    try:
+        logger.info(f"Pulling image: {image_name}")
+        repository, tag = parse_repository_tag(image_name)
+        return client.images.pull(repository, tag=tag or "latest").id
+    except APIError as e:
+        logger.warning(f"Could not pull image {image_name}: {e}")
+        return None
+
+
+def get_image_digest(image_name: str, client: "DockerClient"=None) -> Optional[str]:
+    """
+    Gets the digest of the given image in its registry, without pulling it.
+    :param image_name: image name (can optionally include a version tag)
+    :param client: Docker client to use (created from the environment if `None`)
+    :return: the digest (e.g. `sha256:...`), or `None` if it could not be got from the registry
+    """
+    from docker.errors import APIError
+
+    if client is None:
+        client = create_docker_client()
     try:
-        client.images.build(path=context, dockerfile=dockerfile, tag=image_name)
-    except BuildError as e:
-        raise DockerBuildError(f"Error building image: {image_name}") from e
+        return client.images.get_registry_data(image_name).id
+    except APIError as e:
+        logger.warning(f"Could not get digest of image {image_name}: {e}")
+        return None
+
+
+class ImagePuller:
+    """
+    Pulls images in the background, so they can be pulled whilst other work is done (e.g. preparing the build context).
+
+    Each image is pulled at most once, and only if the Docker daemon does not already have it.
+    """
+    def __init__(self, client: "DockerClient"=None, *, max_workers: int=DEFAULT_PULL_CONCURRENCY):
+        """
+        Constructor.
+        :param client: Docker client to pull with (created from the environment, when first needed, if `None`)
+        :param max_workers: maximum number of images to pull at once
+        """
+        self._client = client
+        self._client_lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="pull")
+        self._pulls: Dict[str, Future] = {}
+        self._pulls_lock = Lock()
+
+    def pull(self, image_name: str) -> Future:
+        """
+        Starts pulling the given image, if it is not already being pulled.
+        :param image_name: image name (can optionally include a version tag)
+        :return: future that resolves to the image's ID, or `None` if the image could not be pulled
+        """
+        with self._pulls_lock:
+            if image_name not in self._pulls:
+                self._pulls[image_name] = self._executor.submit(self._pull, image_name)
+            return self._pulls[image_name]
+
+    def pull_all(self, image_names: Iterable[str]):
+        """
+        Starts pulling the given images.
+        :param image_names: image names (those that use build arguments are ignored)
+        """
+        for image_name in image_names:
+            # Images given by build arguments are not known until build time
+            if "$" not in image_name:
+                self.pull(image_name)
+
+    def get_image_id(self, image_name: str) -> Optional[str]:
+        """
+        Gets the ID of the given image, waiting for it to be pulled.
+        :param image_name: image name (can optionally include a version tag)
+        :return: the image ID, or `None` if the image could not be pulled
+        :raises OperationCancelledError: raised if the operation waiting for the image is cancelled
+        """
+        pull = self.pull(image_name)
+        while True:
+            try:
+                return pull.result(timeout=_CANCELLATION_CHECK_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                check_cancelled()
+
+    def close(self):
+        """
+        Stops pulling images, waiting for pulls that have started to finish.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _pull(self, image_name: str) -> Optional[str]:
+        """
+        Pulls the given image if the Docker daemon does not have it.
+        :param image_name: image name
+        :return: the image ID, or `None` if the image could not be pulled
+        """
+        with span("pull_base_image", image=image_name):
+            return get_image_id(image_name, self._get_client(), pull=True)
+
+    def _get_client(self) -> "DockerClient":
+        """
+        Gets the Docker client to pull with.
+        :return: the client
+        """
+        with self._client_lock:
+            if self._client is None:
+                self._client = create_docker_client()
+            return self._client
+
+    def __enter__(self) -> "ImagePuller":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def find_image_with_label(label: str, value: str, client: "DockerClient"=None) -> Optional["Image"]:
+    """
+    Finds an image in the Docker daemon that has the given label value.
+    :param label: the label
+    :param value: the label value
+    :param client: Docker client to use (created from the environment if `None`)
+    :return: an image with the label value, or `None` if there is no such image
+    """
+    if client is None:
+        client = create_docker_client()
+    images = client.images.list(filters={"label": f"{label}={value}"})
+    return images[0] if len(images) > 0 else None
+
+
+def tag_image(image: "Image", image_name: str):
+    """
+    Tags the given image with the given name.
+    :param image: image to tag
+    :param image_name: image tag (can optionally include a version tag)
+    """
+    from docker.utils import parse_repository_tag
+
+    repository, tag = parse_repository_tag(image_name)
+    image.tag(repository, tag=tag)
@@ -0,0 +1,643 @@
+import json
+import os
+import re
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkstemp
+from typing import List, Optional, Dict, Union, Callable
+
+from logzero import logger
+
+_DIRECTIVE_PATTERN = re.compile(r"^#\s*([a-zA-Z][a-zA-Z0-9]*)\s*=\s*(.*?)\s*$")
+_KNOWN_DIRECTIVES = ("syntax", "escape", "check")
+_INSTRUCTION_PATTERN = re.compile(r"^\s*([a-zA-Z]+)(\s+|$)(.*)$", re.DOTALL)
+_HEREDOC_PATTERN = re.compile(r"<<(-?)([\"']?)([a-zA-Z_][a-zA-Z0-9_]*)\2")
+_HEREDOC_INSTRUCTIONS = ("RUN", "COPY", "ADD")
+_SCRATCH_IMAGE = "scratch"
+_VARIABLE_PATTERN = re.compile(r"\$(?:{([a-zA-Z_][a-zA-Z0-9_]*)(?::([-+])([^}]*))?}|([a-zA-Z_][a-zA-Z0-9_]*))")
+_FLAGS_PATTERN = re.compile(r"^(?:--\S+(?:\s+|$))*")
+_STAGE_REFERENCE_PATTERN = re.compile(r"(?:(?:^|(?<=\s))--from=|(?<=[=,])from=)([^\s,]+)")
+_STAGE_REFERENCE_INSTRUCTIONS = ("COPY", "ADD", "RUN")
+
+DockerfileTransform = Callable[["Dockerfile"], None]
+
+
+class Instruction:
+    """
+    Instruction in a Dockerfile.
+    """
+    def __init__(self, keyword: str, arguments: str, source: str=None, heredocs: List[str]=None):
+        """
+        Constructor.
+        :param keyword: the instruction's keyword (e.g. `FROM`)
+        :param arguments: everything after the keyword, with line continuations joined (for instructions with
+        heredocs, this is the first line, which declares them)
+        :param source: text of the instruction in the Dockerfile it was parsed from (`None` if it was not parsed)
+        :param heredocs: contents of each of the heredocs declared in the arguments, in order, without their
+        terminating lines
+        :raises ValueError: raised if the number of heredocs does not match the number declared in the arguments
+        """
+        self.keyword = keyword.upper()
+        self._heredocs = list(heredocs) if heredocs is not None else []
+        self._check_heredocs(arguments)
+        self._arguments = arguments
+        self.source = source
+
+    @property
+    def arguments(self) -> str:
+        return self._arguments
+
+    @arguments.setter
+    def arguments(self, arguments: str):
+        if arguments != self._arguments:
+            self._check_heredocs(arguments)
+            self._arguments = arguments
+            # The instruction is written on one line now that its original text is no longer valid
+            self.source = None
+
+    @property
+    def heredocs(self) -> List[str]:
+        return list(self._heredocs)
+
+    @heredocs.setter
+    def heredocs(self, heredocs: List[str]):
+        heredocs = list(heredocs)
+        if len(heredocs) != len(self._heredocs):
+            raise ValueError(f"Instruction has {len(self._heredocs)} heredoc(s), not {len(heredocs)}: "
+                             f"{self.keyword} {self._arguments}")
+        if heredocs != self._heredocs:
+            self._heredocs = heredocs
+            self.source = None
+
+    def to_text(self) -> str:
+        """
+        Gets the instruction as Dockerfile text.
+        :return: the original text if the instruction has not been modified, else the instruction on one line,
+        followed by the contents of its heredocs
+        """
+        if self.source is not None:
+            return self.source
+        text = f"{self.keyword} {self._arguments}\n"
+        for heredoc, contents in zip(self._get_heredoc_delimiters(self._arguments), self._heredocs):
+            if contents != "" and not contents.endswith("\n"):
+                contents += "\n"
+            text += f"{contents}{heredoc}\n"
+        return text
+
+    def _get_heredoc_delimiters(self, arguments: str) -> List[str]:
+        """
+        Gets the delimiters of the heredocs declared in the given arguments of the instruction.
+        :param arguments: the arguments
+        :return: the delimiters, in order
+        """
+        if self.keyword not in _HEREDOC_INSTRUCTIONS:
+            return []
+        return [heredoc.group(3) for heredoc in _HEREDOC_PATTERN.finditer(arguments)]
+
+    def _check_heredocs(self, arguments: str):
+        """
+        Checks that the given arguments of the instruction declare the heredocs that it has.
+        :param arguments: the arguments
+        :raises ValueError: raised if the arguments declare a different number of heredocs
+        """
+        declared = len(self._get_heredoc_delimiters(arguments))
+        if declared != len(self._heredocs):
+            raise ValueError(f"Instruction has {len(self._heredocs)} heredoc(s) but {declared} are declared: "
+                             f"{self.keyword} {arguments}")
+
+
+class Stage:
+    """
+    Build stage of a Dockerfile, which starts with a `FROM` instruction.
+    """
+    def __init__(self, index: int, instruction: Instruction, variables: Dict[str, str]=None):
+        """
+        Constructor.
+        :param index: position of the stage in the Dockerfile (from 0)
+        :param instruction: the stage's `FROM` instruction
+        :param variables: values of the build arguments that can be used in the `FROM` instruction
+        :raises ValueError: raised if the `FROM` instruction does not have an image
+        """
+        self.index = index
+        self.instruction = instruction
+        self.variables = variables if variables is not None else {}
+        words = instruction.arguments.split()
+        self.flags = [word for word in words if word.startswith("--")]
+        arguments = [word for word in words if not word.startswith("--")]
+        if len(arguments) == 0:
+            raise ValueError(f"Dockerfile has FROM without an image: {instruction.to_text().strip()}")
+        self._image = arguments[0]
+        self.name = arguments[2] if len(arguments) >= 3 and arguments[1].upper() == "AS" else None
+
+    @property
+    def image(self) -> str:
+        return self._image
+
+    @image.setter
+    def image(self, image: str):
+        self._image = image
+        self.instruction.arguments = " ".join(self.flags + [image] + (["AS", self.name] if self.name else []))
+
+    @property
+    def resolved_image(self) -> str:
+        """
+        Image that the stage is built from, with build arguments substituted (those without values are left as they
+        are, as they are not known until build time).
+        """
+        return _substitute_variables(self._image, self.variables)
+
+    @property
+    def platform(self) -> Optional[str]:
+        """
+        Platform given by the stage's `--platform` flag, if any.
+        """
+        for flag in self.flags:
+            if flag.startswith("--platform="):
+                return flag[len("--platform="):]
+        return None
+
+
+class Dockerfile:
+    """
+    Dockerfile that has been parsed into instructions, which can be modified in memory and then written out at once.
+
+    Comments, blank lines and instructions that are not modified are written out as they were.
+    """
+    @staticmethod
+    def parse(text: str) -> "Dockerfile":
+        """
+        Parses the given Dockerfile text.
+        :param text: contents of the Dockerfile
+        :return: the parsed Dockerfile
+        """
+        lines = text.splitlines(keepends=True)
+        directives: Dict[str, str] = {}
+        elements: List[Union[Instruction, str]] = []
+
+        i = 0
+        while i < len(lines):
+            match = _DIRECTIVE_PATTERN.match(lines[i])
+            if match is None or match.group(1).lower() not in _KNOWN_DIRECTIVES \
+                    or match.group(1).lower() in directives:
+                break
+            directives[match.group(1).lower()] = match.group(2)
+            elements.append(lines[i])
+            i += 1
+        escape = directives.get("escape", "\\")
+
+        while i < len(lines):
+            line = lines[i]
+            if line.strip() == "" or line.lstrip().startswith("#"):
+                elements.append(line)
+                i += 1
+                continue
+            source = [line]
+            logical = ""
+            while True:
+                content = lines[i].rstrip("\r\n")
+                i += 1
+                if not content.rstrip().endswith(escape):
+                    logical += content
+                    break
+                logical += content.rstrip()[:-1]
+                # Comment lines within an instruction are removed, as Docker does
+                while i < len(lines) and lines[i].lstrip().startswith("#"):
+                    source.append(lines[i])
+                    i += 1
+                if i == len(lines):
+                    break
+                source.append(lines[i])
+            match = _INSTRUCTION_PATTERN.match(logical)
+            if match is None:
+                raise ValueError(f"Could not parse Dockerfile line: {line.strip()}")
+            keyword, arguments = match.group(1), match.group(3).strip()
+            heredocs = []
+            if keyword.upper() in _HEREDOC_INSTRUCTIONS:
+                for heredoc in _HEREDOC_PATTERN.finditer(arguments):
+                    contents = []
+                    while i < len(lines):
+                        source.append(lines[i])
+                        i += 1
+                        ending = source[-1].rstrip("\r\n")
+                        if (ending.lstrip("\t") if heredoc.group(1) == "-" else ending) == heredoc.group(3):
+                            break
+                        contents.append(source[-1])
+                    heredocs.append("".join(contents))
+            elements.append(Instruction(keyword, arguments, "".join(source), heredocs))
+        return Dockerfile(elements, directives)
+
+    @staticmethod
+    def from_file(location: str) -> "Dockerfile":
+        """
+        Parses the given Dockerfile.
+        :param location: location of the Dockerfile
+        :return: the parsed Dockerfile
+        """
+        with open(location, "r") as file:
+            return Dockerfile.parse(file.read())
+
+    def __init__(self, elements: List[Union[Instruction, str]]=None, directives: Dict[str, str]=None):
+        """
+        Constructor.
+        :param elements: instructions and the text between them (comments and blank lines), in order
+        :param directives: parser directives (e.g. `escape`), which must also be in the elements as text
+        """
+        self.elements = elements if elements is not None else []
+        self.directives = directives if directives is not None else {}
+
+    @property
+    def instructions(self) -> List[Instruction]:
+        return [element for element in self.elements if isinstance(element, Instruction)]
+
+    @property
+    def stages(self) -> List[Stage]:
+        """
+        Build stages of the Dockerfile, in order.
+        :raises ValueError: raised if a `FROM` instruction does not have an image
+        """
+        instructions = [instruction for instruction in self.instructions if instruction.keyword == "FROM"]
+        variables = self.global_args
+        return [Stage(index, instruction, variables) for index, instruction in enumerate(instructions)]
+
+    @property
+    def global_args(self) -> Dict[str, str]:
+        """
+        Default values of the build arguments declared before the first stage, which can be used in `FROM`
+        instructions.
+        """
+        variables = {}
+        for instruction in self.instructions:
+            if instruction.keyword == "FROM":
+                break
+            if instruction.keyword == "ARG":
+                for word in shlex.split(instruction.arguments):
+                    if "=" in word:
+                        name, value = word.split("=", 1)
+                        variables[name] = _substitute_variables(value, variables)
+        return variables
+
+    def get_stage(self, reference: str) -> Stage:
+        """
+        Gets the stage with the given name or index.
+        :param reference: name (case insensitive) or index (from 0) of the stage
+        :return: the stage
+        :raises ValueError: raised if there is no such stage
+        """
+        for stage in self.stages:
+            if (reference.isdigit() and int(reference) == stage.index) \
+                    or (stage.name is not None and stage.name.lower() == reference.lower()):
+                return stage
+        raise ValueError(f"Dockerfile does not have stage: {reference}")
+
+    def get_dependencies(self, stage: Stage) -> List[Stage]:
+        """
+        Gets the earlier stages that the given stage needs: the stage it is built from and those that it copies or
+        mounts files from.
+        :param stage: the stage
+        :return: the stages that are needed
+        """
+        earlier_stages = self.stages[:stage.index]
+        references = [stage.resolved_image] + [
+            _substitute_variables(reference, stage.variables)
+            for instruction in self._get_stage_elements()[stage.index] if isinstance(instruction, Instruction)
+            for reference in _get_stage_references(instruction)]
+        dependencies = []
+        for reference in references:
+            for earlier_stage in earlier_stages:
+                if (reference.isdigit() and int(reference) == earlier_stage.index) \
+                        or (earlier_stage.name is not None and earlier_stage.name.lower() == reference.lower()):
+                    dependencies.append(earlier_stage)
+        return dependencies
+
+    def remove_stages_not_needed_by(self, target: Stage):
+        """
+        Removes the stages that are not needed to build the given stage, including all stages after it (so it becomes
+        the final stage). References to stages by index are updated.
+        :param target: the stage to build
+        """
+        needed = set()
+        pending = [target]
+        while len(pending) > 0:
+            stage = pending.pop()
+            if stage.index not in needed:
+                needed.add(stage.index)
+                pending.extend(self.get_dependencies(stage))
+
+        stage_elements = self._get_stage_elements()
+        indices = {index: new_index for new_index, index in enumerate(sorted(needed))}
+        elements = list(self.elements[:len(self.elements) - sum(len(elements) for elements in stage_elements)])
+        for index in sorted(needed):
+            for element in stage_elements[index]:
+                if isinstance(element, Instruction) and element.keyword in _STAGE_REFERENCE_INSTRUCTIONS:
+                    _renumber_stage_references(element, indices)
+                elements.append(element)
+        self.elements = elements
+
+    def _get_stage_elements(self) -> List[List[Union[Instruction, str]]]:
+        """
+        Gets the elements of each stage, from its `FROM` instruction up to the next stage.
+        :return: the elements of each stage, in order
+        """
+        stage_elements = []
+        for element in self.elements:
+            if isinstance(element, Instruction) and element.keyword == "FROM":
+                stage_elements.append([])
+            if len(stage_elements) > 0:
+                stage_elements[-1].append(element)
+        return stage_elements
+
+    def get_base_images(self) -> List[str]:
+        """
+        Gets the images that the stages are built from.
+        :return: the base images, in order, excluding `scratch` and earlier stages
+        """
+        return [stage.resolved_image for stage in self.get_image_stages()]
+
+    def get_image_stages(self) -> List[Stage]:
+        """
+        Gets the stages that are built from an image, rather than from `scratch` or an earlier stage.
+        :return: the stages, in order
+        """
+        names = set()
+        image_stages = []
+        for stage in self.stages:
+            image = stage.resolved_image
+            if image.lower() not in names and image != _SCRATCH_IMAGE:
+                image_stages.append(stage)
+            if stage.name is not None:
+                names.add(stage.name.lower())
+        return image_stages
+
+    def get_root_stage(self, stage: Stage=None) -> Stage:
+        """
+        Gets the stage that the given stage is ultimately built on, following stages that are built from earlier
+        stages.
+        :param stage: the stage (the final stage if `None`)
+        :return: the stage that is built from an image
+        :raises ValueError: raised if there are no stages
+        """
+        stages = self.stages
+        if len(stages) == 0:
+            raise ValueError("Dockerfile does not contain a FROM instruction")
+        if stage is None:
+            stage = stages[-1]
+        names = {earlier.name.lower(): earlier for earlier in stages[:stage.index] if earlier.name is not None}
+        while stage.resolved_image.lower() in names:
+            stage = names[stage.resolved_image.lower()]
+            names = {name: earlier for name, earlier in names.items() if earlier.index < stage.index}
+        return stage
+
+    def append(self, instruction: Instruction):
+        """
+        Adds the given instruction to the end of the Dockerfile (i.e. to the final stage).
+        :param instruction: the instruction
+        """
+        if len(self.elements) > 0:
+            last = self.elements[-1]
+            if isinstance(last, str) and not last.endswith("\n"):
+                self.elements[-1] = f"{last}\n"
+            elif isinstance(last, Instruction) and last.source is not None and not last.source.endswith("\n"):
+                last.source = f"{last.source}\n"
+        self.elements.append(instruction)
+
+    def to_text(self) -> str:
+        """
+        Gets the Dockerfile as text.
+        :return: the Dockerfile's contents
+        """
+        return "".join(element if isinstance(element, str) else element.to_text() for element in self.elements)
+
+    def write(self, location: str):
+        """
+        Writes the Dockerfile to the given location, replacing any existing file atomically (so files that it shares
+        its contents with are not changed).
+        :param location: where to write the Dockerfile
+        """
+        descriptor, temp_location = mkstemp(dir=os.path.dirname(os.path.abspath(location)),
+                                            prefix=f".{os.path.basename(location)}.")
+        try:
+            with os.fdopen(descriptor, "w") as file:
+                file.write(self.to_text())
+            if os.path.exists(location):
+                shutil.copymode(location, temp_location)
+            else:
+                os.chmod(temp_location, 0o644)
+            os.replace(temp_location, location)
+        except BaseException:
+            if os.path.exists(temp_location):
+                os.remove(temp_location)
+            raise
+
+
+class SetBaseImage:
+    """
+    Transform that sets the image that a stage is built from. By default, it sets the image that the built image is
+    ultimately based on: the image of the final stage, or of the stage that it is built from if it is built from an
+    earlier stage.
+
+    `--platform` flags and stage names are kept.
+    """
+    def __init__(self, image: str, stage: str=None):
+        """
+        Constructor.
+        :param image: the base image
+        :param stage: name or index of the stage to set the image of (the stage the final stage is based on if `None`)
+        """
+        self.image = image
+        self.stage = stage
+
+    def __call__(self, dockerfile: Dockerfile):
+        stage = dockerfile.get_root_stage() if self.stage is None else dockerfile.get_stage(self.stage)
+        stage.image = self.image
+
+    def __repr__(self) -> str:
+        if self.stage is None:
+            return f"{type(self).__name__}({self.image!r})"
+        return f"{type(self).__name__}({self.image!r}, stage={self.stage!r})"
+
+
+class SelectTarget:
+    """
+    Transform that makes the given stage the final stage, removing the stages that are not needed to build it (so they
+    are not built, whatever the builder).
+    """
+    def __init__(self, stage: str):
+        """
+        Constructor.
+        :param stage: name or index of the stage to build
+        """
+        self.stage = stage
+
+    def __call__(self, dockerfile: Dockerfile):
+        dockerfile.remove_stages_not_needed_by(dockerfile.get_stage(self.stage))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.stage!r})"
+
+
+class PinBaseImages:
+    """
+    Transform that pins the images that stages are built from to their digests (e.g. `alpine:3.10@sha256:...`), so
+    that the image is not changed by the tag being moved.
+
+    Images that use build arguments without defaults, or that are already pinned, are not changed.
+    """
+    def __init__(self, get_digest: Callable[[str], Optional[str]]):
+        """
+        Constructor.
+        :param get_digest: gets the digest of an image (`None` if it cannot be got, in which case it is not pinned)
+        """
+        self.get_digest = get_digest
+
+    def __call__(self, dockerfile: Dockerfile):
+        stages = [stage for stage in dockerfile.get_image_stages()
+                  if "@" not in stage.resolved_image and "$" not in stage.resolved_image]
+        images = sorted({stage.resolved_image for stage in stages})
+        if len(images) == 0:
+            return
+        with ThreadPoolExecutor(len(images)) as executor:
+            digests = dict(zip(images, executor.map(self.get_digest, images)))
+        for stage in stages:
+            digest = digests[stage.resolved_image]
+            if digest is None:
+                logger.warning(f"Not pinning image {stage.resolved_image} as its digest could not be got")
+            else:
+                stage.image = f"{stage.resolved_image}@{digest}"
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class SetArgDefaults:
+    """
+    Transform that sets the default values of build arguments declared with `ARG`.
+    """
+    def __init__(self, values: Dict[str, str]):
+        """
+        Constructor.
+        :param values: default values of build arguments, by name
+        """
+        self.values = dict(values)
+
+    def __call__(self, dockerfile: Dockerfile):
+        declared = set()
+        for instruction in dockerfile.instructions:
+            if instruction.keyword != "ARG":
+                continue
+            words = shlex.split(instruction.arguments, posix=False)
+            for i, word in enumerate(words):
+                name = word.split("=", 1)[0]
+                if name in self.values:
+                    words[i] = f"{name}={_quote(self.values[name])}"
+                    declared.add(name)
+            instruction.arguments = " ".join(words)
+        for name in self.values.keys() - declared:
+            logger.warning(f"Not setting default of build argument {name} as it is not declared in the Dockerfile")
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({sorted(self.values.items())!r})"
+
+
+class AddLabels:
+    """
+    Transform that adds labels to the built image (i.e. to the final stage).
+    """
+    def __init__(self, labels: Dict[str, str]):
+        """
+        Constructor.
+        :param labels: the labels
+        """
+        self.labels = dict(labels)
+
+    def __call__(self, dockerfile: Dockerfile):
+        if len(self.labels) > 0:
+            dockerfile.append(Instruction("LABEL", " ".join(
+                f"{_quote(key)}={_quote(value)}" for key, value in sorted(self.labels.items()))))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({sorted(self.labels.items())!r})"
+
+
+class SubstituteRun:
+    """
+    Transform that substitutes text in `RUN` instructions, including in the scripts given to them in heredocs.
+    """
+    def __init__(self, pattern: str, replacement: str):
+        """
+        Constructor.
+        :param pattern: regular expression to substitute
+        :param replacement: replacement (see `re.sub`)
+        """
+        self.pattern = pattern
+        self.replacement = replacement
+
+    def __call__(self, dockerfile: Dockerfile):
+        for instruction in dockerfile.instructions:
+            if instruction.keyword == "RUN":
+                instruction.arguments = re.sub(self.pattern, self.replacement, instruction.arguments)
+                instruction.heredocs = [re.sub(self.pattern, self.replacement, contents)
+                                        for contents in instruction.heredocs]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.pattern!r}, {self.replacement!r})"
+
+
+def _substitute_variables(text: str, variables: Dict[str, str]) -> str:
+    """
+    Substitutes the given variables into the given text, as Docker does (`$name`, `${name}`, `${name:-default}` and
+    `${name:+alternative}`).
+    :param text: the text
+    :param variables: values of the variables, by name
+    :return: the text with the variables substituted, apart from those without a value (or default)
+    """
+    def substitute(match) -> str:
+        name = match.group(1) or match.group(4)
+        modifier, word = match.group(2), match.group(3)
+        value = variables.get(name)
+        if modifier == "-":
+            return value if value else word
+        elif modifier == "+":
+            return word if value else ""
+        return value if value is not None else match.group(0)
+
+    return _VARIABLE_PATTERN.sub(substitute, text)
+
+
+def _get_stage_references(instruction: Instruction) -> List[str]:
+    """
+    Gets the stages (or images) that the given instruction copies or mounts files from.
+    :param instruction: the instruction
+    :return: the names or indices of the stages (or names of images)
+    """
+    if instruction.keyword not in _STAGE_REFERENCE_INSTRUCTIONS:
+        return []
+    flags = _FLAGS_PATTERN.match(instruction.arguments).group(0)
+    return [match.group(1) for match in _STAGE_REFERENCE_PATTERN.finditer(flags)]
+
+
+def _renumber_stage_references(instruction: Instruction, indices: Dict[int, int]):
+    """
+    Updates the references to stages by index in the given instruction.
+    :param instruction: the instruction
+    :param indices: the new index of each stage, by its old index
+    """
+    def renumber(match) -> str:
+        reference = match.group(1)
+        if not reference.isdigit() or int(reference) not in indices:
+            return match.group(0)
+        return f"{match.group(0)[:-len(reference)]}{indices[int(reference)]}"
+
+    flags = _FLAGS_PATTERN.match(instruction.arguments).group(0)
+    instruction.arguments = _STAGE_REFERENCE_PATTERN.sub(renumber, flags) + instruction.arguments[len(flags):]
+
+
+def _quote(value: str) -> str:
+    """
+    Quotes the given value for use in a Dockerfile, if required.
+    :param value: the value
+    :return: the value, quoted if it is empty or contains whitespace or quotes
+    """
+    if value == "" or re.search(r"[\s\"'\\$]", value):
+        return json.dumps(value)
+    return value
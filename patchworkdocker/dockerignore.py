@@ -0,0 +1,192 @@
+import os
+import posixpath
+import re
+from typing import Iterable, Iterator, Tuple, Pattern, Optional
+
+DOCKERIGNORE_FILE_NAME = ".dockerignore"
+
+
+class _IgnorePattern:
+    """
+    Pattern from a `.dockerignore` file.
+    """
+    def __init__(self, pattern: str):
+        """
+        Constructor.
+        :param pattern: the pattern, which is a negation if it starts with `!`
+        """
+        self.negation = pattern.startswith("!")
+        if self.negation:
+            pattern = pattern[1:].strip()
+        self.pattern = _clean_path(pattern)
+        self._regex = _compile(self.pattern)
+
+    def matches(self, path: str) -> bool:
+        """
+        Gets whether the given path, or any of its parent directories, matches the pattern.
+        :param path: path relative to the root of the context
+        :return: whether there is a match
+        """
+        if self._regex.match(path):
+            return True
+        parent = posixpath.dirname(path)
+        while parent != "":
+            if self._regex.match(parent):
+                return True
+            parent = posixpath.dirname(parent)
+        return False
+
+
+class DockerIgnore:
+    """
+    Rules, following the semantics of `.dockerignore` files, for the files that are excluded from a build context.
+
+    The Dockerfile and `.dockerignore` file are never excluded, as Docker always sends them to the daemon.
+    """
+    @staticmethod
+    def from_text(text: str, *, default_patterns: Iterable[str]=(), dockerfile_location: str="Dockerfile") \
+            -> "DockerIgnore":
+        """
+        Creates rules from the contents of a `.dockerignore` file.
+        :param text: the contents
+        :param default_patterns: patterns that are applied before those in the file (so can be negated by them)
+        :param dockerfile_location: location of the Dockerfile relative to the root of the context
+        :return: the rules
+        """
+        patterns = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line != "" and not line.startswith("#"):
+                patterns.append(line)
+        return DockerIgnore(list(default_patterns) + patterns, dockerfile_location=dockerfile_location)
+
+    @staticmethod
+    def from_directory(directory: str, *, default_patterns: Iterable[str]=(), dockerfile_location: str="Dockerfile") \
+            -> "DockerIgnore":
+        """
+        Creates rules from the `.dockerignore` file in the given context directory, if there is one.
+        :param directory: root of the context
+        :param default_patterns: patterns that are applied before those in the file (so can be negated by them)
+        :param dockerfile_location: location of the Dockerfile relative to the root of the context
+        :return: the rules
+        """
+        location = os.path.join(directory, DOCKERIGNORE_FILE_NAME)
+        text = ""
+        if os.path.isfile(location):
+            with open(location, "r") as file:
+                text = file.read()
+        return DockerIgnore.from_text(text, default_patterns=default_patterns, dockerfile_location=dockerfile_location)
+
+    def __init__(self, patterns: Iterable[str]=(), *, dockerfile_location: str="Dockerfile"):
+        """
+        Constructor.
+        :param patterns: patterns in the form used in `.dockerignore` files, where later patterns take precedence
+        :param dockerfile_location: location of the Dockerfile relative to the root of the context
+        """
+        self.patterns = [_IgnorePattern(pattern) for pattern in patterns]
+        self._always_included = {_clean_path(dockerfile_location), DOCKERIGNORE_FILE_NAME}
+
+    def is_excluded(self, path: str) -> bool:
+        """
+        Gets whether the given path is excluded from the context.
+        :param path: path relative to the root of the context
+        :return: whether the path is excluded
+        """
+        path = _clean_path(path)
+        if path in self._always_included:
+            return False
+        excluded = False
+        for pattern in self.patterns:
+            # Only patterns that could change the outcome need to be evaluated
+            if pattern.negation == excluded and pattern.matches(path):
+                excluded = not pattern.negation
+        return excluded
+
+    def is_pruned(self, directory: str) -> bool:
+        """
+        Gets whether everything in the given excluded directory is excluded, so it does not need to be walked.
+
+        As with Docker, a directory is only walked if a negated pattern, or a file that is always included, is within
+        it.
+        :param directory: path of the directory relative to the root of the context
+        :return: whether the directory's contents are all excluded
+        """
+        directory = _clean_path(directory)
+        prefix = f"{directory}/"
+        for path in [pattern.pattern for pattern in self.patterns if pattern.negation] + list(self._always_included):
+            if f"{path}/".startswith(prefix):
+                return False
+        return True
+
+
+def walk(root: str, dockerignore: Optional[DockerIgnore]=None) -> Iterator[Tuple[str, os.DirEntry]]:
+    """
+    Walks the given directory in a deterministic order, skipping anything excluded by the given rules without reading
+    directories whose contents are all excluded.
+    :param root: directory to walk
+    :param dockerignore: rules for what is excluded (nothing is excluded if `None`)
+    :return: iterator of tuples where the first element is the path relative to the root (`/` separated) and the
+    second is the directory entry (directories are given before their contents)
+    """
+    def walk_directory(directory: str, relative_directory: str) -> Iterator[Tuple[str, os.DirEntry]]:
+        with os.scandir(directory) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            path = entry.name if relative_directory == "" else f"{relative_directory}/{entry.name}"
+            is_directory = entry.is_dir(follow_symlinks=False)
+            if dockerignore is not None and dockerignore.is_excluded(path):
+                if is_directory and not dockerignore.is_pruned(path):
+                    yield from walk_directory(entry.path, path)
+                continue
+            yield path, entry
+            if is_directory:
+                yield from walk_directory(entry.path, path)
+
+    return walk_directory(root, "")
+
+
+def _clean_path(path: str) -> str:
+    """
+    Cleans the given path in the way Docker does before matching.
+    :param path: the path
+    :return: cleaned path, relative to the root of the context
+    """
+    path = posixpath.normpath(path.replace(os.sep, "/")).lstrip("/")
+    return "" if path == "." else path
+
+
+def _compile(pattern: str) -> Pattern:
+    """
+    Compiles the given `.dockerignore` pattern into a regular expression, following Docker's implementation.
+    :param pattern: cleaned pattern
+    :return: compiled regular expression
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        character = pattern[i]
+        if character == "*":
+            if pattern[i + 1:i + 2] == "*":
+                i += 1
+                if pattern[i + 1:i + 2] == "/":
+                    i += 1
+                regex += ".*" if i + 1 >= len(pattern) else "(.*/)?"
+            else:
+                regex += "[^/]*"
+        elif character == "?":
+            regex += "[^/]"
+        elif character == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        elif character == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(character)
+            else:
+                regex += f"[{pattern[i + 1:end]}]"
+                i = end
+        else:
+            regex += re.escape(character)
+        i += 1
+    return re.compile(f"^{regex}$")
+
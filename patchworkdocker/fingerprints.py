@@ -0,0 +1,55 @@
+import hashlib
+import os
+import stat
+
+from patchworkdocker.dockerignore import DockerIgnore, walk
+
+_READ_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(location: str) -> str:
+    """
+    Hashes the contents of the given file.
+    :param location: location of the file
+    :return: SHA-256 hex digest of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(location, "rb") as file:
+        for block in iter(lambda: file.read(_READ_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_path(location: str, dockerignore: DockerIgnore=None) -> str:
+    """
+    Hashes the given file or directory tree.
+
+    The hash of a tree covers the relative path, type, executable bit and contents of everything in it (symlinks are
+    not followed).
+    :param location: location of the file or directory
+    :param dockerignore: rules for files in the tree that are excluded from the hash
+    :return: SHA-256 hex digest
+    """
+    if not os.path.isdir(location):
+        return hash_file(location)
+
+    digest = hashlib.sha256()
+    for path, entry in walk(location, dockerignore):
+        status = entry.stat(follow_symlinks=False)
+        if stat.S_ISLNK(status.st_mode):
+            content = f"link:{os.readlink(entry.path)}"
+        elif stat.S_ISDIR(status.st_mode):
+            content = "directory"
+        else:
+            content = f"file:{status.st_mode & stat.S_IXUSR}:{hash_file(entry.path)}"
+        digest.update(f"{path}\0{content}\0".encode())
+    return digest.hexdigest()
+
+
+def hash_text(text: str) -> str:
+    """
+    Hashes the given text.
+    :param text: text to hash
+    :return: SHA-256 hex digest
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
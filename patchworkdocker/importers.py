@@ -1,10 +1,84 @@
+import hashlib
+import json
 import os
+import re
+import shutil
+import tarfile
 from abc import ABCMeta, abstractmethod
-from distutils import dir_util
-from tempfile import mkdtemp
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from tempfile import mkdtemp, SpooledTemporaryFile
+from threading import Lock
+from typing import Optional, Iterable, Tuple, BinaryIO, Iterator, TYPE_CHECKING, Callable, Dict, Any, List, TypeVar, \
+    FrozenSet
 from urllib.parse import urldefrag, urlparse
+from zipfile import ZipFile, BadZipFile
 
-from git import Repo
+from logzero import logger
+
+from patchworkdocker.caches import GitMirrorCache
+from patchworkdocker.cancellation import check_cancelled
+from patchworkdocker.contexts import ContextBase, DirectoryContextBase, GitContextBase
+from patchworkdocker.copying import clone_tree, clone_file, clear_directory
+from patchworkdocker.docker_images import create_docker_client, get_image_id
+from patchworkdocker.dockerignore import DockerIgnore, walk
+from patchworkdocker.errors import PatchworkDockerError
+from patchworkdocker.fingerprints import hash_path, hash_text
+from patchworkdocker.meta import PACKAGE_NAME, VERSION
+from patchworkdocker.profiling import span, record
+from patchworkdocker.refs import RefResolver
+
+if TYPE_CHECKING:
+    # GitPython is slow to import, so it is only imported when importing from git
+    from git import Repo, Commit
+    from docker import DockerClient
+    from requests import Session
+
+IMPORTERS_ENTRY_POINT_GROUP = f"{PACKAGE_NAME}.importers"
+HTTP_SESSION_RESOURCE = "http_session"
+DOCKER_CLIENT_RESOURCE = "docker_client"
+DEFAULT_ARCHIVE_TIMEOUT = 60
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ZIP_SUFFIXES = (".zip", )
+_ARCHIVE_READ_BLOCK_SIZE = 1024 * 1024
+# Zip archives are read from their end, so they are spooled (in memory, unless larger than this) before extraction
+_ZIP_SPOOL_MAX_MEMORY = 16 * 1024 * 1024
+_GIT_SCHEMES = ("git", "ssh", "git+ssh", "ssh+git")
+# Fragment of a local archive's origin that is taken to be a checksum, rather than part of the archive's file name
+_CHECKSUM_FRAGMENT_PATTERN = re.compile(r"^[A-Za-z0-9_]+=[0-9A-Fa-f]+$")
+
+_ResourceType = TypeVar("_ResourceType")
+
+
+class ArchiveError(PatchworkDockerError):
+    """
+    Raised when an archive cannot be imported.
+    """
+
+
+class ChecksumMismatchError(ArchiveError):
+    """
+    Raised when an archive does not match the checksum that it was expected to have.
+    """
+
+
+class ImageImportError(PatchworkDockerError):
+    """
+    Raised when materials cannot be imported from a Docker image.
+    """
+
+
+@dataclass(frozen=True)
+class ImportUpdate:
+    """
+    Update of loaded materials to the materials that would be loaded from their origin now (see `Importer.get_update`).
+    """
+    # Paths, relative to the load directory, of the files that the update adds, changes or removes
+    changed_paths: FrozenSet[str]
+    # State of the materials once they have been updated (see `Importer.get_state`)
+    state: Any
+    # Updates the load directory, where the files at the changed paths must be as they were loaded
+    apply: Callable[[], None]
 
 
 class Importer(metaclass=ABCMeta):
@@ -30,9 +104,65 @@ class Importer(metaclass=ABCMeta):
         :param load_directory: the directory in which imported materials should be saved
         :return: directory containing the loaded content
         """
+        check_cancelled()
         if load_directory is None:
             load_directory = mkdtemp()
-        return self._load(origin, load_directory)
+        with span("import", origin=origin):
+            return self._load(origin, load_directory)
+
+    def load_base(self, origin: str, load_directory: str=None) -> ContextBase:
+        """
+        Loads the materials from the given origin as a read-only build context base, without copying them into a
+        working tree where it can be avoided.
+
+        The load directory, which is a generated temp directory if `None`, is not cleaned up automatically.
+        :param origin: where to import materials from
+        :param load_directory: the directory in which any materials that have to be saved are saved
+        :return: base of a build context
+        """
+        return DirectoryContextBase(self.load(origin, load_directory))
+
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        """
+        Gets a fingerprint of the materials that would be loaded from the given origin, without loading them.
+        :param origin: where materials would be imported from
+        :return: fingerprint that changes if the loaded materials would change, or `None` if it cannot be determined
+        """
+        return None
+
+    def get_state(self, origin: str, load_directory: str) -> Any:
+        """
+        Gets the state of the materials that have been loaded from the given origin into the given directory, which
+        they can later be updated from (see `get_update`).
+        :param origin: where the materials were imported from
+        :param load_directory: the directory that the materials were loaded into
+        :return: the state, which can be serialised as JSON (`None` if the materials cannot be updated)
+        """
+        return self.get_fingerprint(origin)
+
+    def get_update(self, origin: str, load_directory: str, state: Any) -> Optional[ImportUpdate]:
+        """
+        Gets the update of the materials that were loaded into the given directory, in the given state, to the
+        materials that would be loaded from the given origin now, without changing the directory.
+
+        By default, materials can only be updated if they have not changed.
+        :param origin: where to import materials from
+        :param load_directory: the directory that the materials were loaded into
+        :param state: the state of the loaded materials (see `get_state`)
+        :return: the update, or `None` if the materials cannot be updated, in which case they must be loaded again
+        """
+        if state is None or state != self.get_fingerprint(origin):
+            return None
+        return ImportUpdate(frozenset(), state, lambda: None)
+
+    @property
+    def default_excluded_patterns(self) -> Tuple[str, ...]:
+        """
+        Patterns, in the form used in `.dockerignore` files, for loaded materials that are not part of the build context
+        unless the `.dockerignore` file says otherwise (e.g. version control metadata).
+        :return: the patterns
+        """
+        return ()
 
 
 class GitImporter(Importer):
@@ -40,53 +170,981 @@ class GitImporter(Importer):
     Imports content from a git repository.
     
     For a specific commit, branch or tag, set the fragment, e.g. http://example.com/repo.git#branch_tag_or_commit.
+
+    The fragment is resolved to a commit before anything is cloned, so the commit that is fingerprinted is the commit
+    that is loaded.
     """
+    def __init__(self, mirror_cache: Optional[GitMirrorCache]=None, *, shallow: bool=False,
+                 sparse_paths: Optional[Iterable[str]]=None, ref_resolver: RefResolver=None):
+        """
+        Constructor.
+        :param mirror_cache: cache of repository mirrors to clone from, which is updated from the origin before use
+        (clones directly from the origin if `None`)
+        :param shallow: whether to only fetch the commit that is to be checked out (ignored if using a mirror cache)
+        :param sparse_paths: paths, relative to the repository root, to restrict the checkout to (everything is checked
+        out if `None`)
+        :param ref_resolver: resolves fragments to commits (a resolver without a lockfile if `None`)
+        """
+        self.mirror_cache = mirror_cache
+        self.shallow = shallow
+        self.sparse_paths = sparse_paths
+        self.ref_resolver = ref_resolver if ref_resolver is not None else RefResolver()
+
+    @property
+    def default_excluded_patterns(self) -> Tuple[str, ...]:
+        return (".git", )
+
     def _load(self, origin: str, load_directory: str) -> str:
+        repository, branch, commit = self._clone(origin, load_directory)
+
+        with span("git_checkout"):
+            if self.sparse_paths is not None:
+                GitImporter._set_sparse_checkout(repository, self.sparse_paths)
+
+            if branch != "":
+                if branch not in repository.heads:
+                    repository.create_head(path=branch, commit=commit or GitImporter._get_commit(repository, branch))
+                repository.heads[branch].checkout(force=True)
+            else:
+                repository.git.checkout(force=True)
+            if commit is not None and repository.head.commit.hexsha != commit:
+                # The reference has moved since it was resolved (or was pinned)
+                repository.head.reset(commit, index=True, working_tree=True)
+
+        return load_directory
+
+    def load_base(self, origin: str, load_directory: str=None) -> ContextBase:
+        if load_directory is None:
+            load_directory = mkdtemp()
+        with span("import", origin=origin):
+            repository, branch, commit = self._clone(origin, load_directory)
+            if commit is None:
+                commit = (GitImporter._get_commit(repository, branch) if branch != ""
+                          else repository.head.commit).hexsha
+            return GitContextBase(load_directory, commit, self.sparse_paths)
+
+    def _clone(self, origin: str, load_directory: str) -> Tuple["Repo", str, Optional[str]]:
+        """
+        Clones the given origin into the given directory, without checking out a working tree.
+        :param origin: git origin, with an optional fragment
+        :param load_directory: directory to clone into
+        :return: tuple where the first element is the cloned repository, the second is the branch, tag or commit
+        given in the origin's fragment and the third is the commit that it was resolved to (`None` if not resolved)
+        """
+        from git import Repo
+
         origin, branch = urldefrag(origin)
-        repository = Repo.clone_from(url=origin, to_path=load_directory)
+        commit = self.ref_resolver.try_resolve(origin, branch)
+        with span("git_clone", origin=origin):
+            if self.mirror_cache is not None:
+                if self.shallow:
+                    logger.debug("Not shallow cloning as objects are linked from the mirror cache")
+                with self.mirror_cache.mirror(origin) as mirror_location:
+                    # Cloning from a local path hardlinks the objects, so the clone survives the mirror's eviction
+                    repository = Repo.clone_from(url=mirror_location, to_path=load_directory, no_checkout=True)
+                repository.remote().set_url(origin)
+            elif self.shallow:
+                repository = GitImporter._shallow_fetch(origin, branch, load_directory, commit)
+            else:
+                repository = Repo.clone_from(url=origin, to_path=load_directory, no_checkout=True)
+        return repository, branch, commit
 
-        if branch != "":
-            if branch not in repository.heads:
-                branch_reference = None
-                for reference in repository.refs:
-                    if reference.name == f"origin/{branch}":
-                        branch_reference = reference
-                        break
-                if branch_reference is not None:
-                    commit = branch_reference.commit
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        origin, branch = urldefrag(origin)
+        commit = self.ref_resolver.try_resolve(origin, branch)
+        if commit is None:
+            return None
+        sparse_paths = sorted(self.sparse_paths) if self.sparse_paths is not None else None
+        return hash_text(json.dumps(["git", commit, self.shallow, sparse_paths]))
+
+    def get_state(self, origin: str, load_directory: str) -> Any:
+        from git import Repo
+
+        sparse_paths = sorted(self.sparse_paths) if self.sparse_paths is not None else None
+        return dict(origin=urldefrag(origin)[0], commit=Repo(load_directory).head.commit.hexsha,
+                    sparse_paths=sparse_paths)
+
+    def get_update(self, origin: str, load_directory: str, state: Any) -> Optional[ImportUpdate]:
+        """
+        Gets the update of the checked out repository in the given directory to the commit that would now be checked
+        out, fetching only the commits that the repository does not have.
+
+        The repository cannot be updated if it was loaded from a different repository or with different sparse paths.
+        :param origin: git origin, with an optional fragment
+        :param load_directory: the directory that the repository was loaded into
+        :param state: the state of the loaded repository (see `get_state`)
+        :return: the update, or `None` if the repository cannot be updated
+        """
+        from git import Repo
+
+        origin, branch = urldefrag(origin)
+        sparse_paths = sorted(self.sparse_paths) if self.sparse_paths is not None else None
+        if state is None or state.get("origin") != origin or state.get("sparse_paths") != sparse_paths:
+            return None
+        repository = Repo(load_directory)
+        loaded_commit = state["commit"]
+        commit = self.ref_resolver.try_resolve(origin, branch)
+        if commit is None or commit != loaded_commit:
+            commit = self._fetch(repository, origin, branch, commit)
+        if commit == loaded_commit:
+            return ImportUpdate(frozenset(), state, lambda: None)
+        changed_paths = repository.git.diff("--name-only", "--no-renames", "-z", loaded_commit, commit).split("\0")
+
+        def apply():
+            with span("git_checkout"):
+                # Restored files have their loaded contents but not the file status that the index has for them
+                repository.git.update_index("--refresh", "-q", with_exceptions=False)
+                # Only the files that differ between the commits are checked out (within the sparse paths)
+                repository.git.read_tree("-m", "-u", loaded_commit, commit)
+                if branch != "":
+                    repository.git.update_ref(f"refs/heads/{branch}", commit)
+                    repository.git.symbolic_ref("HEAD", f"refs/heads/{branch}")
                 else:
-                    commit = repository.commit(branch)
-                repository.create_head(path=branch, commit=commit)
-            repository.heads[branch].checkout()
+                    repository.head.reset(commit, index=False, working_tree=False)
 
-        return load_directory
+        logger.info(f"Updating {origin} from {loaded_commit} to {commit}")
+        return ImportUpdate(frozenset(path for path in changed_paths if path != ""), dict(state, commit=commit), apply)
+
+    def _fetch(self, repository: "Repo", origin: str, branch: str, commit: Optional[str]) -> str:
+        """
+        Fetches the commit that the given branch, tag or commit refers to into the given repository, which only fetches
+        the objects that the repository does not already have.
+        :param repository: the repository
+        :param origin: git origin (without fragment)
+        :param branch: branch, tag or commit to fetch (the default branch if empty)
+        :param commit: the commit that the branch, tag or commit has been resolved to, which is fetched instead
+        :return: the fetched commit
+        """
+        from git import GitCommandError
+
+        reference = commit if commit is not None else (branch or "HEAD")
+        with span("git_fetch", origin=origin), ExitStack() as stack:
+            source = origin
+            fetch_kwargs = dict(depth=1) if self.shallow else {}
+            if self.mirror_cache is not None:
+                source = stack.enter_context(self.mirror_cache.mirror(origin))
+                fetch_kwargs = {}
+            try:
+                repository.git.fetch(source, reference, **fetch_kwargs)
+            except GitCommandError:
+                logger.info(f"Could not fetch {reference} from {origin}: fetching all")
+                repository.git.fetch(source, "+refs/heads/*:refs/remotes/origin/*", "+refs/tags/*:refs/tags/*")
+                return commit if commit is not None else GitImporter._get_commit(repository, branch).hexsha
+        return commit if commit is not None else repository.commit("FETCH_HEAD").hexsha
+
+    @staticmethod
+    def _get_commit(repository: "Repo", branch: str) -> "Commit":
+        """
+        Gets the commit that the given branch, tag or commit refers to in the given cloned repository.
+        :param repository: the cloned repository
+        :param branch: branch, tag or commit
+        :return: the commit
+        """
+        if branch in repository.heads:
+            return repository.heads[branch].commit
+        for reference in repository.refs:
+            if reference.name == f"origin/{branch}":
+                return reference.commit
+        return repository.commit(branch)
+
+    @staticmethod
+    def _shallow_fetch(origin: str, branch: str, load_directory: str, commit: str=None) -> "Repo":
+        """
+        Fetches only the commit required to checkout the given branch, tag or commit.
+
+        Falls back to a full fetch if the remote cannot serve the reference directly (e.g. an abbreviated commit).
+        :param origin: git origin (without fragment)
+        :param branch: branch, tag or commit to fetch (the default branch if empty)
+        :param load_directory: the directory to fetch the repository into
+        :param commit: the commit that the branch, tag or commit has been resolved to, which is fetched instead
+        :return: the fetched repository, with the working tree not checked out
+        """
+        from git import Repo, GitCommandError
+
+        reference = commit if commit is not None else branch
+        if reference == "":
+            return Repo.clone_from(url=origin, to_path=load_directory, no_checkout=True, depth=1)
+
+        repository = Repo.init(load_directory)
+        repository.create_remote("origin", origin)
+        try:
+            repository.git.fetch("origin", reference, depth=1)
+        except GitCommandError:
+            logger.info(f"Could not shallow fetch {reference} from {origin}: fetching all")
+            repository.remote().fetch()
+            repository.remote().fetch(tags=True)
+            return repository
+        if branch != "":
+            repository.create_head(path=branch, commit=repository.commit("FETCH_HEAD"))
+        else:
+            repository.head.set_reference(repository.commit("FETCH_HEAD"))
+        return repository
+
+    @staticmethod
+    def _set_sparse_checkout(repository: "Repo", paths: Iterable[str]):
+        """
+        Restricts the checkout of the given repository to the given paths.
+        :param repository: repository to configure
+        :param paths: paths (files or directories), relative to the repository root, to checkout
+        """
+        repository.git.config("core.sparseCheckout", "true")
+        sparse_checkout_location = os.path.join(repository.git_dir, "info", "sparse-checkout")
+        os.makedirs(os.path.dirname(sparse_checkout_location), exist_ok=True)
+        with open(sparse_checkout_location, "w") as file:
+            for path in paths:
+                path = os.path.normpath(path).strip("/")
+                file.write("/*\n" if path == "." else f"/{path}\n")
 
 
 class FileSystemImporter(Importer):
     """
     Imports content from the local file system.
+
+    Files excluded by the origin's `.dockerignore` file are not imported.
+    """
+    def __init__(self, *, dockerfile_location: str="Dockerfile", excluded_patterns: Iterable[str]=(),
+                 link_files: bool=False):
+        """
+        Constructor.
+        :param dockerfile_location: location of the Dockerfile relative to the origin, which is never excluded
+        :param excluded_patterns: patterns for files that are not imported, which are applied before those in the
+        origin's `.dockerignore` file
+        :param link_files: whether imported files may be hardlinks to the originals when they cannot be reflinked, in
+        which case they must be copied up (see `copy_up`) before being modified in place
+        """
+        self.dockerfile_location = dockerfile_location
+        self.excluded_patterns = tuple(excluded_patterns)
+        self.link_files = link_files
+
+    def _load(self, origin: str, load_directory: str) -> str:
+        clone_tree(origin, load_directory, link=self.link_files, dockerignore=self._get_dockerignore(origin))
+        return load_directory
+
+    def load_base(self, origin: str, load_directory: str=None) -> ContextBase:
+        return DirectoryContextBase(origin)
+
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        return hash_text(json.dumps(["file-system", hash_path(origin, self._get_dockerignore(origin))]))
+
+    def get_state(self, origin: str, load_directory: str) -> Any:
+        return dict(origin=os.path.abspath(origin), files=self._get_file_statuses(origin))
+
+    def get_update(self, origin: str, load_directory: str, state: Any) -> Optional[ImportUpdate]:
+        """
+        Gets the update of the materials in the given directory to those in the origin now, which, as with `rsync`,
+        changes the files whose size, modification time or mode have changed in the origin since they were loaded.
+        :param origin: where to import materials from
+        :param load_directory: the directory that the materials were loaded into
+        :param state: the state of the loaded materials (see `get_state`)
+        :return: the update, or `None` if the materials were loaded from a different origin
+        """
+        if state is None or state.get("origin") != os.path.abspath(origin):
+            return None
+        file_statuses = self._get_file_statuses(origin)
+        loaded_file_statuses = state["files"]
+        changed_paths = frozenset(path for path in file_statuses.keys() | loaded_file_statuses.keys()
+                                  if file_statuses.get(path) != loaded_file_statuses.get(path))
+
+        def apply():
+            # Removed first, so directories can replace files (and vice versa)
+            for path in sorted(changed_paths - file_statuses.keys(), reverse=True):
+                if os.path.lexists(os.path.join(load_directory, path)):
+                    os.remove(os.path.join(load_directory, path))
+            for path in sorted(changed_paths & file_statuses.keys()):
+                check_cancelled()
+                source = os.path.join(origin, path)
+                destination = os.path.join(load_directory, path)
+                if os.path.isdir(destination) and not os.path.islink(destination):
+                    shutil.rmtree(destination)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                if os.path.islink(source):
+                    if os.path.lexists(destination):
+                        os.remove(destination)
+                    os.symlink(os.readlink(source), destination)
+                else:
+                    clone_file(source, destination, link=self.link_files)
+            record(files=len(changed_paths))
+
+        return ImportUpdate(changed_paths, dict(state, files=file_statuses), apply)
+
+    def _get_dockerignore(self, origin: str) -> DockerIgnore:
+        """
+        Gets the rules for the files in the given origin that are not imported.
+        :param origin: where materials are imported from
+        :return: the rules
+        """
+        return DockerIgnore.from_directory(origin, default_patterns=self.excluded_patterns,
+                                           dockerfile_location=self.dockerfile_location)
+
+    def _get_file_statuses(self, origin: str) -> Dict[str, List[int]]:
+        """
+        Gets the size, modification time and mode of each file (or symlink) in the given origin that is imported.
+        :param origin: where materials are imported from
+        :return: the statuses, as lists, keyed by the path of the file relative to the origin
+        """
+        file_statuses = {}
+        for path, entry in walk(origin, self._get_dockerignore(origin)):
+            if not entry.is_dir(follow_symlinks=False):
+                status = entry.stat(follow_symlinks=False)
+                file_statuses[path] = [status.st_size, status.st_mtime_ns, status.st_mode]
+        return file_statuses
+
+
+class ArchiveImporter(Importer, metaclass=ABCMeta):
     """
+    Imports content from an archive, which is either a local file or fetched from an HTTP(S) URL.
+
+    The archive is extracted as it is read, so a fetched archive is never saved whole. If the archive contains only a
+    single directory (e.g. a GitHub archive), the contents of that directory are imported.
+
+    An expected checksum of the archive can be given as the fragment, in the form `algorithm=hex_digest`, e.g.
+    http://example.com/release.tar.gz#sha256=e3b0c442.... The import fails, and the extracted files are removed, if the
+    archive does not match it. The checksum is then also the fingerprint of what is imported, so an archive whose
+    prepared context or import is cached is not fetched again.
+    """
+    def __init__(self, *, timeout: float=DEFAULT_ARCHIVE_TIMEOUT, resources: "ImporterResources"=None):
+        """
+        Constructor.
+        :param timeout: timeout in seconds of blocking operations whilst fetching an archive
+        :param resources: resources shared with other importers, including the HTTP session that archives are fetched
+        with, which keeps connections open between fetches (the importer has its own if `None`)
+        """
+        self.timeout = timeout
+        self.resources = resources if resources is not None else ImporterResources()
+
+    @abstractmethod
+    def _extract(self, stream: BinaryIO, load_directory: str):
+        """
+        Extracts the archive read from the given stream into the given directory.
+        :param stream: stream of the archive, which is read sequentially
+        :param load_directory: the directory to extract into
+        :raises ArchiveError: raised if the archive cannot be extracted
+        """
+
     def _load(self, origin: str, load_directory: str) -> str:
-        dir_util.copy_tree(origin, load_directory)
+        location, checksum = ArchiveImporter.parse_origin(origin)
+        with self._open(location) as stream:
+            reader = _HashingReader(stream, checksum[0] if checksum is not None else None)
+            try:
+                self._extract(reader, load_directory)
+                # Anything after the end of the archive (e.g. padding) is part of what the checksum covers
+                reader.read_to_end()
+                if checksum is not None and reader.hexdigest() != checksum[1]:
+                    raise ChecksumMismatchError(f"{checksum[0]} checksum of {location} is {reader.hexdigest()}, "
+                                                f"expected {checksum[1]}")
+            except BaseException:
+                clear_directory(load_directory)
+                raise
+        record(bytes_read=reader.bytes_read)
+        ArchiveImporter._remove_top_level_directory(load_directory)
         return load_directory
 
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        location, checksum = ArchiveImporter.parse_origin(origin)
+        if checksum is not None:
+            return hash_text(json.dumps(["archive", *checksum]))
+        if not ArchiveImporter.is_url(location):
+            return hash_text(json.dumps(["archive", "sha256", hash_path(location)]))
+        logger.info(f"Archive {location} has no checksum, so what is imported from it is not cached (give its checksum "
+                    f"as the fragment, e.g. {location}#sha256=...)")
+        return None
+
+    @staticmethod
+    def parse_origin(origin: str) -> Tuple[str, Optional[Tuple[str, str]]]:
+        """
+        Parses the given origin.
+        :param origin: location or URL of the archive, with an optional checksum fragment
+        :return: tuple where the first element is the location or URL of the archive and the second is the expected
+        checksum, as a tuple of the hash algorithm and the hex digest (`None` if there is no checksum fragment)
+        :raises ValueError: raised if the fragment is not a valid checksum
+        """
+        location, fragment = ArchiveImporter.split_origin(origin)
+        if fragment == "":
+            return location, None
+        algorithm, _, digest = fragment.partition("=")
+        algorithm = algorithm.lower()
+        if algorithm not in hashlib.algorithms_guaranteed or digest == "":
+            raise ValueError(f"Fragment of archive origin must be a checksum in the form algorithm=hex_digest "
+                             f"(where the algorithm is one of {sorted(hashlib.algorithms_guaranteed)}): {fragment}")
+        return location, (algorithm, digest.lower())
+
+    @staticmethod
+    def split_origin(origin: str) -> Tuple[str, str]:
+        """
+        Splits the given origin into the location or URL of the archive and its fragment. The fragment of a local
+        archive is only split off if it is in the form of a checksum, so a file name can contain `#`.
+        :param origin: location or URL of the archive, with an optional fragment
+        :return: tuple where the first element is the location or URL of the archive and the second is the fragment
+        (empty if there is not one)
+        """
+        if ArchiveImporter.is_url(origin):
+            location, fragment = urldefrag(origin)
+            return location, fragment
+        location, _, fragment = origin.rpartition("#")
+        if location == "" or _CHECKSUM_FRAGMENT_PATTERN.match(fragment) is None:
+            return origin, ""
+        return location, fragment
+
+    @staticmethod
+    def is_url(origin: str) -> bool:
+        """
+        Gets whether the given origin is an HTTP(S) URL, rather than a local file.
+        :param origin: the origin
+        :return: whether the origin is a URL
+        """
+        return urlparse(origin).scheme in ("http", "https")
+
+    @contextmanager
+    def _open(self, location: str) -> Iterator[BinaryIO]:
+        """
+        Opens the archive at the given location for reading.
+        :param location: location or HTTP(S) URL of the archive
+        :return: context manager that yields the archive's stream
+        """
+        if not ArchiveImporter.is_url(location):
+            with open(location, "rb") as file:
+                yield file
+            return
+        # Only imported when fetching, as it is slow to import
+        from requests import RequestException
+
+        logger.info(f"Fetching archive: {location}")
+        session = self.resources.get(HTTP_SESSION_RESOURCE, create_http_session)
+        with span("fetch_archive", url=location):
+            try:
+                response = session.get(location, stream=True, timeout=self.timeout)
+                response.raise_for_status()
+            except RequestException as e:
+                raise ArchiveError(f"Could not fetch archive {location}: {e}") from e
+            # The connection is only returned to the session's pool once the response has been read and closed
+            with response:
+                yield response.raw
+
+    @staticmethod
+    def _remove_top_level_directory(load_directory: str):
+        """
+        Moves the contents of the given directory's only entry up into the directory, if that entry is a directory.
+        :param load_directory: the directory
+        """
+        entries = os.listdir(load_directory)
+        if len(entries) != 1:
+            return
+        top_level_location = os.path.join(load_directory, entries[0])
+        if os.path.islink(top_level_location) or not os.path.isdir(top_level_location):
+            return
+        # Moved aside first, as it could contain an entry with the same name as itself
+        moved_location = mkdtemp(dir=load_directory)
+        os.rmdir(moved_location)
+        os.rename(top_level_location, moved_location)
+        for entry in os.listdir(moved_location):
+            os.rename(os.path.join(moved_location, entry), os.path.join(load_directory, entry))
+        os.rmdir(moved_location)
+
+
+class TarballImporter(ArchiveImporter):
+    """
+    Imports content from a tarball (optionally compressed with gzip, bzip2 or xz), which is extracted member by member
+    as it is read.
+    """
+    def _extract(self, stream: BinaryIO, load_directory: str):
+        _extract_tar(stream, load_directory)
+
+
+class ZipImporter(ArchiveImporter):
+    """
+    Imports content from a zip archive.
+
+    Zip archives are indexed at their end, so they cannot be extracted as they are read: a fetched archive is spooled in
+    memory (or, if large, in a temp file) first.
+    """
+    def _extract(self, stream: BinaryIO, load_directory: str):
+        with SpooledTemporaryFile(max_size=_ZIP_SPOOL_MAX_MEMORY) as spool:
+            shutil.copyfileobj(stream, spool, _ARCHIVE_READ_BLOCK_SIZE)
+            spool.seek(0)
+            try:
+                archive = ZipFile(spool)
+            except BadZipFile as e:
+                raise ArchiveError(f"Could not read zip archive: {e}") from e
+            with archive:
+                for member in archive.infolist():
+                    check_cancelled()
+                    _check_archive_path(member.filename)
+                    location = archive.extract(member, load_directory)
+                    # Permissions (e.g. the executable bit) are kept in the high bits of the external attributes
+                    mode = (member.external_attr >> 16) & 0o777
+                    if mode != 0 and not member.is_dir():
+                        os.chmod(location, mode)
+
+
+class ImageImporter(Importer):
+    """
+    Imports content from the file system of a Docker image, given as `docker-image://name:tag#path`, where the path is
+    the directory (or file) in the image to import (everything if it is not given), e.g.
+    `docker-image://example/builder:1.0#/usr/src/app`.
+
+    The image is pulled if the Docker daemon does not have it. Only the given path is streamed out of the image, using
+    the daemon's archive API on a container that is created (but never started) from it, which is then removed.
+    """
+    SCHEME = "docker-image"
+
+    def __init__(self, docker_client: "DockerClient"=None, *, resources: "ImporterResources"=None):
+        """
+        Constructor.
+        :param docker_client: Docker client to import with (that of the resources if `None`)
+        :param resources: resources shared with other importers, including the Docker client, which is created from the
+        environment when first needed (the importer has its own if `None`)
+        """
+        self._docker_client = docker_client
+        self.resources = resources if resources is not None else ImporterResources()
+
+    @property
+    def docker_client(self) -> "DockerClient":
+        """
+        Docker client that is imported with.
+        :return: the client
+        """
+        if self._docker_client is None:
+            self._docker_client = self.resources.get(DOCKER_CLIENT_RESOURCE, create_docker_client)
+        return self._docker_client
+
+    def _load(self, origin: str, load_directory: str) -> str:
+        from docker.errors import NotFound
+
+        image_name, path = ImageImporter.parse_origin(origin)
+        image_id = get_image_id(image_name, self.docker_client, pull=True)
+        if image_id is None:
+            raise ImageImportError(f"Docker image could not be found or pulled: {image_name}")
+        # The container is never started but the daemon requires it to have a command, which the image may not set
+        container = self.docker_client.api.create_container(image_id, command=[PACKAGE_NAME])
+        try:
+            with span("fetch_image_files", image=image_name, path=path):
+                try:
+                    chunks, _ = self.docker_client.api.get_archive(container, path, chunk_size=_ARCHIVE_READ_BLOCK_SIZE)
+                except NotFound as e:
+                    raise ImageImportError(f"Path not found in Docker image {image_name}: {path}") from e
+                reader = _HashingReader(_ChunksReader(chunks), None)
+                try:
+                    _extract_tar(reader, load_directory)
+                except BaseException:
+                    clear_directory(load_directory)
+                    raise
+        finally:
+            self.docker_client.api.remove_container(container, force=True)
+        record(bytes_read=reader.bytes_read)
+        # The daemon archives a directory as an entry named after it, rather than as its contents
+        if path != "/":
+            ArchiveImporter._remove_top_level_directory(load_directory)
+        return load_directory
+
+    def get_fingerprint(self, origin: str) -> Optional[str]:
+        image_name, path = ImageImporter.parse_origin(origin)
+        # Image IDs are content addressed, so they change if any of the image's files do
+        image_id = get_image_id(image_name, self.docker_client)
+        if image_id is None:
+            return None
+        return hash_text(json.dumps(["docker-image", image_id, path]))
+
+    @staticmethod
+    def parse_origin(origin: str) -> Tuple[str, str]:
+        """
+        Parses the given origin.
+        :param origin: the origin, in the form `docker-image://name:tag#path`
+        :return: tuple where the first element is the image name and the second is the absolute path in the image
+        :raises ValueError: raised if the origin is not a Docker image origin
+        """
+        prefix = f"{ImageImporter.SCHEME}://"
+        if not origin.startswith(prefix):
+            raise ValueError(f"Docker image origin must start with {prefix}: {origin}")
+        image_name, _, path = origin[len(prefix):].partition("#")
+        if image_name == "":
+            raise ValueError(f"Docker image origin does not name an image: {origin}")
+        path = os.path.normpath(os.path.join("/", path))
+        # `normpath` keeps a leading double slash
+        return image_name, "/" + path.lstrip("/")
+
+
+def create_http_session() -> "Session":
+    """
+    Creates an HTTP session to fetch materials with.
+    :return: the session
+    """
+    from requests import Session
+
+    session = Session()
+    session.headers["User-Agent"] = f"{PACKAGE_NAME}/{VERSION}"
+    return session
+
+
+class _ChunksReader:
+    """
+    Reader of a stream given as an iterator of chunks of bytes.
+    """
+    def __init__(self, chunks: Iterable[bytes]):
+        """
+        Constructor.
+        :param chunks: the chunks
+        """
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._offset = 0
+
+    def read(self, size: int=-1) -> bytes:
+        parts = []
+        while size != 0:
+            if self._offset == len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._offset = 0
+                if self._chunk is None:
+                    self._chunk = b""
+                    break
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            parts.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b"".join(parts)
+
+
+class _HashingReader:
+    """
+    Reader of a stream that hashes what is read, stopping if the operation is cancelled.
+    """
+    def __init__(self, stream: BinaryIO, algorithm: Optional[str]):
+        """
+        Constructor.
+        :param stream: the stream to read
+        :param algorithm: the hash algorithm (see `hashlib`), or `None` to not hash
+        """
+        self.stream = stream
+        self.bytes_read = 0
+        self._digest = hashlib.new(algorithm) if algorithm is not None else None
+
+    def read(self, size: int=-1) -> bytes:
+        check_cancelled()
+        data = self.stream.read(size)
+        if self._digest is not None:
+            self._digest.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def read_to_end(self):
+        """
+        Reads (and hashes) the rest of the stream.
+        """
+        while len(self.read(_ARCHIVE_READ_BLOCK_SIZE)) > 0:
+            pass
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+def _filter_tar_member(member: tarfile.TarInfo, load_directory: str) -> tarfile.TarInfo:
+    """
+    Extraction filter that refuses members that would be unsafe to extract (see `tarfile.data_filter`), apart from
+    absolute symlinks.
+
+    Absolute symlinks are common in the file systems of images (e.g. `/bin/sh -> /bin/busybox`). They resolve within
+    the extracted tree once it is used as a root file system and, as extracting a member through a symlink is refused,
+    nothing is written through them when extracting.
+    :param member: the member
+    :param load_directory: the directory being extracted into
+    :return: the member to extract
+    """
+    if member.issym() and os.path.isabs(member.linkname):
+        return tarfile.tar_filter(member, load_directory)
+    return tarfile.data_filter(member, load_directory)
+
+
+# Extraction filter that refuses members that would be unsafe to extract, where supported (Python 3.12, and backported)
+_TAR_EXTRACT_KWARGS = dict(filter=_filter_tar_member) if hasattr(tarfile, "data_filter") else {}
+
+
+def _extract_tar(stream: BinaryIO, load_directory: str):
+    """
+    Extracts the tarball read from the given stream into the given directory, member by member as it is read.
+    :param stream: stream of the tarball (optionally compressed), which is read sequentially
+    :param load_directory: the directory to extract into
+    :raises ArchiveError: raised if the tarball contains a path outside of the directory
+    """
+    real_load_directory = os.path.realpath(load_directory)
+    # Extracted as a stream, so the tarball can be extracted as it is fetched
+    with tarfile.open(fileobj=stream, mode="r|*") as archive:
+        for member in archive:
+            check_cancelled()
+            _check_archive_path(member.name)
+            # Members must not be extracted through symlinks that were extracted before them
+            parent = os.path.realpath(os.path.join(load_directory, os.path.dirname(member.name)))
+            if os.path.commonpath([real_load_directory, parent]) != real_load_directory:
+                raise ArchiveError(f"Archive contains a path outside of where it is extracted to: {member.name}")
+            if member.issym():
+                # Absolute targets are resolved within the extracted tree when it is used, rather than on this system
+                if not os.path.isabs(member.linkname):
+                    _check_archive_path(os.path.join(os.path.dirname(member.name), member.linkname))
+            elif member.islnk():
+                _check_archive_path(member.linkname)
+            # The attributes of directories are not set, as read-only directories could not then be extracted into
+            archive.extract(member, load_directory, set_attrs=not member.isdir(), **_TAR_EXTRACT_KWARGS)
+
+
+def _check_archive_path(path: str):
+    """
+    Checks that the given path in an archive is within the directory that the archive is extracted into.
+    :param path: the path, relative to the root of the archive
+    :raises ArchiveError: raised if the path is absolute or is outside of the directory
+    """
+    normalised_path = os.path.normpath(path)
+    if os.path.isabs(path) or normalised_path == ".." or normalised_path.startswith(f"..{os.sep}"):
+        raise ArchiveError(f"Archive contains a path outside of where it is extracted to: {path}")
+
+
+class ImporterResources:
+    """
+    Resources (e.g. HTTP sessions and Docker clients) that are shared between the importers created by importer
+    factories, so that connections are kept open between imports when many imports are run in one process.
+    """
+    def __init__(self):
+        self._resources: Dict[str, Any] = {}
+        self._lock = Lock()
+
+    def get(self, name: str, create: Callable[[], _ResourceType]) -> _ResourceType:
+        """
+        Gets the resource with the given name, creating it if it has not already been created.
+        :param name: name of the resource
+        :param create: creates the resource
+        :return: the resource
+        """
+        with self._lock:
+            if name not in self._resources:
+                self._resources[name] = create()
+            return self._resources[name]
+
+    def close(self):
+        """
+        Closes all the resources that have been created (those with a `close` method).
+        """
+        with self._lock:
+            resources = list(self._resources.values())
+            self._resources.clear()
+        for resource in resources:
+            if hasattr(resource, "close"):
+                resource.close()
+
+    def __enter__(self) -> "ImporterResources":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@dataclass(frozen=True)
+class ImporterRegistration:
+    """
+    Registration of an importer with an `ImporterRegistry`.
+    """
+    name: str
+    # Creates the importer, configured by (and using the resources of) the given factory
+    create: Callable[["ImporterFactory"], Importer]
+    # URL schemes of the origins that the importer imports from
+    schemes: Tuple[str, ...] = ()
+    # Gets whether the importer imports from an origin that does not have a scheme that an importer is registered for
+    detect: Optional[Callable[[str], bool]] = None
+
+
+class ImporterRegistry:
+    """
+    Registry of the importers that origins can be imported with.
+
+    The importer for an origin is the one registered for its URL scheme or, if no importer is registered for it, the
+    first (in the order of registration) that detects that it imports from the origin.
+    """
+    def __init__(self, registrations: Iterable[ImporterRegistration]=()):
+        """
+        Constructor.
+        :param registrations: importers to register, in order
+        """
+        self._registrations: List[ImporterRegistration] = []
+        self._registrations_by_scheme: Dict[str, ImporterRegistration] = {}
+        for registration in registrations:
+            self.register(registration)
+
+    @property
+    def registrations(self) -> Tuple[ImporterRegistration, ...]:
+        return tuple(self._registrations)
+
+    def register(self, registration: ImporterRegistration):
+        """
+        Registers the given importer.
+        :param registration: registration of the importer
+        :raises ValueError: raised if an importer with the same name, or for one of the same schemes, is registered
+        """
+        if any(registration.name == registered.name for registered in self._registrations):
+            raise ValueError(f"Importer already registered with name: {registration.name}")
+        for scheme in registration.schemes:
+            if scheme.lower() in self._registrations_by_scheme:
+                raise ValueError(f"Importer already registered for scheme {scheme}: "
+                                 f"{self._registrations_by_scheme[scheme.lower()].name}")
+        self._registrations.append(registration)
+        for scheme in registration.schemes:
+            self._registrations_by_scheme[scheme.lower()] = registration
+
+    def find(self, origin: str) -> Optional[ImporterRegistration]:
+        """
+        Finds the importer for the given origin.
+        :param origin: where to import materials from
+        :return: registration of the importer, or `None` if no importer imports from the origin
+        """
+        registration = self._registrations_by_scheme.get(urlparse(origin).scheme.lower())
+        if registration is not None:
+            return registration
+        for registration in self._registrations:
+            if registration.detect is not None and registration.detect(origin):
+                return registration
+        return None
+
+    def load_entry_points(self, group: str=IMPORTERS_ENTRY_POINT_GROUP):
+        """
+        Registers the importers of installed packages, which are `ImporterRegistration` instances that are advertised
+        by the packages as entry points in the given group.
+
+        Entry points that cannot be loaded or registered are skipped.
+        :param group: the entry point group
+        """
+        from importlib.metadata import entry_points
+
+        for entry_point in entry_points(group=group):
+            try:
+                registration = entry_point.load()
+                if not isinstance(registration, ImporterRegistration):
+                    raise TypeError(f"Entry point is not an {ImporterRegistration.__name__}: {registration}")
+                self.register(registration)
+            except Exception as e:
+                logger.warning(f"Could not register importer from entry point {entry_point.name}: {e}")
+
+
+def create_default_importer_registry(*, load_entry_points: bool=True) -> ImporterRegistry:
+    """
+    Creates a registry of the built-in importers, followed by those of installed packages (see
+    `ImporterRegistry.load_entry_points`).
+    :param load_entry_points: whether to register the importers of installed packages
+    :return: the registry
+    """
+    registry = ImporterRegistry([
+        ImporterRegistration(
+            "file-system", lambda factory: FileSystemImporter(dockerfile_location=factory.dockerfile_location),
+            detect=_is_file_system_origin),
+        ImporterRegistration(
+            "git", lambda factory: GitImporter(factory.git_mirror_cache, shallow=factory.git_shallow,
+                                               sparse_paths=factory.git_sparse_paths,
+                                               ref_resolver=factory.git_ref_resolver),
+            schemes=_GIT_SCHEMES, detect=_is_git_origin),
+        ImporterRegistration(
+            "docker-image", lambda factory: ImageImporter(resources=factory.resources),
+            schemes=(ImageImporter.SCHEME, )),
+        ImporterRegistration(
+            "tarball", lambda factory: TarballImporter(resources=factory.resources),
+            detect=lambda origin: _is_archive_origin(origin, TAR_SUFFIXES)),
+        ImporterRegistration(
+            "zip", lambda factory: ZipImporter(resources=factory.resources),
+            detect=lambda origin: _is_archive_origin(origin, ZIP_SUFFIXES)),
+    ])
+    if load_entry_points:
+        registry.load_entry_points()
+    return registry
+
+
+_default_importer_registry: Optional[ImporterRegistry] = None
+_default_importer_registry_lock = Lock()
+
+
+def get_default_importer_registry() -> ImporterRegistry:
+    """
+    Gets the registry of the built-in importers and those of installed packages, which is created when first got.
+    :return: the registry
+    """
+    global _default_importer_registry
+    with _default_importer_registry_lock:
+        if _default_importer_registry is None:
+            _default_importer_registry = create_default_importer_registry()
+        return _default_importer_registry
+
+
+def _is_file_system_origin(origin: str) -> bool:
+    """
+    Gets whether the given origin is a location on the local file system, other than that of an archive.
+    :param origin: the origin
+    :return: whether the origin is on the local file system
+    """
+    if os.path.isdir(origin):
+        return True
+    return os.path.exists(origin) and not _is_archive_origin(origin, TAR_SUFFIXES + ZIP_SUFFIXES)
+
+
+def _is_git_origin(origin: str) -> bool:
+    """
+    Gets whether the given origin is a git repository, which is when its path has the `.git` suffix or it is a
+    `file://` URL of a (possibly bare) repository.
+    :param origin: the origin
+    :return: whether the origin is a git repository
+    """
+    parsed_origin = urlparse(origin)
+    if parsed_origin.path.endswith(".git"):
+        return True
+    if parsed_origin.scheme != "file":
+        return False
+    return os.path.isdir(os.path.join(parsed_origin.path, ".git")) \
+        or (os.path.isfile(os.path.join(parsed_origin.path, "HEAD"))
+            and os.path.isdir(os.path.join(parsed_origin.path, "objects")))
+
+
+def _is_archive_origin(origin: str, suffixes: Tuple[str, ...]) -> bool:
+    """
+    Gets whether the given origin is an HTTP(S) URL, or an existing local file, of an archive with one of the given
+    suffixes.
+    :param origin: the origin
+    :param suffixes: the suffixes
+    :return: whether the origin is an archive
+    """
+    # Archive origins can have a checksum fragment, which is not part of the archive's location
+    is_url = ArchiveImporter.is_url(origin)
+    archive_path = urlparse(origin).path if is_url else ArchiveImporter.split_origin(origin)[0]
+    return (is_url or os.path.isfile(archive_path)) and archive_path.lower().endswith(suffixes)
+
 
 class ImporterFactory:
     """
-    Importer factory, which can create the correct importer for an origin.
+    Importer factory, which can create the correct importer for an origin (see `ImporterRegistry`).
     """
+    def __init__(self, git_mirror_cache: Optional[GitMirrorCache]=None, *, git_shallow: bool=False,
+                 git_sparse_paths: Optional[Iterable[str]]=None, git_ref_resolver: RefResolver=None,
+                 dockerfile_location: str="Dockerfile", registry: ImporterRegistry=None,
+                 resources: ImporterResources=None):
+        """
+        Constructor.
+        :param git_mirror_cache: cache of git repository mirrors for created git importers to use
+        :param git_shallow: whether created git importers should only fetch the commit to be checked out
+        :param git_sparse_paths: paths to restrict the checkout of created git importers to (`None` for everything)
+        :param git_ref_resolver: resolves references for created git importers (each has its own if `None`)
+        :param dockerfile_location: location of the Dockerfile relative to the root of the imported materials
+        :param registry: registry of the importers that can be created (see `get_default_importer_registry` if `None`)
+        :param resources: resources for created importers to share (only shared between this factory's importers if
+        `None`)
+        """
+        self.git_mirror_cache = git_mirror_cache
+        self.git_shallow = git_shallow
+        self.git_sparse_paths = git_sparse_paths
+        self.git_ref_resolver = git_ref_resolver
+        self.dockerfile_location = dockerfile_location
+        self.registry = registry if registry is not None else get_default_importer_registry()
+        self.resources = resources if resources is not None else ImporterResources()
+
     def create(self, origin: str) -> Importer:
         """
         Create an importer determined by analysis of the given origin.
         :param origin: where to import materials from
         :return: importer for the given origin
         """
-        if os.path.exists(origin):
-            return FileSystemImporter()
-
-        parsed_origin = urlparse(origin)
-        if parsed_origin.scheme == "git" or parsed_origin.path.endswith(".git"):
-            # XXX: it is possible that there's a Git repo at a location that does not have these attributes...
-            return GitImporter()
-
-        raise NotImplementedError(f"No importer implemented to work with: {origin}")
+        registration = self.registry.find(origin)
+        if registration is None:
+            raise NotImplementedError(f"No importer implemented to work with: {origin}")
+        return registration.create(self)
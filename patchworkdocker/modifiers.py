@@ -1,25 +1,76 @@
-import fileinput
+import hashlib
 import itertools
 import os
 import shutil
-from distutils import dir_util
-from tempfile import TemporaryDirectory
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from tempfile import mkstemp
+from threading import Lock
+from typing import List, Iterable, Tuple, Dict, Callable, Optional, TYPE_CHECKING
 
-from patch import fromfile
+from patchworkdocker.cancellation import submit_cancellable
+from patchworkdocker.copying import clone_file, clone_tree
+from patchworkdocker.dockerfiles import Dockerfile, DockerfileTransform, SetBaseImage
+from patchworkdocker.errors import PatchworkDockerError
+from patchworkdocker.profiling import record, is_profiling, span
+
+if TYPE_CHECKING:
+    # The patch library is only imported when there are patches to read
+    from patch import Hunk, PatchSet
+
+_PATCH_SET_CACHE_SIZE = 256
+# Path of the "file" that created files are patched from and deleted files are patched to (the patch library removes
+# the leading slash from absolute paths)
+_DEV_NULL_PATHS = (b"/dev/null", b"dev/null")
+# Prefix that git gives the paths of the new versions of files (see `get_patched_files`)
+_GIT_TARGET_PREFIX = f"b{os.sep}"
+# Permissions of files that patches create
+_CREATED_FILE_MODE = 0o644
+
+_patch_set_cache: Dict[str, "PatchSet"] = OrderedDict()
+_patch_set_cache_lock = Lock()
+
+
+class PatchApplicationError(PatchworkDockerError):
+    """
+    Error applying a patch.
+    """
+
+
+@dataclass(frozen=True)
+class PatchedFile:
+    """
+    File that part of a patch that changes many files applies to.
+    """
+    # Path of the file, relative to the directory that the patch applies to
+    path: str
+    # Whether the patch creates the file (i.e. it is patched from `/dev/null`)
+    created: bool = False
+    # Whether the patch deletes the file (i.e. it is patched to `/dev/null`)
+    deleted: bool = False
 
 
 def copy_file(file: str, destination: str):
     """
     Copy the given file (which could be a directory) to the given destination.
+
+    Files that already exist at the destination are replaced, rather than written to, so files that they share their
+    contents with are not changed.
     :param file: the file (which could be a directory) to copy
     :param destination: where to copy the file to
     """
     if not os.path.exists(file):
         raise FileExistsError(f"Cannot copy file {file} as it does not exist")
     if os.path.isfile(file):
-        shutil.copy(file, destination)
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(file))
+        clone_file(file, destination)
+        if is_profiling():
+            record(files=1, bytes_written=os.path.getsize(destination))
     else:
-        dir_util.copy_tree(file, destination)
+        clone_tree(file, destination)
 
 
 def apply_patch(patch_file: str, target_file: str):
@@ -30,36 +81,243 @@ def apply_patch(patch_file: str, target_file: str):
     ```
     diff -uNr src_1 src_2
     ```
+    The target file is replaced, rather than written to, so files that it shares its contents with are not changed.
     :param patch_file: the patch to apply
-    :param target_file: the patch target
+    :param target_file: the patch target (the hunks of all files in the patch are applied to it)
+    :raises PatchApplicationError: raised if a hunk of the patch does not match the target file
+    """
+    patch_set = read_patch(patch_file)
+    _apply_hunks(patch_file, patch_set, target_file, list(itertools.chain(*[item.hunks for item in patch_set.items])))
+
+
+def apply_patch_set(patch_file: str, directory: str):
+    """
+    Applies the given patch file, which can change many files (e.g. the output of `git diff` or `diff -ur`), to the
+    files relative to the given directory.
+
+    Files that are patched from `/dev/null` are created and files that are patched to `/dev/null` are deleted (see
+    `get_patched_files`).
+    :param patch_file: the patch to apply
+    :param directory: directory that the paths in the patch are relative to
+    :raises PatchApplicationError: raised if a file in the patch does not exist (or already exists, if it is created)
+    or a hunk does not match its file
+    """
+    apply_patches([(patch_file, directory)])
+
+
+def apply_patches(patches: Iterable[Tuple[str, str]], *, max_workers: int=None):
+    """
+    Applies the given patches.
+
+    If the target of a patch is a directory, each file in the patch is applied to its own file relative to that
+    directory (see `apply_patch_set`), else all of the patch is applied to the target file (see `apply_patch`). Patches
+    to the same file are applied in the order given. Different files are patched concurrently.
+    :param patches: tuples where the first element is the patch to apply and the second is its target file or
+    directory
+    :param max_workers: maximum number of files to patch at once (Python's default for thread pools if `None`)
+    :raises PatchApplicationError: raised if a file in a patch does not exist or a hunk of a patch does not match its
+    file (the first in the given order, if several fail)
+    """
+    hunks_by_target: Dict[str, List[Tuple[str, "PatchSet", List["Hunk"], Optional[PatchedFile]]]] = OrderedDict()
+    for patch_file, target in patches:
+        patch_set = read_patch(patch_file)
+        if os.path.isdir(target):
+            patched_files = get_patched_files(patch_file, lambda path: os.path.isfile(os.path.join(target, path)),
+                                              lambda path: os.path.isdir(os.path.join(target, path)))
+            for patched_file, item in zip(patched_files, patch_set.items):
+                hunks_by_target.setdefault(os.path.normpath(os.path.join(target, patched_file.path)), []).append(
+                    (patch_file, patch_set, item.hunks, patched_file))
+        else:
+            hunks_by_target.setdefault(os.path.normpath(target), []).append(
+                (patch_file, patch_set, list(itertools.chain(*[item.hunks for item in patch_set.items])), None))
+
+    def apply_in_order(target_file: str,
+                       hunk_groups: List[Tuple[str, "PatchSet", List["Hunk"], Optional[PatchedFile]]]):
+        for patch_file, patch_set, hunks, patched_file in hunk_groups:
+            with span("apply_patch", file=target_file):
+                _apply_hunks(patch_file, patch_set, target_file, hunks,
+                             created=patched_file is not None and patched_file.created,
+                             deleted=patched_file is not None and patched_file.deleted)
+
+    if len(hunks_by_target) <= 1:
+        for target_file, hunk_groups in hunks_by_target.items():
+            apply_in_order(target_file, hunk_groups)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [submit_cancellable(executor, apply_in_order, target_file, hunk_groups)
+                   for target_file, hunk_groups in hunks_by_target.items()]
+        for future in futures:
+            future.result()
+
+
+def get_patched_files(patch_file: str, exists: Callable[[str], bool],
+                      is_directory: Callable[[str], bool]) -> List[PatchedFile]:
     """
-    patch_set = fromfile(patch_file)
+    Gets the files that each file in the given patch applies to.
+
+    As with `patch`, the new path of each file is tried before the old path, first as given and then without its first
+    component (e.g. the `a/` and `b/` prefixes given by `diff -ur a b`).
+
+    Files that are patched from `/dev/null` (e.g. by `git diff`) are created. Their path is used as given if its
+    directory exists, else without git's `b/` prefix if it has it. Files that are patched to `/dev/null` are deleted.
+    :param patch_file: the patch
+    :param exists: gets whether there is a file at the given path
+    :param is_directory: gets whether there is a directory at the given path
+    :return: the files, in the order of the files in the patch
+    :raises PatchApplicationError: raised if the file to apply part of the patch to does not exist
+    """
+    patched_files = []
+    for item, candidates in zip(read_patch(patch_file).items, get_patch_set_path_candidates(patch_file)):
+        if item.source in _DEV_NULL_PATHS:
+            path = candidates[0]
+            if not is_directory(os.path.dirname(path) or os.curdir) and path.startswith(_GIT_TARGET_PREFIX):
+                path = path[len(_GIT_TARGET_PREFIX):]
+            patched_files.append(PatchedFile(path, created=True))
+            continue
+        path = next((candidate for candidate in candidates if exists(candidate)), None)
+        if path is None:
+            raise PatchApplicationError(f"File to apply patch {patch_file} to does not exist: {candidates[0]}")
+        patched_files.append(PatchedFile(path, deleted=item.target in _DEV_NULL_PATHS))
+    return patched_files
+
+
+def get_patch_set_path_candidates(patch_file: str) -> List[List[str]]:
+    """
+    Gets the paths that each file in the given patch could apply to, in the order that they are tried (see
+    `get_patched_files`).
+    :param patch_file: the patch
+    :return: the candidate paths of each file, relative to the directory that the patch applies to, in the order of the
+    files in the patch
+    """
+    candidates_of_items = []
+    for item in read_patch(patch_file).items:
+        candidates = []
+        for path in (item.target, item.source):
+            if path in _DEV_NULL_PATHS:
+                continue
+            path = os.path.normpath(path.decode())
+            candidates.append(path)
+            if os.sep in path:
+                candidates.append(path.split(os.sep, 1)[1])
+        candidates_of_items.append(candidates)
+    return candidates_of_items
+
+
+def read_patch(patch_file: str) -> "PatchSet":
+    """
+    Reads the given patch file.
+
+    Parsed patches are cached by their content, so a patch that is reused (e.g. by many builds) is only parsed once.
+    :param patch_file: the patch file
+    :return: the parsed patch, which must not be modified
+    :raises SyntaxError: raised if the patch cannot be parsed
+    """
+    with open(patch_file, "rb") as file:
+        content = file.read()
+    key = hashlib.sha256(content).hexdigest()
+    with _patch_set_cache_lock:
+        if key in _patch_set_cache:
+            _patch_set_cache.move_to_end(key)
+            return _patch_set_cache[key]
+    from patch import fromstring
+
+    patch_set = fromstring(content)
     if not patch_set:
         raise SyntaxError(f"Could not parse contents of patch file: {patch_file}")
+    with _patch_set_cache_lock:
+        _patch_set_cache[key] = patch_set
+        while len(_patch_set_cache) > _PATCH_SET_CACHE_SIZE:
+            _patch_set_cache.popitem(last=False)
+    return patch_set
+
 
-    hunks = list(itertools.chain(*[item.hunks for item in patch_set.items]))
+def _apply_hunks(patch_file: str, patch_set: "PatchSet", target_file: str, hunks: List["Hunk"], *,
+                 created: bool=False, deleted: bool=False):
+    """
+    Applies the given hunks to the given target file, reading and writing it once.
+    :param patch_file: the patch that the hunks are from
+    :param patch_set: the parsed patch
+    :param target_file: the patch target, which is replaced
+    :param hunks: the hunks
+    :param created: whether the hunks create the target file, which must not exist
+    :param deleted: whether the hunks delete the target file, which is removed once they are checked to remove all of
+    its contents
+    :raises PatchApplicationError: raised if a hunk does not match the target file
+    """
+    if created:
+        if os.path.lexists(target_file):
+            raise PatchApplicationError(f"File to be created by patch {patch_file} already exists: {target_file}")
+        os.makedirs(os.path.dirname(target_file), exist_ok=True)
+        content = b""
+    else:
+        try:
+            with open(target_file, "rb") as file:
+                content = file.read()
+        except FileNotFoundError as e:
+            raise PatchApplicationError(f"File to apply patch {patch_file} to does not exist: {target_file}") from e
+    lines = [line.rstrip(b"\r\n") for line in content.splitlines()]
+    for number, hunk in enumerate(hunks, start=1):
+        expected = [line[1:].rstrip(b"\r\n") for line in hunk.text if line[:1] in (b" ", b"-")]
+        start = max(hunk.startsrc - 1, 0)
+        if lines[start:start + len(expected)] != expected:
+            raise PatchApplicationError(f"Hunk {number} of patch {patch_file} does not match {target_file} at line "
+                                        f"{hunk.startsrc}")
 
-    with TemporaryDirectory() as temp_directory:
-        temp_file = os.path.join(temp_directory, os.path.basename(target_file))
-        patch_set.write_hunks(target_file, os.path.join(temp_file), hunks)
-        shutil.move(temp_file, target_file)
+    if deleted:
+        if len(b"".join(patch_set.patch_stream(BytesIO(content), hunks))) > 0:
+            raise PatchApplicationError(f"Patch {patch_file} deletes {target_file} but does not remove all of it")
+        os.remove(target_file)
+        return
+
+    descriptor, temp_location = mkstemp(dir=os.path.dirname(target_file), prefix=f".{os.path.basename(target_file)}.")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            file.writelines(patch_set.patch_stream(BytesIO(content), hunks))
+        if created:
+            os.chmod(temp_location, _CREATED_FILE_MODE)
+        else:
+            shutil.copymode(target_file, temp_location)
+        os.replace(temp_location, target_file)
+    except BaseException:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+    if is_profiling():
+        record(files=1, bytes_read=len(content), bytes_written=os.path.getsize(target_file))
 
 
 def change_base_image(dockerfile_location: str, desired_base: str):
     """
-    TODO
-    :param dockerfile_location:
-    :param desired_base:
-    :return:
-    """
-    changed = False
-    for line in fileinput.input(dockerfile_location, inplace=True):
-        if line.upper().startswith("FROM"):
-            assert not changed
-            print(f"FROM {desired_base}")
-            changed = True
-        else:
-            print(line, end="")
+    Changes the image that the given Dockerfile ultimately builds on (see `SetBaseImage`).
+    :param dockerfile_location: location of the Dockerfile, which is replaced rather than modified in place
+    :param desired_base: the base image
+    :raises ValueError: raised if the Dockerfile does not contain a `FROM` instruction
+    """
+    transform_dockerfile(dockerfile_location, [SetBaseImage(desired_base)])
 
-    if not changed:
-        raise ValueError(f"Dockerfile did not contain FROM line: {dockerfile_location}")
+
+def transform_dockerfile(dockerfile_location: str, transforms: Iterable[DockerfileTransform]):
+    """
+    Applies the given transforms to the given Dockerfile, which is parsed once and written once.
+    :param dockerfile_location: location of the Dockerfile, which is replaced rather than modified in place
+    :param transforms: transforms to apply, in order (see `patchworkdocker.dockerfiles`)
+    :raises ValueError: raised if a transform cannot be applied to the Dockerfile
+    """
+    dockerfile = Dockerfile.from_file(dockerfile_location)
+    try:
+        for transform in transforms:
+            transform(dockerfile)
+    except ValueError as e:
+        raise ValueError(f"{e}: {dockerfile_location}") from e
+    dockerfile.write(dockerfile_location)
+    if is_profiling():
+        record(files=1, bytes_written=os.path.getsize(dockerfile_location))
+
+
+def get_base_images(dockerfile: str) -> List[str]:
+    """
+    Gets the images that the stages of the given Dockerfile are built from.
+    :param dockerfile: contents of the Dockerfile
+    :return: the base images, in order, excluding `scratch` and earlier stages of the Dockerfile
+    """
+    return Dockerfile.parse(dockerfile).get_base_images()
@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Iterator, Iterable
+
+from patchworkdocker.meta import PACKAGE_NAME
+
+PROFILE_FORMATS = ("json", "chrome")
+
+
+class Span:
+    """
+    Timed phase of work, with counts of the files and bytes that it processed.
+    """
+    def __init__(self, profiler: "Profiler", name: str, attributes: Dict[str, Any]):
+        """
+        Constructor.
+        :param profiler: profiler that records the span
+        :param name: name of the phase
+        :param attributes: extra information about the span (e.g. the file it was for)
+        """
+        self.profiler = profiler
+        self.name = name
+        self.attributes = attributes
+        self.thread_id: Optional[int] = None
+        self.depth = 0
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.files = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @property
+    def duration(self) -> float:
+        """
+        Wall time of the span in seconds (up to now if it has not ended).
+        """
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def record(self, *, files: int=0, bytes_read: int=0, bytes_written: int=0):
+        """
+        Adds to the counts of what the span processed.
+        :param files: number of files processed
+        :param bytes_read: number of bytes read
+        :param bytes_written: number of bytes written
+        """
+        self.files += files
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Gets the span as a JSON serialisable dictionary.
+        :return: the span, with times in seconds since profiling started
+        """
+        return dict(name=self.name, start=self.start - self.profiler.started_at, duration=self.duration,
+                    depth=self.depth, thread=self.thread_id, files=self.files, bytes_read=self.bytes_read,
+                    bytes_written=self.bytes_written, attributes=self.attributes)
+
+    def __enter__(self) -> "Span":
+        stack = self.profiler._get_stack()
+        self.thread_id = threading.get_ident()
+        self.depth = len(stack)
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.perf_counter()
+        self.profiler._get_stack().pop()
+        self.profiler._add(self)
+
+
+class _NullSpan:
+    """
+    Span that records nothing, used when not profiling.
+    """
+    def record(self, *, files: int=0, bytes_read: int=0, bytes_written: int=0):
+        pass
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """
+    Records spans of work.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self.started_at = time.perf_counter()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self) -> List[Span]:
+        """
+        Gets the spans that are open in the current thread.
+        :return: the open spans, innermost last
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, span: Span):
+        """
+        Adds the given finished span to those recorded.
+        :param span: the span
+        """
+        with self._lock:
+            self.spans.append(span)
+
+
+_profiler: Optional[Profiler] = None
+
+
+def span(name: str, **attributes: Any):
+    """
+    Creates a span for the given phase of work, which is recorded by the active profiler (see `profiling`).
+
+    When not profiling, a shared span that does nothing is returned, so there is no overhead.
+    :param name: name of the phase
+    :param attributes: extra information about the span
+    :return: context manager that yields the span
+    """
+    profiler = _profiler
+    if profiler is None:
+        return _NULL_SPAN
+    return Span(profiler, name, attributes)
+
+
+def is_profiling() -> bool:
+    """
+    Gets whether there is an active profiler, so that counts which are costly to get are only got when needed.
+    :return: whether profiling
+    """
+    return _profiler is not None
+
+
+def record(*, files: int=0, bytes_read: int=0, bytes_written: int=0):
+    """
+    Adds to the counts of the innermost span that is open in the current thread, if profiling.
+    :param files: number of files processed
+    :param bytes_read: number of bytes read
+    :param bytes_written: number of bytes written
+    """
+    profiler = _profiler
+    if profiler is None:
+        return
+    stack = profiler._get_stack()
+    if len(stack) > 0:
+        stack[-1].record(files=files, bytes_read=bytes_read, bytes_written=bytes_written)
+
+
+def count_bytes_written(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Counts the bytes in the given stream as they are written, in the span that is innermost when the stream is
+    created (the stream is returned unchanged when not profiling).
+    :param chunks: the stream
+    :return: the stream
+    """
+    profiler = _profiler
+    if profiler is None or len(profiler._get_stack()) == 0:
+        return chunks
+    counting_span = profiler._get_stack()[-1]
+
+    def count() -> Iterator[bytes]:
+        for chunk in chunks:
+            counting_span.record(bytes_written=len(chunk))
+            yield chunk
+
+    return count()
+
+
+@contextmanager
+def profiling(profiler: Profiler) -> Iterator[Profiler]:
+    """
+    Makes the given profiler active, across all threads, for the duration of the context.
+    :param profiler: the profiler
+    :return: context manager that yields the profiler
+    """
+    global _profiler
+    previous = _profiler
+    _profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+
+
+def format_table(profiler: Profiler) -> str:
+    """
+    Formats the spans recorded by the given profiler as a table, with a row per phase (nested under the phase that it
+    was first part of).
+    :param profiler: the profiler
+    :return: the table
+    """
+    phases: Dict[str, Dict[str, Any]] = OrderedDict()
+    for span in sorted(profiler.spans, key=lambda span: span.start):
+        phase = phases.setdefault(span.name, dict(depth=span.depth, count=0, duration=0.0, files=0, bytes_read=0,
+                                                  bytes_written=0))
+        phase["count"] += 1
+        phase["duration"] += span.duration
+        phase["files"] += span.files
+        phase["bytes_read"] += span.bytes_read
+        phase["bytes_written"] += span.bytes_written
+
+    rows = [("phase", "count", "time (s)", "files", "read (B)", "written (B)")]
+    for name, phase in phases.items():
+        rows.append((f"{'  ' * phase['depth']}{name}", str(phase["count"]), f"{phase['duration']:.3f}",
+                     str(phase["files"]), str(phase["bytes_read"]), str(phase["bytes_written"])))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        values = [row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]
+        lines.append("  ".join(values).rstrip())
+    return "\n".join(lines)
+
+
+def to_json(profiler: Profiler) -> str:
+    """
+    Serialises the spans recorded by the given profiler as JSON.
+    :param profiler: the profiler
+    :return: the JSON
+    """
+    return json.dumps({"spans": [span.to_dict() for span in sorted(profiler.spans, key=lambda span: span.start)]})
+
+
+def to_chrome_trace(profiler: Profiler) -> str:
+    """
+    Serialises the spans recorded by the given profiler in the Chrome trace event format (viewable in
+    `chrome://tracing` or Perfetto).
+    :param profiler: the profiler
+    :return: the trace, as JSON
+    """
+    events = []
+    for span in sorted(profiler.spans, key=lambda span: span.start):
+        events.append(dict(
+            name=span.name, cat=PACKAGE_NAME, ph="X", pid=os.getpid(), tid=span.thread_id,
+            ts=(span.start - profiler.started_at) * 1e6, dur=span.duration * 1e6,
+            args=dict(files=span.files, bytes_read=span.bytes_read, bytes_written=span.bytes_written,
+                      **{key: str(value) for key, value in span.attributes.items()})))
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
@@ -0,0 +1,137 @@
+import json
+import os
+import re
+import time
+from tempfile import mkstemp
+from threading import Lock
+from typing import Optional, Dict, Tuple
+
+from logzero import logger
+
+from patchworkdocker.profiling import span
+
+DEFAULT_REF_RESOLUTION_TTL = 30.0
+
+_COMMIT_PATTERN = re.compile("^[0-9a-f]{40}$")
+
+
+def resolve_remote_reference(origin: str, reference: str) -> Optional[str]:
+    """
+    Resolves the commit that the given branch, tag or commit refers to in the given remote, without cloning it.
+    :param origin: git origin (without fragment)
+    :param reference: branch, tag or full commit SHA (the default branch if empty)
+    :return: the commit SHA or `None` if the reference cannot be found (e.g. it is an abbreviated commit)
+    :raises GitCommandError: raised if the remote cannot be queried
+    """
+    if _COMMIT_PATTERN.match(reference):
+        return reference
+    # GitPython is slow to import, so it is only imported when a remote is queried
+    from git import Git
+
+    reference = reference or "HEAD"
+    remote_references = {}
+    for line in Git().ls_remote(origin, reference).splitlines():
+        commit, name = line.split("\t")
+        remote_references[name] = commit
+    for name in (reference, f"refs/heads/{reference}", f"refs/tags/{reference}^{{}}", f"refs/tags/{reference}"):
+        if name in remote_references:
+            return remote_references[name]
+    return None
+
+
+class RefResolver:
+    """
+    Resolves git references in remotes to commits before anything is cloned.
+
+    Resolutions are remembered for a short time, so the same reference is not repeatedly resolved during a run. If
+    there is a lockfile, resolutions are pinned in it and pinned references are never resolved again (unless updating).
+    """
+    def __init__(self, *, ttl: float=DEFAULT_REF_RESOLUTION_TTL, lockfile_location: str=None, update: bool=False):
+        """
+        Constructor.
+        :param ttl: number of seconds to remember resolutions for
+        :param lockfile_location: location of the JSON lockfile to pin resolutions in (created if it does not exist,
+        no pinning if `None`)
+        :param update: whether to resolve references that are pinned in the lockfile again, updating their pins
+        """
+        self.ttl = ttl
+        self.lockfile_location = lockfile_location
+        self.update = update
+        self._resolved: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._pins: Optional[Dict[str, str]] = None
+        self._lock = Lock()
+
+    def resolve(self, origin: str, reference: str) -> Optional[str]:
+        """
+        Resolves the commit that the given branch, tag or commit refers to in the given remote.
+        :param origin: git origin (without fragment)
+        :param reference: branch, tag or full commit SHA (the default branch if empty)
+        :return: the commit SHA or `None` if the reference cannot be found (e.g. it is an abbreviated commit)
+        :raises GitCommandError: raised if the remote cannot be queried
+        """
+        pin_key = f"{origin}#{reference}"
+        with self._lock:
+            if not self.update and pin_key in self._get_pins():
+                return self._get_pins()[pin_key]
+            resolved_at, commit = self._resolved.get((origin, reference), (None, None))
+            if resolved_at is not None and time.monotonic() - resolved_at < self.ttl:
+                return commit
+
+        with span("resolve_ref", origin=origin, reference=reference):
+            commit = resolve_remote_reference(origin, reference)
+        logger.debug(f"Resolved {reference or 'HEAD'} in {origin} to {commit}")
+
+        with self._lock:
+            self._resolved[(origin, reference)] = (time.monotonic(), commit)
+            if commit is not None and self.lockfile_location is not None \
+                    and self._get_pins().get(pin_key) != commit:
+                self._get_pins()[pin_key] = commit
+                self._write_pins()
+        return commit
+
+    def try_resolve(self, origin: str, reference: str) -> Optional[str]:
+        """
+        Resolves the commit that the given branch, tag or commit refers to in the given remote, if the remote can be
+        queried.
+        :param origin: git origin (without fragment)
+        :param reference: branch, tag or full commit SHA (the default branch if empty)
+        :return: the commit SHA or `None` if the reference cannot be resolved
+        """
+        from git import GitCommandError
+
+        try:
+            return self.resolve(origin, reference)
+        except GitCommandError as e:
+            logger.warning(f"Could not resolve {reference or 'HEAD'} in {origin}: {e}")
+            return None
+
+    def _get_pins(self) -> Dict[str, str]:
+        """
+        Gets the pinned resolutions, reading them from the lockfile on first use.
+        :return: map of origins with reference fragments to commits
+        """
+        if self._pins is None:
+            self._pins = {}
+            if self.lockfile_location is not None and os.path.exists(self.lockfile_location):
+                with open(self.lockfile_location, "r") as file:
+                    lockfile = json.load(file)
+                if not isinstance(lockfile, dict) or not isinstance(lockfile.get("refs"), dict):
+                    raise ValueError(f"Lockfile must be an object with a \"refs\" object: {self.lockfile_location}")
+                self._pins.update(lockfile["refs"])
+        return self._pins
+
+    def _write_pins(self):
+        """
+        Writes the pinned resolutions to the lockfile, atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(self.lockfile_location))
+        descriptor, temp_location = mkstemp(dir=directory, prefix=f".{os.path.basename(self.lockfile_location)}.")
+        try:
+            with os.fdopen(descriptor, "w") as file:
+                json.dump({"refs": self._pins}, file, indent=2, sort_keys=True)
+                file.write("\n")
+            os.replace(temp_location, self.lockfile_location)
+        except BaseException:
+            if os.path.exists(temp_location):
+                os.remove(temp_location)
+            raise
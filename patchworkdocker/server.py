@@ -0,0 +1,512 @@
+import heapq
+import itertools
+import json
+import os
+import socket
+import socketserver
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum, unique
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from threading import Condition, Lock, Thread
+from typing import Dict, Any, Optional, Callable, List, Deque, TYPE_CHECKING
+from urllib.parse import urlparse, parse_qs
+
+from logzero import logger
+
+from patchworkdocker.batch import JobStatus, create_core
+from patchworkdocker.cancellation import CancellationToken, cancellable, OperationCancelledError
+from patchworkdocker.core import PatchworkDocker
+from patchworkdocker.docker_images import create_docker_client
+from patchworkdocker.errors import PatchworkDockerError
+from patchworkdocker.importers import ImporterResources
+from patchworkdocker.meta import PACKAGE_NAME, VERSION
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+DEFAULT_SERVER_CONCURRENCY = 2
+# Finished jobs are kept (so their outcome can be got) for this long in seconds, up to the maximum number of them
+DEFAULT_JOB_RETENTION = 60 * 60
+DEFAULT_MAX_FINISHED_JOBS = 1000
+
+_FINISHED_STATUSES = {JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED}
+_JOB_OPTIONS = {
+    "prepare": {"build_location", "overlay", "update"},
+    "build": {"build_location", "overlay", "update", "stream_context", "reuse_image"}
+}
+
+
+class ServerAlreadyRunningError(PatchworkDockerError):
+    """
+    Raised when a server is already listening on the socket that another is to serve on.
+    """
+
+
+@unique
+class JobAction(Enum):
+    """
+    What a server job does.
+    """
+    PREPARE = "prepare"
+    BUILD = "build"
+
+
+@dataclass
+class ServerJob:
+    """
+    Job run by the server.
+    """
+    action: JobAction
+    specification: Dict[str, Any]
+    options: Dict[str, Any] = field(default_factory=dict)
+    priority: int = 0
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    core: Optional[PatchworkDocker] = field(default=None, repr=False)
+    status: JobStatus = JobStatus.PENDING
+    result: Optional[str] = None
+    error: Optional[str] = None
+    duration: Optional[float] = None
+    cancellation_token: CancellationToken = field(default_factory=CancellationToken, repr=False)
+    finished_at: Optional[float] = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED_STATUSES
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Gets the JSON representation of the job, as served by the API.
+        :return: JSON representation
+        """
+        return dict(id=self.id, action=self.action.value, priority=self.priority, status=self.status.value,
+                    specification=self.specification, options=self.options, result=self.result, error=self.error,
+                    duration=self.duration)
+
+
+class JobScheduler:
+    """
+    Runs jobs in worker threads, at most a given number at once, highest priority first (then in the order that they
+    were submitted).
+
+    Finished jobs are forgotten once they have been kept for the retention time, or once there are more than the
+    maximum number of them (oldest first). Their cores are dropped as soon as they finish.
+    """
+    def __init__(self, run_job: Callable[[ServerJob], Optional[str]], concurrency: int=DEFAULT_SERVER_CONCURRENCY, *,
+                 retention: float=DEFAULT_JOB_RETENTION, max_finished_jobs: int=DEFAULT_MAX_FINISHED_JOBS):
+        """
+        Constructor.
+        :param run_job: runs the given job, returning its result (called in a worker thread, where the operation is
+        cancellable by the job's cancellation token)
+        :param concurrency: maximum number of jobs to run at once
+        :param retention: time in seconds to keep finished jobs for
+        :param max_finished_jobs: maximum number of finished jobs to keep
+        :raises ValueError: raised if the concurrency is less than 1, or the retention or maximum number of finished
+        jobs is negative
+        """
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1: {concurrency}")
+        if retention < 0 or max_finished_jobs < 0:
+            raise ValueError(f"Retention and maximum number of finished jobs must not be negative: {retention}, "
+                             f"{max_finished_jobs}")
+        self.run_job = run_job
+        self.concurrency = concurrency
+        self.retention = retention
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs: Dict[str, ServerJob] = {}
+        # Finished jobs, in the order that they finished
+        self._finished: Deque[ServerJob] = deque()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = Condition()
+        self._workers: List[Thread] = []
+        self._stopped = False
+
+    def start(self):
+        """
+        Starts running submitted jobs.
+        """
+        with self._condition:
+            if len(self._workers) > 0:
+                return
+            self._workers = [Thread(target=self._work, name=f"{PACKAGE_NAME}-worker-{i}", daemon=True)
+                             for i in range(self.concurrency)]
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self, timeout: float=None):
+        """
+        Stops running jobs, cancelling those that are pending or running.
+        :param timeout: maximum time in seconds to wait for each running job to stop (wait indefinitely if `None`)
+        """
+        with self._condition:
+            self._stopped = True
+            # Copied, as cancelled jobs can be forgotten
+            for job in list(self._jobs.values()):
+                self._cancel(job)
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def submit(self, job: ServerJob) -> ServerJob:
+        """
+        Submits the given job to be run.
+        :param job: the job
+        :return: the submitted job
+        """
+        with self._condition:
+            self._forget_finished()
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (-job.priority, next(self._sequence), job))
+            self._condition.notify_all()
+        logger.info(f"Submitted {job.action.value} job {job.id} with priority {job.priority}")
+        return job
+
+    def get(self, job_id: str) -> Optional[ServerJob]:
+        """
+        Gets the job with the given ID.
+        :param job_id: ID of the job
+        :return: the job (`None` if there is no job with the ID)
+        """
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[ServerJob]:
+        """
+        Lists the submitted jobs, in the order that they were submitted.
+        :return: the jobs
+        """
+        with self._condition:
+            self._forget_finished()
+            return list(self._jobs.values())
+
+    def wait(self, job_id: str, timeout: float=None) -> Optional[ServerJob]:
+        """
+        Waits for the job with the given ID to finish.
+        :param job_id: ID of the job
+        :param timeout: maximum time in seconds to wait (wait indefinitely if `None`)
+        :return: the job, which may not have finished if the timeout was reached (`None` if there is no job with the ID)
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._condition.wait_for(lambda: job.finished, timeout)
+            return job
+
+    def cancel(self, job_id: str) -> Optional[ServerJob]:
+        """
+        Cancels the job with the given ID, which is not run if it is pending, or which stops at its next checkpoint if
+        it is running.
+        :param job_id: ID of the job
+        :return: the job (`None` if there is no job with the ID)
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._cancel(job)
+                self._condition.notify_all()
+            return job
+
+    def _cancel(self, job: ServerJob):
+        """
+        Cancels the given job, which must be done with the condition held.
+        :param job: the job
+        """
+        job.cancellation_token.cancel()
+        if job.status == JobStatus.PENDING:
+            # Left in the queue and skipped by the workers, as removing from the heap would require it to be rebuilt
+            job.status = JobStatus.CANCELLED
+            self._finish(job)
+
+    def _finish(self, job: ServerJob):
+        """
+        Records that the given job has finished, which must be done with the condition held.
+        :param job: the job
+        """
+        job.finished_at = time.monotonic()
+        # The core (and what it holds, e.g. its importer) is not needed once the job has run
+        job.core = None
+        self._finished.append(job)
+        self._forget_finished()
+
+    def _forget_finished(self):
+        """
+        Forgets the finished jobs that are no longer kept, which must be done with the condition held.
+        """
+        expired_at = time.monotonic() - self.retention
+        while len(self._finished) > 0 and (len(self._finished) > self.max_finished_jobs
+                                           or self._finished[0].finished_at <= expired_at):
+            job = self._finished.popleft()
+            del self._jobs[job.id]
+
+    def _work(self):
+        """
+        Runs jobs from the queue until stopped.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or len(self._queue) > 0)
+                if self._stopped:
+                    return
+                _, _, job = heapq.heappop(self._queue)
+                if job.status != JobStatus.PENDING:
+                    continue
+                job.status = JobStatus.PREPARING if job.action == JobAction.PREPARE else JobStatus.BUILDING
+            self._run(job)
+
+    def _run(self, job: ServerJob):
+        """
+        Runs the given job, recording its outcome.
+        :param job: the job
+        """
+        logger.info(f"Running {job.action.value} job {job.id}")
+        started_at = time.monotonic()
+        result, error = None, None
+        try:
+            with cancellable(job.cancellation_token):
+                result = self.run_job(job)
+            status = JobStatus.SUCCEEDED
+        except OperationCancelledError:
+            status = JobStatus.CANCELLED
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            status, error = JobStatus.FAILED, str(e)
+        with self._condition:
+            job.status, job.result, job.error = status, result, error
+            job.duration = time.monotonic() - started_at
+            self._finish(job)
+            self._condition.notify_all()
+        logger.info(f"Job {job.id} {status.value} in {job.duration:.3f}s")
+
+
+class PatchworkDockerServer:
+    """
+    Server that prepares build contexts and builds images for clients (see `ServerClient`), with an HTTP API on a Unix
+    socket.
+
+    The caches, git reference resolver, parsed patches, Docker client and importer resources (e.g. HTTP sessions) are
+    kept warm between jobs, so repeat builds do not pay for them to be set up again.
+    """
+    def __init__(self, socket_location: str, *, concurrency: int=DEFAULT_SERVER_CONCURRENCY,
+                 job_retention: float=DEFAULT_JOB_RETENTION, max_finished_jobs: int=DEFAULT_MAX_FINISHED_JOBS,
+                 docker_client: "DockerClient"=None, **core_kwargs):
+        """
+        Constructor.
+        :param socket_location: location of the Unix socket to serve on
+        :param concurrency: maximum number of jobs to run at once
+        :param job_retention: time in seconds to keep finished jobs for (see `JobScheduler`)
+        :param max_finished_jobs: maximum number of finished jobs to keep
+        :param docker_client: Docker client to build with (created from the environment when first needed if `None`)
+        :param core_kwargs: keyword arguments to construct the core of each job with (e.g. caches), where the server's
+        own importer resources, which it closes when it stops, are used if `importer_resources` is not given
+        """
+        self.socket_location = socket_location
+        self._owns_importer_resources = core_kwargs.get("importer_resources") is None
+        if self._owns_importer_resources:
+            core_kwargs["importer_resources"] = ImporterResources()
+        self.core_kwargs = core_kwargs
+        self.scheduler = JobScheduler(self._run_job, concurrency, retention=job_retention,
+                                      max_finished_jobs=max_finished_jobs)
+        self._docker_client = docker_client
+        self._docker_client_lock = Lock()
+        self._http_server: Optional[_UnixHTTPServer] = None
+
+    @property
+    def docker_client(self) -> "DockerClient":
+        with self._docker_client_lock:
+            if self._docker_client is None:
+                self._docker_client = create_docker_client()
+            return self._docker_client
+
+    def submit(self, action: JobAction, specification: Dict[str, Any], options: Dict[str, Any]=None,
+               priority: int=0) -> ServerJob:
+        """
+        Submits a job.
+        :param action: what the job does
+        :param specification: specification of the build (see `create_core`), where file locations must be absolute
+        and `image_name` is required to build
+        :param options: options of the action (`build_location`, `overlay` and `update`, and additionally
+        `stream_context` and `reuse_image` to build)
+        :param priority: priority of the job (jobs with a higher priority are run first)
+        :return: the submitted job
+        :raises ValueError: raised if the job is invalid
+        """
+        options = options if options is not None else {}
+        unknown_options = set(options.keys()) - _JOB_OPTIONS[action.value]
+        if len(unknown_options) > 0:
+            raise ValueError(f"Unknown options for {action.value} job: {sorted(unknown_options)}")
+        if action == JobAction.BUILD and "image_name" not in specification:
+            raise ValueError(f"Build job must have key image_name: {specification}")
+        if not isinstance(priority, int):
+            raise ValueError(f"Priority must be an integer: {priority}")
+        core = create_core(specification, os.getcwd(), **self.core_kwargs)
+        return self.scheduler.submit(ServerJob(action, specification, options, priority, core=core))
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        :raises ServerAlreadyRunningError: raised if a server is already listening on the socket
+        """
+        self._bind()
+        Thread(target=self._http_server.serve_forever, name=f"{PACKAGE_NAME}-server", daemon=True).start()
+
+    def serve_forever(self):
+        """
+        Serves until shutdown.
+        :raises ServerAlreadyRunningError: raised if a server is already listening on the socket
+        """
+        self._bind()
+        try:
+            self._http_server.serve_forever()
+        finally:
+            self._close()
+
+    def shutdown(self):
+        """
+        Stops serving, cancelling pending and running jobs.
+        """
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._close()
+
+    def _bind(self):
+        """
+        Binds to the socket and starts the job workers.
+        :raises ServerAlreadyRunningError: raised if a server is already listening on the socket
+        """
+        if os.path.exists(self.socket_location):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                try:
+                    connection.connect(self.socket_location)
+                    raise ServerAlreadyRunningError(f"Server already running on {self.socket_location}")
+                except ConnectionRefusedError:
+                    logger.info(f"Removing stale socket: {self.socket_location}")
+                    os.remove(self.socket_location)
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_location)), exist_ok=True)
+        self._http_server = _UnixHTTPServer(self.socket_location, _RequestHandler)
+        self._http_server.patchwork_docker_server = self
+        self.scheduler.start()
+        logger.info(f"Serving on {self.socket_location}")
+
+    def _close(self):
+        """
+        Closes the socket and stops the job workers.
+        """
+        if self._http_server is None:
+            return
+        self._http_server.server_close()
+        self._http_server = None
+        if os.path.exists(self.socket_location):
+            os.remove(self.socket_location)
+        self.scheduler.stop()
+        if self._owns_importer_resources:
+            self.core_kwargs["importer_resources"].close()
+
+    def _run_job(self, job: ServerJob) -> Optional[str]:
+        """
+        Runs the given job.
+        :param job: the job
+        :return: the prepared build directory if the job prepares
+        """
+        if job.action == JobAction.PREPARE:
+            return job.core.prepare(job.options.get("build_location"), overlay=job.options.get("overlay", False),
+                                    update=job.options.get("update", False))
+        job.core.build(job.specification["image_name"], job.options.get("build_location"),
+                       docker_client=self.docker_client, stream_context=job.options.get("stream_context", False),
+                       overlay=job.options.get("overlay", False), update=job.options.get("update", False),
+                       reuse_image=job.options.get("reuse_image", True))
+        return None
+
+    def __enter__(self) -> "PatchworkDockerServer":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server on a Unix socket, handling each request in its own thread.
+    """
+    daemon_threads = True
+    patchwork_docker_server: PatchworkDockerServer
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the server's API:
+    - `GET /health`: the server's name and version.
+    - `POST /jobs`: submits the job given as a JSON object with the keys `action`, `specification`, and optionally
+      `options` and `priority` (see `PatchworkDockerServer.submit`).
+    - `GET /jobs`: the submitted jobs.
+    - `GET /jobs/<id>`: the job, optionally waiting up to `?wait=<seconds>` for it to finish.
+    - `DELETE /jobs/<id>`: cancels the job.
+    """
+    server: _UnixHTTPServer
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._respond(HTTPStatus.OK, dict(name=PACKAGE_NAME, version=VERSION))
+        elif url.path == "/jobs":
+            self._respond(HTTPStatus.OK, [job.to_json() for job in self._scheduler.list()])
+        elif url.path.startswith("/jobs/"):
+            wait = parse_qs(url.query).get("wait")
+            try:
+                timeout = float(wait[0]) if wait is not None else 0
+            except ValueError:
+                self._respond_error(HTTPStatus.BAD_REQUEST, f"Invalid wait: {wait[0]}")
+                return
+            self._respond_job(self._scheduler.wait(url.path[len("/jobs/"):], timeout))
+        else:
+            self._respond_error(HTTPStatus.NOT_FOUND, f"Not found: {url.path}")
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/jobs":
+            self._respond_error(HTTPStatus.NOT_FOUND, f"Not found: {self.path}")
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            job = self.server.patchwork_docker_server.submit(
+                JobAction(request["action"]), request["specification"], request.get("options"),
+                request.get("priority", 0))
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond_error(HTTPStatus.BAD_REQUEST, f"Invalid job: {e}")
+            return
+        self._respond(HTTPStatus.ACCEPTED, job.to_json())
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/jobs/"):
+            self._respond_error(HTTPStatus.NOT_FOUND, f"Not found: {path}")
+            return
+        self._respond_job(self._scheduler.cancel(path[len("/jobs/"):]))
+
+    def log_message(self, format: str, *args):
+        # Overridden as the client address of a Unix socket is empty
+        logger.debug(f"{self.command} {self.path}: {format % args}")
+
+    @property
+    def _scheduler(self) -> JobScheduler:
+        return self.server.patchwork_docker_server.scheduler
+
+    def _respond_job(self, job: Optional[ServerJob]):
+        if job is None:
+            self._respond_error(HTTPStatus.NOT_FOUND, "No such job")
+        else:
+            self._respond(HTTPStatus.OK, job.to_json())
+
+    def _respond_error(self, status: HTTPStatus, message: str):
+        self._respond(status, dict(error=message))
+
+    def _respond(self, status: HTTPStatus, body: Any):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -1,10 +1,28 @@
+import functools
+import hashlib
+import io
+import json
 import os
+import socketserver
+import tarfile
 from abc import ABCMeta
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+from pathlib import Path
+from threading import Thread
+from typing import Iterator, Dict, List, TYPE_CHECKING
+from urllib.parse import urlparse, parse_qs, unquote
 from unittest import TestCase
 from temphelpers import TempManager
 from uuid import uuid4
+
+from git import Repo, Actor
+
 from patchworkdocker.meta import PACKAGE_NAME
 
+if TYPE_CHECKING:
+    from docker import DockerClient
+
 EXAMPLE_GIT_REPOSITORY = "https://github.com/colin-nolan/test-repository.git"
 EXAMPLE_BUILD_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "building")
 
@@ -26,3 +44,171 @@ def create_image_name():
     :return:
     """
     return f"{PACKAGE_NAME}-test:{str(uuid4())}"
+
+
+def create_git_repository(directory: str) -> str:
+    """
+    Creates a git repository that can be used as a local stand-in for `EXAMPLE_GIT_REPOSITORY`.
+
+    The repository has `a/d.txt` and `b.txt` on master (tagged `1.0`) and a `develop` branch that adds `develop.txt`.
+    :param directory: directory in which to create the repository
+    :return: `file://` URL of the created repository
+    """
+    location = os.path.join(directory, "repository.git")
+    repository = Repo.init(location)
+    author = Actor("test", "test@example.com")
+    os.makedirs(os.path.join(location, "a"))
+    Path(os.path.join(location, "a", "d.txt")).touch()
+    Path(os.path.join(location, "b.txt")).touch()
+    repository.index.add(["a/d.txt", "b.txt"])
+    repository.index.commit("Initial commit", author=author, committer=author)
+    repository.create_tag("1.0")
+    repository.git.branch("-M", "master")
+    repository.create_head("develop").checkout()
+    Path(os.path.join(location, "develop.txt")).touch()
+    repository.index.add(["develop.txt"])
+    repository.index.commit("Develop commit", author=author, committer=author)
+    repository.heads.master.checkout()
+    return f"file://{location}"
+
+
+@contextmanager
+def serve_directory(directory: str) -> Iterator[str]:
+    """
+    Serves the given directory over HTTP on localhost, as a local stand-in for a remote file server.
+    :param directory: directory to serve
+    :return: context manager that yields the URL of the served directory (without a trailing slash)
+    """
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FakeDockerDaemon:
+    """
+    Stand-in for a Docker daemon, serving the parts of its API used to import from images on a Unix socket.
+    """
+    API_VERSION = "1.41"
+
+    def __init__(self, socket_location: str, images: Dict[str, Dict[str, bytes]]):
+        """
+        Constructor.
+        :param socket_location: location of the Unix socket to serve on
+        :param images: files in each image, where images are keyed by name and files are keyed by absolute path
+        """
+        self.socket_location = socket_location
+        self.images = images
+        self.containers: Dict[str, str] = {}
+        self.removed_containers: List[str] = []
+        self._server = None
+
+    def create_client(self) -> "DockerClient":
+        """
+        Creates a Docker client of the daemon.
+        :return: the client
+        """
+        from docker import DockerClient
+        return DockerClient(base_url=f"unix://{self.socket_location}", version=FakeDockerDaemon.API_VERSION)
+
+    @staticmethod
+    def get_image_id(image_name: str) -> str:
+        """
+        Gets the ID of the given image.
+        :param image_name: name of the image
+        :return: the image ID
+        """
+        return f"sha256:{hashlib.sha256(image_name.encode()).hexdigest()}"
+
+    def get_archive(self, image_name: str, path: str) -> bytes:
+        """
+        Gets the tarball of the given path in the given image, as the daemon's archive API does.
+        :param image_name: name of the image
+        :param path: absolute path in the image
+        :return: the tarball, or `None` if there is nothing at the path
+        """
+        name = os.path.basename(path.rstrip("/"))
+        tarball = io.BytesIO()
+        found = False
+        with tarfile.open(fileobj=tarball, mode="w") as archive:
+            if name != "" and path not in self.images[image_name]:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                archive.addfile(info)
+            for file_path, content in self.images[image_name].items():
+                if file_path == path or file_path.startswith(f"{path.rstrip('/')}/"):
+                    found = True
+                    info = tarfile.TarInfo(os.path.join(name, os.path.relpath(file_path, path)) if file_path != path
+                                           else name)
+                    info.size = len(content)
+                    info.mode = 0o644
+                    archive.addfile(info, io.BytesIO(content))
+        return tarball.getvalue() if found else None
+
+    def __enter__(self) -> "FakeDockerDaemon":
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = unquote(url.path).split("/")[2:]
+                if parts[0] == "images" and parts[-1] == "json":
+                    image_name = "/".join(parts[1:-1])
+                    if image_name in daemon.images:
+                        return self._respond(200, dict(Id=FakeDockerDaemon.get_image_id(image_name)))
+                    return self._respond(404, dict(message=f"No such image: {image_name}"))
+                elif parts[0] == "containers" and parts[2] == "archive":
+                    archive = daemon.get_archive(daemon.containers[parts[1]], parse_qs(url.query)["path"][0])
+                    if archive is not None:
+                        return self._respond(200, archive, content_type="application/x-tar")
+                self._respond(404, dict(message="Not found"))
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if url.path.endswith("/containers/create"):
+                    image_id = json.loads(body)["Image"]
+                    image_name = next(name for name in daemon.images
+                                      if FakeDockerDaemon.get_image_id(name) == image_id)
+                    container_id = f"{len(daemon.containers):064x}"
+                    daemon.containers[container_id] = image_name
+                    return self._respond(201, dict(Id=container_id, Warnings=[]))
+                # Images cannot be pulled
+                self._respond(404, dict(message="pull access denied: repository does not exist"))
+
+            def do_DELETE(self):
+                container_id = urlparse(self.path).path.split("/")[-1]
+                daemon.removed_containers.append(container_id)
+                self._respond(204, None)
+
+            def _respond(self, status: int, body, content_type: str="application/json"):
+                content = json.dumps(body).encode() if content_type == "application/json" else body
+                self.send_response(status)
+                if body is not None:
+                    self.send_header("Content-Type", content_type)
+                    self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if body is not None:
+                    self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self._server = Server(self.socket_location, Handler)
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import shutil
+import time
+import unittest
+from threading import Event
+
+from patchworkdocker.asynchronous import AsyncPatchworkDocker
+from patchworkdocker.cancellation import check_cancelled, OperationCancelledError
+from patchworkdocker.core import PatchworkDocker
+from patchworkdocker.importers import FileSystemImporter
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY
+
+_TIMEOUT = 10
+
+
+class _BlockingImporter(FileSystemImporter):
+    """
+    `FileSystemImporter` that imports, then waits (whilst checking for cancellation) until it is released.
+    """
+    def __init__(self):
+        super().__init__()
+        self.started = Event()
+        self.released = Event()
+        self.load_directory = None
+        self.cancelled = False
+
+    def _load(self, origin: str, load_directory: str) -> str:
+        super()._load(origin, load_directory)
+        self.load_directory = load_directory
+        self.started.set()
+        started_at = time.monotonic()
+        while not self.released.is_set() and time.monotonic() - started_at < _TIMEOUT:
+            try:
+                check_cancelled()
+            except OperationCancelledError:
+                self.cancelled = True
+                raise
+            time.sleep(0.01)
+        return load_directory
+
+
+class TestAsyncPatchworkDocker(TestWithTempFiles):
+    """
+    Tests for `AsyncPatchworkDocker`.
+    """
+    def test_prepare(self):
+        directory = asyncio.run(AsyncPatchworkDocker(PatchworkDocker(EXAMPLE_BUILD_DIRECTORY)).prepare())
+        try:
+            self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_prepare_many_at_once(self):
+        importers = [_BlockingImporter() for _ in range(3)]
+
+        async def prepare_all():
+            tasks = [asyncio.create_task(AsyncPatchworkDocker(
+                PatchworkDocker(EXAMPLE_BUILD_DIRECTORY, importer=importer)).prepare()) for importer in importers]
+            # All the preparations must be running at once for them all to start
+            for importer in importers:
+                await asyncio.get_running_loop().run_in_executor(None, importer.started.wait, _TIMEOUT)
+                self.assertTrue(importer.started.is_set())
+            for importer in importers:
+                importer.released.set()
+            return await asyncio.gather(*tasks)
+
+        directories = asyncio.run(prepare_all())
+        try:
+            self.assertEqual(3, len(set(directories)))
+        finally:
+            for directory in directories:
+                shutil.rmtree(directory)
+
+    def test_prepare_cancelled(self):
+        importer = _BlockingImporter()
+
+        async def prepare_and_cancel():
+            task = asyncio.create_task(AsyncPatchworkDocker(
+                PatchworkDocker(EXAMPLE_BUILD_DIRECTORY, importer=importer)).prepare())
+            await asyncio.get_running_loop().run_in_executor(None, importer.started.wait, _TIMEOUT)
+            task.cancel()
+            await task
+
+        self.assertRaises(asyncio.CancelledError, asyncio.run, prepare_and_cancel())
+        self.assertTrue(importer.cancelled)
+        self.assertFalse(os.path.exists(importer.load_directory))
+
+    def test_prepare_does_not_block_event_loop(self):
+        importer = _BlockingImporter()
+
+        async def prepare_whilst_running():
+            task = asyncio.create_task(AsyncPatchworkDocker(
+                PatchworkDocker(EXAMPLE_BUILD_DIRECTORY, importer=importer)).prepare())
+            await asyncio.get_running_loop().run_in_executor(None, importer.started.wait, _TIMEOUT)
+            await asyncio.sleep(0)
+            self.assertFalse(task.done())
+            importer.released.set()
+            return await task
+
+        shutil.rmtree(asyncio.run(prepare_whilst_running()))
+
+
+if __name__ == "__main__":
+    unittest.main()
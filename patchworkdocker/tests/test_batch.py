@@ -0,0 +1,157 @@
+import json
+import os
+import unittest
+from typing import List, Optional
+
+import docker
+
+from patchworkdocker.batch import load_manifest, BatchBuilder, BatchJob, JobStatus, format_summary
+from patchworkdocker.caches import PreparedContextCache
+from patchworkdocker.core import PatchworkDocker
+from patchworkdocker.importers import ImporterFactory, Importer
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY, create_image_name, \
+    create_git_repository
+
+
+class _RecordingPatchworkDocker(PatchworkDocker):
+    """
+    `PatchworkDocker` that records the contexts it would build rather than building them.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.built_contexts: List[List[str]] = []
+        self.fingerprints: List[Optional[str]] = []
+
+    def build_prepared(self, image_name: str, repository_location: str, **kwargs):
+        self.built_contexts.append(sorted(os.listdir(repository_location)))
+
+    def get_fingerprint(self, importer: Importer=None) -> Optional[str]:
+        fingerprint = super().get_fingerprint(importer)
+        self.fingerprints.append(fingerprint)
+        return fingerprint
+
+
+class _CountingImporterFactory(ImporterFactory):
+    """
+    `ImporterFactory` that counts the importers it creates.
+    """
+    def __init__(self):
+        super().__init__()
+        self.created = 0
+
+    def create(self, origin: str) -> Importer:
+        self.created += 1
+        return super().create(origin)
+
+
+class TestLoadManifest(TestWithTempFiles):
+    """
+    Tests for `load_manifest`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = self.temp_manager.create_temp_directory()
+
+    def test_load_json(self):
+        jobs = load_manifest(self._write_manifest("manifest.json", json.dumps({"builds": [
+            {"import_from": "context", "image_name": "a", "patches": {"x.patch": "Dockerfile"}},
+            {"import_from": "https://example.com/repo.git#develop", "image_name": "b", "base_image": "alpine",
+             "stage_base_images": {"build": "golang"}, "target": "build"}
+        ]})))
+        self.assertEqual(["a", "b"], [job.image_name for job in jobs])
+        self.assertEqual({os.path.join(self.directory, "x.patch"): "Dockerfile"}, jobs[0].core.patches)
+        self.assertEqual("https://example.com/repo.git#develop", jobs[1].core.import_repository_from)
+        self.assertEqual("alpine", jobs[1].core.base_image)
+        self.assertEqual({"build": "golang"}, jobs[1].core.stage_base_images)
+        self.assertEqual("build", jobs[1].core.target)
+
+    def test_load_yaml(self):
+        jobs = load_manifest(self._write_manifest("manifest.yml", "builds:\n  - import_from: context\n"
+                                                                   "    image_name: a\n"))
+        self.assertEqual(["a"], [job.image_name for job in jobs])
+
+    def test_load_relative_context(self):
+        os.makedirs(os.path.join(self.directory, "context"))
+        jobs = load_manifest(self._write_manifest("manifest.json", json.dumps({"builds": [
+            {"import_from": "context", "image_name": "a"}]})))
+        self.assertEqual(os.path.join(self.directory, "context"), jobs[0].core.import_repository_from)
+
+    def test_load_without_builds(self):
+        self.assertRaises(ValueError, load_manifest, self._write_manifest("manifest.json", "[]"))
+
+    def test_load_with_missing_key(self):
+        self.assertRaises(ValueError, load_manifest, self._write_manifest("manifest.json", json.dumps(
+            {"builds": [{"import_from": "context"}]})))
+
+    def test_load_with_unknown_key(self):
+        self.assertRaises(ValueError, load_manifest, self._write_manifest("manifest.json", json.dumps(
+            {"builds": [{"import_from": "context", "image_name": "a", "other": 1}]})))
+
+    def _write_manifest(self, name: str, content: str) -> str:
+        """
+        Writes a manifest with the given contents.
+        :param name: file name of the manifest
+        :param content: contents of the manifest
+        :return: location of the manifest
+        """
+        location = os.path.join(self.directory, name)
+        with open(location, "w") as file:
+            file.write(content)
+        return location
+
+
+class TestBatchBuilder(TestWithTempFiles):
+    """
+    Tests for `BatchBuilder`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+
+    def test_run_shares_imports(self):
+        importer_factory = _CountingImporterFactory()
+        jobs = [BatchJob(f"image-{i}", _RecordingPatchworkDocker(f"{self.origin}#develop")) for i in range(3)]
+        jobs.append(BatchJob("image-master", _RecordingPatchworkDocker(self.origin)))
+        builder = BatchBuilder(jobs, prepare_concurrency=2, importer_factory=importer_factory)
+        self.assertTrue(builder.run())
+        self.assertEqual(1, importer_factory.created)
+        for job in jobs[:3]:
+            self.assertEqual(JobStatus.SUCCEEDED, job.status)
+            self.assertIn("develop.txt", job.core.built_contexts[0])
+        self.assertNotIn("develop.txt", jobs[3].core.built_contexts[0])
+
+    def test_run_fingerprints_once(self):
+        context_cache = PreparedContextCache(self.temp_manager.create_temp_directory())
+        for _ in range(2):
+            jobs = [BatchJob(f"image-{i}", _RecordingPatchworkDocker(self.origin, context_cache=context_cache))
+                    for i in range(2)]
+            self.assertTrue(BatchBuilder(jobs).run())
+            for job in jobs:
+                self.assertEqual(1, len(job.core.fingerprints))
+                self.assertIn("b.txt", job.core.built_contexts[0])
+
+    def test_run_with_failure(self):
+        statuses = []
+        jobs = [BatchJob("image-1", _RecordingPatchworkDocker(self.origin)),
+                BatchJob("image-2", _RecordingPatchworkDocker(self.origin, patches={"/does-not-exist": "b.txt"}))]
+        builder = BatchBuilder(jobs, on_status_change=lambda job: statuses.append((job.image_name, job.status)))
+        self.assertFalse(builder.run())
+        self.assertEqual(JobStatus.SUCCEEDED, jobs[0].status)
+        self.assertEqual(JobStatus.FAILED, jobs[1].status)
+        self.assertIsNotNone(jobs[1].error)
+        self.assertIn(("image-2", JobStatus.PREPARING), statuses)
+        self.assertIn("1/2 succeeded", format_summary(jobs))
+
+    def test_run_builds(self):
+        image_name = create_image_name()
+        client = docker.from_env()
+        try:
+            self.assertTrue(BatchBuilder([BatchJob(image_name, PatchworkDocker(EXAMPLE_BUILD_DIRECTORY))],
+                                         docker_client=client).run())
+            self.assertEqual(1, len(client.images.list(image_name)))
+        finally:
+            client.images.remove(image_name, force=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import json
+import unittest
+from typing import List, Dict, Any
+
+from patchworkdocker.build_logs import BuildLogParser, BuildEventType, BuildEvent, NdjsonBuildEventWriter, \
+    combine_listeners
+
+_EXAMPLE_BUILD_STREAM = [
+    {"stream": "Step 1/3 : FROM alpine\n"},
+    {"stream": " ---> 0ac33e5f5afa\n"},
+    {"stream": "Step 2/3 : COPY a.txt /\n"},
+    {"stream": " ---> Using cache\n"},
+    {"stream": " ---> 8b3fa1c2d7e1\n"},
+    {"stream": "Step 3/3 : RUN echo hello"},
+    {"stream": "\n"},
+    {"stream": " ---> Running in 4d2c1a0b9e8f\n"},
+    {"stream": "hello\n"},
+    {"stream": "Removing intermediate container 4d2c1a0b9e8f\n ---> 5e6f7a8b9c0d\n"},
+    {"aux": {"ID": "sha256:5e6f7a8b9c0d1e2f"}},
+    {"stream": "Successfully built 5e6f7a8b9c0d\n"}
+]
+
+
+def _parse(chunks: List[Dict[str, Any]], parser: BuildLogParser=None) -> List[BuildEvent]:
+    parser = parser if parser is not None else BuildLogParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    events.extend(parser.close())
+    return events
+
+
+class TestBuildLogParser(unittest.TestCase):
+    """
+    Tests for `BuildLogParser`.
+    """
+    def test_steps(self):
+        events = _parse(_EXAMPLE_BUILD_STREAM)
+        started = [event for event in events if event.type == BuildEventType.STEP_STARTED]
+        self.assertEqual([(1, 3, "FROM alpine"), (2, 3, "COPY a.txt /"), (3, 3, "RUN echo hello")],
+                         [(event.step, event.total_steps, event.instruction) for event in started])
+
+    def test_step_finished(self):
+        events = _parse(_EXAMPLE_BUILD_STREAM)
+        finished = [event for event in events if event.type == BuildEventType.STEP_FINISHED]
+        self.assertEqual([(1, False, "0ac33e5f5afa"), (2, True, "8b3fa1c2d7e1"), (3, False, "5e6f7a8b9c0d")],
+                         [(event.step, event.cached, event.layer) for event in finished])
+        for event in finished:
+            self.assertGreaterEqual(event.duration, 0)
+
+    def test_step_started_not_changed(self):
+        parser = BuildLogParser()
+        started = list(parser.feed(_EXAMPLE_BUILD_STREAM[2]))
+        for chunk in _EXAMPLE_BUILD_STREAM[3:5]:
+            list(parser.feed(chunk))
+        self.assertEqual([(BuildEventType.STEP_STARTED, 2, False, None)],
+                         [(event.type, event.step, event.cached, event.layer) for event in started])
+
+    def test_cache_hit(self):
+        events = _parse(_EXAMPLE_BUILD_STREAM)
+        self.assertEqual([2], [event.step for event in events if event.type == BuildEventType.CACHE_HIT])
+
+    def test_output(self):
+        events = _parse(_EXAMPLE_BUILD_STREAM)
+        output = [(event.step, event.message) for event in events if event.type == BuildEventType.OUTPUT]
+        self.assertIn((3, "hello"), output)
+
+    def test_build_finished(self):
+        parser = BuildLogParser()
+        events = _parse(_EXAMPLE_BUILD_STREAM, parser)
+        self.assertEqual(BuildEventType.BUILD_FINISHED, events[-1].type)
+        self.assertEqual("sha256:5e6f7a8b9c0d1e2f", events[-1].image_id)
+        self.assertIsNone(events[-1].layer)
+        self.assertEqual("sha256:5e6f7a8b9c0d1e2f", parser.image_id)
+        self.assertIsNone(parser.error)
+
+    def test_error(self):
+        parser = BuildLogParser()
+        events = _parse(_EXAMPLE_BUILD_STREAM[:9] + [
+            {"error": "The command '/bin/sh -c echo hello' returned a non-zero code: 1\n",
+             "errorDetail": {"code": 1, "message": "The command '/bin/sh -c echo hello' returned a non-zero code: 1"}}
+        ], parser)
+        self.assertEqual("The command '/bin/sh -c echo hello' returned a non-zero code: 1", parser.error)
+        self.assertEqual([BuildEventType.STEP_FINISHED, BuildEventType.ERROR], [event.type for event in events[-2:]])
+
+
+class TestNdjsonBuildEventWriter(unittest.TestCase):
+    """
+    Tests for `NdjsonBuildEventWriter`.
+    """
+    def test_write(self):
+        file = io.StringIO()
+        events = _parse(_EXAMPLE_BUILD_STREAM)
+        combine_listeners(None, NdjsonBuildEventWriter(file))(events[0])
+        written = [json.loads(line) for line in file.getvalue().splitlines()]
+        self.assertEqual(1, len(written))
+        self.assertEqual(BuildEventType.STEP_STARTED.value, written[0]["type"])
+        self.assertEqual("FROM alpine", written[0]["instruction"])
+        self.assertNotIn("duration", written[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
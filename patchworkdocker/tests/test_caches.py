@@ -0,0 +1,194 @@
+import os
+import time
+import unittest
+
+from git import Repo
+
+from patchworkdocker.caches import DirectoryCache, GitMirrorCache, PreparedContextCache, ImportCache
+from patchworkdocker.tests._common import TestWithTempFiles, create_git_repository
+
+
+class TestDirectoryCache(TestWithTempFiles):
+    """
+    Tests for `DirectoryCache`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache = DirectoryCache(self.temp_manager.create_temp_directory(), max_size=10)
+
+    def test_get_location(self):
+        self.assertEqual(self.cache.get_location("a"), self.cache.get_location("a"))
+        self.assertNotEqual(self.cache.get_location("a"), self.cache.get_location("b"))
+
+    def test_evict_least_recently_used(self):
+        for i, key in enumerate(["a", "b", "c"]):
+            self._create_entry(key, 5)
+            os.utime(self.cache.get_location(key), (i, i))
+        self.cache.touch("a")
+        evicted = self.cache.evict()
+        self.assertEqual([self.cache.get_location("b")], evicted)
+        self.assertTrue(self.cache.contains("a"))
+        self.assertTrue(self.cache.contains("c"))
+
+    def test_evict_keeps_given(self):
+        self._create_entry("a", 20)
+        self.assertEqual([], self.cache.evict(keep=["a"]))
+        self.assertTrue(self.cache.contains("a"))
+
+    def test_evict_skips_locked(self):
+        self._create_entry("a", 20)
+        with self.cache.lock("a"):
+            self.assertEqual([], self.cache.evict())
+        self.assertEqual([self.cache.get_location("a")], self.cache.evict())
+
+    def test_evict_skips_shared_locked(self):
+        self._create_entry("a", 20)
+        with self.cache.lock("a", shared=True), self.cache.lock("a", shared=True):
+            self.assertEqual([], self.cache.evict())
+
+    def test_evict_if_full(self):
+        self._create_entry("a", 5)
+        self.assertEqual([], self.cache.evict_if_full(5))
+        # The cache is not measured again until its tracked size exceeds the maximum
+        self._create_entry("b", 20)
+        self.assertEqual([], self.cache.evict_if_full(5))
+        self.assertEqual([self.cache.get_location("a")], self.cache.evict_if_full(1, keep=["b"]))
+
+    def test_evict_when_unbounded(self):
+        self.cache.max_size = None
+        self._create_entry("a", 20)
+        self.assertEqual([], self.cache.evict())
+
+    def _create_entry(self, key: str, size: int):
+        """
+        Creates a cache entry containing a file of the given size.
+        :param key: entry key
+        :param size: size of the file in the entry
+        """
+        location = self.cache.get_location(key)
+        os.makedirs(location)
+        with open(os.path.join(location, "file"), "wb") as file:
+            file.write(b"0" * size)
+
+
+class TestGitMirrorCache(TestWithTempFiles):
+    """
+    Tests for `GitMirrorCache`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache = GitMirrorCache(self.temp_manager.create_temp_directory())
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+
+    def test_normalise_origin(self):
+        self.assertEqual(GitMirrorCache.normalise_origin("https://Example.com/repo.git/"),
+                         GitMirrorCache.normalise_origin("https://example.com/repo"))
+
+    def test_mirror_created(self):
+        with self.cache.mirror(self.origin) as location:
+            self.assertTrue(Repo(location).bare)
+            self.assertIn("develop", [head.name for head in Repo(location).heads])
+
+    def test_mirror_updated(self):
+        with self.cache.mirror(self.origin):
+            pass
+        Repo(self.origin[len("file://"):]).create_head("new-branch")
+        with self.cache.mirror(self.origin) as location:
+            self.assertIn("new-branch", [head.name for head in Repo(location).heads])
+
+    def test_mirror_touched(self):
+        with self.cache.mirror(self.origin) as location:
+            os.utime(location, (0, 0))
+        before = time.time() - 1
+        with self.cache.mirror(self.origin) as location:
+            self.assertGreater(os.stat(location).st_mtime, before)
+
+
+class TestPreparedContextCache(TestWithTempFiles):
+    """
+    Tests for `PreparedContextCache`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache = PreparedContextCache(self.temp_manager.create_temp_directory())
+        self.context = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(self.context, "a", "empty"))
+        with open(os.path.join(self.context, "a", "file"), "w") as file:
+            file.write("content")
+        os.symlink("a/file", os.path.join(self.context, "link"))
+
+    def test_get_when_missing(self):
+        self.assertFalse(self.cache.get("key", self.temp_manager.create_temp_directory()))
+
+    def test_put_and_get(self):
+        self.cache.put("key", self.context)
+        destination = self.temp_manager.create_temp_directory()
+        self.assertTrue(self.cache.get("key", destination))
+        with open(os.path.join(destination, "link"), "r") as file:
+            self.assertEqual("content", file.read())
+        self.assertTrue(os.path.isdir(os.path.join(destination, "a", "empty")))
+
+    def test_get_not_shared_with_cache(self):
+        self.cache.put("key", self.context)
+        destination = self.temp_manager.create_temp_directory()
+        self.cache.get("key", destination)
+        with open(os.path.join(destination, "a", "file"), "a") as file:
+            file.write(" modified")
+        other_destination = self.temp_manager.create_temp_directory()
+        self.cache.get("key", other_destination)
+        with open(os.path.join(other_destination, "a", "file"), "r") as file:
+            self.assertEqual("content", file.read())
+
+    def test_put_not_shared_with_source(self):
+        self.cache.put("key", self.context)
+        with open(os.path.join(self.context, "a", "file"), "a") as file:
+            file.write(" modified")
+        destination = self.temp_manager.create_temp_directory()
+        self.cache.get("key", destination)
+        with open(os.path.join(destination, "a", "file"), "r") as file:
+            self.assertEqual("content", file.read())
+
+    def test_put_when_exists(self):
+        self.cache.put("key", self.context)
+        self.cache.put("key", self.temp_manager.create_temp_directory())
+        destination = self.temp_manager.create_temp_directory()
+        self.cache.get("key", destination)
+        self.assertTrue(os.path.exists(os.path.join(destination, "a", "file")))
+
+
+class TestImportCache(TestWithTempFiles):
+    """
+    Tests for `ImportCache`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.cache = ImportCache(self.temp_manager.create_temp_directory())
+        self.loaded = []
+
+    def test_use_loads_once(self):
+        for _ in range(2):
+            with self.cache.use("key", self._load) as location:
+                with open(os.path.join(location, "file"), "r") as file:
+                    self.assertEqual("content", file.read())
+        self.assertEqual(1, len(self.loaded))
+
+    def test_use_not_evicted_whilst_in_use(self):
+        self.cache.max_size = 0
+        with self.cache.use("key", self._load) as location:
+            with self.cache.use("other", self._load):
+                pass
+            self.assertTrue(os.path.exists(location))
+        self.assertFalse(self.cache.contains("other"))
+
+    def _load(self, location: str):
+        """
+        Loads an example import into the given location.
+        :param location: location to load into
+        """
+        self.loaded.append(location)
+        with open(os.path.join(location, "file"), "w") as file:
+            file.write("content")
+
+
+if __name__ == "__main__":
+    unittest.main()
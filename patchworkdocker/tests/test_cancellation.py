@@ -0,0 +1,63 @@
+import contextvars
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from patchworkdocker.cancellation import CancellationToken, cancellable, check_cancelled, OperationCancelledError, \
+    submit_cancellable
+
+
+class TestCheckCancelled(unittest.TestCase):
+    """
+    Tests for `check_cancelled`.
+    """
+    def test_not_cancellable(self):
+        check_cancelled()
+
+    def test_not_cancelled(self):
+        with cancellable(CancellationToken()):
+            check_cancelled()
+
+    def test_cancelled(self):
+        with cancellable(CancellationToken()) as token:
+            token.cancel()
+            self.assertRaises(OperationCancelledError, check_cancelled)
+        check_cancelled()
+
+    def test_cancelled_in_copied_context(self):
+        token = CancellationToken()
+        with cancellable(token):
+            context = contextvars.copy_context()
+        token.cancel()
+        check_cancelled()
+        self.assertRaises(OperationCancelledError, context.run, check_cancelled)
+
+
+class TestSubmitCancellable(unittest.TestCase):
+    """
+    Tests for `submit_cancellable`.
+    """
+    def test_run(self):
+        with ThreadPoolExecutor(1) as executor, cancellable(CancellationToken()):
+            self.assertEqual(3, submit_cancellable(executor, sum, [1, 2]).result())
+
+    def test_not_started_when_cancelled(self):
+        called = []
+        with ThreadPoolExecutor(1) as executor, cancellable(CancellationToken()) as token:
+            token.cancel()
+            future = submit_cancellable(executor, called.append, True)
+            self.assertRaises(OperationCancelledError, future.result)
+        self.assertEqual([], called)
+
+    def test_cancelled_whilst_running(self):
+        token = CancellationToken()
+
+        def cancel_then_check():
+            token.cancel()
+            check_cancelled()
+
+        with ThreadPoolExecutor(1) as executor, cancellable(token):
+            self.assertRaises(OperationCancelledError, submit_cancellable(executor, cancel_then_check).result)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,23 @@
+import json
 import os
 import shutil
+import subprocess
+import sys
 import unittest
 
 import docker
 from capturewrap import CaptureWrapBuilder, CaptureResult
 
-from patchworkdocker.cli import main
-from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY, create_image_name
+from patchworkdocker.cli import main, parse_cli_configuration
+from patchworkdocker.server import PatchworkDockerServer
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY, create_image_name, \
+    create_git_repository
+
+# Wall time budget for importing the CLI and printing its help, in seconds (the best of a few runs is used, to reduce
+# noise)
+_STARTUP_TIME_BUDGET = 0.25
+_STARTUP_RUNS = 3
+_LAZILY_IMPORTED_MODULES = ("git", "docker", "patch", "requests", "patchworkdocker.core")
 
 
 class CliTest(TestWithTempFiles):
@@ -33,6 +44,13 @@ class CliTest(TestWithTempFiles):
         result = self._call_wrapped_main(["invalid"])
         self.assertNotEqual(result.exception.code, 0)
 
+    def test_invalid_base_images(self):
+        for base_images in (["a", "b"], ["0=a", "0=b"]):
+            result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY, "--no-server"]
+                                             + [f"--base-image={base_image}" for base_image in base_images])
+            self.assertEqual(2, result.exception.code)
+            self.assertIn("more than once", result.stderr)
+
     def test_basic_prepare(self):
         result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY])
         directory = result.stdout.strip()
@@ -41,6 +59,109 @@ class CliTest(TestWithTempFiles):
         finally:
             shutil.rmtree(directory, ignore_errors=True)
 
+    def test_prepare_with_git_cache(self):
+        origin = create_git_repository(self.temp_manager.create_temp_directory())
+        cache_directory = self.temp_manager.create_temp_directory()
+        result = self._call_wrapped_main(["prepare", origin, "--git-cache-dir", cache_directory])
+        directory = result.stdout.strip()
+        try:
+            self.assertTrue(os.path.exists(os.path.join(directory, "b.txt")))
+            self.assertNotEqual(0, len(os.listdir(cache_directory)))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_prepare_with_cache(self):
+        cache_directory = self.temp_manager.create_temp_directory()
+        directories = []
+        try:
+            for _ in range(2):
+                result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY, "--cache-dir", cache_directory])
+                directories.append(result.stdout.strip())
+            self.assertEqual(sorted(os.listdir(directories[0])), sorted(os.listdir(directories[1])))
+            self.assertNotEqual(0, len(os.listdir(cache_directory)))
+        finally:
+            for directory in directories:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def test_caches_opt_in(self):
+        configuration = parse_cli_configuration(["prepare", EXAMPLE_BUILD_DIRECTORY])
+        self.assertIsNone(configuration.cache_directory)
+        self.assertIsNone(configuration.import_cache_directory)
+
+    def test_prepare_with_overlay(self):
+        import_cache_directory = self.temp_manager.create_temp_directory()
+        directories = []
+        try:
+            for _ in range(2):
+                result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY, "--overlay", "--import-cache-dir",
+                                                  import_cache_directory, "--cache-dir",
+                                                  self.temp_manager.create_temp_directory()])
+                directories.append(result.stdout.strip())
+            for directory in directories:
+                self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(directory)))
+            self.assertEqual(1, len([name for name in os.listdir(import_cache_directory)
+                                     if os.path.isdir(os.path.join(import_cache_directory, name))]))
+        finally:
+            for directory in directories:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def test_prepare_with_update(self):
+        context = self.temp_manager.create_temp_directory()
+        shutil.copytree(EXAMPLE_BUILD_DIRECTORY, context, dirs_exist_ok=True)
+        build_directory = os.path.join(self.temp_manager.create_temp_directory(), "build")
+        for _ in range(2):
+            result = self._call_wrapped_main(["prepare", context, "--update", "--no-cache", "--build-location",
+                                              build_directory])
+            self.assertEqual(build_directory, result.stdout.strip())
+            with open(os.path.join(context, "added.txt"), "w") as file:
+                file.write("added")
+        self.assertTrue(os.path.exists(os.path.join(build_directory, "added.txt")))
+
+    def test_prepare_with_profile(self):
+        profile_location = os.path.join(self.temp_manager.create_temp_directory(), "profile.json")
+        result = self._call_wrapped_main(["--profile-output", profile_location, "--profile-format", "chrome",
+                                          "prepare", EXAMPLE_BUILD_DIRECTORY, "--no-cache"])
+        directory = result.stdout.strip()
+        try:
+            self.assertIn("import", result.stderr)
+            with open(profile_location, "r") as file:
+                trace = json.load(file)
+            self.assertIn("prepare", [event["name"] for event in trace["traceEvents"]])
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_prepare_with_stage_base_images(self):
+        context = self.temp_manager.create_temp_directory()
+        with open(os.path.join(context, "Dockerfile"), "w") as file:
+            file.write("FROM golang AS build\nFROM alpine AS test\nFROM build AS release\nFROM alpine\n")
+        result = self._call_wrapped_main(["prepare", context, "--no-cache", "--base-image", "debian", "--base-image",
+                                          "test=busybox", "--target", "release"])
+        directory = result.stdout.strip()
+        try:
+            with open(os.path.join(directory, "Dockerfile"), "r") as file:
+                self.assertEqual("FROM debian AS build\nFROM build AS release\n", file.read())
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_prepare_on_server(self):
+        socket_location = os.path.join(self.temp_manager.create_temp_directory(), "server.sock")
+        with PatchworkDockerServer(socket_location) as server:
+            result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY, "--server-socket", socket_location])
+            self.assertEqual(1, len(server.scheduler.list()))
+        directory = result.stdout.strip()
+        try:
+            self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_prepare_not_on_server(self):
+        socket_location = os.path.join(self.temp_manager.create_temp_directory(), "server.sock")
+        with PatchworkDockerServer(socket_location) as server:
+            result = self._call_wrapped_main(["prepare", EXAMPLE_BUILD_DIRECTORY, "--server-socket", socket_location,
+                                              "--no-server"])
+            self.assertEqual(0, len(server.scheduler.list()))
+        shutil.rmtree(result.stdout.strip(), ignore_errors=True)
+
     def test_basic_build(self):
         image_name = create_image_name()
         client = docker.from_env()
@@ -57,5 +178,45 @@ class CliTest(TestWithTempFiles):
         return wrapped_main(*args, **kwargs)
 
 
+
+class TestStartup(unittest.TestCase):
+    """
+    Tests that the CLI starts quickly, as it is often invoked from scripts.
+    """
+    def test_help_does_not_import_dependencies(self):
+        imported = json.loads(self._run_python(
+            "import json, sys\n"
+            "from patchworkdocker.cli import main\n"
+            "try:\n"
+            "    main(['--help'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(json.dumps(sorted(sys.modules)), file=sys.stderr)\n"))
+        for module in _LAZILY_IMPORTED_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_help_within_budget(self):
+        durations = [float(self._run_python(
+            "import sys, time\n"
+            "started_at = time.perf_counter()\n"
+            "from patchworkdocker.cli import main\n"
+            "try:\n"
+            "    main(['--help'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(time.perf_counter() - started_at, file=sys.stderr)\n")) for _ in range(_STARTUP_RUNS)]
+        self.assertLess(min(durations), _STARTUP_TIME_BUDGET)
+
+    @staticmethod
+    def _run_python(code: str) -> str:
+        """
+        Runs the given code in a new Python interpreter.
+        :param code: the code
+        :return: what the code wrote to stderr
+        """
+        return subprocess.run([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              check=True, universal_newlines=True).stderr
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,25 @@
+import os
+import socket
+import unittest
+
+from patchworkdocker.client import ServerClient
+from patchworkdocker.tests._common import TestWithTempFiles
+
+
+class TestServerClient(TestWithTempFiles):
+    """
+    Tests for `ServerClient` (see `test_server` for its use with a running server).
+    """
+    def test_is_running_without_socket(self):
+        socket_location = os.path.join(self.temp_manager.create_temp_directory(), "server.sock")
+        self.assertFalse(ServerClient(socket_location).is_running())
+
+    def test_is_running_with_stale_socket(self):
+        socket_location = os.path.join(self.temp_manager.create_temp_directory(), "server.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_socket:
+            server_socket.bind(socket_location)
+        self.assertFalse(ServerClient(socket_location).is_running())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,237 @@
+import io
+import os
+import tarfile
+import unittest
+from typing import Dict
+
+from git import Repo
+
+from patchworkdocker.contexts import DirectoryContextBase, GitContextBase, StreamingContext, ContextBase
+from patchworkdocker.dockerignore import DockerIgnore
+from patchworkdocker.tests._common import TestWithTempFiles, create_git_repository
+
+
+def _read_stream(context: StreamingContext) -> Dict[str, bytes]:
+    """
+    Reads the tar streamed from the given context.
+    :param context: the context to stream
+    :return: map of member names to their contents (`None` for directories)
+    """
+    members = {}
+    with tarfile.open(fileobj=io.BytesIO(b"".join(context.stream())), mode="r") as tar:
+        for member in tar.getmembers():
+            members[member.name] = tar.extractfile(member).read() if member.isreg() else None
+    return members
+
+
+class _TestStreamingContext(TestWithTempFiles):
+    """
+    Tests for `StreamingContext` with a base.
+    """
+    def create_base(self) -> ContextBase:
+        """
+        Creates the base to test with, which must contain empty files `a/d.txt` and `b.txt`.
+        :return: the base
+        """
+        raise NotImplementedError()
+
+    def setUp(self):
+        super().setUp()
+        if type(self) is _TestStreamingContext:
+            self.skipTest("Abstract test")
+        self.context = StreamingContext(self.create_base(), self.temp_manager.create_temp_directory())
+        self.source_directory = self.temp_manager.create_temp_directory()
+
+    def test_stream(self):
+        members = _read_stream(self.context)
+        self.assertEqual(b"", members["a/d.txt"])
+        self.assertEqual(b"", members["b.txt"])
+        self.assertIsNone(members["a"])
+
+    def test_stream_with_file_added(self):
+        self.context.add(self._write_source("new.txt", b"new"), "a")
+        self.context.add(self._write_source("replacement.txt", b"replaced"), "b.txt")
+        members = _read_stream(self.context)
+        self.assertEqual(b"new", members["a/new.txt"])
+        self.assertEqual(b"replaced", members["b.txt"])
+
+    def test_stream_with_directory_added(self):
+        self._write_source("directory/d.txt", b"replaced")
+        self._write_source("directory/e.txt", b"new")
+        self.context.add(os.path.join(self.source_directory, "directory"), "a")
+        members = _read_stream(self.context)
+        self.assertEqual(b"replaced", members["a/d.txt"])
+        self.assertEqual(b"new", members["a/e.txt"])
+        self.assertEqual(b"", members["b.txt"])
+
+    def test_stream_with_dockerignore(self):
+        self.context.add(self._write_source("new.txt", b"new"), "a")
+        self.context.dockerignore = DockerIgnore(["a", "!a/new.txt"])
+        members = _read_stream(self.context)
+        self.assertEqual(b"new", members["a/new.txt"])
+        self.assertNotIn("a/d.txt", members)
+        self.assertIn("b.txt", members)
+
+    def test_read(self):
+        self.context.add(self._write_source("new.txt", b"new"), "new.txt")
+        self.assertEqual(b"new", self.context.read("new.txt"))
+        self.assertEqual(b"", self.context.read("a/d.txt"))
+        self.assertIsNone(self.context.read("a"))
+        self.assertIsNone(self.context.read("other.txt"))
+
+    def test_materialise(self):
+        self.context.add(self._write_source("new.txt", b"new"), "a")
+        self.context.dockerignore = DockerIgnore(["b.txt"])
+        with open(self.context.get_writable("a/d.txt"), "w") as file:
+            file.write("modified")
+        destination = self.temp_manager.create_temp_directory()
+        self.context.materialise(destination, link=True)
+        self.assertEqual(["a"], os.listdir(destination))
+        self.assertEqual(["d.txt", "new.txt"], sorted(os.listdir(os.path.join(destination, "a"))))
+        self.assertEqual("modified", open(os.path.join(destination, "a", "d.txt")).read())
+        self.assertEqual("new", open(os.path.join(destination, "a", "new.txt")).read())
+
+    def test_get_writable(self):
+        location = self.context.get_writable("a/d.txt")
+        with open(location, "w") as file:
+            file.write("modified")
+        self.assertEqual(location, self.context.get_writable("a/d.txt"))
+        self.assertEqual(b"modified", _read_stream(self.context)["a/d.txt"])
+
+    def test_get_writable_of_added(self):
+        source = self._write_source("new.txt", b"new")
+        self.context.add(source, "new.txt")
+        with open(self.context.get_writable("new.txt"), "a") as file:
+            file.write("er")
+        self.assertEqual(b"newer", _read_stream(self.context)["new.txt"])
+        self.assertEqual(b"new", open(source, "rb").read())
+
+    def test_get_writable_when_not_exists(self):
+        self.assertRaises(FileNotFoundError, self.context.get_writable, "other.txt")
+
+    def test_create_writable(self):
+        with open(self.context.create_writable("c/new.txt"), "w") as file:
+            file.write("new")
+        self.assertEqual(b"new", _read_stream(self.context)["c/new.txt"])
+        self.assertTrue(self.context.is_file("c/new.txt"))
+
+    def test_create_writable_when_exists(self):
+        self.assertRaises(FileExistsError, self.context.create_writable, "b.txt")
+
+    def test_remove(self):
+        self.context.get_writable("a/d.txt")
+        self.context.remove("a/d.txt")
+        self.context.remove("b.txt")
+        self.assertEqual(["a"], list(_read_stream(self.context).keys()))
+        self.assertFalse(self.context.is_file("b.txt"))
+        self.assertIsNone(self.context.read("b.txt"))
+        self.assertRaises(FileNotFoundError, self.context.get_writable, "b.txt")
+
+    def test_add_removed(self):
+        self.context.remove("b.txt")
+        self.context.add(self._write_source("replacement.txt", b"replaced"), "b.txt")
+        self.assertEqual(b"replaced", _read_stream(self.context)["b.txt"])
+
+    def _write_source(self, location: str, content: bytes) -> str:
+        """
+        Writes a file to the source directory.
+        :param location: location of the file relative to the source directory
+        :param content: content of the file
+        :return: absolute location of the file
+        """
+        location = os.path.join(self.source_directory, location)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, "wb") as file:
+            file.write(content)
+        return location
+
+
+class TestStreamingContextWithDirectoryBase(_TestStreamingContext):
+    """
+    Tests for `StreamingContext` with a `DirectoryContextBase`.
+    """
+    def create_base(self) -> ContextBase:
+        directory = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(directory, "a"))
+        open(os.path.join(directory, "a", "d.txt"), "w").close()
+        open(os.path.join(directory, "b.txt"), "w").close()
+        return DirectoryContextBase(directory)
+
+
+class TestStreamingContextWithGitBase(_TestStreamingContext):
+    """
+    Tests for `StreamingContext` with a `GitContextBase`.
+    """
+    def create_base(self) -> ContextBase:
+        location = create_git_repository(self.temp_manager.create_temp_directory())[len("file://"):]
+        return GitContextBase(location, Repo(location).heads.master.commit.hexsha)
+
+    def test_stream_excludes_git_directory(self):
+        self.assertFalse(any(name.startswith(".git") for name in _read_stream(self.context)))
+
+
+class TestGitContextBase(TestWithTempFiles):
+    """
+    Tests for `GitContextBase`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.location = create_git_repository(self.temp_manager.create_temp_directory())[len("file://"):]
+
+    def test_get_members_of_commit(self):
+        base = GitContextBase(self.location, "develop")
+        self.assertIn("develop.txt", [member.name for member, _ in base.get_members()])
+
+    def test_get_members_with_paths(self):
+        base = GitContextBase(self.location, "develop", paths=["a"])
+        self.assertEqual(["a", "a/d.txt"], sorted(member.name for member, _ in base.get_members()))
+
+    def test_get_members_ignores_export_attributes(self):
+        repository = Repo(self.location)
+        files = {".gitattributes": "ignored.txt export-ignore\nkept.txt export-subst\n", "ignored.txt": "ignored",
+                 "kept.txt": "$Format:%H$"}
+        for name, content in files.items():
+            with open(os.path.join(self.location, name), "w") as file:
+                file.write(content)
+        repository.index.add(list(files.keys()))
+        base = GitContextBase(self.location, repository.index.commit("Add export attributes").hexsha)
+        contents = {member.name: file.read() for member, file in base.get_members() if file is not None}
+        self.assertEqual(b"ignored", contents["ignored.txt"])
+        self.assertEqual(b"$Format:%H$", contents["kept.txt"])
+
+    def test_get_members_modes(self):
+        repository = Repo(self.location)
+        with open(os.path.join(self.location, "run.sh"), "w") as file:
+            file.write("#!/bin/sh\n")
+        os.chmod(os.path.join(self.location, "run.sh"), 0o755)
+        os.symlink("b.txt", os.path.join(self.location, "link.txt"))
+        repository.index.add(["run.sh", "link.txt"])
+        base = GitContextBase(self.location, repository.index.commit("Add executable and symlink").hexsha)
+        members = {member.name: member for member, _ in base.get_members()}
+        self.assertEqual(0o755, members["run.sh"].mode)
+        self.assertEqual(0o644, members["b.txt"].mode)
+        self.assertTrue(members["link.txt"].issym())
+        self.assertEqual("b.txt", members["link.txt"].linkname)
+        self.assertTrue(members["a"].isdir())
+
+    def test_get_members_closed_early(self):
+        repository = Repo(self.location)
+        # Larger than a pipe's buffer, so git is still writing when the members stop being read
+        with open(os.path.join(self.location, "large.bin"), "wb") as file:
+            file.write(os.urandom(4 * 1024 * 1024))
+        repository.index.add(["large.bin"])
+        base = GitContextBase(self.location, repository.index.commit("Add large file").hexsha)
+        members = base.get_members()
+        next(members)
+        members.close()
+
+    def test_is_directory(self):
+        base = GitContextBase(self.location, "master")
+        self.assertTrue(base.is_directory("a"))
+        self.assertTrue(base.is_directory("."))
+        self.assertFalse(base.is_directory("b.txt"))
+        self.assertFalse(base.is_directory("other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
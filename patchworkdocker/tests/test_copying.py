@@ -0,0 +1,125 @@
+import os
+import unittest
+
+from patchworkdocker.copying import clone_file, clone_tree, copy_up
+from patchworkdocker.dockerignore import DockerIgnore
+from patchworkdocker.tests._common import TestWithTempFiles
+
+
+def _write(location: str, content: str):
+    """
+    Writes the given content to the given location, creating parent directories as required.
+    :param location: location of the file
+    :param content: content of the file
+    """
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(location, "w") as file:
+        file.write(content)
+
+
+def _read(location: str) -> str:
+    """
+    Reads the contents of the given file.
+    :param location: location of the file
+    :return: the contents
+    """
+    with open(location, "r") as file:
+        return file.read()
+
+
+class TestCloneFile(TestWithTempFiles):
+    """
+    Tests for `clone_file`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = self.temp_manager.create_temp_directory()
+        self.source = os.path.join(self.directory, "source")
+        _write(self.source, "content")
+        os.chmod(self.source, 0o755)
+
+    def test_clone_file(self):
+        destination = os.path.join(self.directory, "destination")
+        clone_file(self.source, destination)
+        self.assertEqual("content", _read(destination))
+        self.assertEqual(0o755, os.stat(destination).st_mode & 0o777)
+        self.assertEqual(1, os.stat(self.source).st_nlink)
+
+    def test_clone_file_replaces_destination(self):
+        other = os.path.join(self.directory, "other")
+        _write(other, "other")
+        destination = os.path.join(self.directory, "destination")
+        os.link(other, destination)
+        clone_file(self.source, destination)
+        self.assertEqual("content", _read(destination))
+        self.assertEqual("other", _read(other))
+        self.assertEqual(["destination", "other", "source"], sorted(os.listdir(self.directory)))
+
+    def test_clone_file_with_link(self):
+        destination = os.path.join(self.directory, "destination")
+        clone_file(self.source, destination, link=True)
+        self.assertEqual("content", _read(destination))
+
+
+class TestCloneTree(TestWithTempFiles):
+    """
+    Tests for `clone_tree`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.source = self.temp_manager.create_temp_directory()
+        _write(os.path.join(self.source, "a", "b.txt"), "b")
+        _write(os.path.join(self.source, "c.txt"), "c")
+        os.symlink("c.txt", os.path.join(self.source, "link"))
+        self.destination = os.path.join(self.temp_manager.create_temp_directory(), "destination")
+
+    def test_clone_tree(self):
+        clone_tree(self.source, self.destination)
+        self.assertEqual("b", _read(os.path.join(self.destination, "a", "b.txt")))
+        self.assertEqual("c", _read(os.path.join(self.destination, "c.txt")))
+        self.assertEqual("c.txt", os.readlink(os.path.join(self.destination, "link")))
+
+    def test_clone_tree_into_existing(self):
+        _write(os.path.join(self.destination, "a", "b.txt"), "old")
+        _write(os.path.join(self.destination, "d.txt"), "d")
+        clone_tree(self.source, self.destination)
+        self.assertEqual("b", _read(os.path.join(self.destination, "a", "b.txt")))
+        self.assertEqual("d", _read(os.path.join(self.destination, "d.txt")))
+
+    def test_clone_tree_with_dockerignore(self):
+        clone_tree(self.source, self.destination, dockerignore=DockerIgnore(["a", "!a/b.txt", "c.txt"]))
+        self.assertEqual(["a", "link"], sorted(os.listdir(self.destination)))
+        self.assertEqual("b", _read(os.path.join(self.destination, "a", "b.txt")))
+
+    def test_clone_tree_with_link_then_copy_up(self):
+        clone_tree(self.source, self.destination, link=True, max_workers=1)
+        location = os.path.join(self.destination, "c.txt")
+        copy_up(location)
+        self.assertEqual(1, os.stat(location).st_nlink)
+        _write(location, "changed")
+        self.assertEqual("c", _read(os.path.join(self.source, "c.txt")))
+
+
+class TestCopyUp(TestWithTempFiles):
+    """
+    Tests for `copy_up`.
+    """
+    def test_copy_up(self):
+        directory = self.temp_manager.create_temp_directory()
+        _write(os.path.join(directory, "a"), "a")
+        os.link(os.path.join(directory, "a"), os.path.join(directory, "b"))
+        copy_up(os.path.join(directory, "b"))
+        _write(os.path.join(directory, "b"), "b")
+        self.assertEqual("a", _read(os.path.join(directory, "a")))
+        self.assertEqual(1, os.stat(os.path.join(directory, "a")).st_nlink)
+
+    def test_copy_up_of_unshared(self):
+        directory = self.temp_manager.create_temp_directory()
+        _write(os.path.join(directory, "a"), "a")
+        inode = os.stat(os.path.join(directory, "a")).st_ino
+        copy_up(os.path.join(directory, "a"))
+        self.assertEqual(inode, os.stat(os.path.join(directory, "a")).st_ino)
+
+
+if __name__ == "__main__":
+    unittest.main()
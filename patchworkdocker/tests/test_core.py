@@ -0,0 +1,317 @@
+import difflib
+import hashlib
+import os
+import tarfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from patchworkdocker.caches import PreparedContextCache
+from patchworkdocker.core import PatchworkDocker
+from patchworkdocker.dockerfiles import AddLabels, SetArgDefaults
+from patchworkdocker.importers import ImporterResources, HTTP_SESSION_RESOURCE
+from patchworkdocker.modifiers import PatchApplicationError
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY, serve_directory
+
+_DOCKERFILE = "FROM scratch\nCOPY a.txt /a.txt\n"
+
+
+class TestGetInputDigest(TestWithTempFiles):
+    """
+    Tests for `PatchworkDocker.get_input_digest`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.context = self.temp_manager.create_temp_directory()
+        with open(os.path.join(self.context, "Dockerfile"), "w") as file:
+            file.write(_DOCKERFILE)
+        self.additional_file = os.path.join(self.temp_manager.create_temp_directory(), "a.txt")
+        with open(self.additional_file, "w") as file:
+            file.write("a")
+        self.core = PatchworkDocker(self.context, additional_files={self.additional_file: None})
+
+    def test_digest_stable(self):
+        self.assertEqual(self.core.get_input_digest(_DOCKERFILE), self.core.get_input_digest(_DOCKERFILE))
+
+    def test_digest_changes_with_additional_file(self):
+        digest = self.core.get_input_digest(_DOCKERFILE)
+        with open(self.additional_file, "w") as file:
+            file.write("b")
+        self.assertNotEqual(digest, self.core.get_input_digest(_DOCKERFILE))
+
+    def test_digest_changes_with_dockerfile_location(self):
+        digest = self.core.get_input_digest(_DOCKERFILE)
+        os.rename(os.path.join(self.context, "Dockerfile"), os.path.join(self.context, "Other"))
+        self.core.dockerfile_location = "Other"
+        self.assertNotEqual(digest, self.core.get_input_digest(_DOCKERFILE))
+
+    def test_digest_with_fingerprint(self):
+        fingerprint = self.core.get_fingerprint()
+        digest = self.core.get_input_digest(_DOCKERFILE)
+        with open(self.additional_file, "w") as file:
+            file.write("b")
+        # The given fingerprint is used, rather than being got again
+        self.assertEqual(digest, self.core.get_input_digest(_DOCKERFILE, fingerprint=fingerprint))
+
+    def test_digest_when_base_image_from_build_argument(self):
+        self.assertIsNone(self.core.get_input_digest("ARG BASE\nFROM ${BASE}\n"))
+
+    def test_digest_changes_with_dockerfile_transforms(self):
+        digest = self.core.get_input_digest(_DOCKERFILE)
+        self.core.dockerfile_transforms = [AddLabels({"a": "1"})]
+        self.assertNotEqual(digest, self.core.get_input_digest(_DOCKERFILE))
+
+
+class TestPrepareWithPatchSet(TestWithTempFiles):
+    """
+    Tests for preparing with a patch of many files, applied to the context root.
+    """
+    def setUp(self):
+        super().setUp()
+        self.context = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(self.context, "sub"))
+        with open(os.path.join(self.context, "Dockerfile"), "w") as file:
+            file.write(_DOCKERFILE)
+        with open(os.path.join(self.context, "sub", "a.txt"), "w") as file:
+            file.write("a\n")
+        self.patch_location = os.path.join(self.temp_manager.create_temp_directory(), "change.patch")
+        with open(self.patch_location, "w") as file:
+            file.write("".join(difflib.unified_diff(["FROM scratch\n", "COPY a.txt /a.txt\n"],
+                                                    ["FROM scratch\n", "COPY sub/a.txt /a.txt\n"],
+                                                    "a/Dockerfile", "b/Dockerfile")))
+            file.write("".join(difflib.unified_diff(["a\n"], ["b\n"], "a/sub/a.txt", "b/sub/a.txt")))
+        self.core = PatchworkDocker(self.context, patches={self.patch_location: "."})
+
+    def test_prepare(self):
+        self._assert_patched(self.core.prepare(self.temp_manager.create_temp_directory()))
+
+    def test_prepare_overlay(self):
+        with self.core.prepare_overlay(self.temp_manager.create_temp_directory()) as context:
+            destination = self.temp_manager.create_temp_directory()
+            context.materialise(destination)
+        self._assert_patched(destination)
+        with open(os.path.join(self.context, "sub", "a.txt"), "r") as file:
+            self.assertEqual("a\n", file.read())
+
+    def test_prepare_creating_and_deleting_files(self):
+        self._use_creating_and_deleting_patch()
+        self._assert_created_and_deleted(self.core.prepare(self.temp_manager.create_temp_directory()))
+
+    def test_prepare_overlay_creating_and_deleting_files(self):
+        self._use_creating_and_deleting_patch()
+        with self.core.prepare_overlay(self.temp_manager.create_temp_directory()) as context:
+            self.assertFalse(context.is_file("sub/a.txt"))
+            destination = self.temp_manager.create_temp_directory()
+            context.materialise(destination)
+        self._assert_created_and_deleted(destination)
+        self.assertTrue(os.path.exists(os.path.join(self.context, "sub", "a.txt")))
+
+    def _use_creating_and_deleting_patch(self):
+        with open(self.patch_location, "w") as file:
+            file.write("diff --git a/sub/new.txt b/sub/new.txt\nnew file mode 100644\n--- /dev/null\n"
+                       "+++ b/sub/new.txt\n@@ -0,0 +1 @@\n+new\n")
+            file.write("diff --git a/sub/a.txt b/sub/a.txt\ndeleted file mode 100644\n--- a/sub/a.txt\n"
+                       "+++ /dev/null\n@@ -1 +0,0 @@\n-a\n")
+
+    def _assert_created_and_deleted(self, directory: str):
+        with open(os.path.join(directory, "sub", "new.txt"), "r") as file:
+            self.assertEqual("new\n", file.read())
+        self.assertFalse(os.path.exists(os.path.join(directory, "sub", "a.txt")))
+
+    def _assert_patched(self, directory: str):
+        with open(os.path.join(directory, "Dockerfile"), "r") as file:
+            self.assertEqual("FROM scratch\nCOPY sub/a.txt /a.txt\n", file.read())
+        with open(os.path.join(directory, "sub", "a.txt"), "r") as file:
+            self.assertEqual("b\n", file.read())
+
+
+class TestPrepareWithDockerfileTransforms(TestWithTempFiles):
+    """
+    Tests for preparing with transforms of the Dockerfile.
+    """
+    def setUp(self):
+        super().setUp()
+        self.context = self.temp_manager.create_temp_directory()
+        with open(os.path.join(self.context, "Dockerfile"), "w") as file:
+            file.write("ARG VERSION\nFROM alpine AS build\nFROM build\n")
+        self.core = PatchworkDocker(self.context, base_image="debian", dockerfile_transforms=[
+            SetArgDefaults({"VERSION": "1"}), AddLabels({"a": "1"})])
+
+    def test_prepare(self):
+        self._assert_transformed(self.core.prepare(self.temp_manager.create_temp_directory()))
+
+    def test_prepare_overlay(self):
+        with self.core.prepare_overlay(self.temp_manager.create_temp_directory()) as context:
+            destination = self.temp_manager.create_temp_directory()
+            context.materialise(destination)
+        self._assert_transformed(destination)
+        with open(os.path.join(self.context, "Dockerfile"), "r") as file:
+            self.assertEqual("ARG VERSION\nFROM alpine AS build\nFROM build\n", file.read())
+
+    def test_prepare_reports_base_images(self):
+        base_images = []
+        self.core.prepare(self.temp_manager.create_temp_directory(), on_base_images=base_images.append)
+        with self.core.prepare_overlay(self.temp_manager.create_temp_directory(),
+                                       on_base_images=base_images.append):
+            pass
+        self.assertEqual([["debian"], ["debian"]], base_images)
+
+    def test_prepare_pins_base_images_outside_cache(self):
+        core = PatchworkDocker(self.context, pin_base_images=True,
+                               context_cache=PreparedContextCache(self.temp_manager.create_temp_directory()))
+        for digest in ("sha256:1", "sha256:2", None):
+            with patch("patchworkdocker.core.get_image_digest", return_value=digest):
+                base_images = []
+                directory = core.prepare(self.temp_manager.create_temp_directory(), on_base_images=base_images.append)
+            image = f"alpine@{digest}" if digest is not None else "alpine"
+            with open(os.path.join(directory, "Dockerfile"), "r") as file:
+                self.assertEqual(f"ARG VERSION\nFROM {image} AS build\nFROM build\n", file.read())
+            self.assertEqual([[image]], base_images)
+
+    def _assert_transformed(self, directory: str):
+        with open(os.path.join(directory, "Dockerfile"), "r") as file:
+            self.assertEqual("ARG VERSION=1\nFROM debian AS build\nFROM build\nLABEL a=1\n", file.read())
+
+
+class TestPrepareFromArchive(TestWithTempFiles):
+    """
+    Tests for preparing from a fetched archive.
+    """
+    def setUp(self):
+        super().setUp()
+        self.archive_directory = self.temp_manager.create_temp_directory()
+        archive_location = os.path.join(self.archive_directory, "context.tar.gz")
+        with tarfile.open(archive_location, "w:gz") as archive:
+            archive.add(EXAMPLE_BUILD_DIRECTORY, arcname="context")
+        with open(archive_location, "rb") as file:
+            self.checksum = hashlib.sha256(file.read()).hexdigest()
+        self.context_cache = PreparedContextCache(self.temp_manager.create_temp_directory())
+
+    def test_prepare_fetches_once(self):
+        with serve_directory(self.archive_directory) as url:
+            origin = f"{url}/context.tar.gz#sha256={self.checksum}"
+            build_directory = PatchworkDocker(origin, context_cache=self.context_cache).prepare(
+                self.temp_manager.create_temp_directory())
+        self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(build_directory)))
+        # The server has stopped, so the archive can only come from the cache
+        build_directory = PatchworkDocker(origin, context_cache=self.context_cache).prepare(
+            self.temp_manager.create_temp_directory())
+        self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(build_directory)))
+
+    def test_prepare_reuses_http_session(self):
+        with serve_directory(self.archive_directory) as url:
+            with PatchworkDocker(f"{url}/context.tar.gz") as core:
+                core.prepare(self.temp_manager.create_temp_directory())
+                session = core.importer_resources.get(HTTP_SESSION_RESOURCE, object)
+                self.assertIsInstance(session, requests.Session)
+                self.assertIs(core.importer_resources, core.create_importer().resources)
+        # The core's own resources are closed with it
+        self.assertIsNot(session, core.importer_resources.get(HTTP_SESSION_RESOURCE, object))
+
+    def test_given_resources_not_closed(self):
+        resources = ImporterResources()
+        session = resources.get(HTTP_SESSION_RESOURCE, object)
+        with PatchworkDocker(EXAMPLE_BUILD_DIRECTORY, importer_resources=resources):
+            pass
+        self.assertIs(session, resources.get(HTTP_SESSION_RESOURCE, object))
+
+
+class TestPrepareUpdate(TestWithTempFiles):
+    """
+    Tests for preparing with `update`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.context = self.temp_manager.create_temp_directory()
+        _write(os.path.join(self.context, "Dockerfile"), _DOCKERFILE)
+        _write(os.path.join(self.context, "a.txt"), "a\n")
+        _write(os.path.join(self.context, "b.txt"), "b\n")
+        self.inputs = self.temp_manager.create_temp_directory()
+        self.patch_location = os.path.join(self.inputs, "a.patch")
+        self._write_patch("a.txt", "a\n", "patched\n")
+        self.additional_file = os.path.join(self.inputs, "c.txt")
+        _write(self.additional_file, "c\n")
+        self.build_directory = self.temp_manager.create_temp_directory()
+
+    def test_prepare(self):
+        self._prepare()
+        self.assertEqual("patched\n", _read(os.path.join(self.build_directory, "a.txt")))
+        self.assertEqual("c\n", _read(os.path.join(self.build_directory, "c.txt")))
+
+    def test_update_unchanged(self):
+        self._prepare()
+        modified_at = os.stat(os.path.join(self.build_directory, "a.txt")).st_mtime_ns
+        self._prepare()
+        self.assertEqual("patched\n", _read(os.path.join(self.build_directory, "a.txt")))
+        self.assertEqual(modified_at, os.stat(os.path.join(self.build_directory, "a.txt")).st_mtime_ns)
+
+    def test_update_with_changed_patch(self):
+        self._prepare()
+        added_at = os.stat(os.path.join(self.build_directory, "c.txt")).st_mtime_ns
+        self._write_patch("a.txt", "a\n", "patched again\n")
+        self._prepare()
+        self.assertEqual("patched again\n", _read(os.path.join(self.build_directory, "a.txt")))
+        # The added file is not changed by the patch, so it is not added again
+        self.assertEqual(added_at, os.stat(os.path.join(self.build_directory, "c.txt")).st_mtime_ns)
+
+    def test_update_with_removed_modifications(self):
+        self._prepare()
+        PatchworkDocker(self.context).prepare(self.build_directory, update=True)
+        self.assertEqual("a\n", _read(os.path.join(self.build_directory, "a.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.build_directory, "c.txt")))
+
+    def test_update_with_changed_source(self):
+        self._prepare()
+        _write(os.path.join(self.context, "b.txt"), "changed\n")
+        _write(os.path.join(self.context, "d.txt"), "d\n")
+        os.remove(os.path.join(self.context, "Dockerfile"))
+        _write(os.path.join(self.context, "Dockerfile"), "FROM scratch\n")
+        self._prepare()
+        self.assertEqual("changed\n", _read(os.path.join(self.build_directory, "b.txt")))
+        self.assertEqual("d\n", _read(os.path.join(self.build_directory, "d.txt")))
+        self.assertEqual("FROM scratch\n", _read(os.path.join(self.build_directory, "Dockerfile")))
+        self.assertEqual("patched\n", _read(os.path.join(self.build_directory, "a.txt")))
+
+    def test_update_with_changed_patched_file(self):
+        self._prepare()
+        _write(os.path.join(self.context, "a.txt"), "a\nmore\n")
+        self._prepare()
+        self.assertEqual("patched\nmore\n", _read(os.path.join(self.build_directory, "a.txt")))
+
+    def test_update_after_incomplete_update(self):
+        self._prepare()
+        self._write_patch("a.txt", "unmatched\n", "patched again\n")
+        self.assertRaises(PatchApplicationError, self._prepare)
+        self._write_patch("a.txt", "a\n", "patched again\n")
+        self._prepare()
+        self.assertEqual("patched again\n", _read(os.path.join(self.build_directory, "a.txt")))
+
+    def test_update_not_prepared_to_be_updated(self):
+        PatchworkDocker(self.context).prepare(self.build_directory)
+        self.assertRaises(ValueError, self._prepare)
+
+    def test_update_overlay(self):
+        self.assertRaises(ValueError, PatchworkDocker(self.context).prepare, self.build_directory, overlay=True,
+                          update=True)
+
+    def _prepare(self) -> str:
+        return PatchworkDocker(self.context, patches={self.patch_location: "a.txt"},
+                               additional_files={self.additional_file: None}).prepare(self.build_directory, update=True)
+
+    def _write_patch(self, file: str, old: str, new: str):
+        _write(self.patch_location, "".join(difflib.unified_diff([old], [new], f"a/{file}", f"b/{file}")))
+
+
+def _write(location: str, content: str):
+    with open(location, "w") as file:
+        file.write(content)
+
+
+def _read(location: str) -> str:
+    with open(location, "r") as file:
+        return file.read()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,61 @@
 import os
 import unittest
 import uuid
+from threading import Lock
+from types import SimpleNamespace
+from typing import List
 
 import docker
+from docker.errors import ImageNotFound
 
-from patchworkdocker.docker_images import build_docker_image
+from patchworkdocker.contexts import StreamingContext, DirectoryContextBase
+from patchworkdocker.docker_images import build_docker_image, build_docker_image_from_stream, find_image_with_label, \
+    INPUT_DIGEST_LABEL, ImagePuller
 from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY
 
 
+class _FakeImages:
+    """
+    Images collection of a Docker client, where no images exist until they are pulled.
+    """
+    def __init__(self):
+        self.pulled: List[str] = []
+        self._lock = Lock()
+
+    def get(self, image_name: str):
+        raise ImageNotFound(image_name)
+
+    def pull(self, repository: str, tag: str=None):
+        with self._lock:
+            self.pulled.append(f"{repository}:{tag}")
+        return SimpleNamespace(id=f"sha256:{repository}-{tag}")
+
+
+class TestImagePuller(unittest.TestCase):
+    """
+    Tests for `ImagePuller`.
+    """
+    def setUp(self):
+        self.client = SimpleNamespace(images=_FakeImages())
+
+    def test_get_image_id(self):
+        with ImagePuller(self.client) as image_puller:
+            self.assertEqual("sha256:alpine-3.10", image_puller.get_image_id("alpine:3.10"))
+
+    def test_pull_once(self):
+        with ImagePuller(self.client) as image_puller:
+            image_puller.pull_all(["alpine", "debian", "alpine"])
+            image_puller.get_image_id("alpine")
+            image_puller.get_image_id("debian")
+        self.assertEqual(["alpine:latest", "debian:latest"], sorted(self.client.images.pulled))
+
+    def test_pull_all_ignores_build_arguments(self):
+        with ImagePuller(self.client) as image_puller:
+            image_puller.pull_all(["${BASE}", "alpine"])
+            image_puller.get_image_id("alpine")
+        self.assertEqual(["alpine:latest"], self.client.images.pulled)
+
+
 class TestBuildDockerImage(TestWithTempFiles):
     """
     Test `build_docker_image`.
@@ -27,5 +75,23 @@ class TestBuildDockerImage(TestWithTempFiles):
         self.assertEqual(contents, open(os.path.join(EXAMPLE_BUILD_DIRECTORY, "hello-world.txt"), "r").read())
 
 
+    def test_build_docker_image_from_stream(self):
+        context = StreamingContext(DirectoryContextBase(EXAMPLE_BUILD_DIRECTORY),
+                                   self.temp_manager.create_temp_directory())
+        build_docker_image_from_stream(self._docker_image, context.stream(), "Dockerfile")
+        contents = self._docker_client.containers.run(self._docker_image, "cat /test.txt", remove=True).decode("UTF8")
+        self.assertEqual(contents, open(os.path.join(EXAMPLE_BUILD_DIRECTORY, "hello-world.txt"), "r").read())
+
+    def test_find_image_with_label(self):
+        digest = str(uuid.uuid4())
+        self.assertIsNone(find_image_with_label(INPUT_DIGEST_LABEL, digest, self._docker_client))
+        context = StreamingContext(DirectoryContextBase(EXAMPLE_BUILD_DIRECTORY),
+                                   self.temp_manager.create_temp_directory())
+        build_docker_image_from_stream(self._docker_image, context.stream(), "Dockerfile",
+                                       labels={INPUT_DIGEST_LABEL: digest})
+        image = find_image_with_label(INPUT_DIGEST_LABEL, digest, self._docker_client)
+        self.assertIn(f"{self._docker_image}:latest", image.tags)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,223 @@
+import unittest
+
+from patchworkdocker.dockerfiles import Dockerfile, SetBaseImage, SetArgDefaults, AddLabels, SubstituteRun, \
+    Instruction, SelectTarget, PinBaseImages
+
+_EXAMPLE_DOCKERFILE = """# syntax=docker/dockerfile:1
+# A multi-stage Dockerfile
+ARG VERSION=1.0
+
+FROM --platform=linux/amd64 golang:1.13 AS build
+ARG VERSION
+RUN go get example.com/app \\
+    # Comments in instructions are ignored
+    && go build -o /app
+FROM build AS test
+RUN go test ./...
+
+FROM alpine:3.10
+COPY --from=build /app /app
+RUN apk add --no-cache curl
+"""
+
+
+class TestDockerfile(unittest.TestCase):
+    """
+    Tests for `Dockerfile`.
+    """
+    def test_round_trip(self):
+        self.assertEqual(_EXAMPLE_DOCKERFILE, Dockerfile.parse(_EXAMPLE_DOCKERFILE).to_text())
+
+    def test_round_trip_without_trailing_newline(self):
+        self.assertEqual("FROM alpine\nRUN true", Dockerfile.parse("FROM alpine\nRUN true").to_text())
+
+    def test_directives(self):
+        self.assertEqual({"syntax": "docker/dockerfile:1"}, Dockerfile.parse(_EXAMPLE_DOCKERFILE).directives)
+
+    def test_directives_only_at_start(self):
+        self.assertEqual({}, Dockerfile.parse("FROM alpine\n# escape=`\n").directives)
+
+    def test_instructions(self):
+        instructions = Dockerfile.parse(_EXAMPLE_DOCKERFILE).instructions
+        self.assertEqual(["ARG", "FROM", "ARG", "RUN", "FROM", "RUN", "FROM", "COPY", "RUN"],
+                         [instruction.keyword for instruction in instructions])
+        self.assertEqual("go get example.com/app     && go build -o /app", instructions[3].arguments)
+
+    def test_escape_directive(self):
+        dockerfile = Dockerfile.parse("# escape=`\nFROM windows\nRUN dir `\n    c:\\\n")
+        self.assertEqual(["FROM", "RUN"], [instruction.keyword for instruction in dockerfile.instructions])
+        self.assertEqual("dir     c:\\", dockerfile.instructions[1].arguments)
+
+    def test_heredoc(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nRUN <<EOF\nFROM other\nEOF\nRUN true\n")
+        self.assertEqual(["FROM", "RUN", "RUN"], [instruction.keyword for instruction in dockerfile.instructions])
+        self.assertEqual(["alpine"], dockerfile.get_base_images())
+        self.assertEqual(["FROM other\n"], dockerfile.instructions[1].heredocs)
+
+    def test_stages(self):
+        stages = Dockerfile.parse(_EXAMPLE_DOCKERFILE).stages
+        self.assertEqual([("golang:1.13", "build", "linux/amd64"), ("build", "test", None),
+                          ("alpine:3.10", None, None)], [(stage.image, stage.name, stage.platform) for stage in stages])
+
+    def test_get_base_images(self):
+        self.assertEqual(["golang:1.13", "alpine:3.10"], Dockerfile.parse(_EXAMPLE_DOCKERFILE).get_base_images())
+
+    def test_get_root_stage(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        self.assertEqual(2, dockerfile.get_root_stage().index)
+        self.assertEqual(0, dockerfile.get_root_stage(dockerfile.stages[1]).index)
+
+    def test_global_args(self):
+        dockerfile = Dockerfile.parse("ARG A=1\nARG B\nARG C=${A}2\nFROM alpine\nARG D=4\n")
+        self.assertEqual({"A": "1", "C": "12"}, dockerfile.global_args)
+
+    def test_get_base_images_from_build_arguments(self):
+        dockerfile = Dockerfile.parse("ARG BASE=alpine\nARG TAG\nFROM ${BASE}:${TAG:-3.10} AS build\nFROM $BASE\n"
+                                      "FROM ${OTHER}\n")
+        self.assertEqual(["alpine:3.10", "alpine", "${OTHER}"], dockerfile.get_base_images())
+
+    def test_get_stage(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        self.assertEqual(0, dockerfile.get_stage("BUILD").index)
+        self.assertEqual(2, dockerfile.get_stage("2").index)
+        self.assertRaises(ValueError, dockerfile.get_stage, "3")
+        self.assertRaises(ValueError, dockerfile.get_stage, "other")
+
+    def test_get_dependencies(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        self.assertEqual([0], [stage.index for stage in dockerfile.get_dependencies(dockerfile.stages[1])])
+        self.assertEqual([0], [stage.index for stage in dockerfile.get_dependencies(dockerfile.stages[2])])
+
+    def test_append(self):
+        dockerfile = Dockerfile.parse("FROM alpine")
+        dockerfile.append(Instruction("RUN", "true"))
+        self.assertEqual("FROM alpine\nRUN true\n", dockerfile.to_text())
+
+
+class TestSetBaseImage(unittest.TestCase):
+    """
+    Tests for `SetBaseImage`.
+    """
+    def test_single_stage(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nRUN true\n")
+        SetBaseImage("debian")(dockerfile)
+        self.assertEqual("FROM debian\nRUN true\n", dockerfile.to_text())
+
+    def test_multi_stage(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        SetBaseImage("debian")(dockerfile)
+        self.assertEqual(_EXAMPLE_DOCKERFILE.replace("FROM alpine:3.10", "FROM debian"), dockerfile.to_text())
+
+    def test_final_stage_built_from_earlier_stage(self):
+        dockerfile = Dockerfile.parse("FROM --platform=linux/amd64 alpine AS base\nFROM base\n")
+        SetBaseImage("debian")(dockerfile)
+        self.assertEqual("FROM --platform=linux/amd64 debian AS base\nFROM base\n", dockerfile.to_text())
+
+    def test_without_from(self):
+        self.assertRaises(ValueError, SetBaseImage("debian"), Dockerfile.parse("RUN true\n"))
+
+    def test_stage(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        SetBaseImage("golang:1.14", stage="build")(dockerfile)
+        SetBaseImage("debian", stage="2")(dockerfile)
+        self.assertEqual(_EXAMPLE_DOCKERFILE.replace("golang:1.13", "golang:1.14").replace("alpine:3.10", "debian"),
+                         dockerfile.to_text())
+
+    def test_stage_from_build_argument(self):
+        dockerfile = Dockerfile.parse("ARG BASE=alpine\nFROM ${BASE} AS build\nFROM build\n")
+        SetBaseImage("debian")(dockerfile)
+        self.assertEqual("ARG BASE=alpine\nFROM debian AS build\nFROM build\n", dockerfile.to_text())
+
+    def test_unknown_stage(self):
+        self.assertRaises(ValueError, SetBaseImage("debian", stage="other"), Dockerfile.parse(_EXAMPLE_DOCKERFILE))
+
+
+class TestSelectTarget(unittest.TestCase):
+    """
+    Tests for `SelectTarget`.
+    """
+    def test_select(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        SelectTarget("test")(dockerfile)
+        self.assertEqual(_EXAMPLE_DOCKERFILE[:_EXAMPLE_DOCKERFILE.index("FROM alpine")], dockerfile.to_text())
+
+    def test_select_removes_stages_not_needed(self):
+        dockerfile = Dockerfile.parse("FROM alpine AS a\nFROM alpine AS b\nFROM golang AS c\n"
+                                      "RUN --mount=type=cache,from=0,target=/cache true\nCOPY --from=2 /x /x\n"
+                                      "FROM debian AS d\nCOPY --from=c /x /x\nCOPY --from=nginx /y /y\nFROM d\n")
+        SelectTarget("3")(dockerfile)
+        self.assertEqual("FROM alpine AS a\nFROM golang AS c\nRUN --mount=type=cache,from=0,target=/cache true\n"
+                         "COPY --from=1 /x /x\nFROM debian AS d\nCOPY --from=c /x /x\nCOPY --from=nginx /y /y\n",
+                         dockerfile.to_text())
+
+    def test_select_final_stage(self):
+        dockerfile = Dockerfile.parse(_EXAMPLE_DOCKERFILE)
+        SelectTarget("2")(dockerfile)
+        self.assertEqual(_EXAMPLE_DOCKERFILE[:_EXAMPLE_DOCKERFILE.index("FROM build")]
+                         + _EXAMPLE_DOCKERFILE[_EXAMPLE_DOCKERFILE.index("FROM alpine"):], dockerfile.to_text())
+
+
+class TestPinBaseImages(unittest.TestCase):
+    """
+    Tests for `PinBaseImages`.
+    """
+    def test_pin(self):
+        dockerfile = Dockerfile.parse("ARG BASE=alpine\nFROM ${BASE} AS build\nFROM build\nFROM debian@sha256:1\n"
+                                      "FROM ${OTHER}\nFROM unknown\nFROM scratch\n")
+        PinBaseImages(lambda image: f"sha256:{image}" if image != "unknown" else None)(dockerfile)
+        self.assertEqual("ARG BASE=alpine\nFROM alpine@sha256:alpine AS build\nFROM build\nFROM debian@sha256:1\n"
+                         "FROM ${OTHER}\nFROM unknown\nFROM scratch\n", dockerfile.to_text())
+
+
+class TestSetArgDefaults(unittest.TestCase):
+    """
+    Tests for `SetArgDefaults`.
+    """
+    def test_set(self):
+        dockerfile = Dockerfile.parse("ARG A=1\nFROM alpine\nARG B\nARG C=3 A\n")
+        SetArgDefaults({"A": "x", "B": "y z"})(dockerfile)
+        self.assertEqual("ARG A=x\nFROM alpine\nARG B=\"y z\"\nARG C=3 A=x\n", dockerfile.to_text())
+
+    def test_not_declared(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nARG A\n")
+        SetArgDefaults({"B": "1"})(dockerfile)
+        self.assertEqual("FROM alpine\nARG A\n", dockerfile.to_text())
+
+
+class TestAddLabels(unittest.TestCase):
+    """
+    Tests for `AddLabels`.
+    """
+    def test_add(self):
+        dockerfile = Dockerfile.parse("FROM alpine\n")
+        AddLabels({"b": "two words", "a": "1"})(dockerfile)
+        self.assertEqual("FROM alpine\nLABEL a=1 b=\"two words\"\n", dockerfile.to_text())
+
+
+class TestSubstituteRun(unittest.TestCase):
+    """
+    Tests for `SubstituteRun`.
+    """
+    def test_substitute(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nRUN apk add \\\n    curl\nCOPY curl /\nRUN echo\n")
+        SubstituteRun(r"\bcurl\b", "wget")(dockerfile)
+        self.assertEqual("FROM alpine\nRUN apk add     wget\nCOPY curl /\nRUN echo\n", dockerfile.to_text())
+
+    def test_substitute_heredoc(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nRUN <<EOF\napk add curl\nEOF\nRUN <<-A cat - <<B\n\ta\n\tA\nb\nB\n")
+        SubstituteRun(r"\bcurl\b", "wget")(dockerfile)
+        SubstituteRun(r"<<EOF", "<<END")(dockerfile)
+        SubstituteRun(r"\bcat\b", "tee")(dockerfile)
+        self.assertEqual("FROM alpine\nRUN <<END\napk add wget\nEND\nRUN <<-A tee - <<B\n\ta\nA\nb\nB\n",
+                         dockerfile.to_text())
+
+    def test_substitute_heredoc_declaration(self):
+        dockerfile = Dockerfile.parse("FROM alpine\nRUN <<EOF\napk add curl\nEOF\n")
+        self.assertRaises(ValueError, SubstituteRun(r"<<EOF", "true"), dockerfile)
+
+    def test_repr(self):
+        self.assertEqual("SubstituteRun('a', 'b')", repr(SubstituteRun("a", "b")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import unittest
+from pathlib import Path
+
+from patchworkdocker.dockerignore import DockerIgnore, walk
+from patchworkdocker.tests._common import TestWithTempFiles
+
+
+class TestDockerIgnore(unittest.TestCase):
+    """
+    Tests for `DockerIgnore`.
+    """
+    def test_is_excluded_with_no_patterns(self):
+        self.assertFalse(DockerIgnore().is_excluded("a/b.txt"))
+
+    def test_is_excluded_with_wildcards(self):
+        dockerignore = DockerIgnore(["*.log", "a/?.txt", "[x-z].md"])
+        self.assertTrue(dockerignore.is_excluded("build.log"))
+        self.assertFalse(dockerignore.is_excluded("a/build.log"))
+        self.assertTrue(dockerignore.is_excluded("a/b.txt"))
+        self.assertFalse(dockerignore.is_excluded("a/bc.txt"))
+        self.assertTrue(dockerignore.is_excluded("y.md"))
+        self.assertFalse(dockerignore.is_excluded("a.md"))
+
+    def test_is_excluded_with_double_star(self):
+        dockerignore = DockerIgnore(["**/*.pyc", "build/**"])
+        self.assertTrue(dockerignore.is_excluded("a.pyc"))
+        self.assertTrue(dockerignore.is_excluded("a/b/c.pyc"))
+        self.assertTrue(dockerignore.is_excluded("build/a/b"))
+        self.assertFalse(dockerignore.is_excluded("a/build"))
+
+    def test_is_excluded_when_parent_matches(self):
+        dockerignore = DockerIgnore(["a"])
+        self.assertTrue(dockerignore.is_excluded("a"))
+        self.assertTrue(dockerignore.is_excluded("a/b/c.txt"))
+        self.assertFalse(dockerignore.is_excluded("ab"))
+
+    def test_is_excluded_with_negation(self):
+        dockerignore = DockerIgnore(["*.md", "!README.md", "README*.md"])
+        self.assertTrue(dockerignore.is_excluded("CHANGES.md"))
+        self.assertTrue(dockerignore.is_excluded("README.md"))
+        self.assertFalse(DockerIgnore(["*.md", "!README.md"]).is_excluded("README.md"))
+
+    def test_is_excluded_with_unclean_paths(self):
+        dockerignore = DockerIgnore(["/a/./b/"])
+        self.assertTrue(dockerignore.is_excluded("a/b"))
+        self.assertTrue(dockerignore.is_excluded("./a/b/c"))
+
+    def test_dockerfile_never_excluded(self):
+        dockerignore = DockerIgnore(["*", "docker"], dockerfile_location="docker/Dockerfile")
+        self.assertFalse(dockerignore.is_excluded("docker/Dockerfile"))
+        self.assertFalse(dockerignore.is_excluded(".dockerignore"))
+        self.assertTrue(dockerignore.is_excluded("Dockerfile"))
+
+    def test_is_pruned(self):
+        dockerignore = DockerIgnore(["a", "b", "!b/c.txt"], dockerfile_location="d/Dockerfile")
+        self.assertTrue(dockerignore.is_pruned("a"))
+        self.assertFalse(dockerignore.is_pruned("b"))
+        self.assertFalse(dockerignore.is_pruned("d"))
+        self.assertTrue(dockerignore.is_pruned("bc"))
+
+    def test_from_text(self):
+        dockerignore = DockerIgnore.from_text("# comment\n\n  *.log  \n!keep.log\n", default_patterns=[".git"])
+        self.assertTrue(dockerignore.is_excluded(".git/HEAD"))
+        self.assertTrue(dockerignore.is_excluded("build.log"))
+        self.assertFalse(dockerignore.is_excluded("keep.log"))
+        self.assertFalse(dockerignore.is_excluded("# comment"))
+
+    def test_from_text_can_negate_defaults(self):
+        self.assertFalse(DockerIgnore.from_text("!.git", default_patterns=[".git"]).is_excluded(".git"))
+
+
+class TestWalk(TestWithTempFiles):
+    """
+    Tests for `walk`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = self.temp_manager.create_temp_directory()
+        for location in ["b.txt", "a/c.txt", "a/b/d.txt", "e/f.txt"]:
+            location = os.path.join(self.directory, location)
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            Path(location).touch()
+
+    def test_walk(self):
+        self.assertEqual(["a", "a/b", "a/b/d.txt", "a/c.txt", "b.txt", "e", "e/f.txt"],
+                         [path for path, _ in walk(self.directory)])
+
+    def test_walk_with_dockerignore(self):
+        dockerignore = DockerIgnore(["a", "!a/b/d.txt", "e"])
+        self.assertEqual(["a/b/d.txt", "b.txt"], [path for path, _ in walk(self.directory, dockerignore)])
+
+    def test_walk_does_not_read_pruned_directories(self):
+        os.chmod(os.path.join(self.directory, "e"), 0)
+        try:
+            self.assertEqual(["a", "b.txt"], [path for path, _ in walk(self.directory, DockerIgnore(["a/*", "e"]))])
+        finally:
+            os.chmod(os.path.join(self.directory, "e"), 0o755)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import unittest
+
+from patchworkdocker.fingerprints import hash_path
+from patchworkdocker.tests._common import TestWithTempFiles
+
+
+class TestHashPath(TestWithTempFiles):
+    """
+    Tests for `hash_path`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(self.directory, "a"))
+        self._write("a/file", "content")
+
+    def test_same_tree(self):
+        other_directory = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(other_directory, "a"))
+        with open(os.path.join(other_directory, "a/file"), "w") as file:
+            file.write("content")
+        self.assertEqual(hash_path(self.directory), hash_path(other_directory))
+
+    def test_content_changed(self):
+        before = hash_path(self.directory)
+        self._write("a/file", "changed")
+        self.assertNotEqual(before, hash_path(self.directory))
+
+    def test_file_renamed(self):
+        before = hash_path(self.directory)
+        os.rename(os.path.join(self.directory, "a/file"), os.path.join(self.directory, "a/other"))
+        self.assertNotEqual(before, hash_path(self.directory))
+
+    def test_executable_bit_changed(self):
+        before = hash_path(self.directory)
+        os.chmod(os.path.join(self.directory, "a/file"), 0o755)
+        self.assertNotEqual(before, hash_path(self.directory))
+
+    def test_empty_directory_added(self):
+        before = hash_path(self.directory)
+        os.makedirs(os.path.join(self.directory, "b"))
+        self.assertNotEqual(before, hash_path(self.directory))
+
+    def test_file(self):
+        self.assertNotEqual(hash_path(self.directory), hash_path(os.path.join(self.directory, "a/file")))
+
+    def _write(self, location: str, content: str):
+        """
+        Writes the given content to the given location in the test directory.
+        :param location: location relative to the test directory
+        :param content: content to write
+        """
+        with open(os.path.join(self.directory, location), "w") as file:
+            file.write(content)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,25 @@
+import hashlib
+import io
+import logging
 import os
+import sys
+import tarfile
 import unittest
+import zipfile
 from abc import abstractmethod
 from pathlib import Path
-from typing import TypeVar, Generic, Optional
+from typing import TypeVar, Generic, Optional, Dict
 
-from patchworkdocker.importers import GitImporter, Importer, FileSystemImporter
-from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_GIT_REPOSITORY
+from git import Repo
+from logzero import logger
+
+from patchworkdocker.caches import GitMirrorCache
+from patchworkdocker.importers import GitImporter, Importer, FileSystemImporter, TarballImporter, ZipImporter, \
+    ArchiveError, ChecksumMismatchError, ImporterFactory, ImageImporter, ImageImportError, ImporterRegistry, \
+    ImporterRegistration, ImporterResources, create_default_importer_registry, IMPORTERS_ENTRY_POINT_GROUP
+from patchworkdocker.refs import RefResolver
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_GIT_REPOSITORY, create_git_repository, \
+    serve_directory, FakeDockerDaemon
 
 ImporterType = TypeVar("ImporterType", bound=Importer)
 
@@ -67,6 +81,183 @@ class TestGitImporter(_TestImporter[GitImporter]):
         self.assertTrue(os.path.exists(os.path.join(path, "b.txt")))
 
 
+class TestGitImporterWithMirrorCache(_TestImporter[GitImporter]):
+    """
+    Tests for `GitImporter` when using a mirror cache.
+    """
+    @property
+    def importer(self) -> ImporterType:
+        if self._importer is None:
+            self._importer = GitImporter(GitMirrorCache(self.temp_manager.create_temp_directory()))
+        return self._importer
+
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+
+    def test_load(self):
+        path = self.load(self.origin)
+        self.assertTrue(os.path.exists(os.path.join(path, "a/d.txt")))
+        self.assertEqual(self.origin, Repo(path).remote().url)
+
+    def test_load_branch(self):
+        path = self.load(f"{self.origin}#develop")
+        self.assertTrue(os.path.exists(os.path.join(path, "develop.txt")))
+
+    def test_load_tag(self):
+        path = self.load(f"{self.origin}#1.0")
+        self.assertTrue(os.path.exists(os.path.join(path, "b.txt")))
+        self.assertFalse(os.path.exists(os.path.join(path, "develop.txt")))
+
+    def test_load_base(self):
+        base = self.importer.load_base(f"{self.origin}#develop", self.temp_manager.create_temp_directory())
+        self.assertIn("develop.txt", [member.name for member, _ in base.get_members()])
+
+    def test_load_after_origin_change(self):
+        self.load(self.origin)
+        Repo(self.origin[len("file://"):]).create_head("new-branch", "develop")
+        path = self.load(f"{self.origin}#new-branch")
+        self.assertTrue(os.path.exists(os.path.join(path, "develop.txt")))
+
+
+class TestGitImporterWithPinnedCommit(TestWithTempFiles):
+    """
+    Tests for `GitImporter` when the commit that a reference resolves to is pinned.
+    """
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+        self.origin_repository = Repo(self.origin[len("file://"):])
+        self.ref_resolver = RefResolver(
+            lockfile_location=os.path.join(self.temp_manager.create_temp_directory(), "lock.json"))
+        self.pinned = self.ref_resolver.resolve(self.origin, "master")
+        self.origin_repository.git.merge("develop")
+
+    def test_load(self):
+        self._assert_loads_pinned(GitImporter(ref_resolver=self.ref_resolver))
+
+    def test_load_when_shallow(self):
+        self._assert_loads_pinned(GitImporter(shallow=True, ref_resolver=self.ref_resolver))
+
+    def test_load_base(self):
+        base = GitImporter(ref_resolver=self.ref_resolver).load_base(f"{self.origin}#master")
+        self.assertNotIn("develop.txt", [member.name for member, _ in base.get_members()])
+
+    def _assert_loads_pinned(self, importer: GitImporter):
+        """
+        Asserts that the given importer loads the pinned commit of master, rather than its latest commit.
+        :param importer: the importer
+        """
+        location = importer.load(f"{self.origin}#master", self.temp_manager.create_temp_directory())
+        self.assertEqual(self.pinned, Repo(location).head.commit.hexsha)
+        self.assertFalse(os.path.exists(os.path.join(location, "develop.txt")))
+
+
+class TestGitImporterWithShallowAndSparse(_TestImporter[GitImporter]):
+    """
+    Tests for `GitImporter` when shallow fetching and sparse checking out.
+    """
+    @property
+    def importer(self) -> ImporterType:
+        if self._importer is None:
+            self._importer = GitImporter(shallow=True, sparse_paths=["a"])
+        return self._importer
+
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+        self.origin_repository = Repo(self.origin[len("file://"):])
+
+    def test_load(self):
+        path = self.load(self.origin)
+        self.assertTrue(os.path.exists(os.path.join(path, "a/d.txt")))
+        self.assertFalse(os.path.exists(os.path.join(path, "b.txt")))
+        self.assertEqual("1", Repo(path).git.rev_list("--count", "HEAD"))
+
+    def test_load_branch(self):
+        self._importer = GitImporter(shallow=True, sparse_paths=["develop.txt"])
+        path = self.load(f"{self.origin}#develop")
+        self.assertEqual(["develop.txt"], [name for name in os.listdir(path) if name != ".git"])
+        self.assertEqual("1", Repo(path).git.rev_list("--count", "HEAD"))
+
+    def test_load_commit(self):
+        commit = self.origin_repository.heads.develop.commit.hexsha
+        path = self.load(f"{self.origin}#{commit}")
+        self.assertEqual(commit, Repo(path).head.commit.hexsha)
+        self.assertEqual("1", Repo(path).git.rev_list("--count", "HEAD"))
+
+    def test_load_abbreviated_commit(self):
+        commit = self.origin_repository.heads.develop.commit.hexsha
+        path = self.load(f"{self.origin}#{commit[:8]}")
+        self.assertEqual(commit, Repo(path).head.commit.hexsha)
+
+    def test_load_tag(self):
+        path = self.load(f"{self.origin}#1.0")
+        self.assertEqual(self.origin_repository.tags["1.0"].commit, Repo(path).head.commit)
+
+    def test_load_everything(self):
+        self._importer = GitImporter(shallow=True, sparse_paths=["."])
+        path = self.load(self.origin)
+        self.assertTrue(os.path.exists(os.path.join(path, "b.txt")))
+
+
+class TestGitImporterUpdate(TestWithTempFiles):
+    """
+    Tests for `GitImporter.get_update`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.origin = f"{create_git_repository(self.temp_manager.create_temp_directory())}#master"
+        self.origin_repository = Repo(self.origin[len("file://"):].partition("#")[0])
+        self.load_directory = self.temp_manager.create_temp_directory()
+
+    def test_update_unchanged(self):
+        state = self._load(GitImporter())
+        update = GitImporter().get_update(self.origin, self.load_directory, state)
+        self.assertEqual(frozenset(), update.changed_paths)
+        self.assertEqual(state, update.state)
+
+    def test_update(self):
+        self._test_update(GitImporter())
+
+    def test_update_shallow(self):
+        self._test_update(GitImporter(shallow=True))
+
+    def test_update_with_mirror_cache(self):
+        self._test_update(GitImporter(GitMirrorCache(self.temp_manager.create_temp_directory())))
+
+    def test_update_from_other_origin(self):
+        state = self._load(GitImporter())
+        other_origin = create_git_repository(self.temp_manager.create_temp_directory())
+        self.assertIsNone(GitImporter().get_update(other_origin, self.load_directory, state))
+
+    def _test_update(self, importer: GitImporter):
+        state = self._load(importer)
+        Path(os.path.join(self.load_directory, "b.txt")).write_text("modified")
+        Path(os.path.join(self.origin_repository.working_tree_dir, "new.txt")).write_text("new")
+        self.origin_repository.index.add(["new.txt"])
+        self.origin_repository.index.remove(["a/d.txt"], working_tree=True)
+        commit = self.origin_repository.index.commit("Update").hexsha
+
+        # A new importer, as the importer's reference resolver remembers what references resolved to
+        importer = GitImporter(importer.mirror_cache, shallow=importer.shallow)
+        update = importer.get_update(self.origin, self.load_directory, state)
+        self.assertEqual({"new.txt", "a/d.txt"}, update.changed_paths)
+        self.assertEqual(commit, update.state["commit"])
+        update.apply()
+        self.assertEqual("new", Path(os.path.join(self.load_directory, "new.txt")).read_text())
+        self.assertFalse(os.path.exists(os.path.join(self.load_directory, "a", "d.txt")))
+        # Files that have not changed in the repository are left as they are
+        self.assertEqual("modified", Path(os.path.join(self.load_directory, "b.txt")).read_text())
+        repository = Repo(self.load_directory)
+        self.assertEqual(commit, repository.head.commit.hexsha)
+        self.assertEqual("master", repository.active_branch.name)
+
+    def _load(self, importer: GitImporter) -> dict:
+        importer.load(self.origin, self.load_directory)
+        return importer.get_state(self.origin, self.load_directory)
+
+
 class TestFileSystemImporter(_TestImporter[GitImporter]):
     """
     Tests for `FileSystemImporter`.
@@ -88,6 +279,356 @@ class TestFileSystemImporter(_TestImporter[GitImporter]):
         path = self.load(self.test_directory)
         self.assertTrue(os.path.exists(os.path.join(path, TestFileSystemImporter._EXAMPLE_FILE)))
 
+    def test_load_base(self):
+        base = self.importer.load_base(self.test_directory)
+        self.assertEqual([TestFileSystemImporter._EXAMPLE_FILE], [member.name for member, _ in base.get_members()])
+
+    def test_load_with_dockerignore(self):
+        os.makedirs(os.path.join(self.test_directory, "ignored"))
+        Path(os.path.join(self.test_directory, "ignored", "kept.txt")).touch()
+        Path(os.path.join(self.test_directory, "ignored", "other.txt")).touch()
+        with open(os.path.join(self.test_directory, ".dockerignore"), "w") as file:
+            file.write("ignored\n!ignored/kept.txt\n")
+        path = self.load(self.test_directory)
+        self.assertTrue(os.path.exists(os.path.join(path, "ignored", "kept.txt")))
+        self.assertFalse(os.path.exists(os.path.join(path, "ignored", "other.txt")))
+        self.assertTrue(os.path.exists(os.path.join(path, ".dockerignore")))
+
+    def test_get_fingerprint_ignores_excluded(self):
+        with open(os.path.join(self.test_directory, ".dockerignore"), "w") as file:
+            file.write("*.log\n")
+        fingerprint = self.importer.get_fingerprint(self.test_directory)
+        Path(os.path.join(self.test_directory, "build.log")).touch()
+        self.assertEqual(fingerprint, self.importer.get_fingerprint(self.test_directory))
+
+    def test_update(self):
+        path = self.load(self.test_directory)
+        state = self.importer.get_state(self.test_directory, path)
+        os.makedirs(os.path.join(self.test_directory, "sub"))
+        Path(os.path.join(self.test_directory, "sub", "new.txt")).write_text("new")
+        os.remove(os.path.join(self.test_directory, TestFileSystemImporter._EXAMPLE_FILE))
+        update = self.importer.get_update(self.test_directory, path, state)
+        self.assertEqual({"sub/new.txt", TestFileSystemImporter._EXAMPLE_FILE}, update.changed_paths)
+        update.apply()
+        self.assertEqual(["sub"], os.listdir(path))
+        self.assertEqual("new", Path(os.path.join(path, "sub", "new.txt")).read_text())
+        self.assertEqual(frozenset(), self.importer.get_update(self.test_directory, path, update.state).changed_paths)
+
+    def test_update_from_other_origin(self):
+        path = self.load(self.test_directory)
+        state = self.importer.get_state(self.test_directory, path)
+        self.assertIsNone(self.importer.get_update(self.temp_manager.create_temp_directory(), path, state))
+
+
+class TestTarballImporter(_TestImporter[TarballImporter]):
+    """
+    Tests for `TarballImporter`.
+    """
+    _EXAMPLE_FILES = {"release-1.0/Dockerfile": b"FROM alpine\n", "release-1.0/a/b.txt": b"b"}
+
+    @property
+    def importer(self) -> ImporterType:
+        if self._importer is None:
+            self._importer = TarballImporter()
+        return self._importer
+
+    def setUp(self):
+        super().setUp()
+        self.archive_directory = self.temp_manager.create_temp_directory()
+        self.archive_location = self._create_archive("release.tar.gz", TestTarballImporter._EXAMPLE_FILES)
+
+    def test_load(self):
+        path = self.load(self.archive_location)
+        self.assertEqual(["Dockerfile", "a"], sorted(os.listdir(path)))
+        self.assertEqual("b", Path(os.path.join(path, "a", "b.txt")).read_text())
+
+    def test_load_with_executable(self):
+        location = self._create_archive("executable.tar", {"run.sh": b"#!/bin/sh\n"}, mode=0o755)
+        path = self.load(location)
+        self.assertTrue(os.access(os.path.join(path, "run.sh"), os.X_OK))
+
+    def test_load_with_checksum(self):
+        path = self.load(f"{self.archive_location}#sha256={_sha256(self.archive_location)}")
+        self.assertTrue(os.path.exists(os.path.join(path, "Dockerfile")))
+
+    def test_load_with_incorrect_checksum(self):
+        load_directory = self.temp_manager.create_temp_directory()
+        self.assertRaises(ChecksumMismatchError, self.importer.load, f"{self.archive_location}#sha256=00",
+                          load_directory)
+        self.assertEqual([], os.listdir(load_directory))
+
+    def test_load_with_invalid_checksum(self):
+        self.assertRaises(ValueError, self.importer.load, f"{self.archive_location}#unknown=00")
+
+    def test_load_with_hash_in_name(self):
+        location = self._create_archive("release#1.tar.gz", TestTarballImporter._EXAMPLE_FILES)
+        path = self.load(location)
+        self.assertTrue(os.path.exists(os.path.join(path, "Dockerfile")))
+        path = self.load(f"{location}#sha256={_sha256(location)}")
+        self.assertTrue(os.path.exists(os.path.join(path, "Dockerfile")))
+
+    def test_load_with_path_outside(self):
+        location = self._create_archive("outside.tar", {"../outside.txt": b""})
+        self.assertRaises(ArchiveError, self.importer.load, location)
+
+    def test_load_with_absolute_symlink(self):
+        location = self._create_archive("symlinks.tar", {"Dockerfile": b"", "bin/busybox": b""},
+                                        symlinks={"bin/sh": "/bin/busybox"})
+        path = self.load(location)
+        self.assertEqual("/bin/busybox", os.readlink(os.path.join(path, "bin", "sh")))
+
+    def test_load_with_symlink_outside(self):
+        location = self._create_archive("outside.tar", {}, symlinks={"a/outside": "../../outside"})
+        self.assertRaises(ArchiveError, self.importer.load, location)
+
+    def test_load_through_symlink(self):
+        location = self._create_archive("outside.tar", {"etc/passwd": b""}, symlinks={"etc": "/etc"})
+        self.assertRaises(ArchiveError, self.importer.load, location)
+
+    def test_load_over_http(self):
+        with serve_directory(self.archive_directory) as url:
+            path = self.load(f"{url}/release.tar.gz#sha256={_sha256(self.archive_location)}")
+        self.assertEqual(["Dockerfile", "a"], sorted(os.listdir(path)))
+
+    def test_get_fingerprint_with_checksum(self):
+        checksum = _sha256(self.archive_location)
+        # Not fetched, as the checksum identifies the archive
+        self.assertEqual(self.importer.get_fingerprint(f"http://example.invalid/a.tar.gz#sha256={checksum}"),
+                         self.importer.get_fingerprint(f"{self.archive_location}#sha256={checksum}"))
+        with self.assertLogs(logger, level=logging.INFO) as logs:
+            self.assertIsNone(self.importer.get_fingerprint("http://example.invalid/a.tar.gz"))
+        self.assertIn("http://example.invalid/a.tar.gz#sha256=", "\n".join(logs.output))
+
+    def test_get_fingerprint_of_local_file(self):
+        fingerprint = self.importer.get_fingerprint(self.archive_location)
+        self._create_archive("release.tar.gz", {"other.txt": b""})
+        self.assertNotEqual(fingerprint, self.importer.get_fingerprint(self.archive_location))
+
+    def _create_archive(self, name: str, files: Dict[str, bytes], mode: int=0o644,
+                        symlinks: Dict[str, str]=None) -> str:
+        location = os.path.join(self.archive_directory, name)
+        with tarfile.open(location, "w:gz" if name.endswith(".gz") else "w") as archive:
+            for path, target in (symlinks or {}).items():
+                info = tarfile.TarInfo(path)
+                info.type = tarfile.SYMTYPE
+                info.linkname = target
+                archive.addfile(info)
+            for path, content in files.items():
+                info = tarfile.TarInfo(path)
+                info.size = len(content)
+                info.mode = mode
+                archive.addfile(info, io.BytesIO(content))
+        return location
+
+
+class TestZipImporter(_TestImporter[ZipImporter]):
+    """
+    Tests for `ZipImporter`.
+    """
+    @property
+    def importer(self) -> ImporterType:
+        if self._importer is None:
+            self._importer = ZipImporter()
+        return self._importer
+
+    def setUp(self):
+        super().setUp()
+        self.archive_directory = self.temp_manager.create_temp_directory()
+        self.archive_location = os.path.join(self.archive_directory, "release.zip")
+        with zipfile.ZipFile(self.archive_location, "w") as archive:
+            archive.writestr("Dockerfile", "FROM alpine\n")
+            info = zipfile.ZipInfo("run.sh")
+            info.external_attr = 0o755 << 16
+            archive.writestr(info, "#!/bin/sh\n")
+
+    def test_load(self):
+        path = self.load(self.archive_location)
+        self.assertEqual(["Dockerfile", "run.sh"], sorted(os.listdir(path)))
+        self.assertTrue(os.access(os.path.join(path, "run.sh"), os.X_OK))
+
+    def test_load_over_http(self):
+        with serve_directory(self.archive_directory) as url:
+            path = self.load(f"{url}/release.zip#sha256={_sha256(self.archive_location)}")
+        self.assertEqual(["Dockerfile", "run.sh"], sorted(os.listdir(path)))
+
+    def test_load_invalid(self):
+        Path(self.archive_location).write_text("invalid")
+        self.assertRaises(ArchiveError, self.importer.load, self.archive_location)
+
+
+class TestImageImporter(_TestImporter[ImageImporter]):
+    """
+    Tests for `ImageImporter`.
+    """
+    _EXAMPLE_IMAGES = {"example/builder:1.0": {"/usr/src/app/Dockerfile": b"FROM alpine\n",
+                                               "/usr/src/app/a/b.txt": b"b", "/etc/hostname": b"builder"}}
+
+    @property
+    def importer(self) -> ImporterType:
+        if self._importer is None:
+            self._importer = ImageImporter(self.daemon.create_client())
+        return self._importer
+
+    def setUp(self):
+        super().setUp()
+        socket_location = os.path.join(self.temp_manager.create_temp_directory(), "docker.sock")
+        self.daemon = FakeDockerDaemon(socket_location, TestImageImporter._EXAMPLE_IMAGES).__enter__()
+        self.addCleanup(self.daemon.__exit__)
+
+    def test_load_directory(self):
+        path = self.load("docker-image://example/builder:1.0#/usr/src/app")
+        self.assertEqual(["Dockerfile", "a"], sorted(os.listdir(path)))
+        self.assertEqual("b", Path(os.path.join(path, "a", "b.txt")).read_text())
+        self.assertEqual(list(self.daemon.containers), self.daemon.removed_containers)
+
+    def test_load_file(self):
+        path = self.load("docker-image://example/builder:1.0#etc/hostname")
+        self.assertEqual(["hostname"], os.listdir(path))
+
+    def test_load_missing_path(self):
+        self.assertRaises(ImageImportError, self.importer.load, "docker-image://example/builder:1.0#/missing")
+        self.assertEqual(list(self.daemon.containers), self.daemon.removed_containers)
+
+    def test_load_missing_image(self):
+        self.assertRaises(ImageImportError, self.importer.load, "docker-image://example/missing:1.0")
+        self.assertEqual([], list(self.daemon.containers))
+
+    def test_get_fingerprint(self):
+        fingerprint = self.importer.get_fingerprint("docker-image://example/builder:1.0#/usr/src/app")
+        self.assertIsNotNone(fingerprint)
+        self.assertEqual(fingerprint, self.importer.get_fingerprint("docker-image://example/builder:1.0#/usr/src/app/"))
+        self.assertNotEqual(fingerprint, self.importer.get_fingerprint("docker-image://example/builder:1.0#/etc"))
+        self.assertIsNone(self.importer.get_fingerprint("docker-image://example/missing:1.0"))
+
+    def test_parse_origin(self):
+        self.assertEqual(("registry:5000/builder:1.0", "/"), ImageImporter.parse_origin(
+            "docker-image://registry:5000/builder:1.0"))
+        self.assertEqual(("builder", "/app"), ImageImporter.parse_origin("docker-image://builder#app/"))
+        self.assertRaises(ValueError, ImageImporter.parse_origin, "docker-image://#/app")
+
+
+class TestImporterFactory(TestWithTempFiles):
+    """
+    Tests for `ImporterFactory`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.factory = ImporterFactory()
+
+    def test_create_for_directory(self):
+        self.assertIsInstance(self.factory.create(self.temp_manager.create_temp_directory()), FileSystemImporter)
+
+    def test_create_for_git(self):
+        self.assertIsInstance(self.factory.create("https://example.com/repository.git#develop"), GitImporter)
+
+    def test_create_for_archives(self):
+        directory = self.temp_manager.create_temp_directory()
+        Path(os.path.join(directory, "release.tgz")).touch()
+        self.assertIsInstance(self.factory.create(os.path.join(directory, "release.tgz#sha256=00")), TarballImporter)
+        self.assertIsInstance(self.factory.create("https://example.com/archive/v1.0.tar.gz"), TarballImporter)
+        self.assertIsInstance(self.factory.create("http://example.com/release.ZIP"), ZipImporter)
+
+    def test_create_for_image(self):
+        self.assertIsInstance(self.factory.create("docker-image://example/builder:1.0#/app"), ImageImporter)
+
+    def test_create_for_git_repository_without_suffix(self):
+        location = os.path.join(self.temp_manager.create_temp_directory(), "repository")
+        Repo.init(location)
+        self.assertIsInstance(self.factory.create(f"file://{location}#develop"), GitImporter)
+        self.assertIsInstance(self.factory.create("ssh://example.com/repository"), GitImporter)
+
+    def test_create_for_unknown(self):
+        self.assertRaises(NotImplementedError, self.factory.create, "https://example.com/release")
+
+    def test_create_with_registry(self):
+        registry = ImporterRegistry([ImporterRegistration("example", lambda factory: ZipImporter(), schemes=("ex", ))])
+        factory = ImporterFactory(registry=registry)
+        self.assertIsInstance(factory.create("ex://release"), ZipImporter)
+        self.assertRaises(NotImplementedError, factory.create, self.temp_manager.create_temp_directory())
+
+    def test_created_importers_share_resources(self):
+        first = self.factory.create("https://example.com/first.tar.gz")
+        second = self.factory.create("https://example.com/second.zip")
+        self.assertIs(first.resources, second.resources)
+
+
+class TestImporterRegistry(TestWithTempFiles):
+    """
+    Tests for `ImporterRegistry`.
+    """
+    def test_find_by_scheme(self):
+        registration = ImporterRegistration("example", lambda factory: ZipImporter(), schemes=("example", ))
+        registry = ImporterRegistry([ImporterRegistration("everything", lambda factory: ZipImporter(),
+                                                          detect=lambda origin: True), registration])
+        self.assertIs(registration, registry.find("EXAMPLE://release"))
+        self.assertIsNot(registration, registry.find("other://release"))
+
+    def test_find_by_detection_in_order(self):
+        first = ImporterRegistration("first", lambda factory: ZipImporter(), detect=lambda origin: "a" in origin)
+        second = ImporterRegistration("second", lambda factory: ZipImporter(), detect=lambda origin: True)
+        registry = ImporterRegistry([first, second])
+        self.assertIs(first, registry.find("a"))
+        self.assertIs(second, registry.find("b"))
+
+    def test_find_none(self):
+        self.assertIsNone(ImporterRegistry().find("example://release"))
+
+    def test_register_duplicate(self):
+        registry = ImporterRegistry([ImporterRegistration("example", lambda factory: ZipImporter(), schemes=("ex", ))])
+        self.assertRaises(ValueError, registry.register, ImporterRegistration("example", lambda factory: ZipImporter()))
+        self.assertRaises(ValueError, registry.register, ImporterRegistration(
+            "other", lambda factory: ZipImporter(), schemes=("EX", )))
+
+    def test_load_entry_points(self):
+        directory = self.temp_manager.create_temp_directory()
+        Path(os.path.join(directory, "example_importer.py")).write_text(
+            "from patchworkdocker.importers import ImporterRegistration, ZipImporter\n"
+            "registration = ImporterRegistration('example', lambda factory: ZipImporter(), schemes=('example', ))\n")
+        distribution_directory = os.path.join(directory, "example_importer-1.0.dist-info")
+        os.makedirs(distribution_directory)
+        Path(os.path.join(distribution_directory, "METADATA")).write_text(
+            "Metadata-Version: 2.1\nName: example-importer\nVersion: 1.0\n")
+        Path(os.path.join(distribution_directory, "entry_points.txt")).write_text(
+            f"[{IMPORTERS_ENTRY_POINT_GROUP}]\nexample = example_importer:registration\n"
+            f"invalid = example_importer:ZipImporter\n")
+        sys.path.insert(0, directory)
+        try:
+            registry = create_default_importer_registry()
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop("example_importer", None)
+        self.assertEqual("example", registry.find("example://release").name)
+        self.assertNotIn("invalid", [registration.name for registration in registry.registrations])
+
+
+class TestImporterResources(unittest.TestCase):
+    """
+    Tests for `ImporterResources`.
+    """
+    def test_get_creates_once(self):
+        resources = ImporterResources()
+        first = resources.get("example", object)
+        self.assertIs(first, resources.get("example", object))
+        self.assertIsNot(first, resources.get("other", object))
+
+    def test_close(self):
+        closed = []
+
+        class Resource:
+            def close(self):
+                closed.append(self)
+
+        with ImporterResources() as resources:
+            resource = resources.get("example", Resource)
+            resources.get("other", object)
+        self.assertEqual([resource], closed)
+        self.assertIsNot(resource, resources.get("example", Resource))
+
+
+def _sha256(location: str) -> str:
+    with open(location, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,11 @@
+import difflib
 import os
 import shutil
 import unittest
 from pathlib import Path
 
-from patchworkdocker.modifiers import copy_file, apply_patch
+from patchworkdocker.modifiers import copy_file, apply_patch, get_base_images, apply_patches, PatchApplicationError, \
+    apply_patch_set, read_patch, change_base_image
 from patchworkdocker.tests._common import TestWithTempFiles
 
 _RESOURCES_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
@@ -95,5 +97,201 @@ class TestApplyPatch(TestWithTempFiles):
             return file.read()
 
 
+    def test_mismatched_hunk(self):
+        patch_location = os.path.join(self.temp_manager.create_temp_directory(), "mismatched.patch")
+        with open(patch_location, "w") as file:
+            file.write("".join(difflib.unified_diff(["FROM debian\n"], ["FROM alpine\n"], "a", "b")))
+        with self.assertRaisesRegex(PatchApplicationError, "Hunk 1 of patch .*mismatched.patch"):
+            apply_patch(patch_location, self._dockerfile_location)
+
+    def test_does_not_change_linked_file(self):
+        linked_location = os.path.join(self.temp_manager.create_temp_directory(), "linked")
+        os.link(self._dockerfile_location, linked_location)
+        self._apply(f"{_RESOURCES_LOCATION}/patching/from-change.patch")
+        with open(linked_location, "r") as file:
+            self.assertTrue(file.read().startswith("FROM ubuntu:16.04"))
+
+
+class TestApplyPatches(TestWithTempFiles):
+    """
+    Tests for `apply_patches`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.temp_directory = self.temp_manager.create_temp_directory()
+
+    def test_different_targets(self):
+        patches = []
+        for i in range(10):
+            target_location = self._write(f"target-{i}", f"{i}\n")
+            patches.append((self._create_patch(f"{i}.patch", f"{i}\n", f"{i}-patched\n"), target_location))
+        apply_patches(patches)
+        for i, (_, target_location) in enumerate(patches):
+            self.assertEqual(f"{i}-patched\n", Path(target_location).read_text())
+
+    def test_same_target_in_order(self):
+        target_location = self._write("target", "a\n")
+        apply_patches([(self._create_patch("1.patch", "a\n", "b\n"), target_location),
+                       (self._create_patch("2.patch", "b\n", "c\n"), target_location),
+                       (self._create_patch("other.patch", "x\n", "y\n"), self._write("other", "x\n"))])
+        self.assertEqual("c\n", Path(target_location).read_text())
+
+    def test_failure(self):
+        target_location = self._write("target", "a\n")
+        with self.assertRaisesRegex(PatchApplicationError, "2.patch"):
+            apply_patches([(self._create_patch("1.patch", "a\n", "b\n"), target_location),
+                           (self._create_patch("2.patch", "a\n", "c\n"), target_location)])
+
+    def _write(self, name: str, content: str) -> str:
+        location = os.path.join(self.temp_directory, name)
+        with open(location, "w") as file:
+            file.write(content)
+        return location
+
+    def _create_patch(self, name: str, original: str, patched: str) -> str:
+        return self._write(name, "".join(difflib.unified_diff([original], [patched], "a/file", "b/file")))
+
+
+# Patch in the style of `git diff` that creates `sub/new.txt` and `new/c.txt`, and deletes `a.txt`
+_CREATING_AND_DELETING_PATCH = """diff --git a/sub/new.txt b/sub/new.txt
+new file mode 100644
+--- /dev/null
++++ b/sub/new.txt
+@@ -0,0 +1 @@
++new
+diff --git a/new/c.txt b/new/c.txt
+new file mode 100644
+--- /dev/null
++++ b/new/c.txt
+@@ -0,0 +1 @@
++c
+diff --git a/a.txt b/a.txt
+deleted file mode 100644
+--- a/a.txt
++++ /dev/null
+@@ -1 +0,0 @@
+-a
+"""
+
+
+class TestApplyPatchSet(TestWithTempFiles):
+    """
+    Tests for `apply_patch_set`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.directory = self.temp_manager.create_temp_directory()
+        os.makedirs(os.path.join(self.directory, "sub"))
+        Path(os.path.join(self.directory, "a.txt")).write_text("a\n")
+        Path(os.path.join(self.directory, "sub", "b.txt")).write_text("b\n")
+        self.patch_location = os.path.join(self.temp_manager.create_temp_directory(), "change.patch")
+
+    def test_apply_git_style(self):
+        self._write_patch("a/", "b/")
+        apply_patch_set(self.patch_location, self.directory)
+        self._assert_patched()
+
+    def test_apply_without_prefixes(self):
+        self._write_patch("", "")
+        apply_patch_set(self.patch_location, self.directory)
+        self._assert_patched()
+
+    def test_apply_when_file_does_not_exist(self):
+        self._write_patch("a/", "b/")
+        os.remove(os.path.join(self.directory, "sub", "b.txt"))
+        with self.assertRaisesRegex(PatchApplicationError, "sub/b.txt"):
+            apply_patch_set(self.patch_location, self.directory)
+        self.assertEqual("a\n", Path(os.path.join(self.directory, "a.txt")).read_text())
+
+    def test_apply_creating_and_deleting_files(self):
+        Path(self.patch_location).write_text(_CREATING_AND_DELETING_PATCH)
+        apply_patch_set(self.patch_location, self.directory)
+        self.assertEqual("new\n", Path(os.path.join(self.directory, "sub", "new.txt")).read_text())
+        self.assertEqual("c\n", Path(os.path.join(self.directory, "new", "c.txt")).read_text())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a.txt")))
+
+    def test_apply_creating_existing_file(self):
+        Path(os.path.join(self.directory, "sub", "new.txt")).write_text("existing\n")
+        Path(self.patch_location).write_text(_CREATING_AND_DELETING_PATCH)
+        with self.assertRaisesRegex(PatchApplicationError, "already exists"):
+            apply_patch_set(self.patch_location, self.directory)
+        self.assertEqual("existing\n", Path(os.path.join(self.directory, "sub", "new.txt")).read_text())
+
+    def test_apply_deleting_changed_file(self):
+        Path(os.path.join(self.directory, "a.txt")).write_text("a\nchanged\n")
+        Path(self.patch_location).write_text(_CREATING_AND_DELETING_PATCH)
+        with self.assertRaisesRegex(PatchApplicationError, "a.txt"):
+            apply_patch_set(self.patch_location, self.directory)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "a.txt")))
+
+    def test_read_patch_cached(self):
+        self._write_patch("a/", "b/")
+        other_location = os.path.join(self.temp_manager.create_temp_directory(), "same.patch")
+        shutil.copyfile(self.patch_location, other_location)
+        self.assertIs(read_patch(self.patch_location), read_patch(other_location))
+
+    def _write_patch(self, source_prefix: str, target_prefix: str):
+        with open(self.patch_location, "w") as file:
+            for path, original, patched in (("a.txt", "a\n", "A\n"), ("sub/b.txt", "b\n", "B\n")):
+                file.write("".join(difflib.unified_diff([original], [patched], f"{source_prefix}{path}",
+                                                        f"{target_prefix}{path}")))
+
+    def _assert_patched(self):
+        self.assertEqual("A\n", Path(os.path.join(self.directory, "a.txt")).read_text())
+        self.assertEqual("B\n", Path(os.path.join(self.directory, "sub", "b.txt")).read_text())
+
+
+class TestGetBaseImages(unittest.TestCase):
+    """
+    Tests for `get_base_images`.
+    """
+    def test_single_stage(self):
+        self.assertEqual(["alpine:3.10"], get_base_images("# FROM other\nFROM alpine:3.10\nRUN true\n"))
+
+    def test_multi_stage(self):
+        dockerfile = "FROM golang AS Build\nRUN go build\nFROM --platform=linux/amd64 build AS test\n" \
+                     "FROM scratch\nFROM \\\n  alpine\nCOPY --from=build /app /app\n"
+        self.assertEqual(["golang", "alpine"], get_base_images(dockerfile))
+
+    def test_without_image(self):
+        self.assertRaises(ValueError, get_base_images, "FROM --platform=linux/amd64\n")
+
+
+class TestChangeBaseImage(TestWithTempFiles):
+    """
+    Tests for `change_base_image`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.dockerfile_location = os.path.join(self.temp_manager.create_temp_directory(), "Dockerfile")
+
+    def _change_base_image(self, dockerfile: str, desired_base: str) -> str:
+        with open(self.dockerfile_location, "w") as file:
+            file.write(dockerfile)
+        change_base_image(self.dockerfile_location, desired_base)
+        with open(self.dockerfile_location, "r") as file:
+            return file.read()
+
+    def test_single_stage(self):
+        self.assertEqual("# Example\nFROM debian:stretch\nRUN true\n",
+                         self._change_base_image("# Example\nFROM alpine\nRUN true\n", "debian:stretch"))
+
+    def test_multi_stage(self):
+        dockerfile = "FROM golang AS build\nRUN go build\nFROM alpine\nCOPY --from=build /app /app\n"
+        self.assertEqual("FROM golang AS build\nRUN go build\nFROM debian\nCOPY --from=build /app /app\n",
+                         self._change_base_image(dockerfile, "debian"))
+
+    def test_does_not_change_linked_file(self):
+        linked_location = os.path.join(self.temp_manager.create_temp_directory(), "linked")
+        self._change_base_image("FROM alpine\n", "alpine")
+        os.link(self.dockerfile_location, linked_location)
+        change_base_image(self.dockerfile_location, "debian")
+        with open(linked_location, "r") as file:
+            self.assertEqual("FROM alpine\n", file.read())
+
+    def test_without_from(self):
+        self.assertRaises(ValueError, self._change_base_image, "RUN true\n", "debian")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,75 @@
+import json
+import threading
+import unittest
+
+from patchworkdocker.profiling import Profiler, profiling, span, record, count_bytes_written, format_table, to_json, \
+    to_chrome_trace, is_profiling
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Tests for profiling spans of work.
+    """
+    def test_span_when_not_profiling(self):
+        self.assertFalse(is_profiling())
+        with span("a") as first, span("b") as second:
+            record(files=1)
+        self.assertIs(first, second)
+
+    def test_span(self):
+        with profiling(Profiler()) as profiler:
+            with span("outer", file="a.txt"):
+                with span("inner"):
+                    record(files=2, bytes_read=3, bytes_written=4)
+        self.assertEqual(["inner", "outer"], [span.name for span in profiler.spans])
+        inner, outer = profiler.spans
+        self.assertEqual((1, 2, 3, 4), (inner.depth, inner.files, inner.bytes_read, inner.bytes_written))
+        self.assertEqual((0, 0), (outer.depth, outer.files))
+        self.assertEqual({"file": "a.txt"}, outer.attributes)
+        self.assertLessEqual(inner.duration, outer.duration)
+        self.assertFalse(is_profiling())
+
+    def test_span_in_other_thread(self):
+        with profiling(Profiler()) as profiler:
+            with span("outer"):
+                thread = threading.Thread(target=lambda: span("other").__enter__().__exit__(None, None, None))
+                thread.start()
+                thread.join()
+        other = [span for span in profiler.spans if span.name == "other"][0]
+        self.assertEqual(0, other.depth)
+        self.assertNotEqual(threading.get_ident(), other.thread_id)
+
+    def test_count_bytes_written(self):
+        with profiling(Profiler()) as profiler:
+            with span("upload"):
+                chunks = list(count_bytes_written(iter([b"ab", b"cde"])))
+        self.assertEqual([b"ab", b"cde"], chunks)
+        self.assertEqual(5, profiler.spans[0].bytes_written)
+
+    def test_format_table(self):
+        with profiling(Profiler()) as profiler:
+            for _ in range(2):
+                with span("phase"):
+                    record(files=1)
+        lines = format_table(profiler).splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(["phase", "2"], lines[1].split()[:2])
+
+    def test_to_json(self):
+        with profiling(Profiler()) as profiler:
+            with span("phase"):
+                pass
+        spans = json.loads(to_json(profiler))["spans"]
+        self.assertEqual(["phase"], [span["name"] for span in spans])
+
+    def test_to_chrome_trace(self):
+        with profiling(Profiler()) as profiler:
+            with span("phase", file="a.txt"):
+                pass
+        events = json.loads(to_chrome_trace(profiler))["traceEvents"]
+        self.assertEqual(1, len(events))
+        self.assertEqual(("phase", "X", "a.txt"), (events[0]["name"], events[0]["ph"], events[0]["args"]["file"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
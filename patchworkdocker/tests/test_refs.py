@@ -0,0 +1,105 @@
+import json
+import os
+import unittest
+from pathlib import Path
+
+from git import Repo, Actor, GitCommandError
+
+from patchworkdocker.refs import RefResolver, resolve_remote_reference
+from patchworkdocker.tests._common import TestWithTempFiles, create_git_repository
+
+
+class TestRefResolver(TestWithTempFiles):
+    """
+    Tests for `RefResolver`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+        self.origin_repository = Repo(self.origin[len("file://"):])
+        self.lockfile_location = os.path.join(self.temp_manager.create_temp_directory(), "lock.json")
+
+    def test_resolve(self):
+        self.assertEqual(self.origin_repository.heads.develop.commit.hexsha,
+                         RefResolver().resolve(self.origin, "develop"))
+
+    def test_resolve_remembered(self):
+        resolver = RefResolver()
+        commit = resolver.resolve(self.origin, "develop")
+        self._commit_to_develop()
+        self.assertEqual(commit, resolver.resolve(self.origin, "develop"))
+
+    def test_resolve_after_ttl(self):
+        resolver = RefResolver(ttl=0)
+        commit = resolver.resolve(self.origin, "develop")
+        self._commit_to_develop()
+        self.assertNotEqual(commit, resolver.resolve(self.origin, "develop"))
+
+    def test_resolve_pinned(self):
+        commit = RefResolver(lockfile_location=self.lockfile_location).resolve(self.origin, "develop")
+        with open(self.lockfile_location, "r") as file:
+            self.assertEqual({"refs": {f"{self.origin}#develop": commit}}, json.load(file))
+        self._commit_to_develop()
+        self.assertEqual(commit, RefResolver(lockfile_location=self.lockfile_location).resolve(self.origin, "develop"))
+
+    def test_resolve_pinned_when_updating(self):
+        commit = RefResolver(lockfile_location=self.lockfile_location).resolve(self.origin, "develop")
+        self._commit_to_develop()
+        resolver = RefResolver(lockfile_location=self.lockfile_location, update=True)
+        new_commit = resolver.resolve(self.origin, "develop")
+        self.assertNotEqual(commit, new_commit)
+        with open(self.lockfile_location, "r") as file:
+            self.assertEqual(new_commit, json.load(file)["refs"][f"{self.origin}#develop"])
+
+    def test_resolve_with_invalid_lockfile(self):
+        with open(self.lockfile_location, "w") as file:
+            file.write("[]")
+        self.assertRaises(ValueError, RefResolver(lockfile_location=self.lockfile_location).resolve, self.origin, "")
+
+    def test_try_resolve_when_remote_unavailable(self):
+        origin = f"file://{self.temp_manager.create_temp_directory()}/missing.git"
+        self.assertRaises(GitCommandError, RefResolver().resolve, origin, "")
+        self.assertIsNone(RefResolver().try_resolve(origin, ""))
+
+    def _commit_to_develop(self):
+        """
+        Adds a commit to the origin's develop branch.
+        """
+        self.origin_repository.heads.develop.checkout()
+        location = os.path.join(self.origin_repository.working_tree_dir, "new.txt")
+        Path(location).touch()
+        self.origin_repository.index.add([location])
+        author = Actor("test", "test@example.com")
+        self.origin_repository.index.commit("New commit", author=author, committer=author)
+        self.origin_repository.heads.master.checkout()
+
+
+class TestResolveRemoteReference(TestWithTempFiles):
+    """
+    Tests for `resolve_remote_reference`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.origin = create_git_repository(self.temp_manager.create_temp_directory())
+        self.origin_repository = Repo(self.origin[len("file://"):])
+
+    def test_default_branch(self):
+        self.assertEqual(self.origin_repository.heads.master.commit.hexsha, resolve_remote_reference(self.origin, ""))
+
+    def test_branch(self):
+        self.assertEqual(self.origin_repository.heads.develop.commit.hexsha,
+                         resolve_remote_reference(self.origin, "develop"))
+
+    def test_tag(self):
+        self.assertEqual(self.origin_repository.tags["1.0"].commit.hexsha, resolve_remote_reference(self.origin, "1.0"))
+
+    def test_commit(self):
+        commit = self.origin_repository.heads.develop.commit.hexsha
+        self.assertEqual(commit, resolve_remote_reference(self.origin, commit))
+
+    def test_unknown(self):
+        self.assertIsNone(resolve_remote_reference(self.origin, "unknown"))
+
+
+if __name__ == "__main__":
+    unittest.main()
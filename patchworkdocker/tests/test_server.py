@@ -0,0 +1,186 @@
+import os
+import shutil
+import time
+import unittest
+from threading import Event
+
+from patchworkdocker.batch import JobStatus
+from patchworkdocker.cancellation import check_cancelled
+from patchworkdocker.client import ServerClient, ServerError
+from patchworkdocker.server import JobScheduler, ServerJob, JobAction, PatchworkDockerServer, \
+    ServerAlreadyRunningError
+from patchworkdocker.tests._common import TestWithTempFiles, EXAMPLE_BUILD_DIRECTORY
+
+_TIMEOUT = 10
+
+
+def _create_job(priority: int=0) -> ServerJob:
+    return ServerJob(JobAction.PREPARE, dict(import_from=EXAMPLE_BUILD_DIRECTORY), priority=priority)
+
+
+class TestJobScheduler(unittest.TestCase):
+    """
+    Tests for `JobScheduler`.
+    """
+    def setUp(self):
+        self.run_order = []
+        self.scheduler = JobScheduler(lambda job: self.run_order.append(job.id) or job.id, concurrency=1)
+
+    def tearDown(self):
+        self.scheduler.stop(_TIMEOUT)
+
+    def test_run(self):
+        job = self.scheduler.submit(_create_job())
+        self.scheduler.start()
+        self.assertIs(job, self.scheduler.wait(job.id, _TIMEOUT))
+        self.assertEqual(JobStatus.SUCCEEDED, job.status)
+        self.assertEqual(job.id, job.result)
+        self.assertIsNotNone(job.duration)
+
+    def test_run_in_priority_order(self):
+        jobs = [self.scheduler.submit(_create_job(priority)) for priority in (0, 2, 1, 2)]
+        self.scheduler.start()
+        for job in jobs:
+            self.scheduler.wait(job.id, _TIMEOUT)
+        self.assertEqual([jobs[1].id, jobs[3].id, jobs[2].id, jobs[0].id], self.run_order)
+
+    def test_run_failed(self):
+        def fail(job: ServerJob):
+            raise RuntimeError("Failed")
+        self.scheduler.run_job = fail
+        job = self.scheduler.submit(_create_job())
+        self.scheduler.start()
+        self.scheduler.wait(job.id, _TIMEOUT)
+        self.assertEqual(JobStatus.FAILED, job.status)
+        self.assertEqual("Failed", job.error)
+
+    def test_cancel_pending(self):
+        job = self.scheduler.submit(_create_job())
+        self.scheduler.cancel(job.id)
+        other_job = self.scheduler.submit(_create_job())
+        self.scheduler.start()
+        self.scheduler.wait(other_job.id, _TIMEOUT)
+        self.assertEqual(JobStatus.CANCELLED, job.status)
+        self.assertEqual([other_job.id], self.run_order)
+
+    def test_cancel_running(self):
+        started = Event()
+
+        def run_until_cancelled(job: ServerJob):
+            started.set()
+            started_at = time.monotonic()
+            while time.monotonic() - started_at < _TIMEOUT:
+                check_cancelled()
+                time.sleep(0.01)
+        self.scheduler.run_job = run_until_cancelled
+        job = self.scheduler.submit(_create_job())
+        self.scheduler.start()
+        self.assertTrue(started.wait(_TIMEOUT))
+        self.scheduler.cancel(job.id)
+        self.scheduler.wait(job.id, _TIMEOUT)
+        self.assertEqual(JobStatus.CANCELLED, job.status)
+
+    def test_get_unknown(self):
+        self.assertIsNone(self.scheduler.get("unknown"))
+        self.assertIsNone(self.scheduler.cancel("unknown"))
+
+    def test_finished_job_core_dropped(self):
+        job = _create_job()
+        job.core = object()
+        self.scheduler.submit(job)
+        self.scheduler.start()
+        self.scheduler.wait(job.id, _TIMEOUT)
+        self.assertIsNone(job.core)
+
+    def test_forget_finished_jobs_over_maximum(self):
+        self.scheduler.max_finished_jobs = 1
+        jobs = [self.scheduler.submit(_create_job()) for _ in range(3)]
+        self.scheduler.start()
+        for job in jobs:
+            self.scheduler.wait(job.id, _TIMEOUT)
+        self.assertEqual([jobs[2]], self.scheduler.list())
+        self.assertIsNone(self.scheduler.get(jobs[0].id))
+
+    def test_forget_finished_jobs_after_retention(self):
+        self.scheduler.retention = 0
+        job = self.scheduler.submit(_create_job())
+        self.scheduler.cancel(job.id)
+        self.assertEqual([], self.scheduler.list())
+
+    def test_invalid_concurrency(self):
+        self.assertRaises(ValueError, JobScheduler, lambda job: None, 0)
+
+    def test_invalid_retention(self):
+        self.assertRaises(ValueError, JobScheduler, lambda job: None, retention=-1)
+        self.assertRaises(ValueError, JobScheduler, lambda job: None, max_finished_jobs=-1)
+
+
+class TestPatchworkDockerServer(TestWithTempFiles):
+    """
+    Tests for `PatchworkDockerServer` (and `ServerClient`).
+    """
+    def setUp(self):
+        super().setUp()
+        self.socket_location = os.path.join(self.temp_manager.create_temp_directory(), "server.sock")
+        self.server = PatchworkDockerServer(self.socket_location)
+        self.server.start()
+        self.client = ServerClient(self.socket_location, timeout=_TIMEOUT)
+
+    def tearDown(self):
+        self.server.shutdown()
+        super().tearDown()
+
+    def test_is_running(self):
+        self.assertTrue(self.client.is_running())
+        self.server.shutdown()
+        self.assertFalse(self.client.is_running())
+        self.assertFalse(os.path.exists(self.socket_location))
+
+    def test_prepare(self):
+        job = self.client.submit("prepare", dict(import_from=EXAMPLE_BUILD_DIRECTORY))
+        job = self.client.wait(job["id"])
+        try:
+            self.assertEqual("succeeded", job["status"])
+            self.assertEqual(sorted(os.listdir(EXAMPLE_BUILD_DIRECTORY)), sorted(os.listdir(job["result"])))
+        finally:
+            shutil.rmtree(job["result"], ignore_errors=True)
+        self.assertEqual([job["id"]], [job["id"] for job in self.client.list_jobs()])
+
+    def test_prepare_failed(self):
+        job = self.client.submit("prepare", dict(
+            import_from=EXAMPLE_BUILD_DIRECTORY, patches={os.path.join(EXAMPLE_BUILD_DIRECTORY, "missing.patch"): "a"}))
+        job = self.client.wait(job["id"])
+        self.assertEqual("failed", job["status"])
+        self.assertIsNotNone(job["error"])
+
+    def test_jobs_share_importer_resources(self):
+        # Not started, so the jobs keep their cores (which are dropped once they finish)
+        server = PatchworkDockerServer(os.path.join(self.temp_manager.create_temp_directory(), "other.sock"))
+        jobs = [server.submit(JobAction.PREPARE, dict(import_from=EXAMPLE_BUILD_DIRECTORY)) for _ in range(2)]
+        self.assertIsNotNone(jobs[0].core.importer_resources)
+        self.assertIs(jobs[0].core.importer_resources, jobs[1].core.importer_resources)
+
+    def test_submit_invalid(self):
+        self.assertRaises(ServerError, self.client.submit, "invalid", dict(import_from=EXAMPLE_BUILD_DIRECTORY))
+        self.assertRaises(ServerError, self.client.submit, "prepare", dict())
+        self.assertRaises(ServerError, self.client.submit, "build", dict(import_from=EXAMPLE_BUILD_DIRECTORY))
+        self.assertRaises(ServerError, self.client.submit, "prepare", dict(import_from=EXAMPLE_BUILD_DIRECTORY),
+                          options=dict(invalid=True))
+
+    def test_get_unknown(self):
+        self.assertRaises(ServerError, self.client.get_job, "unknown")
+        self.assertRaises(ServerError, self.client.cancel, "unknown")
+
+    def test_already_running(self):
+        self.assertRaises(ServerAlreadyRunningError, PatchworkDockerServer(self.socket_location).start)
+
+    def test_replaces_stale_socket(self):
+        self.server.shutdown()
+        open(self.socket_location, "w").close()
+        self.server = PatchworkDockerServer(self.socket_location)
+        self.server.start()
+        self.assertTrue(self.client.is_running())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import unittest
+from pathlib import Path
+
+from patchworkdocker.tests._common import TestWithTempFiles
+from patchworkdocker.updates import ModificationRecord, UpdateState, get_modifications_to_redo
+
+
+def _create_record(destination: str, digest: str="digest", paths=None) -> ModificationRecord:
+    return ModificationRecord("file", "/source", destination, digest,
+                              frozenset(paths if paths is not None else [destination]))
+
+
+class TestGetModificationsToRedo(unittest.TestCase):
+    """
+    Tests for `get_modifications_to_redo`.
+    """
+    def test_unchanged(self):
+        records = [_create_record("a"), _create_record("b")]
+        self.assertEqual((set(), set()), get_modifications_to_redo(records, records, {"c"}, {"a", "b"}))
+
+    def test_changed_modification(self):
+        applied = [_create_record("a"), _create_record("b")]
+        modifications = [_create_record("a"), _create_record("b", "other")]
+        self.assertEqual(({1}, {"b"}), get_modifications_to_redo(applied, modifications, (), {"a", "b"}))
+
+    def test_removed_modification(self):
+        applied = [_create_record("a"), _create_record("b")]
+        self.assertEqual((set(), {"b"}), get_modifications_to_redo(applied, applied[:1], (), {"a", "b"}))
+
+    def test_added_modification(self):
+        applied = [_create_record("a")]
+        modifications = [_create_record("a"), _create_record("b")]
+        self.assertEqual(({1}, {"b"}), get_modifications_to_redo(applied, modifications, (), {"a"}))
+
+    def test_changed_modified_file(self):
+        records = [_create_record("a"), _create_record("b")]
+        self.assertEqual(({0}, {"a"}), get_modifications_to_redo(records, records, {"a", "c"}, {"a", "b"}))
+
+    def test_redo_modifications_of_restored_files(self):
+        applied = [_create_record("a", paths={"a", "c"}), _create_record("b", paths={"b", "c"}), _create_record("d")]
+        modifications = [applied[0], _create_record("b", "other", paths={"b", "c"}), applied[2]]
+        self.assertEqual(({0, 1}, {"a", "b", "c"}),
+                         get_modifications_to_redo(applied, modifications, (), {"a", "b", "c", "d"}))
+
+
+class TestUpdateState(TestWithTempFiles):
+    """
+    Tests for `UpdateState`.
+    """
+    def setUp(self):
+        super().setUp()
+        self.build_directory = self.temp_manager.create_temp_directory()
+        self.state = UpdateState(self.build_directory, "Importer", dict(commit="abc"), [_create_record("a")])
+
+    def test_load_when_not_saved(self):
+        self.assertIsNone(UpdateState.load(self.build_directory))
+
+    def test_save_and_load(self):
+        self.state.originals["a"] = False
+        self.state.save()
+        loaded = UpdateState.load(self.build_directory)
+        self.assertEqual("Importer", loaded.importer)
+        self.assertEqual(dict(commit="abc"), loaded.import_state)
+        self.assertEqual(self.state.modifications, loaded.modifications)
+        self.assertEqual(dict(a=False), loaded.originals)
+
+    def test_invalidate(self):
+        self.state.save()
+        self.state.invalidate()
+        self.assertIsNone(UpdateState.load(self.build_directory))
+        self.assertTrue(os.path.isdir(self.state.location))
+
+    def test_keep_and_restore_originals(self):
+        Path(os.path.join(self.build_directory, "a")).write_text("original")
+        self.state.keep_originals(["a", "b"])
+        Path(os.path.join(self.build_directory, "a")).write_text("modified")
+        Path(os.path.join(self.build_directory, "b")).write_text("added")
+        # Originals are only kept before the first modification
+        self.state.keep_originals(["a"])
+        self.state.restore_originals(["a", "b", "c"])
+        self.assertEqual("original", Path(os.path.join(self.build_directory, "a")).read_text())
+        self.assertFalse(os.path.exists(os.path.join(self.build_directory, "b")))
+        self.assertEqual({}, self.state.originals)
+
+
+if __name__ == "__main__":
+    unittest.main()
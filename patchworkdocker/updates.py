@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Optional, Any, List, Dict, FrozenSet, Iterable, Set, Tuple
+
+from logzero import logger
+
+from patchworkdocker.copying import clone_file
+from patchworkdocker.meta import PACKAGE_NAME
+
+UPDATE_STATE_DIRECTORY_NAME = f".{PACKAGE_NAME}"
+_MANIFEST_FILE_NAME = "manifest.json"
+_ORIGINALS_DIRECTORY_NAME = "originals"
+_MANIFEST_VERSION = 1
+
+
+@dataclass(frozen=True)
+class ModificationRecord:
+    """
+    Record of a modification of imported materials: the adding of a file, the applying of a patch or the transforming
+    of the Dockerfile.
+    """
+    kind: str
+    source: Optional[str]
+    destination: str
+    # Digest of the modification's inputs (e.g. the contents of the patch)
+    digest: str
+    # Paths, relative to the build directory, of the files that the modification can change
+    paths: FrozenSet[str]
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Gets the record as a JSON serialisable dictionary.
+        :return: the dictionary
+        """
+        return dict(kind=self.kind, source=self.source, destination=self.destination, digest=self.digest,
+                    paths=sorted(self.paths))
+
+    @staticmethod
+    def from_json(record: Dict[str, Any]) -> "ModificationRecord":
+        """
+        Creates a record from the given dictionary (see `to_json`).
+        :param record: the dictionary
+        :return: the record
+        """
+        return ModificationRecord(record["kind"], record["source"], record["destination"], record["digest"],
+                                  frozenset(record["paths"]))
+
+
+class UpdateState:
+    """
+    State that a prepared build directory is updated from (see `PatchworkDocker.prepare`), which is kept in the build
+    directory: the state of the imported materials, the modifications that were made to them and the imported
+    originals of the files that were modified.
+    """
+    def __init__(self, build_directory: str, importer: str, import_state: Any,
+                 modifications: Iterable[ModificationRecord]=(), originals: Dict[str, bool]=None):
+        """
+        Constructor.
+        :param build_directory: the build directory
+        :param importer: name of the type of importer that imported the materials
+        :param import_state: state of the imported materials (see `Importer.get_state`)
+        :param modifications: modifications that were made to the imported materials, in the order they were made
+        :param originals: whether each file that was modified, keyed by its path relative to the build directory, was
+        imported (in which case its original is kept), rather than created by a modification
+        """
+        self.build_directory = build_directory
+        self.importer = importer
+        self.import_state = import_state
+        self.modifications = list(modifications)
+        self.originals = dict(originals) if originals is not None else {}
+
+    @property
+    def location(self) -> str:
+        """
+        Location of the directory that the state is kept in.
+        :return: the location
+        """
+        return UpdateState.get_location(self.build_directory)
+
+    @staticmethod
+    def get_location(build_directory: str) -> str:
+        """
+        Gets the location of the directory that the state of the given build directory is kept in.
+        :param build_directory: the build directory
+        :return: the location
+        """
+        return os.path.join(build_directory, UPDATE_STATE_DIRECTORY_NAME)
+
+    @staticmethod
+    def load(build_directory: str) -> Optional["UpdateState"]:
+        """
+        Loads the state of the given build directory.
+        :param build_directory: the build directory
+        :return: the state, or `None` if the build directory does not have a complete state (e.g. it was not prepared
+        to be updated, or an update of it did not complete)
+        """
+        manifest_location = os.path.join(UpdateState.get_location(build_directory), _MANIFEST_FILE_NAME)
+        try:
+            with open(manifest_location, "r") as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        if manifest.get("version") != _MANIFEST_VERSION:
+            logger.info(f"Not using update state of {build_directory} written by a different version")
+            return None
+        return UpdateState(build_directory, manifest["importer"], manifest["import_state"],
+                           [ModificationRecord.from_json(record) for record in manifest["modifications"]],
+                           manifest["originals"])
+
+    def save(self):
+        """
+        Saves the state in the build directory.
+        """
+        os.makedirs(self.location, exist_ok=True)
+        manifest_location = os.path.join(self.location, _MANIFEST_FILE_NAME)
+        # Written next to the manifest, so it can atomically replace it
+        with open(f"{manifest_location}.tmp", "w") as file:
+            json.dump(dict(version=_MANIFEST_VERSION, importer=self.importer, import_state=self.import_state,
+                           modifications=[record.to_json() for record in self.modifications],
+                           originals=self.originals), file)
+        os.replace(f"{manifest_location}.tmp", manifest_location)
+
+    def invalidate(self):
+        """
+        Marks the state as incomplete whilst the build directory is being changed, so it is not loaded if the change
+        does not complete.
+        """
+        manifest_location = os.path.join(self.location, _MANIFEST_FILE_NAME)
+        if os.path.exists(manifest_location):
+            os.remove(manifest_location)
+
+    def keep_originals(self, paths: Iterable[str]):
+        """
+        Keeps the imported originals of the files at the given paths, before they are modified, if they have not
+        already been kept.
+        :param paths: paths of the files, relative to the build directory
+        """
+        for path in paths:
+            if path in self.originals:
+                continue
+            location = os.path.join(self.build_directory, path)
+            if os.path.isdir(location):
+                continue
+            self.originals[path] = os.path.lexists(location)
+            if self.originals[path]:
+                original_location = os.path.join(self.location, _ORIGINALS_DIRECTORY_NAME, path)
+                os.makedirs(os.path.dirname(original_location), exist_ok=True)
+                _copy(location, original_location)
+
+    def restore_originals(self, paths: Iterable[str]):
+        """
+        Restores the files at the given paths to their imported originals (removing files that were not imported).
+        Files that were not modified are left as they are.
+        :param paths: paths of the files, relative to the build directory
+        """
+        for path in paths:
+            if path not in self.originals:
+                continue
+            location = os.path.join(self.build_directory, path)
+            original_location = os.path.join(self.location, _ORIGINALS_DIRECTORY_NAME, path)
+            if os.path.isdir(location) and not os.path.islink(location):
+                shutil.rmtree(location)
+            if self.originals.pop(path):
+                logger.debug(f"Restoring original of {location}")
+                _copy(original_location, location)
+                os.remove(original_location)
+            elif os.path.lexists(location):
+                logger.debug(f"Removing {location}, which was not imported")
+                os.remove(location)
+
+
+def get_modifications_to_redo(applied: List[ModificationRecord], modifications: List[ModificationRecord],
+                              changed_paths: Iterable[str], modified_paths: Iterable[str]) -> Tuple[Set[int], Set[str]]:
+    """
+    Gets the modifications that have to be made again to update materials that have had the given modifications
+    applied to them, and the files whose imported originals have to be restored before they are.
+
+    A modification is made again if it differs from the one that was applied in its place, or if it can change a file
+    whose original must be restored (because another modification that can change the file is made again, or because
+    the file has changed in the imported materials). Modifications of other files are kept as they are.
+    :param applied: the modifications that were applied, in order
+    :param modifications: the modifications to apply, in order
+    :param changed_paths: paths of the files that have changed in the imported materials
+    :param modified_paths: paths of the files that the applied modifications changed
+    :return: tuple where the first element is the indices of the modifications that have to be made again and the
+    second is the paths of the files whose originals have to be restored
+    """
+    redo = set()
+    restore = set(changed_paths) & set(modified_paths)
+    for index, modification in enumerate(modifications):
+        if index >= len(applied) or applied[index] != modification:
+            redo.add(index)
+            restore.update(modification.paths)
+    for index, record in enumerate(applied):
+        if index >= len(modifications) or index in redo:
+            restore.update(record.paths)
+
+    # Restoring a file undoes every modification that can change it, so they are all made again
+    while True:
+        newly_redone = {index for index, modification in enumerate(modifications)
+                        if index not in redo and not modification.paths.isdisjoint(restore)}
+        if len(newly_redone) == 0:
+            return redo, restore
+        redo.update(newly_redone)
+        for index in newly_redone:
+            restore.update(modifications[index].paths)
+
+
+def _copy(source: str, destination: str):
+    """
+    Copies the given file (or symlink) to the given destination.
+    :param source: the file
+    :param destination: where to copy the file to
+    """
+    if os.path.islink(source):
+        if os.path.lexists(destination):
+            os.remove(destination)
+        os.symlink(os.readlink(source), destination)
+    else:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        clone_file(source, destination)
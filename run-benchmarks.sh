@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+set -euf -o pipefail
+
+# Results are saved to .benchmarks. To fail on regressions against the last saved run, pass:
+#   --benchmark-compare --benchmark-compare-fail=mean:10%
+# The size of the generated contexts can be set with --context-files, --context-depth and --context-large-file-size
+PYTHONPATH=. python -m pytest benchmarks --benchmark-autosave "$@"